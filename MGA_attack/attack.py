@@ -22,8 +22,8 @@ class MGAAttack(object):
     def __init__(self, pop_size=5, generations=1000, cross_rate=0.7,
                  mutation_rate=0.001, max_queries=2000,
                  epsilon=8. / 255, iters=10, ensemble_models=None, targeted=False):
-        self.loss_fn = nn.CrossEntropyLoss()
-        self.dataset_loader = DataLoaderMaker.get_test_attacked_data(args.dataset, 1)
+        self.loss_fn = nn.CrossEntropyLoss(reduction='none')
+        self.dataset_loader = DataLoaderMaker.get_test_attacked_data(args.dataset, args.batch_size)
         self.total_images = len(self.dataset_loader.dataset)
         # parameters about evolution algorithm
         self.pop_size = pop_size
@@ -39,9 +39,6 @@ class MGAAttack(object):
         self.iters = iters
         self.targeted = targeted
         self.max_queries = max_queries
-        self.idx = np.random.choice(np.arange(self.pop_size), size=2, replace=False)
-        self.is_change = np.zeros(self.pop_size)
-        self.pop_fitness = np.zeros(self.pop_size)
 
         self.query_all = torch.zeros(self.total_images)
         self.correct_all = torch.zeros_like(self.query_all)  # number of images
@@ -50,82 +47,80 @@ class MGAAttack(object):
         self.success_query_all = torch.zeros_like(self.query_all)
 
     def is_success(self, logits, y):
-        label = logits.argmax(dim=1).item()
-        if self.targeted and label == y[0].item():
-            return True
-        elif not self.targeted and label != y[0].item():
-            return True
-        return False
+        label = logits.argmax(dim=1)
+        if self.targeted:
+            return label.eq(y)
+        return label.ne(y)
 
-    def fitness_helper(self, model, individual, x, y):
-
-        # resize to image size
-        individual = individual.copy()
-        zeros = (individual == 0)
-        individual[zeros] = -1
-
-        delta = individual * self.epsilon
-        delta = torch.from_numpy(delta).to(dtype=x.dtype, device=x.device)
+    def get_adv(self, individual, x):
+        """
+        :param individual: (N,C,H,W) the binary individuals, 0 means -epsilon and 1 means +epsilon
+        :param x: (N,C,H,W) the images of the individuals
+        """
+        delta = (individual.to(x.dtype) * 2 - 1) * self.epsilon
+        return torch.clamp(x + delta, self.clip_min, self.clip_max)
 
-        adv = x + delta.unsqueeze(0)
-        adv = torch.clamp(adv, self.clip_min, self.clip_max)
+    def fitness_helper(self, model, individual, x, y):
+        """
+        Evaluate the individuals of all images by one forward.
+        :param individual: (N,C,H,W) the individuals, where N is the flattened (image, individual) pairs
+        :param x: (N,C,H,W) the image of each individual
+        :param y: (N,) the label of each individual
+        :return: the loss and whether the attack succeeds of each individual
+        """
+        adv = self.get_adv(individual, x)
         # only imagenet dataset needs preprocess
-        logits = model(adv)
+        with torch.no_grad():
+            logits = model(adv)
         loss = self.loss_fn(logits, y)
-        if self.is_success(logits, y):
-            self.adv = adv.detach().cpu()
-        return loss.item()
-
-    def get_fitness(self, model, lw, x, y, query):  # lw的shape = (2,C,H,W)
-        first, second = self.idx[0], self.idx[1]
-        if self.is_change[first] == 1:  # losser changed, so fitness also change
-            f1 = self.fitness_helper(model, lw[0], x, y)
-            query += 1
-            self.pop_fitness[first] = f1
-            self.is_change[first] = 0
-        else:
-            f1 = self.pop_fitness[first]
-
-        if self.is_change[second] == 1:
-            f2 = self.fitness_helper(model, lw[1], x, y)
-            query += 1
-            self.pop_fitness[second] = f2
-            self.is_change[second] = 0
-        else:
-            f2 = self.pop_fitness[second]
-
-        return np.array([f1, f2])
-
-    def cross_over(self, lw):
-        cross_point = np.random.rand(lw.shape[-3], lw.shape[-2], lw.shape[-1]) < self.cross_rate
-        lw[0, cross_point] = lw[1, cross_point]  # 输家70%的概率从赢家拿perturbation给输家
-        return lw
-
-    def mutate(self, lw):
+        return loss, self.is_success(logits, y), adv
 
+    def get_fitness(self, model, pop, idx, x, y, query, attacking):
+        """
+        Get the fitness of the two individuals idx of each image, only the changed individuals are queried.
+        :param pop: (B,P,C,H,W) the populations of B images
+        :param idx: (B,2) the index of the loser and winner candidates of each image
+        :param attacking: (B,) bool, the images which are still being attacked
+        :return: the fitness (B,2)
+        """
+        image_index = torch.arange(pop.size(0), device=pop.device).unsqueeze(1).expand_as(idx)
+        changed = self.is_change[image_index, idx] & attacking.unsqueeze(1)  # losser changed, so fitness also change
+        owner, position = torch.nonzero(changed, as_tuple=True)
+        if owner.numel() > 0:
+            individual_idx = idx[owner, position]
+            loss, success, adv = self.fitness_helper(model, pop[owner, individual_idx], x[owner], y[owner])
+            query.index_add_(0, owner.cpu(), torch.ones(owner.size(0)))
+            self.pop_fitness[owner, individual_idx] = loss
+            self.is_change[owner, individual_idx] = False
+            self.record_success(owner[success], adv[success])
+        return self.pop_fitness[image_index, idx]
+
+    def record_success(self, owner, adv):
+        if owner.numel() > 0:
+            self.adv[owner] = adv.detach()
+            self.done[owner] = True
+
+    def cross_over(self, loser, winner):
+        # loser, winner shape = (B,C,H,W)
+        cross_point = torch.rand(loser.size(), device=loser.device) < self.cross_rate
+        return torch.where(cross_point, winner, loser)  # 输家70%的概率从赢家拿perturbation给输家
+
+    def mutate(self, loser):
         # generate mutation point
-        mutation_point = np.random.rand(lw.shape[-3], lw.shape[-2], lw.shape[-1]) < self.mutation_rate
+        mutation_point = torch.rand(loser.size(), device=loser.device) < self.mutation_rate
         # reverse the value at mutation point 1->0, 0->1
-        zeros = (lw[0] == 0)
-        ones = (lw[0] == 1)
-        lw[0, mutation_point & zeros] = 1  # 被修改的是输家
-        lw[0, mutation_point & ones] = 0
-        return lw
+        return torch.where(mutation_point, 1 - loser, loser)  # 被修改的是输家
 
     def init_pop(self, x, y):
-
         adversary = MI_FGSM_ENS(self.ensemble_models, epsilon=self.epsilon, iters=self.iters, targeted=self.targeted)
-        datas, labels = x.repeat((self.pop_size, 1, 1, 1)), y.repeat(self.pop_size)  # pop size = 5
+        datas, labels = x.repeat_interleave(self.pop_size, dim=0), y.repeat_interleave(self.pop_size)  # pop size = 5
         adv = adversary.perturb(datas, labels)
-        delta = adv - x
-        negative = delta <= 0
-        positive = delta > 0
-        delta[negative] = 0
-        delta[positive] = 1
-        return delta.detach().cpu().numpy()
+        delta = adv - datas
+        return (delta > 0).to(torch.uint8).view(x.size(0), self.pop_size, *x.size()[1:])
 
     def make_adversarial_examples(self, model, images, labels):
         """
+        The populations of all images are evolved together.
         :param images: the original images
         :param labels: the original ground truth label in untargeted attack and the target class in targeted attack
         :return: adversarial_images, query_number
@@ -133,50 +128,53 @@ class MGAAttack(object):
         images, labels = images.cuda(), labels.cuda()
         # input train_data parameter
         batch_size, channels, height, width = images.size()
-        adv = images.clone()
-        self.adv = None
+        image_index = torch.arange(batch_size, device=images.device)
+        self.adv = images.clone()
+        self.done = torch.zeros(batch_size, dtype=torch.bool, device=images.device)
         query = torch.zeros(images.size(0))
-        self.pop_fitness = np.zeros(self.pop_size)
-        self.is_change = np.zeros(self.pop_size)
+        self.is_change = torch.zeros(batch_size, self.pop_size, dtype=torch.bool, device=images.device)
         if not self.ensemble_models:
             # initial population
-            pop = np.random.randint(0, 2, (self.pop_size, channels, height, width))
+            pop = torch.randint(0, 2, (batch_size, self.pop_size, channels, height, width), dtype=torch.uint8,
+                                device=images.device)
         else:
             pop = self.init_pop(images, labels)
         # this expense 5 queries, this thy the median always 5
         # init pop fitness, this can reduce query, cause in mga, not all individual changes in a generation
-        for n in range(self.pop_size):
-            self.pop_fitness[n] = self.fitness_helper(model, pop[n], images, labels)  # 根据每个初始化的pop得到loss
-            query+=1
+        loss, success, adv = self.fitness_helper(model, pop.view(-1, channels, height, width),
+                                                 images.repeat_interleave(self.pop_size, dim=0),
+                                                 labels.repeat_interleave(self.pop_size))  # 根据每个初始化的pop得到loss
+        self.pop_fitness = loss.view(batch_size, self.pop_size)
+        query += self.pop_size
+        owner = image_index.repeat_interleave(self.pop_size)
+        self.record_success(owner[success], adv[success])
         for i in range(self.generations):  # 1000次循环
-            self.idx = np.random.choice(np.arange(self.pop_size), size=2, replace=False)  # 从[0-4]随机生成2个数字
-            lw = pop[self.idx].copy()  # short for losser winner
-            fitness = self.get_fitness(model, lw, images, labels, query)
-            # if success, abort early
-            if self.adv is not None:
-                return self.adv, query
+            # if success, abort early; if the query budget is exhausted, the attack fails
+            attacking = ~self.done & (query < self.max_queries).to(images.device)
+            if not attacking.any():
+                break
+            # 每张图片从[0-4]随机生成2个数字
+            idx = torch.argsort(torch.rand(batch_size, self.pop_size, device=images.device), dim=1)[:, :2]
+            fitness = self.get_fitness(model, pop, idx, images, labels, query, attacking)
+            attacking = attacking & ~self.done
             # in target situation, the smaller fitness is, the better
             if self.targeted:
-                fidx = np.argsort(-fitness)  # loss从大到小，由于targeted attack的loss越小越好，因此第一个位置是输家
+                loser_position = (fitness[:, 1] > fitness[:, 0]).long()  # targeted attack的loss越小越好
             else:
-                fidx = np.argsort(fitness)  # loss从小到大，由于untargeted attack的loss越大越好，因此第一个位置是输家
-            lw = lw[fidx]
-            lw = self.cross_over(lw)  # 只修改那个输家，也就是位置=0的
-            lw = self.mutate(lw)  # 只修改那个输家，也就是位置=0的
-
-            lw = lw[fidx]
-            # update population
-            pop[self.idx] = lw.copy()
-
+                loser_position = (fitness[:, 1] < fitness[:, 0]).long()  # untargeted attack的loss越大越好
+            loser_idx = idx[image_index, loser_position]
+            winner_idx = idx[image_index, 1 - loser_position]
+            loser = self.cross_over(pop[image_index, loser_idx], pop[image_index, winner_idx])  # 只修改那个输家
+            loser = self.mutate(loser)
+            # update population of the images which are still attacked
+            attacked_index = image_index[attacking]
+            pop[attacked_index, loser_idx[attacking]] = loser[attacking]
             # losser changed, so fitness should also change
-            self.is_change[self.idx[fidx[0]]] = 1
-            if query[0].item() >= self.max_queries:  # 失败了
-                delta = lw[1] * self.epsilon
-                delta = torch.from_numpy(delta).to(dtype=images.dtype, device=images.device)
-                adv = images + delta.unsqueeze(0)
-                adv = torch.clamp(adv, self.clip_min, self.clip_max).detach().cpu()
-                break
-        return adv, query
+            self.is_change[attacked_index, loser_idx[attacking]] = True
+            # 失败了
+            failed = attacking & (query >= self.max_queries).to(images.device)
+            self.adv[failed] = self.get_adv(pop[image_index[failed], winner_idx[failed]], images[failed])
+        return self.adv.detach().cpu(), query
 
     def attack_all_images(self, args, arch_name, target_model, result_dump_path):
 
@@ -234,16 +232,16 @@ class MGAAttack(object):
             success_query = success * query
 
 
-            log.info('Attack {}-th image over, query:{}, succes: {}'.format(
-                batch_idx, int(query[0].item()), bool(success[0].item())
+            log.info('Attack {}-th batch over, max query:{}, succes: {}/{}'.format(
+                batch_idx, int(query.max().item()), int(success.sum().item()), success.size(0)
             ))
             log.info('        correct: {:.4f}'.format(correct.mean().item()))
             log.info('       not_done: {:.4f}'.format(not_done[correct.byte()].mean().item()))
             if success.sum().item() > 0:
                 log.info('     mean_query: {:.4f}'.format(success_query[success.byte()].mean().item()))
                 log.info('   median_query: {:.4f}'.format(success_query[success.byte()].median().item()))
-            selected = torch.arange(batch_idx * 1,
-                                    min((batch_idx + 1) * 1, self.total_images))
+            selected = torch.arange(batch_idx * args.batch_size,
+                                    min((batch_idx + 1) * args.batch_size, self.total_images))
             for key in ['query', 'correct', 'not_done',
                         'success', 'success_query']:
                 value_all = getattr(self, key + "_all")
@@ -312,6 +310,7 @@ if __name__ == "__main__":
     parser.add_argument('--epsilon', type=float, default=0.03137)
     parser.add_argument('--max_queries', type=int, default=10000)
     parser.add_argument('--pop_size', type=int, default=5)
+    parser.add_argument('--batch_size', type=int, default=100, help='the number of images evolved together')
     parser.add_argument('--mr', type=float, default=0.001)
     parser.add_argument('--cr', type=float, default=0.7)
     parser.add_argument('--iters', type=int, default=10)
@@ -7,6 +7,7 @@ import glob
 import json
 from types import SimpleNamespace
 from dataset.defensive_model import DefensiveModel
+from dataset.pipeline_attack import PipelineAttack
 
 import glog as log
 import numpy as np
@@ -355,6 +356,143 @@ class NES(object):
             value = eval(key)
             value_all[selected] = value.detach().float().cpu()  # 由于value_all是全部图片都放在一个数组里，当前batch选择出来
 
+    def get_batch_grad(self, x, sigma, samples_per_draw, batch_size, true_labels, target_labels, target_model, top_k):
+        """
+        The get_grad of all images in one forward per noise batch, the noises of each image are stacked as
+        (num_images * batch_size, C, H, W). In the partial-information mode, only the noises whose top-k predictions
+        contain the target class are averaged (same as partial_info_loss).
+        :return: loss shape = (num_images,), grad shape = (num_images, C, H, W)
+        """
+        num_images = x.size(0)
+        num_batches = samples_per_draw // batch_size
+        labels = (target_labels if self.targeted else true_labels).repeat_interleave(batch_size)
+        losses = []
+        grads = []
+        for _ in range(num_batches):
+            noise_pos = torch.randn((num_images, batch_size // 2) + tuple(x.shape[1:]))  # N, B//2, C, H, W
+            noise = torch.cat([-noise_pos, noise_pos], dim=1).cuda()  # N, B, C, H, W
+            eval_points = x.unsqueeze(1) + sigma * noise
+            logits = target_model(eval_points.view(-1, *x.shape[1:]))  # N * B, num_classes
+            loss = F.cross_entropy(logits, labels, reduction='none')
+            if top_k < self.num_classes:
+                _, inds = torch.topk(logits, dim=1, k=top_k, largest=True, sorted=True)
+                good = (inds == labels.unsqueeze(1)).any(dim=1).float()
+            else:
+                good = torch.ones_like(loss)
+            loss, good = loss.view(num_images, batch_size), good.view(num_images, batch_size)
+            good_num = good.sum(1).clamp(min=1)
+            grad = ((loss * good).view(num_images, batch_size, 1, 1, 1) * noise).sum(1) / good_num.view(-1, 1, 1, 1) / sigma
+            losses.append((loss * good).sum(1) / good_num)
+            grads.append(grad)
+        return torch.stack(losses).mean(0), torch.stack(grads).mean(0)
+
+    def init_state(self, images, true_labels, target_labels, target_model, args):
+        """
+        The per-image state of the pipeline attack (dataset/pipeline_attack.py), the scalars of
+        make_adversarial_examples (epsilon, max_lr, last_ls, etc.) become per-image tensors.
+        """
+        batch_size = images.size(0)
+        adv_images = images.clone()
+        epsilon = args.epsilon
+        if args.top_k > 0 or self.targeted:
+            assert self.targeted, "Partial-information attack is a targeted attack."
+            adv_images = self.get_image_of_target_class(self.dataset_name, target_labels, target_model).cuda()
+            epsilon = args.starting_eps
+        state = {"images": images, "adv_images": adv_images, "true_labels": true_labels,
+                 "g": torch.zeros_like(images),
+                 "query": torch.zeros(batch_size).cuda(),
+                 "success": torch.zeros(batch_size).bool().cuda(),
+                 "epsilon": torch.full((batch_size,), float(epsilon)).cuda(),
+                 "max_lr": torch.full((batch_size,), float(args.max_lr)).cuda(),
+                 "delta_epsilon": torch.full((batch_size,), float(args.starting_delta_eps or 0.0)).cuda(),
+                 "last_ls": torch.zeros(batch_size, args.plateau_length).cuda(),  # ring buffer of the last losses
+                 "last_ls_count": torch.zeros(batch_size).long().cuda()}
+        if target_labels is not None:
+            state["target_labels"] = target_labels
+        return state
+
+    def step(self, state, target_model, args):
+        images, adv_images = state["images"], state["adv_images"].clone()
+        true_labels, target_labels = state["true_labels"], state.get("target_labels")
+        batch_size = images.size(0)
+        k = args.top_k if args.top_k > 0 or self.targeted else self.num_classes
+        goal_epsilon = args.epsilon
+        l, g = self.get_batch_grad(adv_images, args.sigma, args.samples_per_draw, args.batch_size, true_labels,
+                                   target_labels, target_model, k)
+        query = state["query"] + args.samples_per_draw
+        # SIMPLE MOMENTUM
+        g = args.momentum * state["g"] + (1.0 - args.momentum) * g
+        # PLATEAU LR ANNEALING
+        last_ls, last_ls_count = state["last_ls"].clone(), state["last_ls_count"] + 1
+        last_ls[torch.arange(batch_size), (last_ls_count - 1) % args.plateau_length] = l
+        oldest_l = last_ls[torch.arange(batch_size), last_ls_count % args.plateau_length]
+        plateau = (last_ls_count >= args.plateau_length) & (l > oldest_l)
+        max_lr = torch.where(plateau & (state["max_lr"] > args.min_lr),
+                             torch.clamp(state["max_lr"] / args.plateau_drop, min=args.min_lr), state["max_lr"])
+        last_ls_count = last_ls_count * (~plateau).long()
+        # SEARCH FOR LR AND EPSILON DECAY
+        epsilon, delta_epsilon = state["epsilon"].clone(), state["delta_epsilon"].clone()
+        current_lr = max_lr.clone()
+        prop_de = torch.where(epsilon > goal_epsilon, delta_epsilon, torch.zeros_like(delta_epsilon))
+        image_step = self.l2_image_step if args.norm == 'l2' else self.linf_image_step
+        searching = current_lr >= args.min_lr
+        while searching.any():
+            idx = torch.nonzero(searching).view(-1)
+            if self.targeted:
+                proposed_epsilon = torch.clamp(epsilon[idx] - prop_de[idx], min=goal_epsilon)
+            else:
+                proposed_epsilon = torch.full_like(epsilon[idx], goal_epsilon)
+            proposed_adv = image_step(adv_images[idx], g[idx], current_lr[idx].view(-1, 1, 1, 1))
+            eps = proposed_epsilon.view(-1, 1, 1, 1)
+            delta = proposed_adv - images[idx]
+            if args.norm == 'l2':
+                out_of_bounds_mask = (self.norm(delta) > eps).float()
+                proposed_adv = (images[idx] + eps * delta / self.norm(delta)) * out_of_bounds_mask \
+                               + proposed_adv * (1 - out_of_bounds_mask)
+            else:
+                proposed_adv = images[idx] + torch.max(torch.min(delta, eps), -eps)
+            proposed_adv = torch.clamp(proposed_adv, 0, 1)
+            if self.targeted or k != self.num_classes:
+                query[idx] += 1  # we must query for check robust_in_top_k
+            if self.targeted:
+                robust = target_model(proposed_adv).argmax(dim=1).eq(target_labels[idx])
+            else:
+                robust = torch.ones_like(idx).bool()
+            accept_idx, fail_idx = idx[robust], idx[~robust]
+            delta_epsilon[accept_idx] = torch.where(prop_de[accept_idx] > 0,
+                                                    torch.clamp(prop_de[accept_idx], min=args.min_delta_eps or 0.0),
+                                                    delta_epsilon[accept_idx])
+            adv_images[accept_idx] = proposed_adv[robust]
+            if self.targeted:
+                epsilon[accept_idx] = proposed_epsilon[robust]
+            else:
+                epsilon[accept_idx] = torch.clamp(epsilon[accept_idx] - prop_de[accept_idx] / args.conservative,
+                                                  min=goal_epsilon)
+            searching[accept_idx] = False
+            # the failed images halve the lr, then halve the epsilon decay and search again from max_lr
+            halve_lr = current_lr[fail_idx] >= args.min_lr * 2
+            current_lr[fail_idx[halve_lr]] /= 2
+            backtrack_idx = fail_idx[~halve_lr]
+            prop_de[backtrack_idx] /= 2
+            searching[backtrack_idx[prop_de[backtrack_idx] == 0]] = False
+            prop_de[backtrack_idx] = torch.where(prop_de[backtrack_idx] < 2e-3, torch.zeros_like(prop_de[backtrack_idx]),
+                                                 prop_de[backtrack_idx])
+            current_lr[backtrack_idx] = max_lr[backtrack_idx]
+            searching &= current_lr >= args.min_lr
+        with torch.no_grad():
+            adv_pred = target_model(adv_images).argmax(dim=1)
+        if self.targeted:
+            success = adv_pred.eq(target_labels)
+        else:
+            success = ~adv_pred.eq(true_labels)
+        state.update({"adv_images": adv_images, "g": g, "query": query, "epsilon": epsilon, "max_lr": max_lr,
+                      "delta_epsilon": delta_epsilon, "last_ls": last_ls, "last_ls_count": last_ls_count,
+                      "success": success & (epsilon <= goal_epsilon)})
+        return state
+
+    def is_done(self, state, args):
+        return state["success"] | (state["query"] >= args.max_queries)
+
 def get_exp_dir_name(dataset, norm, targeted, target_type, args):
 
     target_str = "untargeted" if not targeted else "targeted_{}".format(target_type)
@@ -427,6 +565,10 @@ if __name__ == "__main__":
     parser.add_argument('--seed', default=0, type=int, help='random seed')
     parser.add_argument('--attack_defense', action="store_true")
     parser.add_argument('--defense_model', type=str, default=None)
+    parser.add_argument('--pipeline', action="store_true",
+                        help='attack pipeline_slots images together and refill the finished ones with new images')
+    parser.add_argument('--pipeline_slots', type=int, default=20, help='the number of images attacked together')
+    parser.add_argument('--refill_interval', type=int, default=50, help='refill the finished slots every N steps')
 
     args = parser.parse_args()
     os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
@@ -507,6 +649,12 @@ if __name__ == "__main__":
         model.cuda()
         model.eval()
         log.info("Begin attack {} on {}, result will be saved to {}".format(arch, args.dataset, save_result_path))
-        attacker.attack_all_images(args, arch, model, save_result_path)
+        if args.pipeline:
+            pipeline = PipelineAttack(attacker, DataLoaderMaker.get_test_attacked_data(args.dataset, args.pipeline_slots),
+                                      args.dataset, args.pipeline_slots, args.refill_interval)
+            with torch.no_grad():
+                pipeline.attack_all_images(args, arch, model, save_result_path)
+        else:
+            attacker.attack_all_images(args, arch, model, save_result_path)
         model.cpu()
     log.info("All done!")
\ No newline at end of file
@@ -1,9 +1,35 @@
+from collections import OrderedDict
+
 from torch import nn
 import torch
 import numpy as np
 from torch.nn import functional as F
 
 
+def convert_multihead_state_dict(state_dict, num_heads=4, prefix=""):
+    """
+    Map the weights of the old per-head multihead attention (nn.Sequential "heads" of 4 Conv1d layers per head: query,
+    key, value and output projection) onto the fused projections att_q, att_k, att_v and att_out of NP.
+    The queries, keys and values of all heads are concatenated along the output dimension, the output projections are
+    concatenated along the input dimension, and their biases are summed because the old heads summed their outputs.
+    :param state_dict: the state_dict of an old NP model
+    :param prefix: the prefix of the NP model's keys in state_dict
+    :return: a new state_dict which can be loaded into the current NP model
+    """
+    def head_param(head_index, layer_index, param_name):
+        return state_dict[prefix + "heads.{}.{}".format(head_index * 4 + layer_index, param_name)].squeeze(-1)
+
+    converted = OrderedDict((key, value) for key, value in state_dict.items()
+                            if not key.startswith(prefix + "heads."))
+    for layer_index, name in enumerate(["att_q", "att_k", "att_v"]):
+        for param_name in ["weight", "bias"]:
+            converted[prefix + "{}.{}".format(name, param_name)] = torch.cat(
+                [head_param(h, layer_index, param_name) for h in range(num_heads)], dim=0)
+    converted[prefix + "att_out.weight"] = torch.cat([head_param(h, 3, "weight") for h in range(num_heads)], dim=1)
+    converted[prefix + "att_out.bias"] = sum(head_param(h, 3, "bias") for h in range(num_heads))
+    return converted
+
+
 class NP(nn.Module):
     def __init__(self, c, device, data_dim, args):
         super(NP, self).__init__()
@@ -39,21 +65,7 @@ class NP(nn.Module):
         self.num_heads = 4
 
         if args.att_type == 'multihead':
-            d_k, d_v = c, self.r_dim
-            self.heads = []
-            head_size = int(self.r_dim / self.num_heads)
-
-            for i in range(self.num_heads):
-                self.heads.append(nn.Conv1d(d_k, d_k, 1))
-                self.heads[-1].weight.data.normal_(0, d_k ** (-0.5))
-                self.heads.append(nn.Conv1d(d_k, d_k, 1))
-                self.heads[-1].weight.data.normal_(0, d_k ** (-0.5))
-                self.heads.append(nn.Conv1d(d_v, head_size, 1))
-                self.heads[-1].weight.data.normal_(0, d_k ** (-0.5))
-                self.heads.append(nn.Conv1d(head_size, self.r_dim, 1))
-                self.heads[-1].weight.data.normal_(0, d_v ** (-0.5))
-
-            self.heads = nn.Sequential(*(self.heads))
+            self.build_multihead_attention(c, self.r_dim)
 
         self.g_1 = nn.Linear(self.z_dim * 2 + c, self.hidden_dim)
         self.g_2 = nn.Linear(self.hidden_dim, self.hidden_dim)
@@ -65,6 +77,37 @@ class NP(nn.Module):
 
         self.attention_type = args.att_type
 
+    def build_multihead_attention(self, d_k, d_v):
+        # the projections of all heads are fused into one layer, head h owns the h-th slice of the output features
+        head_size = int(d_v / self.num_heads)
+        self.att_q = nn.Linear(d_k, d_k * self.num_heads)
+        self.att_q.weight.data.normal_(0, d_k ** (-0.5))
+        self.att_k = nn.Linear(d_k, d_k * self.num_heads)
+        self.att_k.weight.data.normal_(0, d_k ** (-0.5))
+        self.att_v = nn.Linear(d_v, head_size * self.num_heads)
+        self.att_v.weight.data.normal_(0, d_k ** (-0.5))
+        self.att_out = nn.Linear(head_size * self.num_heads, d_v)
+        self.att_out.weight.data.normal_(0, d_v ** (-0.5))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # the checkpoints saved before the fused projections keep the per-head Conv1d layers in "heads"
+        if prefix + "heads.0.weight" in state_dict:
+            converted = convert_multihead_state_dict(state_dict, self.num_heads, prefix)
+            for key in [key for key in state_dict if key.startswith(prefix + "heads.")]:
+                del state_dict[key]
+            state_dict.update(converted)
+        super(NP, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def __setstate__(self, state):
+        # the models pickled by torch.save(model) before the fused projections
+        super(NP, self).__setstate__(state)
+        if "heads" in self._modules:
+            heads = self._modules.pop("heads")
+            old_state_dict = OrderedDict(("heads." + key, value) for key, value in heads.state_dict().items())
+            self.build_multihead_attention(heads[0].in_channels, heads[2].in_channels)
+            self.to(heads[0].weight.device)
+            self.load_state_dict(convert_multihead_state_dict(old_state_dict, self.num_heads), strict=False)
+
     def encoder_determinate(self, x_y):
         x_y = F.relu(self.h_1(x_y))
         x_y = F.relu(self.h_2(x_y))
@@ -156,23 +199,16 @@ class NP(nn.Module):
         Returns:
           tensor of shape [B,m,d_v].
         """
-        # print (q.shape)
-        # print (k.shape)
-        # print (v.shape)
-        d_k = q.shape[-1]
-        d_v = v.shape[-1]
-        head_size = d_v / num_heads
-
-        rep = 0.0
-        for h in range(num_heads):
-            o = self.dot_product_attention(
-                self.heads[h * 4](q.permute(0, 2, 1)).permute(0, 2, 1),
-                self.heads[h * 4 + 1](k.permute(0, 2, 1)).permute(0, 2, 1),
-                self.heads[h * 4 + 2](v.permute(0, 2, 1)).permute(0, 2, 1),
-                normalise=True)
-
-            rep += self.heads[h * 4 + 3](o.permute(0, 2, 1)).permute(0, 2, 1)
-        return rep
+        batch_size, m, d_k = q.size()
+        n = k.size(1)
+        q = self.att_q(q).view(batch_size, m, num_heads, d_k).transpose(1, 2)  # [B,heads,m,d_k]
+        k = self.att_k(k).view(batch_size, n, num_heads, d_k).transpose(1, 2)  # [B,heads,n,d_k]
+        v = self.att_v(v).view(batch_size, n, num_heads, -1).transpose(1, 2)  # [B,heads,n,head_size]
+        unnorm_weights = torch.matmul(q, k.transpose(-1, -2)) / np.sqrt(1.0 * d_k)  # [B,heads,m,n]
+        weights = F.softmax(unnorm_weights, dim=-1)
+        o = torch.matmul(weights, v)  # [B,heads,m,head_size]
+        o = o.transpose(1, 2).contiguous().view(batch_size, m, -1)  # [B,m,heads*head_size]
+        return self.att_out(o)
 
     def corss_attention(self, content_x, target_x, r):
         if self.attention_type == 'uniform':
@@ -15,6 +15,7 @@ import glob
 from config import IMAGE_SIZE, IN_CHANNELS, CLASS_NUM, MODELS_TEST_STANDARD, PY_ROOT, MODELS_TRAIN_STANDARD, \
     MODELS_TRAIN_WITHOUT_RESNET
 from dataset.dataset_loader_maker import DataLoaderMaker
+from dataset.surrogate_ensemble import SurrogateEnsemble
 from dataset.defensive_model import DefensiveModel
 from torch.nn import functional as F
 import glog as log
@@ -22,9 +23,54 @@ import torch
 from dataset.standard_model import StandardModel
 
 
+class ODSDirectionQueue(object):
+    """
+    The queue of precomputed ODS directions of each image. When the queue of an image is empty, queue_size directions
+    (each has a random surrogate model and random output weights) are computed at its current x_best, the empty
+    queues of all images are refilled together in one call of the surrogate ensemble.
+    The queue of an image is cleared after its x_best is updated, so every direction is computed at the current x_best.
+    """
+    def __init__(self, surrogate_ensemble, num_classes, queue_size):
+        self.surrogate_ensemble = surrogate_ensemble
+        self.num_classes = num_classes
+        self.queue_size = queue_size
+        self.directions = None
+        self.remain = None
+
+    def reset(self, x):
+        self.directions = torch.zeros(x.size(0), self.queue_size, *x.shape[1:], device=x.device)  # B,K,C,H,W
+        self.remain = torch.zeros(x.size(0)).long()
+
+    def clear(self, img_idxes):
+        self.remain[img_idxes] = 0
+
+    def refill(self, x, img_idxes):
+        random_direction = torch.rand((self.queue_size, img_idxes.size(0), self.num_classes)) * 2 - 1
+        model_indexes = np.random.randint(len(self.surrogate_ensemble), size=self.queue_size).tolist()
+        grads = self.surrogate_ensemble.output_gradients(x, random_direction, model_indexes)  # K,n,C,H,W
+        grad_norm = grads.view(grads.size(0), grads.size(1), -1).norm(dim=2).view(*grads.shape[:2], 1, 1, 1)
+        self.directions[img_idxes.to(self.directions.device)] = (grads / grad_norm).transpose(0, 1).to(
+            self.directions.device)
+        self.remain[img_idxes] = self.queue_size
+
+    def pop(self, x, img_idxes):
+        """
+        :param x: the current x_best of the images img_idxes, shape = (n, C, H, W)
+        :param img_idxes: the indexes of the images in the batch, shape = (n,)
+        :return: the next direction of each image, shape = (n, C, H, W)
+        """
+        empty = self.remain[img_idxes].eq(0)
+        if empty.any():
+            self.refill(x[empty.to(x.device)], img_idxes[empty])
+        position = self.queue_size - self.remain[img_idxes]
+        self.remain[img_idxes] -= 1
+        return self.directions[img_idxes.to(self.directions.device), position.to(self.directions.device)]
+
+
 class SimBAODS(object):
     def __init__(self, dataset, batch_size, ODS, surrogate_models, freq_dims, stride, order,
-                 max_iters, targeted, target_type, norm, pixel_epsilon, l2_bound, linf_bound, lower_bound=0.0, upper_bound=1.0):
+                 max_iters, targeted, target_type, norm, pixel_epsilon, l2_bound, linf_bound, lower_bound=0.0, upper_bound=1.0,
+                 ods_queue_size=1):
         """
             :param pixel_epsilon: perturbation limit according to lp-ball
             :param norm: norm for the lp-ball constraint
@@ -34,7 +80,8 @@ class SimBAODS(object):
         """
         assert norm in ['linf', 'l2'], "{} is not supported".format(norm)
         self.pixel_epsilon = pixel_epsilon
-        self.surrogate_models = surrogate_models
+        self.surrogate_models = surrogate_models  # SurrogateEnsemble
+        self.direction_queue = ODSDirectionQueue(surrogate_models, CLASS_NUM[dataset], ods_queue_size)
         self.dataset = dataset
         self.norm = norm
         self.ODS = ODS
@@ -81,7 +128,7 @@ class SimBAODS(object):
             second_max_index = target_is_max.long() * argsort[:, 1] + (1 - target_is_max).long() * argsort[:, 0]
             target_logit = logits[torch.arange(logits.shape[0]), target]
             second_max_logit = logits[torch.arange(logits.shape[0]), second_max_index]
-            return torch.sum(target_logit - second_max_logit)
+            return target_logit - second_max_logit
         else:
             # untargeted cw loss: max_{i\neq y}logit_i - logit_y
             _, argsort = logits.sort(dim=1, descending=True)
@@ -89,110 +136,123 @@ class SimBAODS(object):
             second_max_index = gt_is_max.long() * argsort[:, 1] + (1 - gt_is_max).long() * argsort[:, 0]
             gt_logit = logits[torch.arange(logits.shape[0]), label]
             second_max_logit = logits[torch.arange(logits.shape[0]), second_max_index]
-            return torch.sum(second_max_logit - gt_logit)
+            return second_max_logit - gt_logit
 
     def xent_loss(self, logits, label, target=None):
         if target is not None:
-            return -F.cross_entropy(logits, target)
+            return -F.cross_entropy(logits, target, reduction='none')
         else:
-            return F.cross_entropy(logits, label)
+            return F.cross_entropy(logits, label, reduction='none')
 
     def loss(self, logits, true_labels, target_labels):
+        # the loss of each image, shape = (batch_size,)
         if self.targeted:
-            return self.xent_loss(logits, true_labels, target_labels).item()
+            return self.xent_loss(logits, true_labels, target_labels).detach()
         else:
-            return self.cw_loss(logits, true_labels, target_labels).item()
+            return self.cw_loss(logits, true_labels, target_labels).detach()
 
     def l2_proj(self, image, eps):
         orig = image.clone()
-        def proj(new_x):
-            delta = new_x - orig
+        def proj(new_x, img_idxes):
+            delta = new_x - orig[img_idxes]
             out_of_bounds_mask = (self.normalize(delta) > eps).float()
-            x = (orig + eps * delta / self.normalize(delta)) * out_of_bounds_mask
+            x = (orig[img_idxes] + eps * delta / self.normalize(delta)) * out_of_bounds_mask
             x += new_x * (1 - out_of_bounds_mask)
             return x
         return proj
 
     def linf_proj(self, image, eps):
         orig = image.clone()
-        def proj(new_x):
-            return orig + torch.clamp(new_x - orig, -eps, eps)
+        def proj(new_x, img_idxes):
+            return orig[img_idxes] + torch.clamp(new_x - orig[img_idxes], -eps, eps)
         return proj
 
-    def get_perturbation(self, x, image_size):
+    def get_perturbation(self, x, img_idxes, image_size):
+        """
+        :param x: the current x_best of the images img_idxes, shape = (n, C, H, W)
+        :param img_idxes: the indexes of the images in the batch, shape = (n,)
+        """
         if self.ODS:
-            x_grad = x.clone()
-            x_grad.requires_grad_()
-            random_direction = torch.rand((1, CLASS_NUM[self.dataset])).cuda() * 2 - 1
-            ind = np.random.randint(len(self.surrogate_models))
-            surrogate_model = self.surrogate_models[ind]
-            surrogate_model.cuda()
-            with torch.enable_grad():
-                loss = (surrogate_model(x_grad) * random_direction).sum()
-                loss.backward()
-            surrogate_model.cpu()
-            perturbation = x_grad.grad.data / x_grad.grad.norm()
+            perturbation = self.direction_queue.pop(x, img_idxes)
         else:
-            ind1 = np.random.randint(x.size(1))
-            ind2 = np.random.randint(image_size)
-            ind3 = np.random.randint(image_size)
+            ind1 = np.random.randint(x.size(1), size=x.size(0))
+            ind2 = np.random.randint(image_size, size=x.size(0))
+            ind3 = np.random.randint(image_size, size=x.size(0))
             perturbation = torch.zeros(x.size()).cuda()
-            perturbation[:,ind1,ind2,ind3] = 1
+            perturbation[torch.arange(x.size(0)), ind1, ind2, ind3] = 1
         return perturbation
 
+    def get_not_done(self, logits, true_labels, target_labels):
+        adv_pred = logits.argmax(dim=1)
+        if self.targeted:
+            return (1 - adv_pred.eq(target_labels).float()).float()  # not_done初始化为 correct, shape = (batch_size,)
+        return adv_pred.eq(true_labels).float()
+
     # The SimBA_DCT attack, argument labels is the target labels or true labels
-    def attack_batch_images(self, model, images, true_labels, target_labels):
-        proj_maker = self.l2_proj if args.norm == 'l2' else self.linf_proj  # 调用proj_maker返回的是一个函数
+    def attack_batch_images(self, model, images, true_labels, target_labels, max_queries):
+        """
+        Every image tries the +/- sign of its own direction, the images that are not done are queried together:
+        first all of them with the + sign, then the ones that are not improved with the - sign.
+        """
+        proj_maker = self.l2_proj if self.norm == 'l2' else self.linf_proj  # 调用proj_maker返回的是一个函数
         if self.norm == "l2":
             proj_step = proj_maker(images, self.l2_bound)
         else:
             proj_step = proj_maker(images, self.linf_bound)
         batch_size = images.size(0)
-        assert batch_size == 1
         max_iters = self.max_iters
         x_best = images.clone()
-        logits = model(images)
+        with torch.no_grad():
+            logits = model(images)
         pred = logits.argmax(dim=1)
         correct = pred.eq(true_labels).float()
         loss_best = self.loss(logits, true_labels, target_labels)
-        queries = 1 # https://github.com/ermongroup/ODS/issues/4
+        queries = torch.ones(batch_size) # https://github.com/ermongroup/ODS/issues/4
+        not_done = correct.clone().cpu()
+        if self.ODS:
+            self.direction_queue.reset(images)
         for m in range(max_iters):
-            delta = self.get_perturbation(x_best, images.size(-1))
+            # the images that exceed max_queries are failed anyway, thus they stop querying
+            img_idxes = torch.nonzero(not_done.bool() & (queries < max_queries)).view(-1)
+            if img_idxes.size(0) == 0:
+                break
+            delta = self.get_perturbation(x_best[img_idxes.cuda()], img_idxes, images.size(-1))
+            trying = img_idxes
             for sign in [1,-1]:
-                x_new = x_best + self.pixel_epsilon * sign * delta
+                trying_gpu = trying.cuda()
+                x_new = x_best[trying_gpu] + self.pixel_epsilon * sign * delta
                 if self.norm == "linf":
-                    x_new = proj_step(x_new)
+                    x_new = proj_step(x_new, trying_gpu)
                 x_new = torch.clamp(x_new, 0, 1)
-                logits = model(x_new)
-                queries += 1
-                loss_new = self.loss(logits, true_labels, target_labels)
-                if loss_best < loss_new:
-                    x_best = x_new
-                    loss_best = loss_new
+                with torch.no_grad():
+                    logits = model(x_new)
+                queries[trying] += 1
+                loss_new = self.loss(logits, true_labels[trying_gpu],
+                                     target_labels[trying_gpu] if target_labels is not None else None)
+                # the success is decided by the last query of each image
+                not_done[trying] = self.get_not_done(logits, true_labels[trying_gpu],
+                                                     target_labels[trying_gpu] if target_labels is not None else None).cpu()
+                improved = loss_best[trying_gpu] < loss_new
+                improved_idxes = trying_gpu[improved]
+                x_best[improved_idxes] = x_new[improved]
+                loss_best[improved_idxes] = loss_new[improved]
+                if self.ODS:
+                    self.direction_queue.clear(trying[improved.cpu()])
+                trying = trying[~improved.cpu()]
+                delta = delta[~improved]
+                if trying.size(0) == 0:
                     break
-            adv_pred = logits.argmax(dim=1)
-            if args.targeted:
-                not_done =  (1 - adv_pred.eq(target_labels).float()).float()  # not_done初始化为 correct, shape = (batch_size,)
-            else:
-                not_done =  adv_pred.eq(true_labels).float()
-            success = (1 - not_done) * correct
-            if success[0].item() == 1:
-                break
-        dist = (x_best - images).norm().item()  # L2 norm distance
-        if self.norm == "l2" and dist > self.l2_bound:
-            x_best = proj_step(x_best)
-            logits = model(x_best)
-            adv_pred = logits.argmax(dim=1)
-            if args.targeted:
-                not_done =  (1 - adv_pred.eq(target_labels).float()).float()  # not_done初始化为 correct, shape = (batch_size,)
-            else:
-                not_done =  adv_pred.eq(true_labels).float()
-            success = (1 - not_done) * correct
-        query = torch.zeros(1).float()
-        query.fill_(queries)
-        distortion = torch.zeros(1).float()
-        distortion.fill_(dist)
-        return x_best, success.detach().cpu().float(), correct.detach().cpu().float(), query, distortion
+        success = (1 - not_done.cuda()) * correct
+        dist = (x_best - images).view(batch_size, -1).norm(dim=1)  # L2 norm distance
+        if self.norm == "l2" and (dist > self.l2_bound).any():
+            out_of_bound = torch.nonzero(dist > self.l2_bound).view(-1)
+            x_best[out_of_bound] = proj_step(x_best[out_of_bound], out_of_bound)
+            with torch.no_grad():
+                logits = model(x_best[out_of_bound])
+            not_done_proj = self.get_not_done(logits, true_labels[out_of_bound],
+                                              target_labels[out_of_bound] if target_labels is not None else None)
+            success[out_of_bound] = (1 - not_done_proj) * correct[out_of_bound]
+        return x_best, success.detach().cpu().float(), correct.detach().cpu().float(), queries, dist.detach().cpu().float()
 
     def normalize(self, t):
         assert len(t.shape) == 4
@@ -240,10 +300,11 @@ class SimBAODS(object):
             true_labels = true_labels.cuda()
             if self.targeted:
                 target_labels = target_labels.cuda()
-            adv_images, success, correct, query, distortion = self.attack_batch_images(model, images.cuda(), true_labels, target_labels)
-            if query[0].item() > args.max_queries:
-                success[0] = 0
-            log.info("{}-th image attack over, query:{}, success:{}".format(batch_idx, query, bool(success)))
+            adv_images, success, correct, query, distortion = self.attack_batch_images(model, images.cuda(), true_labels,
+                                                                                       target_labels, args.max_queries)
+            success[query > args.max_queries] = 0
+            log.info("{}-th batch attack over, mean query:{:.1f}, success rate:{:.3f}".format(batch_idx,
+                                                    query.mean().item(), success.mean().item()))
             success = success * correct
             success_query = success * query
             for key in ['query', 'correct',
@@ -322,6 +383,11 @@ def get_parse_args():
     parser.add_argument('--target_type', type=str, default='increment', choices=['random', 'least_likely', "increment"])
     parser.add_argument('--attack_defense', action="store_true")
     parser.add_argument('--defense_model', type=str, default=None)
+    parser.add_argument('--ods_queue_size', type=int, default=4,
+                        help='the number of ODS directions precomputed for each image in one surrogate backward')
+    parser.add_argument('--surrogate_memory_budget', type=float, default=None,
+                        help='GPU memory (GB) of the resident surrogate models, the least recently used ones are swapped '
+                             'out when exceeded. Default keeps all surrogate models resident.')
     args = parser.parse_args()
     os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
     os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
@@ -410,8 +476,11 @@ if __name__ == "__main__":
         surrogate_model = StandardModel(args.dataset, surr_arch, no_grad=False)
         surrogate_model.eval()
         surrogate_models.append(surrogate_model)
-    attacker = SimBAODS(args.dataset, args.batch_size, args.ODS, surrogate_models, args.freq_dims, args.stride, args.order,max_iters,
-                     args.targeted,args.target_type, args.norm, args.pixel_epsilon, args.l2_bound, args.linf_bound, 0.0, 1.0)
+    memory_budget = int(args.surrogate_memory_budget * 1024 ** 3) if args.surrogate_memory_budget is not None else None
+    surrogate_ensemble = SurrogateEnsemble(surrogate_models, memory_budget=memory_budget)
+    attacker = SimBAODS(args.dataset, args.batch_size, args.ODS, surrogate_ensemble, args.freq_dims, args.stride, args.order,max_iters,
+                     args.targeted,args.target_type, args.norm, args.pixel_epsilon, args.l2_bound, args.linf_bound, 0.0, 1.0,
+                     args.ods_queue_size)
 
     log.info('Command line is: {}'.format(' '.join(sys.argv)))
     log.info("Log file is written in {}".format(log_file_path))
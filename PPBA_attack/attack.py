@@ -10,10 +10,9 @@ import glog as log
 import json
 import numpy as np
 import torch
-from scipy.fftpack import dct, idct
 from torchvision import models
 from torchvision.utils import save_image
-from PPBA_attack.utils import block_order,block_idct
+from PPBA_attack.utils import block_order, dct_matrix, low_freq_idct
 from config import IMAGE_SIZE, IN_CHANNELS, CLASS_NUM, MODELS_TEST_STANDARD, PY_ROOT
 from dataset.dataset_loader_maker import DataLoaderMaker
 from torch.nn import functional as F
@@ -25,7 +24,7 @@ from dataset.standard_model import StandardModel
 class PPBA(object):
     def __init__(self, dataset, order, r, rho, mom,n_samples,
                  targeted, target_type,  norm, epsilon, low_dim, lower_bound=0.0, upper_bound=1.0,
-                 max_queries=10000):
+                 max_queries=10000, batch_size=100, device="cuda"):
         """
             :param epsilon: perturbation limit according to lp-ball
             :param norm: norm for the lp-ball constraint
@@ -33,6 +32,8 @@ class PPBA(object):
             :param upper_bound: maximum value data point can take in any coordinate
             :param max_queries: max number of calls to model per data point
             :param max_crit_queries: max number of calls to early stopping criterion  per data poinr
+            :param batch_size: the number of images attacked together, each image has its own coefficients
+            :param device: the device of the images and the DCT basis, e.g. "cpu" on a machine without GPU
         """
         assert norm in ['linf', 'l2'], "{} is not supported".format(norm)
         self.epsilon = epsilon
@@ -48,7 +49,8 @@ class PPBA(object):
         self.targeted = targeted
         self.target_type = target_type
         self.dataset = dataset
-        self.data_loader = DataLoaderMaker.get_test_attacked_data(dataset, 1)
+        self.device = torch.device(device)
+        self.data_loader = DataLoaderMaker.get_test_attacked_data(dataset, batch_size)
         self.total_images = len(self.data_loader.dataset)
         self.image_height = IMAGE_SIZE[dataset][0]
         self.image_width = IMAGE_SIZE[dataset][1]
@@ -72,26 +74,48 @@ class PPBA(object):
         self.mom =mom  # default 1 not add
         self.n_samples = n_samples # number of samples per iteration (1 by default), not the number of images to be evaluated.
         self.rho = rho
-        self.construct_random_matrix()
+        self.construct_low_freq_indices()
 
-    def construct_random_matrix(self):
+    def construct_low_freq_indices(self):
+        """
+        The projection matrix of low_dim x C*H*W is never materialized: its i-th row is the inverse DCT of the one-hot
+        coefficient image at self.coefficient_index[i], so z @ matrix is computed by scattering z into the sampled
+        low frequency coefficients and applying the inverse DCT on the fly (see self.perturbation).
+        """
         if self.order == "strided":
-            self.random_matrix = np.zeros((self.low_dim, self.in_channels * self.image_height * self.image_width))
             indices = block_order(self.image_height, self.in_channels, initial_size=self.freq_dim, stride=self.stride)
+            indices = indices[:self.low_dim]
         else:
-            self.random_matrix = np.zeros((self.low_dim, self.in_channels * self.freq_dim * self.freq_dim))
-            indices = random.sample(range(self.r), self.low_dim)
-        for i in range(self.low_dim):
-            self.random_matrix[i][indices[i]] = 1
-
-        if self.order == "strided":
-            self.random_matrix = torch.from_numpy(self.random_matrix).view(-1, self.in_channels, self.image_height, self.image_width)
-        else:
-            self.random_matrix = torch.from_numpy(self.random_matrix).view(-1, self.in_channels, self.freq_dim, self.freq_dim)
-        self.random_matrix = block_idct(self.expand_vector(
-            self.random_matrix, size=(self.image_height if self.order == "strided" else self.freq_dim),),
-            block_size=self.image_height).view(self.low_dim, -1).cuda()
+            # the indices of the (C, freq_dim, freq_dim) top-left coefficients, which are expanded to (C, H, W)
+            assert self.r <= self.in_channels * self.freq_dim * self.freq_dim, "r must be within the low frequency"
+            indices = torch.LongTensor(random.sample(range(self.r), self.low_dim))
+            channel, rest = indices // (self.freq_dim * self.freq_dim), indices % (self.freq_dim * self.freq_dim)
+            indices = channel * self.image_height * self.image_width + (rest // self.freq_dim) * self.image_width \
+                      + rest % self.freq_dim
+        rows = (indices % (self.image_height * self.image_width)) // self.image_width
+        cols = indices % self.image_width
+        # only the top-left (coefficient_rows x coefficient_cols) coefficients can be nonzero
+        self.coefficient_rows = rows.max().item() + 1
+        self.coefficient_cols = cols.max().item() + 1
+        channel = indices // (self.image_height * self.image_width)
+        self.coefficient_index = (channel * self.coefficient_rows * self.coefficient_cols + rows * self.coefficient_cols
+                                  + cols).to(self.device)
+        self.dct_basis_h = dct_matrix(self.image_height).to(self.device)
+        self.dct_basis_w = dct_matrix(self.image_width).to(self.device)
 
+    def perturbation(self, z):
+        """
+        :param z: (..., low_dim) the low dimensional coefficients
+        :return: (..., C, H, W) the perturbation z @ random_matrix
+        """
+        batch_shape = z.size()[:-1]
+        z = z.reshape(-1, self.low_dim)
+        coefficients = torch.zeros(z.size(0), self.in_channels * self.coefficient_rows * self.coefficient_cols,
+                                   device=z.device)
+        coefficients.scatter_(1, self.coefficient_index.unsqueeze(0).expand_as(z), z)
+        coefficients = coefficients.view(-1, self.in_channels, self.coefficient_rows, self.coefficient_cols)
+        perturbation = low_freq_idct(coefficients, self.dct_basis_h, self.dct_basis_w)
+        return perturbation.view(*batch_shape, self.in_channels, self.image_height, self.image_width)
 
     def cw_loss(self, model, images, label, target=None):
         logits = model(images)
@@ -123,30 +147,28 @@ class PPBA(object):
     #     else:
     #         return torch.clamp(j - i, min=0)
 
-    def expand_vector(self, x, size):
-        batch_size = x.size(0)
-        x = x.view(-1, self.in_channels, size, size)
-        z = torch.zeros(batch_size, self.in_channels, self.image_height, self.image_width)
-        z[:, :, :size, :size] = x
-        return z
-
-    def get_probability(self, success_probability):
-        probability = [v / sum(success_probability) for v in success_probability]
-        return probability
-
-    def func(self, model, orig_images, xs, true_labels, target_labels):
-        z = torch.from_numpy(xs).float().cuda().view(-1, self.low_dim)
-        perturbation = (z @ self.random_matrix).view(z.shape[0], self.in_channels, self.image_height, self.image_width)  # matrix multiplication
+    def func(self, model, orig_images, z, true_labels, target_labels):
+        """
+        :param orig_images: (B, C, H, W) the original images
+        :param z: (B, n_samples, low_dim) the coefficients of each image
+        :return: the loss (B, n_samples)
+        """
+        batch_size, n_samples = z.size(0), z.size(1)
+        perturbation = self.perturbation(z)
         if self.norm == "linf":
             perturbation = torch.clamp(perturbation, -self.epsilon, self.epsilon)
-        new_image = (orig_images + perturbation).clamp(0, 1)
-        loss = self.cw_loss(model, new_image, true_labels, target_labels)
-        return loss
+        new_image = (orig_images.unsqueeze(1) + perturbation).clamp(0, 1).view(-1, *orig_images.size()[1:])
+        true_labels = true_labels.repeat_interleave(n_samples)
+        if target_labels is not None:
+            target_labels = target_labels.repeat_interleave(n_samples)
+        with torch.no_grad():
+            loss = self.cw_loss(model, new_image, true_labels, target_labels)
+        return loss.view(batch_size, n_samples)
 
-    # only supports 1 image to be passed in
     def attack_batch_images(self, model, batch_index, images, true_labels):
         batch_size = images.size(0)
-        query = torch.zeros(batch_size).cuda()
+        device = images.device
+        query = torch.zeros(batch_size, device=device)
         with torch.no_grad():
             logit = model(images)
         pred = logit.argmax(dim=1)
@@ -156,11 +178,12 @@ class PPBA(object):
 
         if self.targeted:
             if self.target_type == 'random':
-                target_labels = torch.randint(low=0, high=CLASS_NUM[self.dataset], size=true_labels.size()).long().cuda()
+                target_labels = torch.randint(low=0, high=CLASS_NUM[self.dataset], size=true_labels.size(), device=device).long()
                 invalid_target_index = target_labels.eq(true_labels)
                 while invalid_target_index.sum().item() > 0:
                     target_labels[invalid_target_index] = torch.randint(low=0, high=logit.shape[1],
-                                                                 size=target_labels[invalid_target_index].shape).long().cuda()
+                                                                 size=target_labels[invalid_target_index].shape,
+                                                                        device=device).long()
                     invalid_target_index = target_labels.eq(true_labels)
             elif self.target_type == 'least_likely':
                 target_labels = logit.argmin(dim=1)
@@ -171,59 +194,49 @@ class PPBA(object):
         else:
             target_labels = None
 
-        z = np.zeros((1,self.low_dim))
-        prev_f = self.func(model, images, z, true_labels, target_labels)[0].item()
+        # the coefficients and the statistics of the sampled directions of each image
+        z = torch.zeros(batch_size, self.low_dim, device=device)
+        prev_f = self.func(model, images, z.unsqueeze(1), true_labels, target_labels)[:, 0]
         query += not_done
-        is_success = 0 if prev_f > 0 else 1
-        effective_number = [
-            np.ones((1, self.low_dim)),
-            np.ones((1, self.low_dim)),
-            np.ones((1, self.low_dim)),
-        ]
-        ineffective_number = [
-            np.ones((1, self.low_dim)),
-            np.ones((1, self.low_dim)),
-            np.ones((1, self.low_dim)),
-        ]
+        # effective_number[i] and ineffective_number[i] count the value -1, 0, 1 of u, shape = (3, B, low_dim)
+        effective_number = torch.ones(3, batch_size, self.low_dim, device=device)
+        ineffective_number = torch.ones(3, batch_size, self.low_dim, device=device)
+        u_values = torch.tensor([-1.0, 0.0, 1.0], device=device).view(3, 1, 1, 1)
+        attacking = not_done.bool() & (prev_f > 0)
         for k in range(self.max_queries-1):
-            u = np.zeros((self.n_samples, self.low_dim))
-            r = np.random.uniform(size=(self.n_samples, self.low_dim))
+            idx = torch.nonzero(attacking).view(-1)
+            if idx.size(0) == 0:
+                break
+            r = torch.rand(idx.size(0), self.n_samples, self.low_dim, device=device)
             # 这里 u 会为最终采样出来的方向，由于 $u \in [-\rho, 0, \rho]^n$, 在计算每个值出现的概率之后，通过 r 均匀采样，来确定 u 最终的值.
             # (比如初始三者都是等概率,即分成0-0.33,0.33-0.66,0.66-1三个区间，r随机得到0.6落在第二个区间，则该位取 0)
-            effective_probability = [
-                effective_number[i] / (effective_number[i] + ineffective_number[i])
-                for i in range(len(effective_number))
-            ]
-            probability = self.get_probability(effective_probability)
+            effective_probability = effective_number[:, idx] / (effective_number[:, idx] + ineffective_number[:, idx])
+            probability = (effective_probability / effective_probability.sum(0, keepdim=True)).unsqueeze(2)
+            u = torch.zeros_like(r)
             u[r < probability[0]] = -1
             u[r >= probability[0] + probability[1]] = 1
-            uz = z + self.rho * u
+            uz = z[idx].unsqueeze(1) + self.rho * u
             if self.norm == "l2":
-                uz_l2 = np.linalg.norm(uz, axis=1)
-                uz = uz * np.minimum(1, self.epsilon / uz_l2).reshape(-1, 1)
-            fu = self.func(model, images, uz, true_labels, target_labels).detach().cpu().numpy()
-            query += not_done
-            if fu.min().item() < prev_f:
-                worked_u = u[fu < prev_f]
-                effective_probability[0] = effective_probability[0] * self.mom + (worked_u == -1).sum(0)
-                effective_probability[1] = effective_probability[1] * self.mom + (worked_u == 0).sum(0)
-                effective_probability[2] = effective_probability[2] * self.mom + (worked_u == 1).sum(0)
-                not_worked_u = u[fu >= prev_f]
-                ineffective_number[0] = ineffective_number[0] * self.mom + (not_worked_u == -1).sum(0)
-                ineffective_number[1] = ineffective_number[1] * self.mom + (not_worked_u == 0).sum(0)
-                ineffective_number[2] = ineffective_number[2] * self.mom + (not_worked_u == 1).sum(0)
-                z = uz[np.argmin(fu).item()]
-                prev_f = fu.min().item()
-            else:
-                ineffective_number[0] += (u == -1).sum(0)
-                ineffective_number[1] += (u == 0).sum(0)
-                ineffective_number[2] += (u == 1).sum(0)
-            if prev_f <= 0:
-                is_success = 1
-                break
+                uz_l2 = torch.norm(uz, p=2, dim=2, keepdim=True)
+                uz = uz * torch.clamp(self.epsilon / uz_l2, max=1)
+            fu = self.func(model, images[idx], uz, true_labels[idx],
+                           target_labels[idx] if target_labels is not None else None)
+            query[idx] += 1
+            min_fu, argmin_fu = fu.min(1)
+            improved = min_fu < prev_f[idx]  # (n,)
+            worked = (fu < prev_f[idx].unsqueeze(1)).float().unsqueeze(0).unsqueeze(-1)  # (1, n, n_samples, 1)
+            counts = u.unsqueeze(0).eq(u_values).float()  # (3, n, n_samples, low_dim)
+            # the counts of the improved images decay with the momentum, the others are only accumulated
+            decay = torch.where(improved, torch.full_like(min_fu, self.mom), torch.ones_like(min_fu)).view(1, -1, 1)
+            effective_number[:, idx] = effective_number[:, idx] * decay + \
+                                       (counts * worked * improved.float().view(1, -1, 1, 1)).sum(2)
+            ineffective_number[:, idx] = ineffective_number[:, idx] * decay + (counts * (1 - worked)).sum(2)
+            improved_idx = idx[improved]
+            z[improved_idx] = uz[improved, argmin_fu[improved]]
+            prev_f[improved_idx] = min_fu[improved]
+            attacking[idx] = prev_f[idx] > 0
 
-        z = torch.from_numpy(z).float().cuda()
-        perturbation = (z @ self.random_matrix).view(1, self.in_channels, self.image_height, self.image_width)
+        perturbation = self.perturbation(z)
         if self.norm == "linf":
             perturbation = torch.clamp(perturbation, -self.epsilon, self.epsilon)
         adv_images = (images + perturbation).clamp(0, 1)
@@ -239,8 +252,8 @@ class PPBA(object):
         success = success * (query <= self.max_queries).float()
         success_query = success * query
         not_done_prob = adv_prob[torch.arange(batch_size), true_labels] * not_done
-        is_success = int(success[0].item()) & is_success
-        log.info("{}-th image attack success: {} query: {}".format(batch_index, bool(is_success), int(query[0].item())))
+        log.info("{}-th batch attack success: {}/{} mean query: {:.1f}".format(batch_index, int(success.sum().item()),
+                                                                              batch_size, query.mean().item()))
         for key in ['query', 'correct',  'not_done',
                     'success', 'success_query', 'not_done_prob']:
             value_all = getattr(self, key+"_all")
@@ -278,10 +291,10 @@ class PPBA(object):
                 self.image_height = model.input_size[-1]
                 if images.size(-1) != model.input_size[-1]:
                     images = F.interpolate(images, size=model.input_size[-1], mode='bilinear',align_corners=True)
-                if self.random_matrix.size(1) != self.in_channels * self.image_height * self.image_width:
-                    self.construct_random_matrix()
+                if self.dct_basis_h.size(0) != self.image_height or self.dct_basis_w.size(0) != self.image_width:
+                    self.construct_low_freq_indices()
 
-            self.attack_batch_images(model, batch_idx, images.cuda(), true_labels.cuda())
+            self.attack_batch_images(model, batch_idx, images.to(self.device), true_labels.to(self.device))
             tmp_info_dict = {"batch_idx": batch_idx + 1}
             for key in ['query_all', 'correct_all', 'not_done_all',
                         'success_all', 'success_query_all','not_done_prob_all']:
@@ -316,6 +329,7 @@ def get_parse_args():
     parser.add_argument("--r", type=int, default=2352)
     parser.add_argument("--max_queries", type=int, default=10000)
     parser.add_argument("--n_samples", type=int, default=1)
+    parser.add_argument("--batch_size", type=int, default=100, help="the number of images attacked together")
     parser.add_argument("--rho", type=float, default=0.001, help="modify from original 0.01 to 0.001 due to epsilon = 1.0 in CIFAR-10")
     parser.add_argument('--attack_defense', action="store_true")
     parser.add_argument('--defense_model', type=str, default=None)
@@ -330,6 +344,8 @@ def get_parse_args():
     parser.add_argument('--target_type', type=str, default='increment', choices=['random', 'least_likely', "increment"])
     parser.add_argument('--exp-dir', default='logs', type=str, help='directory to save results and logs')
     parser.add_argument('--seed',type=int,default=0)
+    parser.add_argument('--device', type=str, default="cuda" if torch.cuda.is_available() else "cpu",
+                        help='the device of the attack, cpu on a machine without GPU')
     args = parser.parse_args()
     os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
     os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
@@ -427,7 +443,7 @@ if __name__ == "__main__":
     log.info('Called with args:')
     print_args(args)
     attacker = PPBA(args.dataset, args.order, args.r, args.rho, args.mom,args.n_samples,args.targeted,args.target_type,
-                    args.norm, args.epsilon, args.low_dim, 0.0, 1.0, args.max_queries)
+                    args.norm, args.epsilon, args.low_dim, 0.0, 1.0, args.max_queries, args.batch_size, args.device)
     for arch in archs:
         if args.attack_defense:
             save_result_path = args.exp_dir + "/{}_{}_result.json".format(arch, args.defense_model)
@@ -442,7 +458,7 @@ if __name__ == "__main__":
             model = DefensiveModel(args.dataset, arch, no_grad=True, defense_model=args.defense_model)
         else:
             model = StandardModel(args.dataset, arch, no_grad=True)
-        model.cuda()
+        model.to(args.device)
         model.eval()
         attacker.attack_all_images(args, model, tmp_result_path, save_result_path)
         model.cpu()
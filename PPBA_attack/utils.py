@@ -150,4 +150,19 @@ def block_idct(x, block_size=8, masked=False, ratio=0.5):
             if masked:
                 submat = submat * mask
             z[:, :, (i * block_size):((i + 1) * block_size), (j * block_size):((j + 1) * block_size)] = torch.from_numpy(idct(idct(submat, axis=3, norm='ortho'), axis=2, norm='ortho'))
-    return z
\ No newline at end of file
+    return z
+
+# the orthonormal DCT-II matrix D of size (size, size), dct(x, norm='ortho') = D @ x and idct(y, norm='ortho') = D.T @ y
+def dct_matrix(size, device=None):
+    n = torch.arange(size, dtype=torch.float64, device=device)
+    k = n.view(-1, 1)
+    matrix = torch.cos(math.pi * k * (2 * n + 1) / (2 * size)) * math.sqrt(2.0 / size)
+    matrix[0] /= math.sqrt(2.0)
+    return matrix.float()
+
+
+# applies IDCT to the whole image without materializing the zero high frequency coefficients,
+# only the top-left (rows x cols) coefficients of x are used, x: (B, C, rows, cols), basis_h: (H, H), basis_w: (W, W)
+def low_freq_idct(x, basis_h, basis_w):
+    rows, cols = x.size(-2), x.size(-1)
+    return basis_h[:rows].t() @ x @ basis_w[:cols]
@@ -15,7 +15,8 @@ import torch
 
 from TREMBA.imagenet_model.resnet import resnet152_denoise
 from dataset.dataset_loader_maker import DataLoaderMaker
-from TREMBA.utils import Function, MarginLossSingle
+from dataset.query_profiler import QueryProfiler, ProfiledModel
+from TREMBA.utils import BatchFunction, margin_loss
 from config import CLASS_NUM, PY_ROOT, MODELS_TEST_STANDARD
 from dataset.standard_model import StandardModel
 import numpy as np
@@ -23,56 +24,79 @@ import numpy as np
 from defensive_model import DefensiveModel
 
 
-def EmbedBA(function, encoder, decoder, image, label, config, latent=None):
-    device = image.device
-    if latent is None:
-        latent = encoder(image.unsqueeze(0)).squeeze().view(-1)
-    momentum = torch.zeros_like(latent)
-    dimension = len(latent)
-    noise = torch.empty((dimension, config.sample_size), device=device)
-    origin_image = image.clone()
-    last_loss = []
-    lr = config.lr
+def BatchEmbedBA(function, encoder, decoder, images, labels, config, latents=None):
+    """
+    The embedding black-box attack of TREMBA, the B images are attacked together in the latent space, each slot keeps
+    its own latent, momentum, learning rate and plateau history. The slot is retired once it succeeds or runs out of
+    queries.
+    :param function: BatchFunction with B slots
+    :param images: shape of (B, C, H, W)
+    :param labels: shape of (B,), the true labels (untargeted) or the target labels (targeted)
+    :return: success (B,), adv_images (B, C, H, W), query counts (B,)
+    """
+    device = images.device
+    batch_size = images.size(0)
+    if latents is None:
+        latents = encoder(images)
+    latents = latents.view(batch_size, -1)
+    momentum = torch.zeros_like(latents)
+    dimension = latents.size(1)
+    half = config.sample_size // 2
+    noise = torch.empty((batch_size, dimension, config.sample_size), device=device)
+    lr = torch.full((batch_size,), float(config.lr), device=device)
+    loss_history = torch.zeros(batch_size, config.plateau_length, device=device)
+    history_len = torch.zeros(batch_size, dtype=torch.long, device=device)
+    slots = torch.arange(batch_size, device=device)
+    active = torch.ones(batch_size, dtype=torch.bool, device=device)
+    success = torch.zeros(batch_size, dtype=torch.bool, device=device)
+    adv_images = images.clone()
     for iter in range(config.num_iters + 1):
-        perturbation = torch.clamp(decoder(latent.unsqueeze(0)).squeeze(0) * config.epsilon,
-                                   -config.epsilon, config.epsilon)
-        logit, loss = function(torch.clamp(image + perturbation, 0, 1), label)
+        idx = slots[active]
+        if idx.numel() == 0:
+            break
+        perturbation = torch.clamp(decoder(latents[idx]) * config.epsilon, -config.epsilon, config.epsilon)
+        adv = torch.clamp(images[idx] + perturbation, 0, 1)
+        logit, loss = function(adv, labels[idx], idx)
         if config.targeted:
-            success = torch.argmax(logit, dim=1) == label
+            success_curr = torch.argmax(logit, dim=1) == labels[idx]
         else:
-            success = torch.argmax(logit, dim=1) != label
-        last_loss.append(loss.item())
+            success_curr = torch.argmax(logit, dim=1) != labels[idx]
+        loss_history[idx] = torch.cat((loss_history[idx, 1:], loss.unsqueeze(1)), dim=1)
+        history_len[idx] = torch.clamp(history_len[idx] + 1, max=config.plateau_length)
 
-        if function.current_counts > config.max_queries:
+        out_of_queries = function.current_counts[idx.cpu()].to(device) > config.max_queries
+        adv_images[idx[success_curr]] = adv[success_curr]
+        success[idx[success_curr & ~out_of_queries]] = True
+        active[idx[success_curr | out_of_queries]] = False
+        keep = ~success_curr & ~out_of_queries
+        idx = idx[keep]
+        if idx.numel() == 0:
             break
 
-        if bool(success.item()):
-            return True, torch.clamp(image + perturbation, 0, 1), function.current_counts
-
-        nn.init.normal_(noise)
-        noise[:, config.sample_size // 2:] = -noise[:, :config.sample_size // 2]
-        latents = latent.repeat(config.sample_size, 1) + noise.transpose(0, 1) * config.sigma
-        perturbations = torch.clamp(decoder(latents) * config.epsilon, -config.epsilon, config.epsilon)
-        _, losses = function(torch.clamp(image.expand_as(perturbations) + perturbations, 0, 1), label)
-
-        grad = torch.mean(losses.expand_as(noise) * noise, dim=1)
-
-        # if iter % config.log_interval == 0 and config.print_log:
-        #     log.info("iteration: {} loss: {}, l2_deviation {}".format(iter, float(loss.item()),
-        #                                                            float(torch.norm(perturbation))))
+        noise_curr = noise[:idx.numel()]
+        nn.init.normal_(noise_curr)
+        noise_curr[:, :, half:] = -noise_curr[:, :, :half]
+        sample_latents = latents[idx].unsqueeze(1) + noise_curr.transpose(1, 2) * config.sigma  # B', sample_size, D
+        perturbations = torch.clamp(decoder(sample_latents.reshape(-1, dimension)) * config.epsilon,
+                                    -config.epsilon, config.epsilon)
+        perturbations = perturbations.view(idx.numel(), config.sample_size, *images.size()[1:])
+        sample_images = torch.clamp(images[idx].unsqueeze(1) + perturbations, 0, 1).view(-1, *images.size()[1:])
+        _, losses = function(sample_images, labels[idx], idx, repeats=config.sample_size)
+        grad = torch.mean(losses.view(idx.numel(), 1, config.sample_size) * noise_curr, dim=2)
 
-        momentum = config.momentum * momentum + (1 - config.momentum) * grad
+        momentum[idx] = config.momentum * momentum[idx] + (1 - config.momentum) * grad
+        latents[idx] = latents[idx] - lr[idx].unsqueeze(1) * momentum[idx]
 
-        latent = latent - lr * momentum
+        first_loss, last_loss = loss_history[idx, -config.plateau_length], loss_history[idx, -1]
+        plateau = ((last_loss > first_loss + config.plateau_overhead) | ((last_loss > first_loss) & (last_loss < 0.6))) \
+                  & (history_len[idx] == config.plateau_length)
+        plateau_idx = idx[plateau]
+        lr[plateau_idx] = torch.where(lr[plateau_idx] > config.lr_min,
+                                      torch.clamp(lr[plateau_idx] / config.lr_decay, min=config.lr_min),
+                                      lr[plateau_idx])
+        history_len[plateau_idx] = 0
 
-        last_loss = last_loss[-config.plateau_length:]
-        if (last_loss[-1] > last_loss[0] + config.plateau_overhead or last_loss[-1] > last_loss[0] and last_loss[
-            -1] < 0.6) and len(last_loss) == config.plateau_length:
-            if lr > config.lr_min:
-                lr = max(lr / config.lr_decay, config.lr_min)
-            last_loss = []
-
-    return False,function.current_counts
+    return success, adv_images, function.current_counts.clone()
 
 
 def get_args():
@@ -87,6 +111,11 @@ def get_args():
     parser.add_argument("--dataset",type=str, required=True)
     parser.add_argument("--max_queries", type=int, default=10000, help="Maximum number of queries.")
     parser.add_argument("--OSP", action="store_true", help="whether to use optimal starting point")
+    parser.add_argument("--batch_size", type=int, default=20, help="the number of images attacked together")
+    parser.add_argument("--target_type", type=str, default='increment', choices=['random', 'least_likely', "increment"])
+    parser.add_argument("--attack_defense", action="store_true")
+    parser.add_argument("--defense_model", type=str, default=None)
+    parser.add_argument('--profile', action="store_true", help='export the query/latency profile next to the result json')
     args = parser.parse_args()
     return args
 
@@ -195,7 +224,13 @@ def main():
         encoder.eval()
         decoder.to(device)
         decoder.eval()
-        F = Function(model, state.batch_size, state.margin, CLASS_NUM[args.dataset], state.targeted)
+        profiler = QueryProfiler(len(data_loader.dataset), state.batch_size, enabled=args.profile)
+        if args.profile:
+            model = ProfiledModel(model, profiler)
+            if args.OSP:
+                source_model = ProfiledModel(source_model, profiler, tag="source")
+        F = BatchFunction(model, args.batch_size, state.batch_size, state.margin, CLASS_NUM[args.dataset], state.targeted,
+                          profiler=profiler)
         total_success = 0
         count_total = 0
         queries = []
@@ -205,60 +240,61 @@ def main():
         for i, (images, labels) in enumerate(data_loader):
             images = images.to(device)
             labels = labels.to(device)
-            logits = model(images)
-            correct = torch.argmax(logits, dim=1).eq(labels).item()
-            correct_all.append(int(correct))
-            if correct:
-                if args.targeted:
-                    if args.target_type == 'random':
-                        target_labels = torch.randint(low=0, high=CLASS_NUM[args.dataset], size=labels.size()).long().cuda()
+            with torch.no_grad(), profiler.uncharged():  # the clean prediction is not a query of the attack
+                logits = model(images)
+            correct = torch.argmax(logits, dim=1).eq(labels)
+            correct_all.extend(correct.long().tolist())
+            if args.targeted:
+                if args.target_type == 'random':
+                    target_labels = torch.randint(low=0, high=CLASS_NUM[args.dataset], size=labels.size()).long().to(device)
+                    invalid_target_index = target_labels.eq(labels)
+                    while invalid_target_index.sum().item() > 0:
+                        target_labels[invalid_target_index] = torch.randint(low=0, high=logits.shape[1],
+                                                                            size=target_labels[
+                                                                                invalid_target_index].shape).long().to(device)
                         invalid_target_index = target_labels.eq(labels)
-                        while invalid_target_index.sum().item() > 0:
-                            target_labels[invalid_target_index] = torch.randint(low=0, high=logit.shape[1],
-                                                                                size=target_labels[
-                                                                                    invalid_target_index].shape).long().cuda()
-                            invalid_target_index = target_labels.eq(labels)
-                    elif args.target_type == 'least_likely':
-                        with torch.no_grad():
-                            logit = model(images)
-                        target_labels = logit.argmin(dim=1)
-                    elif args.target_type == "increment":
-                        target_labels = torch.fmod(labels + 1, CLASS_NUM[args.dataset]).cuda()
-                    labels = target_labels[0].item()
-                else:
-                    labels = labels[0].item()
+                elif args.target_type == 'least_likely':
+                    target_labels = logits.argmin(dim=1)
+                elif args.target_type == "increment":
+                    target_labels = torch.fmod(labels + 1, CLASS_NUM[args.dataset]).to(device)
+                labels = target_labels
+            batch_queries = torch.zeros(images.size(0), dtype=torch.long)
+            batch_not_done = torch.ones(images.size(0), dtype=torch.long)
+            correct_idx = torch.nonzero(correct).view(-1)
+            if correct_idx.numel() > 0:
+                images, labels = images[correct_idx], labels[correct_idx]
+                F.new_counter(correct_idx.numel())
+                profiler.set_batch(i * args.batch_size + correct_idx.cpu())  # the slots are the correct images
                 if args.OSP:
-                    hinge_loss = MarginLossSingle(state.white_box_margin, state.target)
                     images.requires_grad = True
                     latents = encoder(images)
                     for k in range(state.white_box_iters):
                         perturbations = decoder(latents) * state.epsilon
                         logits = source_model(torch.clamp(images + perturbations, 0, 1))
-                        loss = hinge_loss(logits, labels)
+                        loss = margin_loss(logits, labels, state.white_box_margin, state.target).sum()
                         grad = torch.autograd.grad(loss, latents)[0]
                         latents = latents - state.white_box_lr * grad
                     with torch.no_grad():
-                        success, adv, query_count = EmbedBA(F, encoder, decoder, images[0], labels, state, latents.view(-1))
+                        success, adv, query_count = BatchEmbedBA(F, encoder, decoder, images.detach(), labels, state,
+                                                                 latents.detach())
                 else:
                     with torch.no_grad():
-                        success, adv, query_count = EmbedBA(F, encoder, decoder, images[0], labels, state)
-                not_done.append(1 - int(success))
-                total_success += int(success)
-                count_total += int(correct)
-                if success:
-                    queries.append(query_count)
-                else:
-                    queries.append(args.max_queries)
-
-                log.info("image: {} eval_count: {} success: {} average_count: {} success_rate: {}".format(i, F.current_counts,
-                                                                                                       success, F.get_average(),
-                                                                                        float(total_success) / float(count_total)))
-                F.new_counter()
-            else:
-                queries.append(0)
-                not_done.append(1)
-                log.info("The {}-th image is already classified incorrectly.".format(i))
-        correct_all = np.concatenate(correct_all, axis=0).astype(np.int32)
+                        success, adv, query_count = BatchEmbedBA(F, encoder, decoder, images, labels, state)
+                success = success.cpu()
+                batch_not_done[correct_idx] = 1 - success.long()
+                batch_queries[correct_idx] = torch.where(success, query_count,
+                                                         torch.full_like(query_count, args.max_queries))
+                total_success += int(success.sum().item())
+                count_total += correct_idx.numel()
+                log.info("images: {}-{} success: {}/{} average_count: {} success_rate: {}".format(
+                    i * args.batch_size, i * args.batch_size + len(correct), int(success.sum().item()), correct_idx.numel(),
+                    F.get_average(), float(total_success) / float(count_total)))
+            if correct_idx.numel() < len(correct):
+                log.info("{} images of the {}-th batch are already classified incorrectly.".format(
+                    len(correct) - correct_idx.numel(), i))
+            queries.extend(batch_queries.tolist())
+            not_done.extend(batch_not_done.tolist())
+        correct_all = np.array(correct_all).astype(np.int32)
         query_all = np.array(queries).astype(np.int32)
         not_done_all = np.array(not_done).astype(np.int32)
         success = (1 - not_done_all) * correct_all
@@ -274,3 +310,5 @@ def main():
         with open(save_result_path, "w") as result_file_obj:
             json.dump(meta_info_dict, result_file_obj, sort_keys=True)
         log.info("Done, write stats info to {}".format(save_result_path))
+        if args.profile:
+            profiler.export(save_result_path)
@@ -105,3 +105,64 @@ class Function(nn.Module):
         counts = np.array(self.counts)
         return np.mean(counts[counts < iter])
 
+
+
+def margin_loss(logits, labels, margin=0, target=False):
+    """
+    The margin loss of each row, labels is a LongTensor of shape (N,) thus every row has its own label.
+    """
+    label_logits = logits.gather(1, labels.view(-1, 1)).squeeze(1)
+    other_logits = logits.scatter(1, labels.view(-1, 1), float('-inf'))
+    if not target:
+        diff = label_logits - torch.max(other_logits, dim=1)[0]
+    else:
+        diff = torch.max(other_logits, dim=1)[0] - label_logits
+    return torch.nn.functional.relu(diff + margin, True) - margin
+
+
+class BatchFunction(nn.Module):
+    """
+    The batch version of Function: each row of images has its own label, the queries are sent to the model in chunks
+    of batch_size, the query counts are accumulated per image slot.
+    If a QueryProfiler is given, the rows of each chunk are charged to the images they belong to (the slot i is the
+    i-th image of the profiler's current batch).
+    """
+    def __init__(self, model, num_slots, batch_size=256, margin=0, nlabels=10, target=False, profiler=None):
+        super(BatchFunction, self).__init__()
+        self.model = model
+        self.profiler = profiler
+        self.margin = margin
+        self.target = target
+        self.batch_size = batch_size
+        self.nlabels = nlabels
+        self.current_counts = torch.zeros(num_slots, dtype=torch.long)
+        self.counts = []
+
+    def forward(self, images, labels, slots, repeats=1):
+        '''
+        :param images: shape of (N * repeats, C, H, W), the rows of each slot are contiguous
+        :param labels: shape of (N,)
+        :param slots: the slot indexes of the N images, shape of (N,)
+        :param repeats: the number of queries of each slot
+        :return: logits of shape (N * repeats, #class) and loss of shape (N * repeats,)
+        '''
+        n = len(images)
+        labels = labels.repeat_interleave(repeats)
+        logits = torch.zeros((n, self.nlabels), dtype=torch.float32, device=images.device)
+        owners = slots.cpu().repeat_interleave(repeats)  # the slot of each row
+        for start in range(0, n, self.batch_size):
+            end = min(start + self.batch_size, n)
+            if self.profiler is not None:  # a chunk may cut the rows of a slot, thus each row is charged separately
+                self.profiler.set_active(owners[start:end])
+            logits[start:end] = self.model(images[start:end])
+        loss = margin_loss(logits, labels, self.margin, self.target)
+        self.current_counts[slots.cpu()] += repeats
+        return logits, loss
+
+    def new_counter(self, num_slots):
+        self.counts.extend([count for count in self.current_counts.tolist() if count > 0])
+        self.current_counts = torch.zeros(num_slots, dtype=torch.long)
+
+    def get_average(self, iter=50000):
+        counts = np.array(self.counts)
+        return np.mean(counts[counts < iter])
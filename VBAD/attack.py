@@ -45,7 +45,8 @@ class VBADAttack(object):
         self.targeted = args.targeted
         self.norm = args.norm
 
-        self.dataset_loader = DataLoaderMaker.get_test_attacked_data(args.dataset, 1)
+        self.batch_size = args.batch_size
+        self.dataset_loader = DataLoaderMaker.get_test_attacked_data(args.dataset, args.batch_size)
         self.total_images = len(self.dataset_loader.dataset)
         self.query_all = torch.zeros(self.total_images)
         self.correct_all = torch.zeros_like(self.query_all)  # number of images
@@ -93,68 +94,60 @@ class VBADAttack(object):
 
     def sim_rectification_vector(self, model, adv_images, tentative_directions, n, sigma, target_class, rank_transform,
                                  sub_num, group_gen, untargeted):
-
-        # 此处的frame_number只能选择1
+        """
+        Estimate the rectification vector of the patches of each image by NES (antithetic sampling).
+        :param adv_images: shape = (batch_size, C, H, W)
+        :param tentative_directions: shape = (batch_size, C, H, W)
+        :param target_class: shape = (batch_size,), one class per image
+        :return: loss of each image (batch_size,), grads (batch_size, patch_number * patch_number),
+                 valid mask (batch_size,) which is False if no sample of this image is available
+        """
         with torch.no_grad():
-            grads = torch.zeros(len(group_gen), device='cuda') # len(group_len) = frame_number * patch_number of a image
-            count_in = 0
-            loss_total = 0
-            # log.info('sampling....')
+            batch_size = adv_images.size(0)
             batch_loss = []
             batch_noise = []
             batch_idx = []
 
             assert n % sub_num == 0 and sub_num % 2 == 0
             for _ in range(n // sub_num):
-                adv_vid_rs = adv_images.repeat((sub_num,) + (1,) * len(adv_images.size())) # shape = (sub_num, frame_number, C, H, W)
-                noise_list = torch.randn((sub_num // 2,) + grads.size(), device='cuda') * sigma  # shape = (sub_num//2, frame_number * patch number * patch_number)
-                all_noise = torch.cat([noise_list, -noise_list], 0)   # shape = (sub_num, frame_number * patch number * patch_number)
-                perturbation_sample = group_gen.apply_group_change(tentative_directions, all_noise)  # 1 个patch一个扰动数值
-                adv_vid_rs += perturbation_sample  # shape = (sub_num, frame_number, C, H, W)
-                del perturbation_sample
-                top_val, top_idx, logits = self.output_top_values(model, adv_vid_rs)  # logits shape = (sub_num,)
-                # top_val & top_idx shape = (sub_num,1),
+                noise_list = torch.randn(batch_size, sub_num // 2, len(group_gen), device=adv_images.device) * sigma  # shape = (B, sub_num//2, patch number * patch_number)
+                all_noise = torch.cat([noise_list, -noise_list], 1)   # shape = (B, sub_num, patch number * patch_number)
+                adv_vid_rs = group_gen.apply_group_change(tentative_directions, all_noise)  # 1 个patch一个扰动数值, shape = (B, sub_num, C, H, W)
+                adv_vid_rs += adv_images.unsqueeze(1)  # broadcast (B,1,C,H,W), the base images are not repeated
+                top_val, top_idx, logits = self.output_top_values(model, adv_vid_rs.view((-1,) + adv_images.size()[1:]))
+                del adv_vid_rs
+                # top_val & top_idx shape = (B * sub_num, 1),
                 if untargeted:
                     loss = -torch.max(logits, 1)[0]
                 else:
-                    loss = F.cross_entropy(logits, torch.tensor(target_class, dtype=torch.long,
-                                                               device='cuda').repeat(sub_num), reduction='none')
-                batch_loss.append(loss)
-                batch_idx.append(top_idx)
+                    loss = F.cross_entropy(logits, target_class.repeat_interleave(sub_num), reduction='none')
+                batch_loss.append(loss.view(batch_size, sub_num))
+                batch_idx.append(top_idx.view(batch_size, sub_num))
                 batch_noise.append(all_noise)
-            batch_noise = torch.cat(batch_noise, 0)
-            batch_idx = torch.cat(batch_idx)  # n, 1
-            batch_loss = torch.cat(batch_loss)  # n
+            batch_noise = torch.cat(batch_noise, 1)  # B, n, patch number * patch_number
+            batch_idx = torch.cat(batch_idx, 1)  # B, n
+            batch_loss = torch.cat(batch_loss, 1)  # B, n
+            good_idx = batch_idx == target_class.view(-1, 1)  # B, n
+            count_in = good_idx.sum(1).float()
 
             # Apply rank-based loss transformation
             if rank_transform:
-                good_idx = torch.sum(batch_idx == target_class, 1).byte()  # good_idx shape = (n,)
-                changed_loss = torch.where(good_idx, batch_loss, torch.tensor(1000., device='cuda'))
-                loss_order = torch.zeros(changed_loss.size(0), device='cuda')
-                sort_index = changed_loss.sort()[1]
-                loss_order[sort_index] = torch.arange(0, changed_loss.size(0), device='cuda', dtype=torch.float)
-                available_number = torch.sum(good_idx).item()
-                count_in += available_number
-                unavailable_number = n - available_number
-                unavailable_weight = torch.sum(torch.where(good_idx, torch.tensor(0., device='cuda'),
-                                                           loss_order)) / unavailable_number if unavailable_number else torch.tensor(
-                    0., device='cuda')
-                rank_weight = torch.where(good_idx, loss_order, unavailable_weight) / (n - 1)
-                grads += torch.sum(batch_noise / sigma * (rank_weight.view((-1,) + (1,) * (len(batch_noise.size()) - 1))), 0)
+                changed_loss = torch.where(good_idx, batch_loss, torch.full_like(batch_loss, 1000.))
+                sort_index = changed_loss.sort(dim=1)[1]
+                loss_order = torch.zeros_like(changed_loss).scatter_(1, sort_index, torch.arange(
+                    0, n, device=changed_loss.device, dtype=torch.float).expand(batch_size, n).contiguous())
+                unavailable_number = n - count_in
+                unavailable_weight = torch.where(good_idx, torch.zeros_like(loss_order), loss_order).sum(1) \
+                                     / unavailable_number.clamp(min=1)  # 0 if all samples are available
+                rank_weight = torch.where(good_idx, loss_order, unavailable_weight.view(-1, 1).expand_as(loss_order)) / (n - 1)
+                grads = torch.sum(batch_noise / sigma * rank_weight.unsqueeze(-1), 1)
+                loss_total = torch.zeros_like(count_in)
             else:
-                idxs = (batch_idx == target_class).nonzero()
-                valid_idxs = idxs[:, 0]
-                valid_loss = torch.index_select(batch_loss, 0, valid_idxs)
-
-                loss_total += torch.mean(valid_loss).item()
-                count_in += valid_loss.size(0)
-                noise_select = torch.index_select(batch_noise, 0, valid_idxs)
-                grads += torch.sum(noise_select / sigma * (valid_loss.view((-1,) + (1,) * (len(noise_select.size()) - 1))),0)
-
-            if count_in == 0:
-                return None, None
+                valid_loss = batch_loss * good_idx.float()
+                loss_total = valid_loss.sum(1) / count_in.clamp(min=1)  # mean of the valid loss
+                grads = torch.sum(batch_noise / sigma * valid_loss.unsqueeze(-1), 1)
             # log.info('count in: {}'.format(count_in))
-            return loss_total / count_in, grads
+            return loss_total / count_in.clamp(min=1), grads, count_in > 0
 
     def normalize(self, t):
         assert len(t.shape) == 4
@@ -162,18 +155,25 @@ class VBADAttack(object):
         norm_vec += (norm_vec == 0).float() * 1e-8
         return norm_vec
 
+    # lr is the step size of each image, shape = (batch_size,)
     def l2_image_step(self, x, g, lr):
+        lr = lr.view(-1, 1, 1, 1)
         if self.targeted:
             return x - lr * g / self.normalize(g)
         return x + lr * g / self.normalize(g)
 
     def linf_image_step(self, x, g, lr):
+        lr = lr.view(-1, 1, 1, 1)
         if self.targeted:
             return x - lr * torch.sign(g)
         return x + lr * torch.sign(g)
 
+    # eps is a float or the radius of each image (batch_size,)
     def l2_proj(self, image, eps):
         orig = image.clone()
+        if not torch.is_tensor(eps):
+            eps = torch.full((image.size(0),), eps, device=image.device)
+        eps = eps.view(-1, 1, 1, 1)
         def proj(new_x):
             delta = new_x - orig
             out_of_bounds_mask = (self.normalize(delta) > eps).float()
@@ -184,205 +184,252 @@ class VBADAttack(object):
 
     def linf_proj(self, image, eps):
         orig = image.clone()
+        if not torch.is_tensor(eps):
+            eps = torch.full((image.size(0),), eps, device=image.device)
+        eps = eps.view(-1, 1, 1, 1)
         def proj(new_x):
-            return orig + torch.clamp(new_x - orig, -eps, eps)
+            return orig + torch.min(torch.max(new_x - orig, -eps), eps)
         return proj
 
     def output_top_values(self, model, images, k=1):
-        if images.dim() == 5:
-            images = images.squeeze(1)  #   (sub_num, frame_number, C, H, W) -> (sub_num, C, H, W)
         assert images.dim() == 4
         with torch.no_grad():
             out = model(images)
             top_val, top_idx = torch.topk(F.softmax(out,1), k, dim=-1)  # top_val是最大logits的那个位置的概率，top_idx是对应class id
         return top_val, top_idx, out
 
+    def push_window(self, buffer, count, idx, value):
+        """
+        Append value to the sliding window of each image in idx, the window is kept as a ring buffer.
+        :param buffer: shape = (batch_size, window_size)
+        :param count: the number of values ever appended after the last clear, shape = (batch_size,)
+        :return: the oldest and the newest value in the window of each image in idx
+        """
+        window_size = buffer.size(1)
+        buffer[idx, count[idx] % window_size] = value
+        count[idx] += 1
+        oldest = buffer[idx, torch.where(count[idx] >= window_size, count[idx] % window_size, torch.zeros_like(count[idx]))]
+        return oldest, value
+
     # Input images should be torch.tensor and its shape should be [b, c, w, h].
     # The input should be normalized to [0, 1]
     # target_labels shape = (batch_size,)
     def targeted_attack(self, target_model, images, target_class_images, target_labels):
-        assert target_labels.size(0) == 1
-        target_class = target_labels[0].item()
+        batch_size = images.size(0)
+        device = images.device
         image_step = self.l2_image_step if self.norm == 'l2' else self.linf_image_step
         proj_maker = self.l2_proj if self.norm == 'l2' else self.linf_proj
-        delta_eps = self.delta_eps
+        delta_eps = torch.full((batch_size,), self.delta_eps, device=device)
         adv_images = target_class_images.clone()
-        query_num = torch.zeros(adv_images.size(0))  # shape = 1
-        cur_eps = self.starting_eps
-
-        explore_succ = collections.deque(maxlen=5)
-        reduce_eps_fail = 0
-        cur_min_lr = self.min_lr
-        cur_max_lr = self.max_lr
-
-        delta_eps_schedule = [0.01, 0.003, 0.001, 0]
-        update_steps = [1, 10, 100, 100]
-        update_weight = [2, 1.5, 1.5, 1.5]
-        cur_eps_period = 0
+        query_num = torch.zeros(batch_size, device=device)
+        cur_eps = torch.full((batch_size,), self.starting_eps, device=device)
+        done = torch.zeros(batch_size, dtype=torch.bool, device=device)
+        is_success = torch.zeros(batch_size, dtype=torch.bool, device=device)
+
+        explore_succ = torch.zeros(batch_size, 5, device=device)  # the last 5 exploring results of each image
+        explore_count = torch.zeros(batch_size, dtype=torch.long, device=device)
+        reduce_eps_fail = torch.zeros(batch_size, dtype=torch.long, device=device)
+        cur_min_lr = torch.full((batch_size,), self.min_lr, device=device)
+        cur_max_lr = torch.full((batch_size,), self.max_lr, device=device)
+
+        delta_eps_schedule = torch.tensor([0.01, 0.003, 0.001, 0], device=device)
+        update_steps = torch.tensor([1, 10, 100, 100], device=device)
+        update_weight = torch.tensor([2, 1.5, 1.5, 1.5], device=device)
+        cur_eps_period = torch.zeros(batch_size, dtype=torch.long, device=device)
 
         group_gen = EquallySplitGrouping(self.image_split)
 
-        while query_num.min().item() < self.max_iter:
-            top_val, top_idx, _ = self.output_top_values(target_model, adv_images)  # shape = (frame_number,1)
-            query_num += 1
+        while True:
+            active = (~done) & (query_num < self.max_iter)
+            if not active.any():
+                break
+            idx = torch.nonzero(active).view(-1)
+            top_val, top_idx, _ = self.output_top_values(target_model, adv_images[idx])  # shape = (b,1)
+            query_num[idx] += 1
 
-            tentative_directions = self.directions_generator(adv_images).cuda()  # shape = (frame_number, C, H, W)
+            tentative_directions = self.directions_generator(adv_images[idx], idx).cuda()  # shape = (b, C, H, W)
             # tentative_directions is signed gradient (Linf) or normalized gradient (L2) according to args.norm
             group_gen.initialize(tentative_directions)
 
-            l, g = self.sim_rectification_vector(target_model, adv_images, tentative_directions, self.sample_per_draw, self.sigma,
-                                                 target_class, self.rank_transform, self.sub_num_sample, group_gen, untargeted=False)
-            query_num += self.sample_per_draw
-            if l is None and g is None:
-                log.info('nes sim fails, try again....')
-                continue
+            l, g, valid = self.sim_rectification_vector(target_model, adv_images[idx], tentative_directions,
+                                                        self.sample_per_draw, self.sigma, target_labels[idx],
+                                                        self.rank_transform, self.sub_num_sample, group_gen, untargeted=False)
+            query_num[idx] += self.sample_per_draw
+            if not valid.all():
+                log.info('nes sim fails on {} images, try again....'.format(int((~valid).sum().item())))
 
             # Rectify tentative perturabtions
-            assert g.size(0) == len(group_gen), 'rectification vector size error!'
+            assert g.size(1) == len(group_gen), 'rectification vector size error!'
             rectified_directions = group_gen.apply_group_change(tentative_directions, torch.sign(g) if self.norm == "linf" else g)
 
-            if target_class == top_idx[0][0] and cur_eps <= self.eps:
-                log.info('early stop at iterartion {}'.format(query_num))
-                return True & bool(query_num[0].item() <= self.max_iter), query_num, adv_images
-            idx = (top_idx == target_class).nonzero()
-            pre_score = top_val[0][idx[0][1]]
-            log.info('cur target prediction: {}'.format(pre_score))
-            log.info('cur eps: {}'.format(cur_eps))
-            cur_lr = cur_max_lr
-            prop_de = delta_eps
-
-            while True:
-                proposed_adv_images = adv_images.clone()  # 1,C,H,W
-                assert proposed_adv_images.size() == rectified_directions.size(), 'rectification error!'
+            early_stop = valid & (top_idx[:, 0] == target_labels[idx]) & (cur_eps[idx] <= self.eps)
+            if early_stop.any():
+                stop_idx = idx[early_stop]
+                log.info('early stop at iterartion {}'.format(query_num[stop_idx].long().tolist()))
+                done[stop_idx] = True
+                is_success[stop_idx] = query_num[stop_idx] <= self.max_iter
+            keep = valid & (~early_stop)
+            idx, rectified_directions, top_val = idx[keep], rectified_directions[keep], top_val[keep]
+            if idx.size(0) == 0:
+                continue
+            log.info('cur target prediction: {:.4f}, cur eps: {:.4f}'.format(top_val[:, 0].mean().item(),
+                                                                              cur_eps[idx].mean().item()))
+            directions = torch.zeros_like(adv_images)
+            directions[idx] = rectified_directions
+            cur_lr = cur_max_lr.clone()
+            prop_de = delta_eps.clone()
+            searching = torch.zeros_like(done)
+            searching[idx] = True
+
+            while searching.any():
+                s_idx = torch.nonzero(searching).view(-1)
+                assert adv_images[s_idx].size() == directions[s_idx].size(), 'rectification error!'
                 # PGD
-                proposed_adv_images = image_step(proposed_adv_images, rectified_directions, cur_lr)
-                proposed_eps = max(cur_eps - prop_de, self.eps)
-                proj_step = proj_maker(images, proposed_eps)
+                proposed_adv_images = image_step(adv_images[s_idx], directions[s_idx], cur_lr[s_idx])
+                proposed_eps = torch.clamp(cur_eps[s_idx] - prop_de[s_idx], min=self.eps)
+                proj_step = proj_maker(images[s_idx], proposed_eps)
                 proposed_adv_images = proj_step(proposed_adv_images)
                 proposed_adv_images = torch.clamp(proposed_adv_images, 0., 1.)
-                top_val, top_idx, _ = self.output_top_values(target_model, proposed_adv_images)
-                query_num += 1
-                if target_class in top_idx[0]:  # top_idx shape = (1, 1) 取第一帧，看看是否== target_class
-                    log.info('update with delta eps: {}'.format(prop_de))
-                    if prop_de > 0:
-                        cur_max_lr = self.max_lr
-                        cur_min_lr = self.min_lr
-                        explore_succ.clear()
-                        reduce_eps_fail = 0
-                    else:
-                        explore_succ.append(True)
-                        reduce_eps_fail += 1
-
-                    adv_images = proposed_adv_images.clone()
-                    cur_eps = max(cur_eps - prop_de, self.eps)
-                    break
+                _, top_idx, _ = self.output_top_values(target_model, proposed_adv_images)
+                query_num[s_idx] += 1
+                hit = top_idx[:, 0] == target_labels[s_idx]
+                # update the images which are still classified as target class
+                hit_idx = s_idx[hit]
+                reduced = prop_de[hit_idx] > 0
+                reset_idx, explore_idx = hit_idx[reduced], hit_idx[~reduced]
+                cur_max_lr[reset_idx] = self.max_lr
+                cur_min_lr[reset_idx] = self.min_lr
+                explore_count[reset_idx] = 0
+                reduce_eps_fail[reset_idx] = 0
+                self.push_window(explore_succ, explore_count, explore_idx, 1.)
+                reduce_eps_fail[explore_idx] += 1
+                adv_images[hit_idx] = proposed_adv_images[hit]
+                cur_eps[hit_idx] = proposed_eps[hit]
+                searching[hit_idx] = False
                 # Adjust the learning rate
-                elif cur_lr >= cur_min_lr * 2:
-                    cur_lr = cur_lr / 2
-                else:
-                    if prop_de == 0:
-                        explore_succ.append(False)
-                        reduce_eps_fail += 1
-                        logging.info('Trying to eval grad again.....')
-                        break
-                    prop_de = 0
-                    cur_lr = cur_max_lr
+                miss_idx = s_idx[~hit]
+                halve = cur_lr[miss_idx] >= cur_min_lr[miss_idx] * 2
+                cur_lr[miss_idx[halve]] /= 2
+                rest_idx = miss_idx[~halve]
+                give_up = prop_de[rest_idx] == 0
+                give_up_idx, retry_idx = rest_idx[give_up], rest_idx[~give_up]
+                self.push_window(explore_succ, explore_count, give_up_idx, 0.)
+                reduce_eps_fail[give_up_idx] += 1
+                searching[give_up_idx] = False
+                prop_de[retry_idx] = 0
+                cur_lr[retry_idx] = cur_max_lr[retry_idx]
 
             # Adjust delta eps
-            if reduce_eps_fail >= update_steps[cur_eps_period]:
-                delta_eps = max(delta_eps / update_weight[cur_eps_period], delta_eps_schedule[cur_eps_period])
-                log.info('Success rate of reducing eps is too low. Decrease delta eps to {}'.format(delta_eps))
-                if delta_eps <= delta_eps_schedule[cur_eps_period]:
-                    cur_eps_period += 1
-                if delta_eps < 1e-5:
-                    log.info('fail to converge at query number {} with eps {}'.format(query_num, cur_eps))
-                    return False, query_num, adv_images
-                reduce_eps_fail = 0
+            period = cur_eps_period[idx]
+            adjust = reduce_eps_fail[idx] >= update_steps[period]
+            adjust_idx, period = idx[adjust], period[adjust]
+            if adjust_idx.size(0) > 0:
+                delta_eps[adjust_idx] = torch.max(delta_eps[adjust_idx] / update_weight[period], delta_eps_schedule[period])
+                log.info('Success rate of reducing eps is too low. Decrease delta eps to {}'.format(delta_eps[adjust_idx].tolist()))
+                next_period = delta_eps[adjust_idx] <= delta_eps_schedule[period]
+                cur_eps_period[adjust_idx[next_period]] = (period[next_period] + 1).clamp(max=len(delta_eps_schedule) - 1)
+                fail_idx = adjust_idx[delta_eps[adjust_idx] < 1e-5]
+                if fail_idx.size(0) > 0:
+                    log.info('fail to converge at query number {} with eps {}'.format(query_num[fail_idx].long().tolist(),
+                                                                                      cur_eps[fail_idx].tolist()))
+                    done[fail_idx] = True
+                reduce_eps_fail[adjust_idx] = 0
 
             # Adjust the max lr and min lr
-            if len(explore_succ) == explore_succ.maxlen and cur_min_lr > 1e-7:
-                succ_p = np.mean(explore_succ)
-                if succ_p < 0.5:
-                    cur_min_lr /= 2
-                    cur_max_lr /= 2
-                    explore_succ.clear()
-                    log.info('explore succ rate too low. increase lr scope [{}, {}]'.format(cur_min_lr, cur_max_lr))
-            log.info('step {} : loss {} | lr {}'.format(query_num, l, cur_lr))
-        return False, query_num, adv_images
-
-
-    # Input video should be torch.tensor and its shape should be [num_frames, c, w, h]
-    # The input should be normalized to [0, 1], orig_class只能有一个
-    # 这段函数要好好考虑下怎么改，因为ori_class
+            full_idx = idx[(explore_count[idx] >= explore_succ.size(1)) & (cur_min_lr[idx] > 1e-7)]
+            low_idx = full_idx[explore_succ[full_idx].mean(1) < 0.5]
+            if low_idx.size(0) > 0:
+                cur_min_lr[low_idx] /= 2
+                cur_max_lr[low_idx] /= 2
+                explore_count[low_idx] = 0
+                log.info('explore succ rate too low. increase lr scope of {} images'.format(low_idx.size(0)))
+            log.info('step {} : loss {:.4f} | lr {:.6f}'.format(int(query_num[idx].max().item()), l[keep].mean().item(),
+                                                               cur_lr[idx].mean().item()))
+        return is_success, query_num, adv_images
+
+
+    # Input images should be torch.tensor and its shape should be [b, c, w, h]
+    # The input should be normalized to [0, 1], true_labels shape = (batch_size,)
     def untargeted_attack(self, target_model, images, true_labels):
-        assert true_labels.size(0) == 1
-        ori_class = true_labels[0].item()
+        batch_size = images.size(0)
+        device = images.device
         image_step = self.l2_image_step if self.norm == 'l2' else self.linf_image_step
         proj_maker = self.l2_proj if self.norm == 'l2' else self.linf_proj
         proj_step = proj_maker(images, self.eps)
-        adv_images = image_step(images, torch.rand_like(images) * 2 - 1, self.eps)
+        adv_images = image_step(images, torch.rand_like(images) * 2 - 1, torch.full((batch_size,), self.eps, device=device))
         adv_images = proj_step(adv_images)
         adv_images = torch.clamp(adv_images, 0, 1)
-        query_num = torch.zeros(adv_images.size(0))  # shape = 1
-        cur_lr = self.max_lr
-        last_p = []
-        last_score = []
+        query_num = torch.zeros(batch_size, device=device)
+        cur_lr = torch.full((batch_size,), self.max_lr, device=device)
+        done = torch.zeros(batch_size, dtype=torch.bool, device=device)
+        is_success = torch.zeros(batch_size, dtype=torch.bool, device=device)
+        last_p = torch.zeros(batch_size, 20, device=device)  # sliding windows of the prediction score of each image
+        last_p_count = torch.zeros(batch_size, dtype=torch.long, device=device)
+        last_score = torch.zeros(batch_size, 200, device=device)
+        last_score_count = torch.zeros(batch_size, dtype=torch.long, device=device)
 
         group_gen = EquallySplitGrouping(self.image_split)
 
-        while query_num.min().item() < self.max_iter:
-            top_val, top_idx, _ = self.output_top_values(target_model, adv_images)
-            query_num += 1
-            if ori_class != top_idx[0][0]:
-                # log.info('early stop at iterartion {}'.format(query_num[0].item()))
-                return True & bool(query_num[0].item() <= self.max_iter), query_num, adv_images
-            idx = (top_idx == ori_class).nonzero()
-            pre_score = top_val[0][idx[0][1]]
+        while True:
+            active = (~done) & (query_num < self.max_iter)
+            if not active.any():
+                break
+            idx = torch.nonzero(active).view(-1)
+            top_val, top_idx, _ = self.output_top_values(target_model, adv_images[idx])
+            query_num[idx] += 1
+            succeed = true_labels[idx] != top_idx[:, 0]
+            if succeed.any():
+                # log.info('early stop at iterartion {}'.format(query_num[idx[succeed]].tolist()))
+                done[idx[succeed]] = True
+                is_success[idx[succeed]] = query_num[idx[succeed]] <= self.max_iter
+            idx, pre_score = idx[~succeed], top_val[~succeed, 0]
             # log.info('cur target prediction: {}'.format(pre_score))
 
-            last_score.append(pre_score)
-            last_score = last_score[-200:]
-            if last_score[-1] >= last_score[0] and len(last_score) == 200:
+            oldest, newest = self.push_window(last_score, last_score_count, idx, pre_score)
+            no_descent = (last_score_count[idx] >= last_score.size(1)) & (newest >= oldest)
+            if no_descent.any():
                 # log.info('FAIL: No Descent, Stop iteration')
-                return False, query_num, adv_images
+                done[idx[no_descent]] = True
+            idx, pre_score = idx[~no_descent], pre_score[~no_descent]
+            if idx.size(0) == 0:
+                continue
 
             # Annealing max learning rate
-            last_p.append(pre_score)
-            last_p = last_p[-20:]
-            if last_p[-1] <= last_p[0] and len(last_p) == 20:
-                if cur_lr > self.min_lr:
-                    # print("[log] Annealing max_lr")
-                    cur_lr = max(cur_lr / 2., self.min_lr)
-                last_p = []
+            oldest, newest = self.push_window(last_p, last_p_count, idx, pre_score)
+            anneal_idx = idx[(last_p_count[idx] >= last_p.size(1)) & (newest <= oldest)]
+            cur_lr[anneal_idx] = torch.clamp(cur_lr[anneal_idx] / 2., min=self.min_lr)
+            last_p_count[anneal_idx] = 0
             # tentative_directions is signed gradient (Linf) or normalized gradient (L2) according to args.norm
-            tentative_directions = self.directions_generator(adv_images).cuda()
+            tentative_directions = self.directions_generator(adv_images[idx], idx).cuda()
             group_gen.initialize(tentative_directions)
 
-            l, g = self.sim_rectification_vector(target_model, adv_images, tentative_directions, self.sample_per_draw, self.sigma,
-                                            ori_class, self.rank_transform, self.sub_num_sample, group_gen, untargeted=True)
-            query_num += self.sample_per_draw
-            if l is None and g is None:
+            l, g, valid = self.sim_rectification_vector(target_model, adv_images[idx], tentative_directions,
+                                                        self.sample_per_draw, self.sigma, true_labels[idx],
+                                                        self.rank_transform, self.sub_num_sample, group_gen, untargeted=True)
+            query_num[idx] += self.sample_per_draw
+            idx, tentative_directions, g = idx[valid], tentative_directions[valid], g[valid]
+            if idx.size(0) == 0:
                 continue
 
             # Rectify tentative perturabtions
-            assert g.size(0) == len(group_gen), 'rectification vector size error!'
+            assert g.size(1) == len(group_gen), 'rectification vector size error!'
             rectified_directions = group_gen.apply_group_change(tentative_directions, torch.sign(g) if self.norm == "linf" else g)
-            proposed_adv_images = adv_images
+            proposed_adv_images = adv_images[idx]
             assert proposed_adv_images.size() == rectified_directions.size(), 'rectification error!'
 
-            proposed_adv_images = image_step(proposed_adv_images, rectified_directions, cur_lr)
-            proposed_adv_images = proj_step(proposed_adv_images)
+            proposed_adv_images = image_step(proposed_adv_images, rectified_directions, cur_lr[idx])
+            proposed_adv_images = proj_maker(images[idx], self.eps)(proposed_adv_images)
             proposed_adv_images = torch.clamp(proposed_adv_images, 0., 1.)
-            adv_images = proposed_adv_images.clone()
-        return False, query_num, adv_images
+            adv_images[idx] = proposed_adv_images
+        return is_success, query_num, adv_images
 
     def attack_all_images(self, args, arch_name, target_model, result_dump_path):
         while target_model.input_size[-1] % self.image_split != 0:
             args.image_split = args.image_split + 1
             self.image_split = args.image_split
         for batch_index, data_tuple in enumerate(self.dataset_loader):
-            selected = torch.arange(batch_index,
-                                    min(batch_index + 1, self.total_images))
+            selected = torch.arange(batch_index * self.batch_size,
+                                    min((batch_index + 1) * self.batch_size, self.total_images))
             if args.dataset == "ImageNet":
                 if target_model.input_size[-1] >= 299:
                     images, true_labels = data_tuple[1], data_tuple[2]
@@ -431,17 +478,17 @@ class VBADAttack(object):
                 adv_logit = target_model(adv_images)
             # adv_pred = adv_logit.argmax(dim=1)
             adv_prob = F.softmax(adv_logit, dim=1)
-            not_done.fill_(1.0 - float(is_success))
+            not_done = 1.0 - is_success.float()
             # if args.targeted:
             #     not_done = not_done * (1 - adv_pred.eq(target_labels).float()).float()  # not_done初始化为 correct, shape = (batch_size,)
             # else:
             #     not_done = not_done * adv_pred.eq(true_labels).float()
             success = (1 - not_done) * correct
             success_query = success * query.cuda()
-            not_done_prob = adv_prob[torch.arange(1), true_labels] * not_done
+            not_done_prob = adv_prob[torch.arange(images.size(0)), true_labels] * not_done
 
-            log.info('Attacking {}-th image, query {}, success: {}'.format(
-                batch_index,  int(query.min().item()), is_success)
+            log.info('Attacking image {} - {} / {}, step {}'.format(
+                batch_index * self.batch_size, (batch_index + 1) * self.batch_size, self.total_images, int(query.max().item()))
             )
             log.info('        correct: {:.4f}'.format(correct.mean().item()))
             log.info('       not_done: {:.4f}'.format(not_done[correct.byte()].mean().item()))
@@ -504,8 +551,10 @@ def get_args_parse():
     parser.add_argument('--sample_per_draw', type=int, default=50, help='Number of samples used for NES')
     parser.add_argument('--image_split', type=int, default=8)
     parser.add_argument('--sub_num_sample', type=int, default=10,
-                        help='Number of samples processed each time. Adjust this number if the gpu memory is limited.'
+                        help='Number of samples of each image processed each time. Adjust this number if the gpu memory is limited.'
                              'This number should be even and sample_per_draw can be divisible by it.')
+    parser.add_argument('--batch_size', type=int, default=100,
+                        help='Number of images attacked together, each forward has batch_size * sub_num_sample images.')
     parser.add_argument('--attack_defense', action="store_true")
     parser.add_argument('--defense_model', type=str, default=None)
     parser.add_argument('--dataset',type=str, required=True)
@@ -45,15 +45,18 @@ class TentativePerturbationGenerator():
                 self.target_feature.append(r.view((output_size[0], -1)))
 
     # vid shape: [num_frames, c, w, h]
-    def create_adv_directions(self, vid, random=True):
+    # frame_index: the rows of target_feature that belong to vid (e.g. the images that are not done), default is all rows
+    def create_adv_directions(self, vid, frame_index=None, random=True):
         vid = vid.clone().cuda(self.device)
         assert hasattr(self, 'target'), 'Error, AdvDirectionCreator\' mode unset'
+        if frame_index is None:
+            frame_index = torch.arange(vid.size(0))
         start_idx = 0
         adv_directions = []
         part_size = self.part_size
         while start_idx < vid.size(0):
             adv_directions.append(self.backpropagate2frames(vid[start_idx:min(start_idx + part_size, vid.size(0))],
-                                                            start_idx, start_idx + part_size, random))
+                                                            frame_index[start_idx:start_idx + part_size], random))
             start_idx += part_size
         adv_directions = torch.cat(adv_directions, 0)
         return adv_directions
@@ -64,7 +67,7 @@ class TentativePerturbationGenerator():
         norm_vec += (norm_vec == 0).float() * 1e-8
         return norm_vec
 
-    def backpropagate2frames(self, part_vid, start_idx, end_idx, random):
+    def backpropagate2frames(self, part_vid, part_index, random):
         part_vid.requires_grad = True
         processed_vid = part_vid.clone()
         if self.preprocess:
@@ -75,23 +78,21 @@ class TentativePerturbationGenerator():
             processed_vid = processed_vid.sub_(mean).div_(std)
 
         for idx, extractor in enumerate(self.extractors):
-            perturb_loss = 0
+            # the MSE loss of each frame is averaged over its own features and then summed over frames,
+            # so the direction of one frame does not depend on how many frames are processed together.
             o = extractor(processed_vid)[0]
             o = o.view((o.size(0), -1))
             if self.target:
+                target_feature = self.target_feature[idx][part_index.to(o.device)]
                 if random:
-                    mask = torch.rand_like(o) <= self.random_mask
-                    perturb_loss += nn.MSELoss(reduction='mean')(torch.masked_select(o, mask),
-                                                                             torch.masked_select(
-                                                                                 self.target_feature[idx][
-                                                                                 start_idx:end_idx], mask))
+                    mask = (torch.rand_like(o) <= self.random_mask).float()
+                    perturb_loss = (((o - target_feature) ** 2 * mask).sum(1) / mask.sum(1).clamp(min=1)).sum()
                 else:
-                    perturb_loss += nn.MSELoss(reduction='mean')(o, self.target_feature[idx][
-                                                                                start_idx:end_idx])
+                    perturb_loss = ((o - target_feature) ** 2).mean(1).sum()
             else:
                 r = torch.randn_like(o) * self.scale + self.translate
                 r = torch.where(r >= 0, r, -r)
-                perturb_loss += nn.MSELoss(reduction='mean')(o, r)
+                perturb_loss = ((o - r) ** 2).mean(1).sum()
 
             perturb_loss.backward()
             extractor.zero_grad()
@@ -101,5 +102,5 @@ class TentativePerturbationGenerator():
             grad = part_vid.grad.clone()
         return grad
 
-    def __call__(self, vid):
-        return self.create_adv_directions(vid)
+    def __call__(self, vid, frame_index=None):
+        return self.create_adv_directions(vid, frame_index)
@@ -12,7 +12,7 @@ from torchvision import  transforms
 from config import PY_ROOT
 from dataset.standard_model import StandardModel
 import math
-from adversarial_defense.adversarial_train.pgd import xent_loss
+from adversarial_defense.training_engine import DefenseTrainer, PGDStep, FreeStep, step_decay_lr
 from dataset.dataset_loader_maker import DataLoaderMaker
 
 def initialize_weights(module):
@@ -43,11 +43,11 @@ parser.add_argument('--momentum', type=float, default=0.9, metavar='M',
                     help='SGD momentum')
 parser.add_argument('--no-cuda', action='store_true', default=False,
                     help='disables CUDA training')
-parser.add_argument('--epsilon', default=8/255.0,
+parser.add_argument('--epsilon', default=8/255.0, type=float,
                     help='perturbation')
-parser.add_argument('--num-steps', default=10,
+parser.add_argument('--num-steps', default=10, type=int,
                     help='perturb number of steps')
-parser.add_argument('--step-size', default=0.007,
+parser.add_argument('--step-size', default=0.007, type=float,
                     help='perturb step size')
 parser.add_argument('--seed', type=int, default=1, metavar='S',
                     help='random seed (default: 1)')
@@ -60,6 +60,16 @@ parser.add_argument('--save-freq', '-s', default=1, type=int, metavar='N',
 parser.add_argument('--dataset', required=True, type=str, help='dataset')  # concat cascade
 parser.add_argument('-a', '--arch', type=str, required=True, help="The arch used to generate adversarial images for testing")
 parser.add_argument('--gpu',type=int, required=True)
+parser.add_argument('--train-mode', default='pgd', type=str, choices=['pgd', 'replay'],
+                    help='pgd: num-steps PGD iterations before each update, replay: each batch is replayed '
+                         'replays times, one backward updates both the weights and the perturbation')
+parser.add_argument('--replays', default=8, type=int,
+                    help='the number of replays of each batch in the replay mode, the number of passes over the '
+                         'training set is epochs / replays')
+parser.add_argument('--amp', action='store_true',
+                    help='mixed precision training (float16 on GPU, bfloat16 on CPU)')
+parser.add_argument('--channels-last', action='store_true',
+                    help='use the channels_last memory format')
 args = parser.parse_args()
 os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
 os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
@@ -83,104 +93,36 @@ train_loader = DataLoaderMaker.get_imgid_img_label_data_loader(args.dataset, arg
 test_loader = DataLoaderMaker.get_imgid_img_label_data_loader(args.dataset, args.batch_size, False, seed=1234)
 
 
-def train(args, model, device, train_loader, optimizer, epoch):
-    model.train()
-    for batch_idx, (_, data, target) in enumerate(train_loader):
-        data, target = data.to(device), target.to(device)
-
-        optimizer.zero_grad()
-
-        # calculate robust loss
-        loss = xent_loss(model=model,
-                           x_natural=data,
-                           y=target,
-                           optimizer=optimizer,
-                           step_size=args.step_size,
-                           epsilon=args.epsilon,
-                           perturb_steps=args.num_steps,
-                           )
-        loss.backward()
-        optimizer.step()
-
-        # print progress
-        if batch_idx % args.log_interval == 0:
-            print('Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}'.format(
-                epoch, batch_idx * len(data), len(train_loader.dataset),
-                       100. * batch_idx / len(train_loader), loss.item()))
-
-
-def eval_train(model, device, train_loader):
-    model.eval()
-    train_loss = 0
-    correct = 0
-    with torch.no_grad():
-        for _, data, target in train_loader:
-            data, target = data.to(device), target.to(device)
-            output = model(data)
-            train_loss += F.cross_entropy(output, target, size_average=False).item()
-            pred = output.max(1, keepdim=True)[1]
-            correct += pred.eq(target.view_as(pred)).sum().item()
-    train_loss /= len(train_loader.dataset)
-    print('Training: Average loss: {:.4f}, Accuracy: {}/{} ({:.0f}%)'.format(
-        train_loss, correct, len(train_loader.dataset),
-        100. * correct / len(train_loader.dataset)))
-    training_accuracy = correct / len(train_loader.dataset)
-    return train_loss, training_accuracy
-
-
-def eval_test(model, device, test_loader):
-    model.eval()
-    test_loss = 0
-    correct = 0
-    with torch.no_grad():
-        for _, data, target in test_loader:
-            data, target = data.to(device), target.to(device)
-            output = model(data)
-            test_loss += F.cross_entropy(output, target, size_average=False).item()
-            pred = output.max(1, keepdim=True)[1]
-            correct += pred.eq(target.view_as(pred)).sum().item()
-    test_loss /= len(test_loader.dataset)
-    print('Test: Average loss: {:.4f}, Accuracy: {}/{} ({:.0f}%)'.format(
-        test_loss, correct, len(test_loader.dataset),
-        100. * correct / len(test_loader.dataset)))
-    test_accuracy = correct / len(test_loader.dataset)
-    return test_loss, test_accuracy
-
-
-def adjust_learning_rate(optimizer, epoch):
-    """decrease the learning rate"""
-    lr = args.lr
-    if epoch >= 75:
-        lr = args.lr * 0.1
-    if epoch >= 90:
-        lr = args.lr * 0.01
-    if epoch >= 100:
-        lr = args.lr * 0.001
-    for param_group in optimizer.param_groups:
-        param_group['lr'] = lr
-
-
 def main():
     model = StandardModel(args.dataset, args.arch, no_grad=False, load_pretrained=False)
-    model.cuda()
-    model.train()
-    device = torch.device("cuda")
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
     optimizer = optim.SGD(model.parameters(), lr=args.lr, momentum=args.momentum, weight_decay=args.weight_decay)
+    if args.train_mode == 'replay':
+        attack = FreeStep(args.epsilon, args.epsilon, args.replays)
+        # the same number of weight updates as args.epochs epochs of standard training
+        epochs, epoch_scale = int(math.ceil(args.epochs / args.replays)), args.replays
+    else:
+        attack = PGDStep(args.epsilon, args.step_size, args.num_steps)
+        epochs, epoch_scale = args.epochs, 1
+    eval_attack = PGDStep(args.epsilon, args.step_size, args.num_steps)
+    trainer = DefenseTrainer(model, optimizer, attack, device, amp=args.amp, channels_last=args.channels_last,
+                             log_interval=args.log_interval)
     model_path = '{}/train_pytorch_model/adversarial_train/adv_train/{}@{}@epoch_{}@batch_{}.pth.tar'.format(
         PY_ROOT, args.dataset, args.arch, args.epochs, args.batch_size)
     os.makedirs(os.path.dirname(model_path), exist_ok=True)
     print("After trained, the model will save to {}".format(model_path))
-    for epoch in range(1, args.epochs + 1):
+    for epoch in range(1, epochs + 1):
         # adjust learning rate for SGD
-        adjust_learning_rate(optimizer, epoch)
+        step_decay_lr(optimizer, args.lr, epoch * epoch_scale)
 
         # adversarial training
-        train(args, model, device, train_loader, optimizer, epoch)
+        trainer.train_epoch(train_loader, epoch)
 
         # evaluation on natural examples
         print('================================================================')
-        eval_train(model, device, train_loader)
-        eval_test(model, device, test_loader)
+        trainer.evaluate(train_loader, "Training")
+        trainer.evaluate(test_loader, "Test")
+        trainer.evaluate(test_loader, "Test PGD-{}".format(args.num_steps), attack=eval_attack)
         print('================================================================')
 
         # save checkpoint
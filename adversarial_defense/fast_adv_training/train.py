@@ -13,6 +13,7 @@ from config import PY_ROOT
 
 sys.path.append('../cifar10-fast/')
 from adversarial_defense.fast_adv_training.utils import *
+from adversarial_defense.training_engine import DefenseTrainer, NoAttackStep, FGSMStep, PGDStep, FreeStep
 from dataset.dataset_loader_maker import DataLoaderMaker
 from dataset.standard_model import StandardModel
 
@@ -31,10 +32,6 @@ upper_limit = ((1 - mu)/ std)
 lower_limit = ((0 - mu)/ std)
 
 
-def clamp(X, lower_limit, upper_limit):
-    return torch.max(torch.min(X, upper_limit), lower_limit)
-
-
 def initialize_weights(module):
     if isinstance(module, nn.Conv2d):
         n = module.kernel_size[0] * module.kernel_size[1] * module.out_channels
@@ -48,25 +45,6 @@ def initialize_weights(module):
         module.bias.data.zero_()
 
 
-def attack_pgd(model, X, y, epsilon, alpha, attack_iters, restarts, opt):
-    delta = torch.zeros_like(X).cuda()
-    delta[:, 0, :, :].uniform_(-epsilon[0][0][0].item(), epsilon[0][0][0].item())
-    delta[:, 1, :, :].uniform_(-epsilon[1][0][0].item(), epsilon[1][0][0].item())
-    delta[:, 2, :, :].uniform_(-epsilon[2][0][0].item(), epsilon[2][0][0].item())
-    delta.requires_grad = True
-    for _ in range(attack_iters):
-        output = model(clamp(X + delta, lower_limit, upper_limit))
-        loss = F.cross_entropy(output, y)
-        with amp.scale_loss(loss, opt) as scaled_loss:
-            scaled_loss.backward()
-        grad = delta.grad.detach()
-        delta.data = clamp(delta + alpha * torch.sign(grad), -epsilon, epsilon)
-        delta.grad.zero_()
-    return delta.detach()
-
-
-
-
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--batch-size', default=128, type=int)
@@ -86,6 +64,8 @@ def get_args():
     parser.add_argument('--seed', default=0, type=int)
     parser.add_argument('--overfit-check', action='store_true')
     parser.add_argument('--gpu', default=0, type=int, help='GPU id to use.')
+    parser.add_argument('--no-amp', action='store_true', help='train in float32 instead of mixed precision')
+    parser.add_argument('--channels-last', action='store_true', help='use the channels_last memory format')
     return parser.parse_args()
 
 
@@ -111,21 +91,18 @@ def main():
 
     model = StandardModel(args.dataset, args.arch, no_grad=False)
     model.apply(initialize_weights)
-    model.cuda()
-    model.train()
 
     opt = torch.optim.SGD(model.parameters(), lr=args.lr_max, momentum=0.9, weight_decay=5e-4)
 
-    model, opt = amp.initialize(model, opt, opt_level="O2", loss_scale=1.0, master_weights=False)
-
-    criterion = nn.CrossEntropyLoss()
-
-    if args.attack == 'free':
-        delta = torch.zeros(args.batch_size, 3, 32, 32).cuda()
-        delta.requires_grad = True
-    elif args.attack == 'fgsm' and args.fgsm_init == 'previous':
-        delta = torch.zeros(args.batch_size, 3, 32, 32).cuda()
-        delta.requires_grad = True
+    if args.attack == 'pgd':
+        attack = PGDStep(epsilon, pgd_alpha, args.attack_iters, init="uniform", clip_min=lower_limit,
+                         clip_max=upper_limit, attack_in_eval_mode=False)
+    elif args.attack == 'fgsm':
+        attack = FGSMStep(epsilon, args.fgsm_alpha, init=args.fgsm_init, clip_min=lower_limit, clip_max=upper_limit)
+    elif args.attack == 'free':
+        attack = FreeStep(epsilon, epsilon, args.attack_iters, clip_min=lower_limit, clip_max=upper_limit)
+    elif args.attack == 'none':
+        attack = NoAttackStep()
 
     if args.attack == 'free':
         assert args.epochs % args.attack_iters == 0
@@ -144,82 +121,24 @@ def main():
             else:
                 return args.lr_max / 100.
 
+    trainer = DefenseTrainer(model, opt, attack, torch.device("cuda"), amp=not args.no_amp,
+                             channels_last=args.channels_last, grad_clip=0.5, lr_schedule=lr_schedule,
+                             log_interval=0)
+    overfit_check_attack = PGDStep(epsilon, pgd_alpha, args.attack_iters, init="uniform", clip_min=lower_limit,
+                                   clip_max=upper_limit, attack_in_eval_mode=False)
     prev_robust_acc = 0.
     logger.info('Epoch \t Time \t LR \t \t Train Loss \t Train Acc')
     for epoch in range(epochs):
         start_time = time.time()
-        train_loss = 0
-        train_acc = 0
-        train_n = 0
-        for i, (X, y) in enumerate(train_loader):
-            X = X.cuda().float()
-            y = y.cuda().long()
-            if i == 0:
-                first_batch = X, y
-            lr = lr_schedule(epoch + (i + 1) / len(train_loader))
-            opt.param_groups[0].update(lr=lr)
-
-            if args.attack == 'pgd':
-                delta = attack_pgd(model, X, y, epsilon, pgd_alpha, args.attack_iters, args.restarts, opt)
-
-            elif args.attack == 'fgsm':
-                if args.fgsm_init == 'zero':
-                    delta = torch.zeros_like(X, requires_grad=True)
-                    delta.requires_grad = True
-                elif args.fgsm_init == 'random':
-                    delta = torch.zeros_like(X).cuda()
-                    delta[:, 0, :, :].uniform_(-epsilon[0][0][0].item(), epsilon[0][0][0].item())
-                    delta[:, 1, :, :].uniform_(-epsilon[1][0][0].item(), epsilon[1][0][0].item())
-                    delta[:, 2, :, :].uniform_(-epsilon[2][0][0].item(), epsilon[2][0][0].item())
-                    delta.requires_grad = True
-                elif args.fgsm_init == 'previous':
-                    delta.requires_grad = True
-                output = model(X + delta[:X.size(0)])
-                loss = F.cross_entropy(output, y)
-                with amp.scale_loss(loss, opt) as scaled_loss:
-                    scaled_loss.backward()
-                grad = delta.grad.detach()
-                delta.data = clamp(delta + args.fgsm_alpha * epsilon * torch.sign(grad), -epsilon, epsilon)
-                delta = delta.detach()
-
-            elif args.attack == 'free':
-                delta.requires_grad = True
-                for j in range(args.attack_iters):
-                    epoch_iters = epoch * args.attack_iters + (i * args.attack_iters + j + 1) / len(train_loader)
-                    lr = lr_schedule(epoch_iters)
-                    opt.param_groups[0].update(lr=lr)
-                    output = model(clamp(X + delta[:X.size(0)], lower_limit, upper_limit))
-                    loss = F.cross_entropy(output, y)
-                    opt.zero_grad()
-                    with amp.scale_loss(loss, opt) as scaled_loss:
-                        scaled_loss.backward()
-                    grad = delta.grad.detach()
-                    delta.data = clamp(delta + epsilon * torch.sign(grad), -epsilon, epsilon)
-                    nn.utils.clip_grad_norm_(model.parameters(), 0.5)
-                    opt.step()
-                    delta.grad.zero_()
-            elif args.attack == 'none':
-                delta = torch.zeros_like(X)
-
-            output = model(clamp(X + delta[:X.size(0)], lower_limit, upper_limit))
-            loss = criterion(output, y)
-            if args.attack != 'free':
-                opt.zero_grad()
-                with amp.scale_loss(loss, opt) as scaled_loss:
-                    scaled_loss.backward()
-                nn.utils.clip_grad_norm_(model.parameters(), 0.5)
-                opt.step()
-
-            train_loss += loss.item() * y.size(0)
-            train_acc += (output.max(1)[1] == y).sum().item()
-            train_n += y.size(0)
+        train_loss, train_acc = trainer.train_epoch(train_loader, epoch)
+        lr = opt.param_groups[0]['lr']
 
         if args.overfit_check:
             # Check current PGD robustness of model using random minibatch
-            X, y = first_batch['input'], first_batch['target']
-            pgd_delta = attack_pgd(model, X, y, epsilon, pgd_alpha, args.attack_iters, args.restarts, opt)
+            X, y = trainer.prepare_batch(next(iter(train_loader)))
+            X_adv = overfit_check_attack.perturb(trainer, X, y)
             with torch.no_grad():
-                output = model(clamp(X + pgd_delta[:X.size(0)], lower_limit, upper_limit))
+                output = trainer.forward(X_adv)
             robust_acc = (output.max(1)[1] == y).sum().item() / y.size(0)
             if robust_acc - prev_robust_acc < -0.5:
                 break
@@ -228,7 +147,7 @@ def main():
 
         train_time = time.time()
         logger.info('%d \t %.1f \t %.4f \t %.4f \t %.4f',
-            epoch, train_time - start_time, lr, train_loss/train_n, train_acc/train_n)
+            epoch, train_time - start_time, lr, train_loss, train_acc)
     torch.save(best_state_dict, model_path)
     logger.info('Total time: %.4f', train_time - start_start_time)
 
@@ -1,4 +1,3 @@
-import apex.amp as amp
 import torch
 import torch.nn.functional as F
 from torchvision import datasets, transforms
@@ -67,11 +66,7 @@ def attack_pgd(model, X, y, epsilon, alpha, attack_iters, restarts, opt=None):
             if len(index[0]) == 0:
                 break
             loss = F.cross_entropy(output, y)
-            if opt is not None:
-                with amp.scale_loss(loss, opt) as scaled_loss:
-                    scaled_loss.backward()
-            else:
-                loss.backward()
+            loss.backward()  # opt is kept for the old callers, the sign of the gradient does not need loss scaling
             grad = delta.grad.detach()
             d = delta[index[0], :, :, :]
             g = grad[index[0], :, :, :]
@@ -1,4 +1,5 @@
 import argparse
+import math
 import os
 import sys
 import time
@@ -9,6 +10,7 @@ from torchvision.transforms import transforms
 
 sys.path.append("/home1/machen/meta_perturbations_black_box_attack")
 from adversarial_defense.model.feature_defense_model import FeatureDefenseModel
+from adversarial_defense.training_engine import DefenseTrainer, FreeStep, PGDStep
 
 from advertorch.attacks import LinfPGDAttack
 import glog as log
@@ -38,7 +40,16 @@ def parse_args():
     parser.add_argument('--weight_decay', dest='weight_decay', type=float, default=1e-4, help='weight_decay')
     parser.add_argument('--momentum', dest='momentum', type=float, default=0.9, help='momentum')
     parser.add_argument("--dataset", type=str, required=True)
-    parser.add_argument("--test_interval",type=int, default=50)
+    parser.add_argument("--test_interval",type=int, default=50, help="the epochs between two PGD-30 tests of the pgd mode")
+    parser.add_argument("--train_mode", type=str, default="pgd", choices=["pgd", "replay"],
+                        help="pgd: 30 PGD iterations before each update, replay: each batch is replayed replays times, "
+                             "one backward updates both the weights and the perturbation")
+    parser.add_argument("--replays", type=int, default=8,
+                        help="the number of replays of each batch in the replay mode, "
+                             "the number of passes over the training set is epochs / replays")
+    parser.add_argument("--eval_pgd_steps", type=int, default=10,
+                        help="the PGD iterations of the test accuracy evaluated after each epoch of the replay mode, "
+                             "the best model is selected by it")
     args = parser.parse_args()
     return args
 
@@ -132,10 +143,10 @@ def main():
     log.info('Command line is: {}'.format(' '.join(sys.argv)))
     log.info('Called with args:')
     print_args(args)
-    model_path = '{}/train_pytorch_model/adversarial_train/feature_denoise/pgd_adv_train_{}@{}_{}_{}.pth.tar'.format(
-        PY_ROOT, args.dataset, args.arch, args.filter_type, args.ksize)
-    best_model_path = '{}/train_pytorch_model/adversarial_train/feature_denoise/best_pgd_adv_train_{}@{}_{}_{}.pth.tar'.format(
-        PY_ROOT, args.dataset, args.arch, args.filter_type, args.ksize)
+    model_path = '{}/train_pytorch_model/adversarial_train/feature_denoise/{}_adv_train_{}@{}_{}_{}.pth.tar'.format(
+        PY_ROOT, args.train_mode, args.dataset, args.arch, args.filter_type, args.ksize)
+    best_model_path = '{}/train_pytorch_model/adversarial_train/feature_denoise/best_{}_adv_train_{}@{}_{}_{}.pth.tar'.format(
+        PY_ROOT, args.train_mode, args.dataset, args.arch, args.filter_type, args.ksize)
 
     model = FeatureDefenseModel(args.dataset, args.arch, no_grad=False)
     model = model.cuda()
@@ -158,8 +169,15 @@ def main():
     else:
         criterion = nn.CrossEntropyLoss().cuda()
     optimizer = optim.SGD(model.parameters(), lr=args.learning_rate, weight_decay=args.weight_decay, momentum=args.momentum, nesterov=True)
+    epochs = args.epochs
+    if args.train_mode == "replay":
+        # the same number of weight updates as args.epochs epochs of standard training
+        epochs = int(math.ceil(args.epochs / args.replays))
+        trainer = DefenseTrainer(model, optimizer, FreeStep(0.031372, 0.031372, args.replays),
+                                 torch.device("cuda"), log_interval=0, log_fn=log.info)
+        eval_attack = PGDStep(0.031372, 0.01, args.eval_pgd_steps, init="uniform")
     scheduler = MultiStepLR(optimizer,
-                            milestones=[int(args.epochs / 2), int(args.epochs * 3 / 4), int(args.epochs * 7 / 8)],
+                            milestones=[int(epochs / 2), int(epochs * 3 / 4), int(epochs * 7 / 8)],
                             gamma=0.1)
 
     total, correct, train_loss = 0, 0, 0
@@ -168,8 +186,8 @@ def main():
     log.info(
         "basic model: {}, whether denoising: {}, filter type: {}, kernel size: {}".format(
             args.arch, args.whether_denoising, args.filter_type, args.ksize))
-    for epoch in range(resume_epoch, args.epochs):
-        if epoch % args.test_interval == 0:
+    for epoch in range(resume_epoch, epochs):
+        if args.train_mode == "pgd" and epoch % args.test_interval == 0:  # the replay mode is tested after each epoch
             model.eval()
             test_total, test_correct, test_robustness = 0, 0, 0
             attack = LinfPGDAttack(model, loss_fn=nn.CrossEntropyLoss(reduction="sum"), eps=0.031372,nb_iter=30,
@@ -198,6 +216,26 @@ def main():
                 best_epoch, best_test_clean_acc, best_test_adv_acc))
             log.info("Epoch:{} clean_test_acc: {:.3f}  adv_test_acc: {:.3f} during {} seconds".format(epoch, test_acc, test_adv_acc, testset_total_time))
 
+        if args.train_mode == "replay":
+            start_time = time.time()
+            train_adv_loss, train_adv_acc = trainer.train_epoch(train_loader, epoch)
+            scheduler.step(epoch)
+            trainset_total_time = time.time() - start_time
+            log.info("Epoch:{} train_adv_loss: {:.3f} adv_train_acc: {:.3f}  Consumed time:{}".format(
+                epoch, train_adv_loss, train_adv_acc, trainset_total_time))
+            _, test_acc = trainer.evaluate(test_loader, "Epoch:{} clean test".format(epoch))
+            _, test_adv_acc = trainer.evaluate(test_loader, "Epoch:{} PGD-{} test".format(epoch, args.eval_pgd_steps),
+                                               attack=eval_attack)
+            if test_adv_acc > best_test_adv_acc:
+                best_epoch = epoch
+                best_test_adv_acc = test_adv_acc
+                best_test_clean_acc = test_acc
+                torch.save({"state_dict": model.state_dict(), "epoch": epoch + 1}, best_model_path)
+            log.info("Present best adversarial model ----- best epoch: {} clean_test_acc: {:.3f} adv_test_acc: {:.3f}".format(
+                best_epoch, best_test_clean_acc, best_test_adv_acc))
+            torch.save({"state_dict": model.state_dict(), "epoch": epoch + 1}, model_path)
+            continue
+
         # Test and Train on the trainset
         train_total, train_correct, train_robustness = 0, 0, 0
         train_clean_loss, train_adv_loss, train_loss = 0, 0, 0
@@ -130,6 +130,14 @@ class Attack_FeaScatter(nn.Module):
         ) else config['box_type']
         self.ls_factor = 0.1 if 'ls_factor' not in config.keys(
         ) else config['ls_factor']
+        self.ot_niter = 100 if 'ot_niter' not in config.keys(
+        ) else config['ot_niter']
+        self.ot_thresh = 1e-1 if 'ot_thresh' not in config.keys(
+        ) else config['ot_thresh']
+        self.ot_check_every = 1 if 'ot_check_every' not in config.keys(
+        ) else config['ot_check_every']
+        self.ot_warm_start = True if 'ot_warm_start' not in config.keys(
+        ) else config['ot_warm_start']
 
         print(config)
 
@@ -168,11 +176,12 @@ class Attack_FeaScatter(nn.Module):
         logits_pred_nat = aux_net(inputs)
 
         num_classes = logits_pred_nat.size(1)
-        y_gt = one_hot_tensor(targets, num_classes, device)
+        y_gt = one_hot_tensor(targets, num_classes, inputs.device)
 
         loss_ce = softCrossEntropy()
 
         iter_num = self.num_steps
+        potentials = None  # the dual potentials of the previous step, the natural logits are the same in all steps
 
         for i in range(iter_num):
             x.requires_grad_()
@@ -182,9 +191,12 @@ class Attack_FeaScatter(nn.Module):
 
             logits_pred = aux_net(x)
 
-            ot_loss = ot.sinkhorn_loss_joint_IPOT(1, 0.00, logits_pred_nat,
-                                                  logits_pred, None, None,
-                                                  0.01, m, n)
+            ot_loss, potentials = ot.sinkhorn_loss_joint_IPOT(1, 0.00, logits_pred_nat,
+                                                              logits_pred, None, None,
+                                                              0.01, m, n, niter=self.ot_niter, thresh=self.ot_thresh,
+                                                              check_every=self.ot_check_every,
+                                                              warm_start=potentials if self.ot_warm_start else None,
+                                                              return_potentials=True)
 
             aux_net.zero_grad()
             adv_loss = ot_loss
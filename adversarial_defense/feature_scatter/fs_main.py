@@ -79,6 +79,13 @@ parser.add_argument('--num_classes', type=int, help='num classes')
 parser.add_argument('--image_size', type=int, help='image size')
 parser.add_argument('--dataset', required=True, type=str, help='dataset')  # concat cascade
 parser.add_argument('-a', '--arch', type=str, required=True, help="The arch used to generate adversarial images for testing")
+parser.add_argument('--ot_niter', default=100, type=int, help='max number of sinkhorn iterations')
+parser.add_argument('--ot_thresh', default=1e-1, type=float,
+                    help='stop the sinkhorn iterations when the L1 change of the dual potential u is below this threshold')
+parser.add_argument('--ot_check_every', default=1, type=int,
+                    help='test the sinkhorn stopping criterion every ot_check_every iterations')
+parser.add_argument('--no_ot_warm_start', action='store_true',
+                    help='do not reuse the dual potentials of the previous feature scatter step')
 args = parser.parse_args()
 os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
 os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
@@ -143,6 +150,10 @@ config_feature_scatter = {
     'step_size': 8.0 / 255 * 2,
     'random_start': True,
     'ls_factor': 0.5,
+    'ot_niter': args.ot_niter,
+    'ot_thresh': args.ot_thresh,
+    'ot_check_every': args.ot_check_every,
+    'ot_warm_start': not args.no_ot_warm_start,
 }
 
 if args.adv_mode.lower() == 'feature_scatter':
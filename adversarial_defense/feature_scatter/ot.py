@@ -6,92 +6,116 @@ OT using IPOT and Sinkhorn algorithm
 
 import torch
 import torch.nn as nn
-from torch.autograd import Variable
 
 
 def sinkhorn_loss_joint_IPOT(alpha, beta, x_feature, y_feature, x_label,
-                             y_label, epsilon, m, n):
-
+                             y_label, epsilon, m, n, niter=100, thresh=1e-1, check_every=1,
+                             warm_start=None, return_potentials=False):
+    """
+    The OT cost between x_feature and y_feature, shape = (..., m, d) and (..., n, d), a leading batch dimension solves
+    several independent problems at once.
+    :param warm_start: the potentials returned by the previous call (e.g. the previous feature scatter step)
+    :param return_potentials: also return the dual potentials of this call for the next warm start
+    """
     C_fea = get_cost_matrix(x_feature, y_feature)
     C = C_fea
-    T = sinkhorn(C, 0.01, 100)
+    T, potentials = sinkhorn(C, 0.01, niter, thresh=thresh, check_every=check_every, warm_start=warm_start,
+                             return_potentials=True)
     # T = IPOT(C, 1)
-    batch_size = C.size(0)
     cost_ot = torch.sum(T * C)
+    if return_potentials:
+        return cost_ot, potentials
     return cost_ot
 
 
-def sinkhorn(C, epsilon, niter=50, device='cuda'):
-    m = C.size(0)
-    n = C.size(1)
-    mu = Variable(1. / m * torch.FloatTensor(m).fill_(1).to('cuda'),
-                  requires_grad=False)
-    nu = Variable(1. / n * torch.FloatTensor(n).fill_(1).to('cuda'),
-                  requires_grad=False)
-
-    # Parameters of the Sinkhorn algorithm.
-    rho = 1  # (.5) **2          # unbalanced transport
-    tau = -.8  # nesterov-like acceleration
-    lam = rho / (rho + epsilon)  # Update exponent
-    thresh = 10**(-1)  # stopping criterion
+def marginal_violation(pi, mu, nu):
+    """
+    The L1 violation of the marginals of the transport plans pi, shape = (..., m, n), the max over the batch.
+    """
+    row_err = (pi.sum(-1) - mu).abs().sum(-1)
+    col_err = (pi.sum(-2) - nu).abs().sum(-1)
+    return torch.max(row_err, col_err).max()
+
+
+def sinkhorn(C, epsilon, niter=50, thresh=1e-1, check_every=1, warm_start=None, return_potentials=False):
+    """
+    Log-domain Sinkhorn iterations with uniform marginals on the device of C.
+    :param C: the cost matrices, shape = (..., m, n)
+    :param niter: the max number of iterations
+    :param thresh: stopping criterion, stop when the L1 change of u in one iteration is below thresh for all plans,
+                   None runs niter iterations
+    :param check_every: only test the stopping criterion every check_every iterations (each test syncs with the GPU)
+    :param warm_start: the dual potentials (u, v) of a previous call, shape = (..., m) and (..., n), ignored if the
+                       shape does not match C (e.g. the last batch of an epoch)
+    :return: the transport plans, shape = (..., m, n), and the detached dual potentials if return_potentials
+    """
+    m = C.size(-2)
+    n = C.size(-1)
+    mu = torch.full(C.shape[:-1], 1. / m, dtype=C.dtype, device=C.device)
+    nu = torch.full(C.shape[:-2] + (n,), 1. / n, dtype=C.dtype, device=C.device)
 
     # Elementary operations .....................................................................
-    def ave(u, u1):
-        "Barycenter subroutine, used by kinetic acceleration through extrapolation."
-        return tau * u + (1 - tau) * u1
-
     def M(u, v):
         "Modified cost for logarithmic updates"
         "$M_{ij} = (-c_{ij} + u_i + v_j) / \epsilon$"
-        return (-C + u.unsqueeze(1) + v.unsqueeze(0)) / epsilon
+        return (-C + u.unsqueeze(-1) + v.unsqueeze(-2)) / epsilon
 
-    def lse(A):
+    def lse(A, dim):
         "log-sum-exp"
-        return torch.log(torch.exp(A).sum(1, keepdim=True) +
-                         1e-6)  # add 10^-6 to prevent NaN
+        return torch.log(torch.exp(A).sum(dim) + 1e-6)  # add 10^-6 to prevent NaN
 
     # Actual Sinkhorn loop ......................................................................
-    u, v, err = 0. * mu, 0. * nu, 0.
-    actual_nits = 0  # to check if algorithm terminates because of threshold or max iterations reached
+    if warm_start is not None and warm_start[0].shape == mu.shape and warm_start[1].shape == nu.shape:
+        u, v = warm_start[0].to(C.device), warm_start[1].to(C.device)
+    else:
+        u, v = 0. * mu, 0. * nu
 
     for i in range(niter):
         u1 = u  # useful to check the update
-        u = epsilon * (torch.log(mu) - lse(M(u, v)).squeeze()) + u
-        v = epsilon * (torch.log(nu) - lse(M(u, v).t()).squeeze()) + v
-        # accelerated unbalanced iterations
-        # u = ave( u, lam * ( epsilon * ( torch.log(mu) - lse(M(u,v)).squeeze()   ) + u ) )
-        # v = ave( v, lam * ( epsilon * ( torch.log(nu) - lse(M(u,v).t()).squeeze() ) + v ) )
-        err = (u - u1).abs().sum()
-
-        actual_nits += 1
-        if (err < thresh).cpu().data.numpy():
-            break
-    U, V = u, v
-
-    pi = torch.exp(M(U, V))  # Transport plan pi = diag(a)*K*diag(b)
-    pi = pi.to('cuda').float()
+        u = epsilon * (torch.log(mu) - lse(M(u, v), -1)) + u
+        v = epsilon * (torch.log(nu) - lse(M(u, v), -2)) + v
+        if thresh is not None and (i + 1) % check_every == 0:
+            err = (u - u1).abs().sum(-1).max()
+            if err.item() < thresh:
+                break
+
+    pi = torch.exp(M(u, v)).float()  # Transport plan pi = diag(a)*K*diag(b)
+    if return_potentials:
+        return pi, (u.detach(), v.detach())
     return pi  # return the transport
 
 
-def IPOT(cost_matrix, beta=1, device='cuda'):
-    m = cost_matrix.size(0)
-    n = cost_matrix.size(1)
-    sigma = 1.0 / n * torch.ones([n, 1]).to(device)
-
-    T = torch.ones([m, n]).to(device)
+def IPOT(cost_matrix, beta=1, niter=50, tol=None, check_every=1, warm_start=None, return_potentials=False):
+    """
+    Inexact proximal point OT with 1 inner iteration on the device of cost_matrix.
+    :param cost_matrix: shape = (..., m, n)
+    :param tol: stop when the L1 violation of the marginals of all plans is below tol, None runs niter iterations
+    :param check_every: only test the stopping criterion every check_every iterations (each test syncs with the GPU)
+    :param warm_start: the (T, sigma) of a previous call, ignored if the shape does not match cost_matrix
+    :return: the transport plans, shape = (..., m, n), and the detached (T, sigma) if return_potentials
+    """
+    m = cost_matrix.size(-2)
+    n = cost_matrix.size(-1)
+    mu = torch.full(cost_matrix.shape[:-1], 1. / m, dtype=cost_matrix.dtype, device=cost_matrix.device)
+    nu = torch.full(cost_matrix.shape[:-2] + (n,), 1. / n, dtype=cost_matrix.dtype, device=cost_matrix.device)
+    if warm_start is not None and warm_start[0].shape == cost_matrix.shape:
+        T, sigma = warm_start[0].to(cost_matrix.device), warm_start[1].to(cost_matrix.device)
+    else:
+        T = torch.ones_like(cost_matrix)
+        sigma = nu.clone()
     A = torch.exp(-cost_matrix / beta)
 
-    for t in range(50):
-        # BUG: should be elementwise product, * in numpy
-        #Q = torch.mm(A, T)
+    for t in range(niter):
         Q = A * T  # Hardmard product
         for k in range(1):
-            delta = 1.0 / (m * torch.mm(Q, sigma))
-            sigma = 1.0 / (n * torch.mm(delta.t(), Q)).t()
-            #sigma = 1.0 / (n * torch.mv(Q, delta))
-        tmp = torch.mm(construct_diag(torch.squeeze(delta)), Q)
-        T = torch.mm(tmp, construct_diag(torch.squeeze(sigma)))
+            delta = 1.0 / (m * torch.matmul(Q, sigma.unsqueeze(-1)).squeeze(-1))
+            sigma = 1.0 / (n * torch.matmul(delta.unsqueeze(-2), Q).squeeze(-2))
+        T = delta.unsqueeze(-1) * Q * sigma.unsqueeze(-2)  # diag(delta) * Q * diag(sigma)
+        if tol is not None and (t + 1) % check_every == 0 and marginal_violation(T, mu, nu).item() < tol:
+            break
 
+    if return_potentials:
+        return T, (T.detach(), sigma.detach())
     return T
 
 
@@ -111,11 +135,11 @@ def cost_matrix_cos(x, y, p=2):
     # return the m*n sized cost matrix
     "Returns the matrix of $|x_i-y_j|^p$."
     # un squeeze differently so that the tensors can broadcast
-    # dim-2 (summed over) is the feature dim
-    x_col = x.unsqueeze(1)
-    y_lin = y.unsqueeze(0)
+    # the last dim (summed over) is the feature dim, x and y may have the same leading batch dims
+    x_col = x.unsqueeze(-2)
+    y_lin = y.unsqueeze(-3)
 
-    cos = nn.CosineSimilarity(dim=2, eps=1e-6)
+    cos = nn.CosineSimilarity(dim=-1, eps=1e-6)
     c = torch.clamp(1 - cos(x_col, y_lin), min=0)
 
     return c
\ No newline at end of file
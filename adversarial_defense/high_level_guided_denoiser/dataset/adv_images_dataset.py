@@ -1,3 +1,6 @@
+import json
+import os
+
 import numpy as np
 import torch
 from torch.utils.data import Dataset
@@ -5,43 +8,78 @@ from torch.utils.data import Dataset
 from config import IN_CHANNELS, IMAGE_SIZE, PY_ROOT
 
 
+def get_adv_images_paths(data_root_dir, dataset):
+    """
+    The files of the generated training set of the guided denoiser.
+    adv_images and clean_images are raw float32 memmaps of shape (N, C, H, W), labels is an int32 npy file,
+    progress is the sidecar written by script/generate_train_set.py (the old generator writes shape instead).
+    """
+    return {"adv_images": "{}/{}_adv_images.npy".format(data_root_dir, dataset),
+            "clean_images": "{}/{}_clean_images.npy".format(data_root_dir, dataset),
+            "labels": "{}/{}_labels.npy".format(data_root_dir, dataset),
+            "shape": "{}/{}_shape.txt".format(data_root_dir, dataset),
+            "progress": "{}/{}_progress.json".format(data_root_dir, dataset)}
+
+
 class AdvImagesDataset(Dataset):
     def __init__(self,  dataset):
         """
-        :param root: root path of gradients file
-        :param arch: the architecture name
-        :param batchsz: batch size of sets, not batch of imgs
-        :param n_way:
-        :param k_shot:
-        :param k_query: num of qeruy imgs per class
-        :param resize: resize to
+        The memmaps are opened once in each worker at the first read, index can be an int or a list of indexes,
+        the latter reads the whole batch in one fancy-indexed read of each memmap, use it with
+        DataLoader(dataset, sampler=BatchSampler(...), batch_size=None).
+        :param dataset: the dataset name
         """
         self.dataset = dataset
         self.num_channels = IN_CHANNELS[dataset]
         self.data_root_dir = "{}/data_adv_defense/guided_denoiser".format(PY_ROOT)
-        self.adv_images_path = "{}/{}_adv_images.npy".format(self.data_root_dir, dataset)
-        self.clean_images_path = "{}/{}_clean_images.npy".format(self.data_root_dir, dataset)
-        self.labels_path = "{}/{}_labels.npy".format(self.data_root_dir, dataset)
-        self.shape_path = "{}/{}_shape.txt".format(self.data_root_dir, dataset)
-        self.labels = np.load(self.labels_path)
-        with open(self.shape_path, "r") as file_obj:
-            self.shape = eval(file_obj.read().strip())
+        paths = get_adv_images_paths(self.data_root_dir, dataset)
+        self.adv_images_path = paths["adv_images"]
+        self.clean_images_path = paths["clean_images"]
+        self.labels_path = paths["labels"]
+        if os.path.exists(paths["progress"]):
+            # each model owns images_per_model records, only the written records are valid
+            with open(paths["progress"], "r") as file_obj:
+                progress = json.load(file_obj)
+            self.shape = tuple(progress["shape"])
+            images_per_model = progress["images_per_model"]
+            self.rows = np.concatenate([np.arange(model_index * images_per_model,
+                                                  model_index * images_per_model + progress["written"][model_name])
+                                        for model_index, model_name in enumerate(progress["model_names"])])
+        else:
+            with open(paths["shape"], "r") as file_obj:
+                self.shape = eval(file_obj.read().strip())
+            self.rows = np.arange(self.shape[0])
+        self.adv_images = None
+        self.clean_images = None
+        self.labels = None
+
+    def open_memmaps(self):
+        self.adv_images = np.memmap(self.adv_images_path, dtype='float32', mode='r', shape=self.shape)
+        self.clean_images = np.memmap(self.clean_images_path, dtype='float32', mode='r', shape=self.shape)
+        self.labels = np.load(self.labels_path, mmap_mode='r')
+
+    def __getstate__(self):
+        # the DataLoader workers open their own memmaps
+        state = self.__dict__.copy()
+        state["adv_images"] = state["clean_images"] = state["labels"] = None
+        return state
 
     def __len__(self):
-        return self.shape[0]
+        return self.rows.shape[0]
 
     def __getitem__(self, index):
-        with open(self.adv_images_path, "rb") as file_obj:
-            adv_image = np.memmap(file_obj, dtype='float32', mode='r', shape=(IN_CHANNELS[self.dataset],
-                                                                         IMAGE_SIZE[self.dataset][0],
-                                                                         IMAGE_SIZE[self.dataset][1]),
-                             offset=index * IN_CHANNELS[self.dataset] * IMAGE_SIZE[self.dataset][0] * \
-                                    IMAGE_SIZE[self.dataset][1] * 32 // 8)
-        with open(self.clean_images_path, "rb") as file_obj:
-            clean_image = np.memmap(file_obj, dtype='float32', mode='r', shape=(IN_CHANNELS[self.dataset],
-                                                                         IMAGE_SIZE[self.dataset][0],
-                                                                         IMAGE_SIZE[self.dataset][1]),
-                             offset=index * IN_CHANNELS[self.dataset] * IMAGE_SIZE[self.dataset][0] * \
-                                    IMAGE_SIZE[self.dataset][1] * 32 // 8)
-        label = self.labels[index]
-        return torch.from_numpy(clean_image), torch.from_numpy(adv_image), label
\ No newline at end of file
+        if self.adv_images is None:
+            self.open_memmaps()
+        if isinstance(index, (int, np.integer)):
+            row = self.rows[index]
+            return torch.from_numpy(np.array(self.clean_images[row])), torch.from_numpy(np.array(self.adv_images[row])), \
+                   self.labels[row]
+        rows = self.rows[np.asarray(index)]
+        order = np.argsort(rows)  # read the rows in the file order, then restore the order of index
+        inverse = np.empty_like(order)
+        inverse[order] = np.arange(order.shape[0])
+        sorted_rows = rows[order]
+        clean_images = self.clean_images[sorted_rows][inverse]
+        adv_images = self.adv_images[sorted_rows][inverse]
+        labels = self.labels[sorted_rows][inverse].astype(np.int64)
+        return torch.from_numpy(clean_images), torch.from_numpy(adv_images), torch.from_numpy(labels)
@@ -10,7 +10,7 @@ import numpy as np
 import torch
 from torch import optim
 from torch.backends import cudnn
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, BatchSampler, RandomSampler
 from adversarial_defense.model.tinyimagenet_resnet_return_feature import resnet101, resnet152, resnet34, resnet50
 from torch import nn
 from adversarial_defense.high_level_guided_denoiser.dataset.adv_images_dataset import AdvImagesDataset
@@ -195,11 +195,14 @@ def main():
     os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
     os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
     train_dataset = AdvImagesDataset(args.dataset) # 这个dataset没有经mean和std normalize过的
-    train_data_loader = torch.utils.data.DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True,
-                                              num_workers=0)
+    # 每个batch用一次memmap读取, 每个worker只打开一次memmap
+    train_data_loader = torch.utils.data.DataLoader(train_dataset, batch_size=None, num_workers=args.workers,
+                                                    sampler=BatchSampler(RandomSampler(train_dataset),
+                                                                         args.batch_size, drop_last=False))
     test_dataset = AdvImagesDataset(args.dataset)
-    test_data_loader = torch.utils.data.DataLoader(test_dataset, batch_size=args.batch_size, shuffle=True,
-                                              num_workers=0)
+    test_data_loader = torch.utils.data.DataLoader(test_dataset, batch_size=None, num_workers=args.workers,
+                                                   sampler=BatchSampler(RandomSampler(test_dataset),
+                                                                        args.batch_size, drop_last=False))
     if args.dataset.startswith("CIFAR"):
         pretrained_model_path = "{root}/train_pytorch_model/real_image_model/{dataset}-pretrained/{arch}/checkpoint.pth.tar".format(
             root=PY_ROOT, dataset=args.dataset, arch=args.arch)
@@ -1,62 +1,117 @@
 import argparse
-import glob
+import json
 import random
-import re
 import sys
 
 sys.path.append("/home1/machen/meta_perturbations_black_box_attack")
 from dataset.standard_model import StandardModel
 import glog as log
-from config import PY_ROOT, MODELS_TRAIN_STANDARD, MODELS_TEST_STANDARD
+from config import PY_ROOT, MODELS_TRAIN_STANDARD, MODELS_TEST_STANDARD, IN_CHANNELS, IMAGE_SIZE
 from cifar_models_myself import *
 from dataset.dataset_loader_maker import DataLoaderMaker
+from adversarial_defense.high_level_guided_denoiser.dataset.adv_images_dataset import get_adv_images_paths
 from advertorch.attacks import LinfPGDAttack, L2PGDAttack, FGSM, MomentumIterativeAttack
 import numpy as np
 import os
+import torch
+from torch import nn
 
-def generate_and_save_adv_examples(dataset, data_loader, attackers, save_dir_path):
-    all_adv_images = []
-    all_orig_labels = []
-    all_clean_images = []
-    for idx, (images, labels) in enumerate(data_loader):
-        images = images.cuda()
-        labels = labels.cuda()
-        attacker = random.choice(attackers)
-        adv_images = attacker.perturb(images, labels)
-        all_adv_images.append(adv_images.detach().cpu().numpy())
-        all_orig_labels.append(labels.detach().cpu().numpy())
-        all_clean_images.append(images.detach().cpu().numpy())
-        log.info("process data {}/{} done".format(idx, len(data_loader)))
+class AdvExamplesWriter(object):
+    """
+    Write the adversarial examples into preallocated memmaps, each model owns a fixed range of images_per_model
+    records. After each batch the memmaps are flushed and the progress sidecar (json) records how many records of each
+    model are written, so that an interrupted generation resumes from the sidecar and skips the completed models.
+    """
+    def __init__(self, save_dir_path, dataset, model_names, images_per_model, image_shape):
+        self.paths = get_adv_images_paths(save_dir_path, dataset)
+        self.images_per_model = images_per_model
+        shape = (len(model_names) * images_per_model, *image_shape)
+        if os.path.exists(self.paths["progress"]):
+            with open(self.paths["progress"], "r") as file_obj:
+                self.progress = json.load(file_obj)
+            if tuple(self.progress["shape"]) != shape or self.progress["model_names"] != list(model_names):
+                raise ValueError("{} was generated with shape {} and models {}, remove it to generate with shape {} "
+                                 "and models {}".format(self.paths["progress"], self.progress["shape"],
+                                                        self.progress["model_names"], shape, model_names))
+            mode = "r+"
+            self.labels = np.load(self.paths["labels"], mmap_mode="r+")
+        else:
+            self.progress = {"shape": list(shape), "model_names": list(model_names),
+                             "images_per_model": images_per_model,
+                             "written": {model_name: 0 for model_name in model_names}, "completed": []}
+            mode = "w+"
+            self.labels = np.lib.format.open_memmap(self.paths["labels"], mode="w+", dtype=np.int32,
+                                                    shape=(shape[0],))
+        self.adv_images = np.memmap(self.paths["adv_images"], dtype='float32', mode=mode, shape=shape)
+        self.clean_images = np.memmap(self.paths["clean_images"], dtype='float32', mode=mode, shape=shape)
+        if mode == "w+":
+            self.save_progress()
 
-    all_adv_images = np.concatenate(all_adv_images, 0)
-    all_clean_images = np.concatenate(all_clean_images, 0)
-    all_orig_labels = np.concatenate(all_orig_labels, 0).astype(np.int32)
-    save_adv_images_path = save_dir_path + "/{}_adv_images.npy".format(dataset)
-    save_clean_images_path = save_dir_path + "/{}_clean_images.npy".format(dataset)
-    save_labels_path = save_dir_path + "/{}_labels.npy".format(dataset)
-    shape_path = save_dir_path + "/{}_shape.txt".format(dataset)
-    fp = np.memmap(save_adv_images_path, dtype='float32', mode='w+', shape=all_adv_images.shape)
-    fp[:, :, :, :] = all_adv_images[:, :, :, :]
-    del fp
-    fp = np.memmap(save_clean_images_path, dtype='float32', mode='w+', shape=all_clean_images.shape)
-    fp[:, :, :, :] = all_clean_images[:, :, :, :]
-    del fp
+    def save_progress(self):
+        tmp_path = self.paths["progress"] + ".tmp"
+        with open(tmp_path, "w") as file_obj:
+            json.dump(self.progress, file_obj)
+            file_obj.flush()
+            os.fsync(file_obj.fileno())
+        os.replace(tmp_path, self.paths["progress"])  # the sidecar is never half written
+
+    def is_completed(self, model_name):
+        return model_name in self.progress["completed"]
+
+    def remaining(self, model_name):
+        return self.images_per_model - self.progress["written"][model_name]
+
+    def write(self, model_name, clean_images, adv_images, labels):
+        """
+        Append a batch (numpy arrays) to the records of model_name, the images beyond its range are dropped.
+        """
+        num = min(self.remaining(model_name), labels.shape[0])
+        begin = self.progress["model_names"].index(model_name) * self.images_per_model + \
+                self.progress["written"][model_name]
+        self.adv_images[begin:begin + num] = adv_images[:num]
+        self.clean_images[begin:begin + num] = clean_images[:num]
+        self.labels[begin:begin + num] = labels[:num]
+        for memmap in [self.adv_images, self.clean_images, self.labels]:
+            memmap.flush()
+        self.progress["written"][model_name] += num
+        if self.remaining(model_name) == 0:
+            self.progress["completed"].append(model_name)
+        self.save_progress()
+
+    def close(self):
+        if len(self.progress["completed"]) == len(self.progress["model_names"]):
+            # the shape file of the old generator, written only when the whole set is generated
+            with open(self.paths["shape"], "w") as file_obj:
+                file_obj.write(str(tuple(self.progress["shape"])))
+                file_obj.flush()
+        del self.adv_images, self.clean_images, self.labels
 
-    np.save(save_labels_path, all_orig_labels)
-    with open(shape_path, "w") as file_obj:
-        file_obj.write(str(all_adv_images.shape))
-        file_obj.flush()
-    log.info("Write to directory {} done".format(save_dir_path))
 
-def get_already_gen_models(loss_type, save_path, datasetname):
-    dir_path = "{}/{}/{}/{}_model_*_images.npy".format(save_path, loss_type, datasetname, datasetname)
-    pattern = re.compile(".*{}_model_(.*?)_label.*".format(datasetname))
-    model_names = set()
-    for model_path in glob.glob(dir_path):
-        ma = pattern.match(os.path.basename(model_path))
-        arch = ma.group(1)
-        model_names.add(arch)
-    return model_names
+def generate_and_save_adv_examples(model_name, data_loader, attackers, writer):
+    """
+    Generate the adversarial examples of one model until its records in writer are full, each batch is attacked by
+    a randomly chosen attacker of this model.
+    """
+    while writer.remaining(model_name) > 0:
+        for idx, (images, labels) in enumerate(data_loader):
+            images = images.cuda()
+            labels = labels.cuda()
+            attacker = random.choice(attackers)
+            adv_images = attacker.perturb(images, labels)
+            writer.write(model_name, images.detach().cpu().numpy(), adv_images.detach().cpu().numpy(),
+                         labels.detach().cpu().numpy().astype(np.int32))
+            log.info("{}: process data {}/{} done, {} images remain".format(model_name, idx, len(data_loader),
+                                                                           writer.remaining(model_name)))
+            if writer.remaining(model_name) == 0:
+                break
+    log.info("Write the adversarial examples of {} to {} done".format(model_name, writer.paths["adv_images"]))
+
+def get_already_gen_models(save_dir_path, datasetname):
+    progress_path = get_adv_images_paths(save_dir_path, datasetname)["progress"]
+    if not os.path.exists(progress_path):
+        return set()
+    with open(progress_path, "r") as file_obj:
+        return set(json.load(file_obj)["completed"])
 
 
 def set_log_file(fname):
@@ -65,36 +120,50 @@ def set_log_file(fname):
     os.dup2(tee.stdin.fileno(), sys.stdout.fileno())
     os.dup2(tee.stdin.fileno(), sys.stderr.fileno())
 
-def generate(datasetname, batch_size):
+def get_attackers(model):
+    linf_PGD_attack =LinfPGDAttack(model, loss_fn=nn.CrossEntropyLoss(reduction="sum"), eps=0.031372, nb_iter=30,
+                  eps_iter=0.01, rand_init=True, clip_min=0.0, clip_max=1.0, targeted=False)
+    l2_PGD_attack = L2PGDAttack(model, loss_fn=nn.CrossEntropyLoss(reduction="sum"),eps=1.0,
+                                nb_iter=30,clip_min=0.0, clip_max=1.0, targeted=False)
+    FGSM_attack = FGSM(model, loss_fn=nn.CrossEntropyLoss(reduction="sum"))
+    momentum_attack = MomentumIterativeAttack(model, loss_fn=nn.CrossEntropyLoss(reduction="sum"), eps=0.031372, nb_iter=30,
+                  eps_iter=0.01, clip_min=0.0, clip_max=1.0, targeted=False)
+    return [linf_PGD_attack, l2_PGD_attack, FGSM_attack, momentum_attack]
+
+def generate(datasetname, batch_size, images_per_model=None):
     save_dir_path = "{}/data_adv_defense/guided_denoiser".format(PY_ROOT)
     os.makedirs(save_dir_path, exist_ok=True)
     set_log_file(save_dir_path + "/generate_{}.log".format(datasetname))
     data_loader = DataLoaderMaker.get_img_label_data_loader(datasetname, batch_size, is_train=True)
-    attackers = []
-    for model_name in MODELS_TRAIN_STANDARD[datasetname] + MODELS_TEST_STANDARD[datasetname]:
+    model_names = MODELS_TRAIN_STANDARD[datasetname] + MODELS_TEST_STANDARD[datasetname]
+    if images_per_model is None:  # the same total number of images as one pass of the training set
+        images_per_model = len(data_loader.dataset) // len(model_names)
+    writer = AdvExamplesWriter(save_dir_path, datasetname, model_names, images_per_model,
+                               (IN_CHANNELS[datasetname], IMAGE_SIZE[datasetname][0], IMAGE_SIZE[datasetname][1]))
+    already_gen_models = get_already_gen_models(save_dir_path, datasetname)
+    for model_name in model_names:
+        if model_name in already_gen_models:
+            log.info("Skip {}, its adversarial examples are already generated".format(model_name))
+            continue
+        # 每次只加载一个模型
         model = StandardModel(datasetname, model_name, no_grad=False)
         model = model.cuda().eval()
-        linf_PGD_attack =LinfPGDAttack(model, loss_fn=nn.CrossEntropyLoss(reduction="sum"), eps=0.031372, nb_iter=30,
-                      eps_iter=0.01, rand_init=True, clip_min=0.0, clip_max=1.0, targeted=False)
-        l2_PGD_attack = L2PGDAttack(model, loss_fn=nn.CrossEntropyLoss(reduction="sum"),eps=1.0,
-                                    nb_iter=30,clip_min=0.0, clip_max=1.0, targeted=False)
-        FGSM_attack = FGSM(model, loss_fn=nn.CrossEntropyLoss(reduction="sum"))
-        momentum_attack = MomentumIterativeAttack(model, loss_fn=nn.CrossEntropyLoss(reduction="sum"), eps=0.031372, nb_iter=30,
-                      eps_iter=0.01, clip_min=0.0, clip_max=1.0, targeted=False)
-        attackers.append(linf_PGD_attack)
-        attackers.append(l2_PGD_attack)
-        attackers.append(FGSM_attack)
-        attackers.append(momentum_attack)
         log.info("Create model {} done!".format(model_name))
-
-    generate_and_save_adv_examples(datasetname, data_loader, attackers, save_dir_path)
+        generate_and_save_adv_examples(model_name, data_loader, get_attackers(model), writer)
+        del model
+        torch.cuda.empty_cache()
+    writer.close()
+    log.info("Write to directory {} done".format(save_dir_path))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='PyTorch ImageNet Training')
     parser.add_argument("--dataset", type=str, default='CIFAR-10')
     parser.add_argument('--gpu', default=0, type=int, help='GPU id to use.')
     parser.add_argument("--batch_size",type=int,default=10)
+    parser.add_argument("--images_per_model", type=int, default=None,
+                        help="the number of adversarial examples of each model, default is the size of the training set "
+                             "divided by the number of models")
     args = parser.parse_args()
     os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
     os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
-    generate(args.dataset,  args.batch_size)
\ No newline at end of file
+    generate(args.dataset,  args.batch_size, args.images_per_model)
\ No newline at end of file
@@ -0,0 +1,307 @@
+"""
+The shared training loop of the adversarial training defenses (adversarial_train, TRADES, fast_adv_training).
+A defense is a DefenseTrainer configured with an inner attack step:
+    NoAttackStep    standard training
+    FGSMStep        one signed gradient step from a zero/random/previous initialization (fast adversarial training)
+    PGDStep         perturb_steps signed gradient steps inside the l_inf ball (Madry's adversarial training)
+    TRADESStep      PGD on the KL divergence to the natural prediction, trained by CE + beta * KL (TRADES)
+    FreeStep        every batch is replayed several times, the backward of each replay updates both the weights and
+                    the perturbation (free adversarial training)
+The trainer supports native mixed precision (torch.autocast + GradScaler on CUDA, bfloat16 autocast on CPU),
+channels_last memory format, and keeps the perturbation buffer allocated across batches.
+"""
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def clamp(X, lower_limit, upper_limit):
+    # lower_limit and upper_limit can be numbers or tensors that broadcast to X (e.g. per-channel limits)
+    if not torch.is_tensor(lower_limit) and not torch.is_tensor(upper_limit):
+        return torch.clamp(X, lower_limit, upper_limit)
+    return torch.max(torch.min(X, torch.as_tensor(upper_limit, device=X.device)),
+                     torch.as_tensor(lower_limit, device=X.device))
+
+
+def make_grad_scaler(enabled):
+    if hasattr(torch, "amp") and hasattr(torch.amp, "GradScaler"):
+        return torch.amp.GradScaler("cuda", enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
+def step_decay_lr(optimizer, base_lr, epoch, milestones=(75, 90, 100), gamma=0.1):
+    """decrease the learning rate by gamma at each milestone epoch"""
+    lr = base_lr
+    for milestone in milestones:
+        if epoch >= milestone:
+            lr *= gamma
+    for param_group in optimizer.param_groups:
+        param_group['lr'] = lr
+    return lr
+
+
+class DefenseTrainer(object):
+    def __init__(self, model, optimizer, attack, device, amp=False, channels_last=False, grad_clip=None,
+                 lr_schedule=None, log_interval=100, log_fn=print):
+        """
+        :param attack: the inner attack step, e.g. PGDStep
+        :param amp: train with torch.autocast, float16 with a GradScaler on CUDA, bfloat16 on CPU
+        :param grad_clip: the max norm of the gradients of the weights, None means no clipping
+        :param lr_schedule: a function maps the training progress in epochs (a float) to the learning rate,
+                            it is set before each update, None means the learning rate is managed by the caller
+        """
+        self.device = torch.device(device)
+        self.channels_last = channels_last
+        self.model = model.to(self.device)
+        if channels_last:
+            self.model = self.model.to(memory_format=torch.channels_last)
+        self.optimizer = optimizer
+        self.attack = attack
+        self.amp = amp
+        self.amp_dtype = torch.float16 if self.device.type == "cuda" else torch.bfloat16
+        self.scaler = make_grad_scaler(amp and self.device.type == "cuda")  # bfloat16 does not need loss scaling
+        self.grad_clip = grad_clip
+        self.lr_schedule = lr_schedule
+        self.log_interval = log_interval
+        self.log = log_fn
+        self.delta = None  # the perturbation buffer of the attack steps
+        self.epoch = 0
+        self.batch_idx = 0
+        self.num_batches = 0
+
+    def autocast(self):
+        return torch.autocast(device_type=self.device.type, dtype=self.amp_dtype, enabled=self.amp)
+
+    def forward(self, x):
+        with self.autocast():
+            return self.model(x).float()
+
+    def prepare_batch(self, batch):
+        # the loaders yield (images, labels) or (image ids, images, labels)
+        x, y = batch[-2], batch[-1]
+        x = x.to(self.device, non_blocking=True).float()
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        return x, y.to(self.device, non_blocking=True).long()
+
+    def delta_buffer(self, x):
+        """
+        The perturbation buffer, allocated at the first batch (and when the image shape changes) and reused by the
+        later batches, the last batch of an epoch uses its first x.size(0) rows.
+        """
+        if self.delta is None or self.delta.size(0) < x.size(0) or self.delta.shape[1:] != x.shape[1:]:
+            self.delta = torch.zeros_like(x)
+        return self.delta[:x.size(0)]
+
+    def input_gradient(self, loss, x):
+        # the loss is scaled to avoid the underflow of float16 gradients, the attacks only use the sign
+        return torch.autograd.grad(self.scaler.scale(loss), [x])[0].detach()
+
+    def set_lr(self, progress):
+        if self.lr_schedule is not None:
+            lr = self.lr_schedule(progress)
+            for param_group in self.optimizer.param_groups:
+                param_group['lr'] = lr
+
+    def backward_and_step(self, loss):
+        self.optimizer.zero_grad()
+        self.scaler.scale(loss).backward()
+        if self.grad_clip is not None:
+            self.scaler.unscale_(self.optimizer)
+            nn.utils.clip_grad_norm_(self.model.parameters(), self.grad_clip)
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+
+    def train_epoch(self, train_loader, epoch):
+        """
+        :return: the average training loss and accuracy of the epoch
+        """
+        self.epoch = epoch
+        self.num_batches = len(train_loader)
+        train_loss, train_acc, train_n = 0.0, 0, 0
+        for batch_idx, batch in enumerate(train_loader):
+            self.batch_idx = batch_idx
+            x, y = self.prepare_batch(batch)
+            loss, logits = self.attack.train_step(self, x, y)
+            train_loss += loss.item() * y.size(0)
+            train_acc += (logits.max(1)[1] == y).sum().item()
+            train_n += y.size(0)
+            # print progress
+            if self.log_interval and batch_idx % self.log_interval == 0:
+                self.log('Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}'.format(
+                    epoch, batch_idx * len(x), len(train_loader.dataset),
+                           100. * batch_idx / len(train_loader), loss.item()))
+        return train_loss / train_n, train_acc / train_n
+
+    def evaluate(self, data_loader, name="Test", attack=None):
+        """
+        :param attack: an attack step to evaluate the robust accuracy, None evaluates the natural images
+        :return: the average loss and accuracy
+        """
+        self.model.eval()
+        train_delta, self.delta = self.delta, None  # the attack must not overwrite the perturbation carried by training
+        total_loss = 0
+        correct = 0
+        n = 0
+        for batch in data_loader:
+            x, y = self.prepare_batch(batch)
+            if attack is not None:
+                x = attack.perturb(self, x, y)
+            with torch.no_grad():
+                output = self.forward(x)
+            total_loss += F.cross_entropy(output, y, reduction='sum').item()
+            correct += output.max(1)[1].eq(y).sum().item()
+            n += y.size(0)
+        self.delta = train_delta
+        total_loss /= n
+        self.log('{}: Average loss: {:.4f}, Accuracy: {}/{} ({:.0f}%)'.format(
+            name, total_loss, correct, n, 100. * correct / n))
+        return total_loss, correct / n
+
+
+class NoAttackStep(object):
+    attack_in_eval_mode = True  # the adversarial examples are generated with the model in eval mode
+
+    def perturb(self, trainer, x, y):
+        return x
+
+    def loss(self, trainer, x, x_adv, y):
+        logits = trainer.forward(x_adv)
+        return F.cross_entropy(logits, y), logits
+
+    def train_step(self, trainer, x, y):
+        trainer.set_lr(trainer.epoch + (trainer.batch_idx + 1) / trainer.num_batches)
+        if self.attack_in_eval_mode:
+            trainer.model.eval()
+        x_adv = self.perturb(trainer, x, y).detach()
+        trainer.model.train()
+        loss, logits = self.loss(trainer, x, x_adv, y)
+        trainer.backward_and_step(loss)
+        return loss.detach(), logits.detach()
+
+
+class PGDStep(NoAttackStep):
+    def __init__(self, epsilon, step_size, perturb_steps, init="normal", clip_min=0.0, clip_max=1.0,
+                 attack_in_eval_mode=True):
+        """
+        :param epsilon: the l_inf radius, a number or a tensor that broadcasts to the images (e.g. per-channel)
+        :param init: "normal" starts from 0.001 * N(0, 1) (adversarial_train and TRADES), "uniform" from
+                     U(-epsilon, epsilon), "zero" from the natural images
+        :param attack_in_eval_mode: False generates the adversarial examples in train mode (fast_adv_training)
+        """
+        self.attack_in_eval_mode = attack_in_eval_mode
+        self.epsilon = epsilon
+        self.step_size = step_size
+        self.perturb_steps = perturb_steps
+        self.init = init
+        self.clip_min = clip_min
+        self.clip_max = clip_max
+
+    def init_delta(self, trainer, x):
+        delta = trainer.delta_buffer(x)
+        if self.init == "normal":
+            delta.normal_().mul_(0.001)
+        elif self.init == "uniform":
+            delta.uniform_(-1, 1).mul_(self.epsilon)
+        elif self.init == "zero":
+            delta.zero_()
+        return delta
+
+    def attack_loss(self, trainer, x_adv, y, target):
+        return F.cross_entropy(trainer.forward(x_adv), y)
+
+    def attack_target(self, trainer, x):
+        return None
+
+    def perturb(self, trainer, x, y):
+        x_adv = x + self.init_delta(trainer, x)
+        target = self.attack_target(trainer, x)
+        for _ in range(self.perturb_steps):
+            x_adv.requires_grad_()
+            with torch.enable_grad():
+                loss = self.attack_loss(trainer, x_adv, y, target)
+            grad = trainer.input_gradient(loss, x_adv)
+            x_adv = x_adv.detach() + self.step_size * torch.sign(grad)
+            x_adv = clamp(x_adv, x - self.epsilon, x + self.epsilon)
+            x_adv = clamp(x_adv, self.clip_min, self.clip_max)
+        return clamp(x_adv, self.clip_min, self.clip_max).detach()
+
+
+class FGSMStep(PGDStep):
+    def __init__(self, epsilon, alpha, init="random", clip_min=0.0, clip_max=1.0, attack_in_eval_mode=False):
+        """
+        :param alpha: the step size is alpha * epsilon
+        :param init: "zero", "random" (U(-epsilon, epsilon)) or "previous" (the perturbation of the previous batch)
+        """
+        super(FGSMStep, self).__init__(epsilon, alpha * epsilon, 1, init, clip_min, clip_max, attack_in_eval_mode)
+
+    def perturb(self, trainer, x, y):
+        delta = trainer.delta_buffer(x)
+        if self.init == "zero":
+            delta.zero_()
+        elif self.init == "random":
+            delta.uniform_(-1, 1).mul_(self.epsilon)
+        delta = delta.clone().requires_grad_()  # "previous" starts from the buffer as it is
+        with torch.enable_grad():
+            loss = F.cross_entropy(trainer.forward(x + delta), y)
+        grad = trainer.input_gradient(loss, delta)
+        delta = clamp(delta.detach() + self.step_size * torch.sign(grad), -self.epsilon, self.epsilon)
+        trainer.delta_buffer(x).copy_(delta)
+        return clamp(x + delta, self.clip_min, self.clip_max).detach()
+
+
+class TRADESStep(PGDStep):
+    def __init__(self, epsilon, step_size, perturb_steps, beta, clip_min=0.0, clip_max=1.0):
+        """
+        :param beta: the weight of the robust (KL) loss, i.e. 1/lambda in TRADES
+        """
+        super(TRADESStep, self).__init__(epsilon, step_size, perturb_steps, "normal", clip_min, clip_max)
+        self.beta = beta
+        self.criterion_kl = nn.KLDivLoss(reduction='sum')
+
+    def attack_target(self, trainer, x):
+        # the natural prediction does not change during the attack, it is computed once
+        with torch.no_grad():
+            return F.softmax(trainer.forward(x), dim=1)
+
+    def attack_loss(self, trainer, x_adv, y, target):
+        return self.criterion_kl(F.log_softmax(trainer.forward(x_adv), dim=1), target)
+
+    def loss(self, trainer, x, x_adv, y):
+        batch_size = x.size(0)
+        logits = trainer.forward(x)
+        loss_natural = F.cross_entropy(logits, y)
+        logits_adv = trainer.forward(x_adv)
+        loss_robust = (1.0 / batch_size) * self.criterion_kl(F.log_softmax(logits_adv, dim=1),
+                                                             F.softmax(logits, dim=1))
+        return loss_natural + self.beta * loss_robust, logits_adv
+
+
+class FreeStep(NoAttackStep):
+    def __init__(self, epsilon, step_size, replays, clip_min=0.0, clip_max=1.0):
+        """
+        Free adversarial training: each batch is replayed replays times, one backward gives the gradients of both the
+        weights and the perturbation, the perturbation is carried across the replays and to the next batch.
+        The learning rate schedule (if any) advances by 1 / replays of a batch per replay.
+        :param step_size: the step size of the perturbation in each replay
+        """
+        self.epsilon = epsilon
+        self.step_size = step_size
+        self.replays = replays
+        self.clip_min = clip_min
+        self.clip_max = clip_max
+
+    def train_step(self, trainer, x, y):
+        trainer.model.train()
+        delta = trainer.delta_buffer(x).clone()
+        for j in range(self.replays):
+            trainer.set_lr(trainer.epoch * self.replays +
+                           (trainer.batch_idx * self.replays + j + 1) / trainer.num_batches)
+            delta.requires_grad_()
+            logits = trainer.forward(clamp(x + delta, self.clip_min, self.clip_max))
+            loss = F.cross_entropy(logits, y)
+            trainer.backward_and_step(loss)  # the scaled backward also fills delta.grad
+            grad = delta.grad.detach()  # the sign does not depend on the loss scale
+            delta = clamp(delta.detach() + self.step_size * torch.sign(grad), -self.epsilon, self.epsilon)
+        trainer.delta_buffer(x).copy_(delta)
+        return loss.detach(), logits.detach()
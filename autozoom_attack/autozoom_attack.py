@@ -14,65 +14,55 @@ ADAM_BETA1 = 0.9
 ADAM_BETA2 = 0.999
 
 
-def coordinate_ADAM(losses, indice, grad, hess, batch_size, mt_arr, vt_arr, real_modifier, lr, adam_epoch, beta1, beta2, proj):
-    for i in range(batch_size):
-        grad[i] = (losses[i*2+1] - losses[i*2+2]) / 0.0002
+# All the solvers below work on the images of one batch at the same time, every state is a torch tensor on one device:
+# losses: (N, R) the losses of the R query rows of each image, the row 0 is the current modifier
+# mt_arr, vt_arr, adam_epoch: (N, var_size), real_modifier: (N, C, m, m), which are updated in place.
+def coordinate_ADAM(losses, indice, mt_arr, vt_arr, real_modifier, lr, adam_epoch, beta1, beta2, proj):
+    # indice shape = (N, B), the coordinates of each image, whose gradients are estimated by row 2i+1 and row 2i+2
+    grad = (losses[:, 1::2] - losses[:, 2::2]) / 0.0002
     # ADAM update
-    mt = mt_arr[indice]
+    mt = mt_arr.gather(1, indice)
     mt = beta1 * mt + (1 - beta1) * grad
-    mt_arr[indice] = mt
-    vt = vt_arr[indice]
+    mt_arr.scatter_(1, indice, mt)
+    vt = vt_arr.gather(1, indice)
     vt = beta2 * vt + (1 - beta2) * (grad * grad)
-    vt_arr[indice] = vt
+    vt_arr.scatter_(1, indice, vt)
     # epoch is an array; for each index we can have a different epoch number
-    epoch = adam_epoch[indice]
-    corr = (np.sqrt(1 - np.power(beta2,epoch))) / (1 - np.power(beta1, epoch))
-    m = real_modifier.reshape(-1)
-    old_val = m[indice]
-    old_val -= lr * corr * mt / (np.sqrt(vt)  + 1e-8 )
+    epoch = adam_epoch.gather(1, indice)
+    corr = torch.sqrt(1 - torch.pow(beta2, epoch)) / (1 - torch.pow(beta1, epoch))
+    m = real_modifier.view(real_modifier.size(0), -1)
+    old_val = m.gather(1, indice)
+    old_val -= lr * corr * mt / (torch.sqrt(vt) + 1e-8)
+    m.scatter_(1, indice, old_val)
+    adam_epoch.scatter_(1, indice, epoch + 1)
 
-    m[indice] = old_val
-    adam_epoch[indice] = epoch + 1
 
+def random_vector_grad(losses, beta, z, valid_mask):
+    # z shape = (N, q, var_size), valid_mask shape = (N, q): the image n only uses its first q_n random vectors.
+    # avg_grad = 1/q_n * sum_i q_n * (losses[i+1] - losses[0]) * z[i] / beta
+    diff = (losses[:, 1:] - losses[:, :1]) * valid_mask.float()
+    return torch.sum(diff.unsqueeze(-1) * z, dim=1) / beta
 
 
 # 原作者的image是-0.5到+0.5之间
-def SGD(losses, indice, grad, hess, batch_size, mt_arr, vt_arr, real_modifier, lr, adam_epoch, beta1, beta2, proj, beta, z, q=1):
-    for i in range(q):
-        grad[i] = q * (losses[i+1] - losses[0]) * z[i] / beta
-
-    # argument indice should be removed for the next version
+def SGD(losses, mt_arr, vt_arr, real_modifier, lr, adam_epoch, beta1, beta2, proj, beta, z, valid_mask):
     # the entire modifier is updated for every epoch and thus indice is not required
-    avg_grad = np.mean(grad, axis=0)
-    m = real_modifier.reshape(-1)
-    old_val = m[indice]
-    old_val -= lr * np.sign(avg_grad)
-    m[indice] = old_val
+    avg_grad = random_vector_grad(losses, beta, z, valid_mask)
+    m = real_modifier.view(real_modifier.size(0), -1)
+    m -= lr * torch.sign(avg_grad)
 
 
 # 原作者的image是-0.5到+0.5之间
-def ADAM(losses, indice, grad, hess, batch_size, mt_arr, vt_arr, real_modifier, lr, adam_epoch, beta1, beta2, proj, beta, z, q=1):
-    for i in range(q):
-        grad[i] = q * (losses[i+1] - losses[0]) * z[i] / beta
-
-    # argument indice should be removed for the next version
+def ADAM(losses, mt_arr, vt_arr, real_modifier, lr, adam_epoch, beta1, beta2, proj, beta, z, valid_mask):
     # the entire modifier is updated for every epoch and thus indice is not required
-    avg_grad = np.mean(grad, axis=0)
+    avg_grad = random_vector_grad(losses, beta, z, valid_mask)
     # ADAM update
-    mt = mt_arr[indice]
-    mt = beta1 * mt + (1 - beta1) * avg_grad
-    mt_arr[indice] = mt
-    vt = vt_arr[indice]
-    vt = beta2 * vt + (1 - beta2) * (avg_grad * avg_grad)
-    vt_arr[indice] = vt
-
-    epoch = adam_epoch[indice]
-    corr = (np.sqrt(1 - np.power(beta2,epoch))) / (1 - np.power(beta1, epoch))
-    m = real_modifier.reshape(-1)
-    old_val = m[indice]
-    old_val -= lr * corr * mt / (np.sqrt(vt)  + 1e-8 )
-    m[indice] = old_val
-    adam_epoch[indice] = epoch + 1
+    mt_arr.mul_(beta1).add_((1 - beta1) * avg_grad)
+    vt_arr.mul_(beta2).add_((1 - beta2) * (avg_grad * avg_grad))
+    corr = torch.sqrt(1 - torch.pow(beta2, adam_epoch)) / (1 - torch.pow(beta1, adam_epoch))
+    m = real_modifier.view(real_modifier.size(0), -1)
+    m -= lr * corr * mt_arr / (torch.sqrt(vt_arr) + 1e-8)
+    adam_epoch += 1
 
 def atanh(x):
     return 0.5*torch.log((1+x)/(1-x))
@@ -101,19 +91,30 @@ class BlackboxAttack(metaclass=ABCMeta):
         self.image_shape = (self.num_channels, self.image_size, self.image_size)
         self.modifier_shape = (self.num_channels, self.modifier_size, self.modifier_size)
         # self.early_stop_iters = args["early_stop_iters"] if args["early_stop_iters"] != 0 else self.MAX_ITER // 10
-        self.real_modifier = np.zeros((1,) + self.modifier_shape, dtype=np.float32)
         self.define_loss_func()
 
         self.var_size = self.modifier_size * self.modifier_size * self.num_channels
         self.use_var_len = self.var_size
-        self.var_list = np.array(range(0, self.use_var_len), dtype = np.int32)
-        # ADAM status
-        self.mt = np.zeros(self.var_size, dtype=np.float32)
-        self.vt = np.zeros(self.var_size, dtype=np.float32)
         self.beta1 = ADAM_BETA1
         self.beta2 = ADAM_BETA2
-        self.adam_epoch = np.ones(self.var_size, dtype=np.int32)
-        self.stage = 0
+        # the solver status of all images in the attacked batch, see reset_solver
+        self.reset_solver(1, next(self.model.parameters()).device)
+
+    def reset_solver(self, num_images, device):
+        """
+        All the images of one batch share one solver, each row of the following tensors belongs to one image.
+        """
+        self.real_modifier = torch.zeros((num_images,) + self.modifier_shape, device=device)
+        # ADAM status
+        self.mt = torch.zeros(num_images, self.var_size, device=device)
+        self.vt = torch.zeros(num_images, self.var_size, device=device)
+        self.adam_epoch = torch.ones(num_images, self.var_size, device=device)
+        self.stage = torch.zeros(num_images, dtype=torch.bool, device=device)
+
+    def reset_adam(self, idx):
+        self.mt[idx] = 0.0
+        self.vt[idx] = 0.0
+        self.adam_epoch[idx] = 1
 
     def define_loss_func(self):
         if self.USE_TANH:
@@ -131,7 +132,7 @@ class BlackboxAttack(metaclass=ABCMeta):
         self.loss2 = self.l2dist
 
     def get_newimg(self, timg, modifier):
-        # modifier shape = (2B+1)
+        # modifier shape = (rows, C, m, m), timg shape = (rows, C, H, W), each row has its own clean image
         self.set_img_modifier(modifier)  # set self.img_modifier
         img_modifier = self.img_modifier
         if self.USE_TANH:
@@ -157,14 +158,36 @@ class BlackboxAttack(metaclass=ABCMeta):
         if true_label.size(0)!=logits.size(0):
             assert logits.size(0) % true_label.size(0) == 0
             repeat_num = logits.size(0) // true_label.size(0)
-            true_label = true_label.repeat(repeat_num)
+            true_label = true_label.repeat_interleave(repeat_num)
             if target_label is not None:
-                target_label = target_label.repeat(repeat_num)
+                target_label = target_label.repeat_interleave(repeat_num)
         loss1_val = self.cw_loss(logits, true_label, target_label)
         loss2_val = self.loss2(newimg, timg)  # returned shape = (batch_size,) ; clean_x shape = (1,C,H,W) newimg = (B,C,H,W)
         assert loss1_val.size() == loss2_val.size()
         return const * loss1_val + loss2_val, loss1_val, loss2_val, logits
 
+    def query_rows(self, modifier, timg, true_label, target_label, const, row_mask=None):
+        """
+        Evaluate all the query rows of the attacked images by one forward of the model.
+        :param modifier: (n, R, C, m, m), R query rows of each image, the row 0 is the current modifier.
+        :param timg, true_label, target_label, const: the clean image, labels and constants of the n images.
+        :param row_mask: (n, R) bool, only the valid rows are sent to the model (e.g. the image has fewer random vectors).
+        :return: losses (n, R) (the invalid rows are 0), and loss1, loss2, score and new image of row 0 of each image.
+        """
+        n, R = modifier.size(0), modifier.size(1)
+        owner = torch.arange(n, device=modifier.device).unsqueeze(1).expand(n, R)
+        if row_mask is None:
+            row_mask = torch.ones(n, R, dtype=torch.bool, device=modifier.device)
+        flat_modifier = modifier[row_mask]
+        owner = owner[row_mask]
+        target_rows = target_label[owner] if target_label is not None else None
+        newimg = self.get_newimg(timg[owner], flat_modifier)
+        losses, loss1, loss2, scores = self.loss(newimg, timg[owner], true_label[owner], target_rows, const[owner])
+        full_losses = torch.zeros(n, R, device=losses.device)
+        full_losses[row_mask] = losses
+        first_row = torch.cumsum(row_mask.long().sum(1), 0) - row_mask.long().sum(1)  # the position of row 0 of each image
+        return full_losses, loss1[first_row], loss2[first_row], scores[first_row], newimg[first_row]
+
     # def real(self, logits, tlab):
     #     out = logits[torch.arange(logits.size(0)), tlab.long()]
     #     return out
@@ -198,199 +221,185 @@ class BlackboxAttack(metaclass=ABCMeta):
 
     def print_info(self, loss, loss1, loss2, eval_costs):
         log.info(
-            "[Iter] iter:{}, const:{}, cost:{}, time:{:.3f}, size:{}, loss:{:.5g}, loss1:{:.5g}, loss2:{:.10g}".format(
-                self.current_iter, self.current_const, eval_costs, self.train_timer, self.real_modifier.shape,
-                loss, loss1, loss2))
+            "[Iter] iter:{}, const:{:.5g}, cost:{:.1f}, time:{:.3f}, size:{}, loss:{:.5g}, loss1:{:.5g}, loss2:{:.10g}".format(
+                self.current_iter, self.current_const.mean().item(), eval_costs.mean().item(), self.train_timer,
+                tuple(self.real_modifier.shape), loss.mean().item(), loss1.mean().item(), loss2.mean().item()))
 
     @abstractmethod
     def set_img_modifier(self, modifier):
         pass
 
     @abstractmethod
-    def get_eval_costs(self):
+    def get_eval_costs(self, idx):
         pass
 
     @abstractmethod
-    def blackbox_optimizer(self, iteration, timg, true_label, target_label, const):
+    def blackbox_optimizer(self, iteration, timg, true_label, target_label, const, idx):
         pass
     @abstractmethod
-    def post_success_setting(self):
+    def post_success_setting(self, idx):
         pass
 
 
     def compare(self, x, true_label, target_label):
+        """
+        :param x: the scores (n, num_classes) or the predicted labels (n,) of n images
+        :return: (n,) bool tensor, whether the attack of each image succeeds
+        """
         if target_label is None:
-            y = true_label[0].item()
+            y = true_label
         else:
             assert self.ATTACK_TYPE == "targeted"
-            y = target_label[0].item()
-        temp_x = np.copy(x)
-        if not isinstance(x, (float, int, np.int64)):
+            y = target_label
+        if x.dim() == 2:
+            temp_x = x.clone()
             if self.ATTACK_TYPE == "targeted":
-                temp_x[y] -= self.CONFIDENCE
-                temp_x = np.argmax(temp_x)
+                temp_x[torch.arange(x.size(0)), y] -= self.CONFIDENCE
             else:
-                for i in range(len(temp_x)):
-                    if i != y:
-                        temp_x[i] -= self.CONFIDENCE
-                temp_x = np.argmax(temp_x)
+                temp_x -= self.CONFIDENCE
+                temp_x[torch.arange(x.size(0)), y] += self.CONFIDENCE
+            temp_x = temp_x.argmax(dim=1)
+        else:
+            temp_x = x
         if self.ATTACK_TYPE == "targeted":
-            return temp_x == y
+            return temp_x.eq(y)
         else:
-            return temp_x != y
+            return temp_x.ne(y)
 
 
     def attack(self, img, true_label, target_label):
         """
-        Perform the L_2 attack on the given images for the given targets.
+        Perform the L_2 attack on the given images for the given targets, all images share one solver,
+        i.e. the queries of all images are issued by one forward in each iteration.
         # img : (B,C,H,W) 4D tensor
         If self.targeted is true, then the targets represents the target labels.
         If self.targeted is false, then targets are the original class labels.
         """
 
         batch_size = img.size(0)
-        query = torch.zeros(batch_size).cuda()
+        device = img.device
+        query = torch.zeros(batch_size, device=device)
         with torch.no_grad():
             logit = self.model(img)
         pred = logit.argmax(dim=1)
         correct = pred.eq(true_label).float()  # shape = (batch_size,)
         not_done = correct.clone()  # shape = (batch_size,)
+        adv_logit = logit.clone()
+        o_bestattack = img.clone()  # the over all best attack is in pixel space
         # convert to tanh-space
         if self.USE_TANH:  # tf版本像素范围-0.5到0.5
             img = atanh((img - 0.5) * 1.99999)  # atanh形参数值范围(-1,1)
-        # remove the extra batch dimension
-        assert batch_size == 1
-        # if img.dim() == 4:
-        #     img = img[0]  # C,H,W
-        # set the lower and upper bounds accordingly
-        lower_bound = 0.0
-        CONST = self.INIT_CONST
+        # set the lower and upper bounds of each image accordingly
+        lower_bound = torch.zeros(batch_size, device=device)
+        CONST = torch.full((batch_size,), float(self.INIT_CONST), device=device)
         self.current_const = CONST
-        upper_bound = 1e10
-
-        # set the upper and lower bounds for the modifier
-        if not self.USE_TANH:
-            img_flatten = img.view(-1)
-            self.modifier_up =  torch.ones_like(img_flatten) - img_flatten
-            self.modifier_down = torch.zeros_like(img_flatten) - img_flatten
+        upper_bound = torch.full((batch_size,), 1e10, device=device)
 
         # the over all best l2, score, and image attack
-        o_bestl2 = 1e10
-        o_bestattack = img
-        last_loss1 = 1e10
+        o_bestl2 = torch.full((batch_size,), 1e10, device=device)
+        last_loss1 = torch.full((batch_size,), 1e10, device=device)
         # inner best l2 and scores
-        bestl2 = 1e10
-        bestscore = -1
+        bestl2 = torch.full((batch_size,), 1e10, device=device)
+        bestscore = torch.full((batch_size,), -1, dtype=torch.long, device=device)
         timg = img
-        const = CONST
-        prev = 1e6
         self.train_timer = 0.0
-        last_loss2 = 1e10
-
-        # reset ADAM status
-        self.mt.fill(0.0)
-        self.vt.fill(0.0)
-        self.adam_epoch.fill(1)
-        self.real_modifier.fill(0)  # clear the modifier
-        self.stage = 0
-        eval_costs = 0
-        o_bestscore = -1
-        # np.random.seed(1234)
+
+        # reset ADAM status and clear the modifier
+        self.reset_solver(batch_size, device)
+        eval_costs = torch.zeros(batch_size, device=device)
+        # the images that are misclassified originally or early stopped are not attacked anymore
+        attacking = correct.bool()
         attack_begin_time = time.time()
         for iteration in range(self.MAX_ITER):
-
+            idx = torch.nonzero(attacking).view(-1)
+            if idx.numel() == 0:
+                break
             # perform the attack
-            l, l2, loss1, loss2, score, nimg = self.blackbox_optimizer(iteration, timg, true_label, target_label, const)
-            eval_costs += self.get_eval_costs()
+            l, l2, loss1, loss2, score, nimg = self.blackbox_optimizer(iteration, timg, true_label, target_label,
+                                                                       CONST, idx)
+            eval_costs[idx] += self.get_eval_costs(idx)
             if iteration % self.PRINT_EVERY == 0:
                 self.current_iter = iteration
-                self.print_info(l, loss1, loss2, self.get_eval_costs())
+                self.print_info(l, loss1, loss2, eval_costs[idx])
 
             # reset ADAM states when a valid example has been found
-            if loss1 == 0.0 and last_loss1 != 0.0 and self.stage == 0:
+            reset = loss1.eq(0) & last_loss1[idx].ne(0) & ~self.stage[idx]
+            if reset.any():
                 # we have reached the fine tunning point
                 # reset ADAM to avoid overshoot
-                log.info("##### Reset ADAM #####")
-                self.mt.fill(0.0)
-                self.vt.fill(0.0)
-                self.adam_epoch.fill(1)
-                self.stage = 1
-            last_loss1 = loss1
-            score = score.detach().cpu().numpy()
-            if l2 < bestl2 and self.compare(score, true_label, target_label):
-                bestl2 = l2
-                bestscore = np.argmax(score)
-
-            if l2 < o_bestl2 and self.compare(score, true_label, target_label):
+                log.info("##### Reset ADAM of {} images #####".format(reset.sum().item()))
+                self.reset_adam(idx[reset])
+                self.stage[idx[reset]] = True
+            last_loss1[idx] = loss1
+            true_label_idx = true_label[idx]
+            target_label_idx = target_label[idx] if target_label is not None else None
+            succeed = self.compare(score, true_label_idx, target_label_idx)
+            improved = (l2 < bestl2[idx]) & succeed
+            bestl2[idx[improved]] = l2[improved]
+            bestscore[idx[improved]] = score[improved].argmax(dim=1)
+
+            improved = (l2 < o_bestl2[idx]) & succeed
+            if improved.any():
                 # print a message if it is the first attack found
-                if o_bestl2 == 1e10:
-                    # print("save modifier")
+                first = improved & o_bestl2[idx].eq(1e10)
+                if first.any():
                     log.info(
-                        "[STATS][FirstAttack] iter:{}, const:{}, cost:{}, time:{:.3f}, size:{}, loss:{:.5g}, loss1:{:.5g}, loss2:{:.5g}, l2:{:.5g}".format(
-                            iteration, CONST, eval_costs, self.train_timer, self.real_modifier.shape, l, loss1,
-                            loss2, l2))
-                    self.post_success_setting()
-                    lower_bound = 0.0
-                o_bestl2 = l2
-                o_bestattack = nimg
-                # begin statistics
-                query.fill_(eval_costs)
-                with torch.no_grad():
-                    adv_logit = self.model(o_bestattack)
-                    adv_prob = F.softmax(adv_logit, dim=1)
-                adv_pred = adv_logit.argmax(dim=1)
+                        "[STATS][FirstAttack] iter:{}, {} images, const:{:.5g}, cost:{:.1f}, time:{:.3f}, size:{}, loss:{:.5g}, loss1:{:.5g}, loss2:{:.5g}, l2:{:.5g}".format(
+                            iteration, first.sum().item(), CONST[idx[first]].mean().item(),
+                            eval_costs[idx[first]].mean().item(), self.train_timer, tuple(self.real_modifier.shape),
+                            l[first].mean().item(), loss1[first].mean().item(), loss2[first].mean().item(),
+                            l2[first].mean().item()))
+                    self.post_success_setting(idx[first])
+                    lower_bound[idx[first]] = 0.0
+                improved_idx = idx[improved]
+                o_bestl2[improved_idx] = l2[improved]
+                o_bestattack[improved_idx] = nimg[improved].detach()
+                # begin statistics, the score of row 0 is the logit of nimg, thus no extra query is needed
+                query[improved_idx] = eval_costs[improved_idx]
+                adv_logit[improved_idx] = score[improved].detach()
+                adv_pred = adv_logit[improved_idx].argmax(dim=1)
                 if self.ATTACK_TYPE == "targeted":
-                    not_done = not_done * (1 - adv_pred.eq(target_label)).float()
+                    not_done[improved_idx] = not_done[improved_idx] * adv_pred.ne(target_label[improved_idx]).float()
                 else:
-                    not_done = not_done * adv_pred.eq(true_label).float()
-                success = (1 - not_done) * correct
-                success_query = success * query
-                not_done_prob = adv_prob[torch.arange(batch_size), true_label] * not_done
+                    not_done[improved_idx] = not_done[improved_idx] * adv_pred.eq(true_label[improved_idx]).float()
                 # end statistics
                 if self.ABORT_EARLY:
-                    if loss2 < self.epsilone and not not_done.byte().any():
-                        log.info(
-                            "Early stopping attack successfully and total pixels' distortion is {:.3f}".format(loss2))
-                        break
-            self.train_timer += time.time() - attack_begin_time
+                    early_stop = improved & (loss2 < self.epsilone) & not_done[idx].eq(0)
+                    if early_stop.any():
+                        log.info("Early stopping {} images attack successfully and mean pixels' distortion is {:.3f}".format(
+                            early_stop.sum().item(), loss2[early_stop].mean().item()))
+                        attacking[idx[early_stop]] = False
+            self.train_timer = time.time() - attack_begin_time
 
             # switch constant when reaching switch iterations
             if iteration % self.SWITCH_ITER == 0 and iteration != 0:
-                if self.compare(bestscore, true_label, target_label) and bestscore != -1:
-                    # success, divide const by two
-                    log.info("iter:{} old constant:{}".format(iteration, CONST))
-                    upper_bound = min(upper_bound, CONST)
-                    if upper_bound < 1e9:
-                        CONST = (lower_bound + upper_bound) / 2
-                    log.info("iter:{} new constant:{}".format(iteration, CONST))
-                else:
-                    # failure, either multiply by 10 if no solution found yet
-                    #          or do binary search with the known upper bound
-                    log.info("iter:{} old constant:{}".format(iteration, CONST))
-                    lower_bound = max(lower_bound, CONST)
-                    if upper_bound < 1e9:
-                        CONST = (lower_bound + upper_bound) / 2
-                    elif CONST < 1e8:
-                        CONST *= 10
-                    else:
-                        log.info("CONST > 1e8, no change")
-
-                    log.info("iter:{} new constant:{}".format(iteration, CONST))
-
-                bestl2 = 1e10
-                bestscore = -1
-                self.current_const = CONST
-
-                if self.stage == 1:
-                    self.mt.fill(0.0)
-                    self.vt.fill(0.0)
-                    self.adam_epoch.fill(1)
-
-                self.current_const = CONST
+                log.info("iter:{} old mean constant:{:.5g}".format(iteration, CONST[idx].mean().item()))
+                has_solution = bestscore[idx].ne(-1)
+                success_idx = idx[has_solution & self.compare(bestscore[idx], true_label_idx, target_label_idx)]
+                failure_idx = idx[~(has_solution & self.compare(bestscore[idx], true_label_idx, target_label_idx))]
+                # success, divide const by two
+                upper_bound[success_idx] = torch.min(upper_bound[success_idx], CONST[success_idx])
+                # failure, either multiply by 10 if no solution found yet
+                #          or do binary search with the known upper bound
+                lower_bound[failure_idx] = torch.max(lower_bound[failure_idx], CONST[failure_idx])
+                binary_search = upper_bound[idx] < 1e9
+                CONST[idx[binary_search]] = (lower_bound[idx[binary_search]] + upper_bound[idx[binary_search]]) / 2
+                multiply = torch.zeros_like(attacking)
+                multiply[failure_idx] = True
+                multiply = multiply[idx] & ~binary_search & (CONST[idx] < 1e8)
+                CONST[idx[multiply]] *= 10
+                log.info("iter:{} new mean constant:{:.5g}".format(iteration, CONST[idx].mean().item()))
+
+                bestl2[idx] = 1e10
+                bestscore[idx] = -1
                 # update constant
-                timg = img
-                const = CONST
+                self.current_const = CONST
+                self.reset_adam(idx[self.stage[idx]])
 
+        success = (1 - not_done) * correct
+        success_query = success * query
+        adv_prob = F.softmax(adv_logit, dim=1)
+        not_done_prob = adv_prob[torch.arange(batch_size), true_label] * not_done
         # return the best solution found
         stats_info = {"query": query, "correct":correct, "not_done": not_done,
                       "success": success, "success_query":success_query, "not_done_prob":not_done_prob,
@@ -402,8 +411,6 @@ class ZOO(BlackboxAttack):
 
     def __init__(self, model, dataset, args):
         super(ZOO, self).__init__(model, dataset, args)
-        self.grad = np.zeros(self.BATCH_SIZE, dtype=np.float32)
-        self.hess = np.zeros(self.BATCH_SIZE, dtype=np.float32)
         self.solver = coordinate_ADAM
 
     def set_img_modifier(self, modifier):
@@ -415,29 +422,37 @@ class ZOO(BlackboxAttack):
             self.img_modifier = F.interpolate(modifier, [self.image_size, self.image_size], mode="bilinear",
                                               align_corners=True)
 
-    def get_eval_costs(self):
-        return self.BATCH_SIZE * 2
+    def get_eval_costs(self, idx):
+        return torch.full((idx.size(0),), float(self.BATCH_SIZE * 2), device=idx.device)
 
-    def blackbox_optimizer(self, iteration, timg, true_label, target_label, const):
+    def blackbox_optimizer(self, iteration, timg, true_label, target_label, const, idx):
         # argument iteration is for debugging
-        # build new inputs, based on current variable value
-        var = np.repeat(self.real_modifier, self.BATCH_SIZE * 2 + 1, axis=0)
-        # randomly select a coordinate for each image to estimate gradient
-        var_indice = np.random.choice(self.var_list.size, self.BATCH_SIZE, replace=False)
-        indice = self.var_list[var_indice] # var_indice shape = (B,)  而self.var_list是[0,...,HxWxC], 相当于一个图片的分辨率，其中选择batch_size,为每个图片随机选择一个坐标，估计梯度
-        for i in range(self.BATCH_SIZE):
-            var[i * 2 + 1].reshape(-1)[indice[i]] += 0.0001
-            var[i * 2 + 2].reshape(-1)[indice[i]] -= 0.0001
-        modifier = torch.from_numpy(var).cuda().float()
-        newimg = self.get_newimg(timg, modifier)  # newimg shape = (2B+1,C,H,W) small shift (fake) images to estimate gradient
-        losses, loss1, loss2, scores = self.loss(newimg, timg, true_label, target_label, const)
+        # build new inputs of the images idx, based on current variable value, shape = (n, 2B+1, var_size)
+        n = idx.size(0)
+        real_modifier = self.real_modifier[idx]
+        var = real_modifier.view(n, 1, -1).repeat(1, self.BATCH_SIZE * 2 + 1, 1)
+        # randomly select BATCH_SIZE coordinates for each image to estimate gradient
+        indice = torch.multinomial(torch.ones(n, self.use_var_len, device=var.device), self.BATCH_SIZE,
+                                   replacement=False)  # shape = (n, B)
+        rows = torch.arange(self.BATCH_SIZE, device=var.device) * 2 + 1
+        image_index = torch.arange(n, device=var.device).unsqueeze(1)
+        var[image_index, rows.unsqueeze(0), indice] += 0.0001
+        var[image_index, rows.unsqueeze(0) + 1, indice] -= 0.0001
+        modifier = var.view((n, self.BATCH_SIZE * 2 + 1) + self.modifier_shape)
+        target_label = target_label[idx] if target_label is not None else None
+        # newimg shape = (n*(2B+1),C,H,W) small shift (fake) images to estimate gradient
+        losses, loss1, loss2, scores, nimg = self.query_rows(modifier, timg[idx], true_label[idx], target_label,
+                                                             const[idx])
         # 下面这一步修改了real_modifier,然后这个变量增加在timg上,从而修改图像
-        self.solver(losses.detach().cpu().numpy(), indice, self.grad, self.hess, self.BATCH_SIZE, self.mt, self.vt, self.real_modifier,
-                    self.LEARNING_RATE, self.adam_epoch, self.beta1, self.beta2, not self.USE_TANH)
+        mt, vt, adam_epoch = self.mt[idx], self.vt[idx], self.adam_epoch[idx]
+        self.solver(losses, indice, mt, vt, real_modifier, self.LEARNING_RATE, adam_epoch,
+                    self.beta1, self.beta2, not self.USE_TANH)
+        self.mt[idx], self.vt[idx], self.adam_epoch[idx] = mt, vt, adam_epoch
+        self.real_modifier[idx] = real_modifier
         # return l, l2, loss1, loss2, score, nimg
-        return losses[0].item(), loss2[0].item(), loss1[0].item(), loss2[0].item(), scores[0], newimg[0].unsqueeze(0)
+        return losses[:, 0], loss2, loss1, loss2, scores, nimg
 
-    def post_success_setting(self):
+    def post_success_setting(self, idx):
         pass
 
 
@@ -455,7 +470,7 @@ class ZOO_AE(ZOO):
             self.img_modifier = F.interpolate(self.decoder_output, [self.image_size, self.image_size], mode="bilinear",
                                               align_corners=True)
 
-    def post_success_setting(self):
+    def post_success_setting(self, idx):
         pass
 
 
@@ -463,11 +478,13 @@ class AutoZOOM_BiLIN(BlackboxAttack):
 
     def __init__(self, model, dataset, args):
         super(AutoZOOM_BiLIN, self).__init__(model, dataset, args)
-        self.hess = np.zeros(self.BATCH_SIZE, dtype=np.float32)
         self.solver = ADAM
-        self.num_rand_vec = 1
         self.post_success_num_rand_vec = args["num_rand_vec"]
-        self.grad = np.zeros((self.num_rand_vec, self.var_size), dtype=np.float32)
+
+    def reset_solver(self, num_images, device):
+        super(AutoZOOM_BiLIN, self).reset_solver(num_images, device)
+        # the number of random vectors of each image, which is increased after its first success
+        self.num_rand_vec = torch.full((num_images,), 1, dtype=torch.long, device=device)
 
     def set_img_modifier(self, modifier):
         assert modifier.size()[1:] == self.modifier_shape
@@ -477,48 +494,45 @@ class AutoZOOM_BiLIN(BlackboxAttack):
         else:
             self.img_modifier = F.interpolate(modifier, [self.image_size, self.image_size],mode="bilinear",align_corners=True)
 
-    def get_eval_costs(self):
-        return self.num_rand_vec + 1
+    def get_eval_costs(self, idx):
+        return (self.num_rand_vec[idx] + 1).float()
 
-    def blackbox_optimizer(self, iteration, timg, true_label, target_label, const):
+    def blackbox_optimizer(self, iteration, timg, true_label, target_label, const, idx):
         # argument iteration is for debugging
-        var_size = self.real_modifier.size
-        indice = list(range(var_size))
+        n = idx.size(0)
+        var_size = self.var_size
         self.beta = 1.0 / (var_size)  # 使用beta相乘，会使值变得过小，从而loss2越变越大，暂时不知道园有
-        var_noise = np.random.normal(loc=0, scale=1000, size=(self.num_rand_vec, var_size))
-        # var_mean = np.mean(var_noise, axis=1, keepdims=True)
-        # var_std = np.std(var_noise, axis=1, keepdims=True)
-        noise_norm = np.apply_along_axis(np.linalg.norm, 1, var_noise, keepdims=True)
-        var_noise = var_noise / noise_norm
-        var = np.concatenate((self.real_modifier,
-                              self.real_modifier + self.beta * var_noise.reshape(self.num_rand_vec, self.num_channels,
-                                                                                 self.modifier_size, self.modifier_size,
-                                                                                 )), axis=0)
-        modifier = torch.from_numpy(var).cuda().float() # 此时修改modifier内容不会影响var或者self.real_modifier的内容
-        newimg = self.get_newimg(timg, modifier)
-        losses, loss1, loss2, scores = self.loss(newimg, timg, true_label, target_label, const)
-        print("losses :{}, loss1:{}, loss2:{}".format(losses, loss1, loss2))
-        # if (iteration + 1) % 10 == 0:
-        #     time.sleep(5)
-        self.solver(losses.detach().cpu().numpy(), indice, self.grad, self.hess, self.BATCH_SIZE, self.mt, self.vt, self.real_modifier,
-                    self.LEARNING_RATE, self.adam_epoch, self.beta1, self.beta2, not self.USE_TANH, self.beta,
-                    var_noise, self.num_rand_vec)
-        return losses[0].item(), loss2[0].item(), loss1[0].item(), loss2[0].item(), scores[0], newimg[0].unsqueeze(0)
-
-    def post_success_setting(self):
-        self.num_rand_vec = self.post_success_num_rand_vec
-        self.grad = np.zeros((self.num_rand_vec, self.var_size), dtype = np.float32)
-        log.info("Set random vector number to :{}".format(self.num_rand_vec))
+        num_rand_vec = self.num_rand_vec[idx]
+        max_rand_vec = num_rand_vec.max().item()
+        # the image n uses its first num_rand_vec[n] random vectors, the other rows are not queried
+        valid_mask = torch.arange(max_rand_vec, device=idx.device).unsqueeze(0) < num_rand_vec.unsqueeze(1)
+        var_noise = torch.randn(n, max_rand_vec, var_size, device=idx.device)
+        var_noise = var_noise / torch.norm(var_noise, p=2, dim=2, keepdim=True)
+        real_modifier = self.real_modifier[idx]
+        var = torch.cat((real_modifier.view(n, 1, var_size),
+                         real_modifier.view(n, 1, var_size) + self.beta * var_noise), dim=1)  # shape = (n, q+1, var_size)
+        modifier = var.view((n, max_rand_vec + 1) + self.modifier_shape)
+        row_mask = torch.cat((torch.ones(n, 1, dtype=torch.bool, device=idx.device), valid_mask), dim=1)
+        target_label = target_label[idx] if target_label is not None else None
+        losses, loss1, loss2, scores, nimg = self.query_rows(modifier, timg[idx], true_label[idx], target_label,
+                                                             const[idx], row_mask)
+        mt, vt, adam_epoch = self.mt[idx], self.vt[idx], self.adam_epoch[idx]
+        self.solver(losses, mt, vt, real_modifier, self.LEARNING_RATE, adam_epoch, self.beta1, self.beta2,
+                    not self.USE_TANH, self.beta, var_noise, valid_mask)
+        self.mt[idx], self.vt[idx], self.adam_epoch[idx] = mt, vt, adam_epoch
+        self.real_modifier[idx] = real_modifier
+        return losses[:, 0], loss2, loss1, loss2, scores, nimg
+
+    def post_success_setting(self, idx):
+        self.num_rand_vec[idx] = self.post_success_num_rand_vec
+        log.info("Set random vector number of {} images to :{}".format(idx.size(0), self.post_success_num_rand_vec))
 
 class AutoZOOM_AE(AutoZOOM_BiLIN):
 
     def __init__(self, model, dataset, args, decoder):
         super(AutoZOOM_AE, self).__init__(model, dataset, args)
         self.decoder = decoder
-        self.num_rand_vec = 1
         self.post_success_num_rand_vec = args["num_rand_vec"]
-        self.grad = np.zeros((self.num_rand_vec, self.var_size), dtype=np.float32)
-        self.hess = np.zeros(self.BATCH_SIZE, dtype=np.float32)
         self.solver = ADAM
 
     def set_img_modifier(self, modifier):
@@ -529,11 +543,3 @@ class AutoZOOM_AE(AutoZOOM_BiLIN):
             self.decoder_output = self.decoder(modifier)
             self.img_modifier = F.interpolate(self.decoder_output, [self.image_size, self.image_size], mode="bilinear",
                                               align_corners=True)
-
-    def post_success_setting(self):
-        self.num_rand_vec = self.post_success_num_rand_vec
-        self.grad = np.zeros((self.num_rand_vec, self.var_size), dtype = np.float32)
-        log.info("Set random vector number to :{}".format(self.num_rand_vec))
-
-    def get_eval_costs(self):
-        return self.num_rand_vec + 1
\ No newline at end of file
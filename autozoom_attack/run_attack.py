@@ -20,7 +20,7 @@ from dataset.standard_model import StandardModel
 class AutoZoomAttackFramework(object):
 
     def __init__(self, args):
-        self.dataset_loader = DataLoaderMaker.get_test_attacked_data(args["dataset"], 1)
+        self.dataset_loader = DataLoaderMaker.get_test_attacked_data(args["dataset"], args["attack_batch_size"])
         self.total_images = len(self.dataset_loader.dataset)
         self.query_all = torch.zeros(self.total_images)
         self.correct_all = torch.zeros_like(self.query_all)  # number of images
@@ -56,9 +56,9 @@ class AutoZoomAttackFramework(object):
             diff_mse = torch.mean(diff_img.view(-1).pow(2)).item()
             log.info("[AE] MSE:{:.4f}".format(diff_mse))
 
-        batch_size = 1
+        batch_size = args["attack_batch_size"]
         selected = torch.arange(batch_index * batch_size,
-                                (batch_index + 1) * batch_size)  # 选择这个batch的所有图片的index
+                                min((batch_index + 1) * batch_size, self.total_images))  # 选择这个batch的所有图片的index
         if args["attack_type"] == "targeted":
 
             if args["target_type"] == "random":
@@ -205,6 +205,8 @@ if __name__ == "__main__":
     parser.add_argument("-a", "--attack_method", type=str, required=True,
                         choices=["zoo", "zoo_ae", "autozoom_bilin", "autozoom_ae"], help="the attack method")
     parser.add_argument("-b", "--batch_size", type=int, default=None, help="the batch size for zoo, zoo_ae attack")
+    parser.add_argument("--attack_batch_size", type=int, default=100,
+                        help="the number of images that share one solver, their queries are issued by one forward")
     parser.add_argument("-c", "--init_const", type=float, default=1, help="the initial setting of the constant lambda")
     parser.add_argument("-d", "--dataset", type=str, required=True, choices=["CIFAR-10", "CIFAR-100", "ImageNet", "MNIST", "FashionMNIST"])
     parser.add_argument("-m", "--max_iterations", type=int, default=None, help="set 0 to use the default value")
@@ -10,6 +10,7 @@ import random
 from types import SimpleNamespace
 from dataset.standard_model import StandardModel
 from dataset.defensive_model import DefensiveModel
+from dataset.query_profiler import QueryProfiler, ProfiledModel
 import glog as log
 import numpy as np
 import torch
@@ -29,6 +30,7 @@ class BanditsAttack(object):
         self.success_query_all = torch.zeros_like(self.query_all)
         self.not_done_loss_all = torch.zeros_like(self.query_all)
         self.not_done_prob_all = torch.zeros_like(self.query_all)
+        self.profiler = QueryProfiler(self.total_images, args.batch_size, enabled=args.profile)
 
     def norm(self, t):
         assert len(t.shape) == 4
@@ -119,7 +121,7 @@ class BanditsAttack(object):
             upsampler = Upsample(size=(target_model.input_size[-2], target_model.input_size[-1]))
         else:
             upsampler = lambda x: x
-        with torch.no_grad():
+        with torch.no_grad(), self.profiler.uncharged():  # the clean prediction is not a query of the attack
             logit = target_model(images)
         pred = logit.argmax(dim=1)
         query = torch.zeros(args.batch_size).cuda()
@@ -127,6 +129,7 @@ class BanditsAttack(object):
         not_done = correct.clone()  # shape = (batch_size,)
         selected = torch.arange(batch_index * args.batch_size,
                                 min((batch_index + 1) * args.batch_size, self.total_images))  # 选择这个batch的所有图片的index
+        self.profiler.set_batch(selected)
         if args.targeted:
             if args.target_type == 'random':
                 target_labels = torch.randint(low=0, high=CLASS_NUM[args.dataset], size=true_labels.size()).long().cuda()
@@ -162,6 +165,8 @@ class BanditsAttack(object):
             # Loss points for finite difference estimator
             q1_images = adv_images + args.fd_eta * q1 / self.norm(q1)
             q2_images = adv_images + args.fd_eta * q2 / self.norm(q2)
+            # the whole batch is forwarded, but only the images that are not done are charged (query += 2 * not_done)
+            self.profiler.set_active(not_done.bool(), full_batch_rows=True)
             with torch.no_grad():
                 q1_logits = target_model(q1_images)
                 q2_logits = target_model(q2_images)
@@ -179,7 +184,7 @@ class BanditsAttack(object):
             adv_images = image_step(adv_images, grad * correct.view(-1, 1, 1, 1), args.image_lr)  # prior放大后相当于累积的更新量，可以用来更新
             adv_images = proj_step(adv_images)
             adv_images = torch.clamp(adv_images, 0, 1)
-            with torch.no_grad():
+            with torch.no_grad(), self.profiler.uncharged():  # the verification of adv_images is not counted
                 adv_logit = target_model(adv_images)
             adv_pred = adv_logit.argmax(dim=1)
             adv_prob = F.softmax(adv_logit, dim=1)
@@ -211,6 +216,7 @@ class BanditsAttack(object):
 
             if not not_done.byte().any():  # all success
                 break
+        self.profiler.reset_active()
 
 
         for key in ['query', 'correct',  'not_done',
@@ -261,6 +267,9 @@ class BanditsAttack(object):
         with open(result_dump_path, "w") as result_file_obj:
             json.dump(meta_info_dict, result_file_obj, sort_keys=True)
         log.info("done, write stats info to {}".format(result_dump_path))
+        if args.profile:
+            self.profiler.export(result_dump_path)
+            self.profiler.reset()
 
 
 
@@ -320,6 +329,7 @@ if __name__ == "__main__":
     parser.add_argument('--seed', default=0, type=int, help='random seed')
     parser.add_argument('--attack_defense',action="store_true")
     parser.add_argument('--defense_model',type=str, default=None)
+    parser.add_argument('--profile', action="store_true", help='export the query/latency profile next to the result json')
 
     args = parser.parse_args()
     os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
@@ -412,5 +422,7 @@ if __name__ == "__main__":
             model = StandardModel(args.dataset, arch, no_grad=True)
         model.cuda()
         model.eval()
+        if args.profile:
+            model = ProfiledModel(model, attacker.profiler)
         attacker.attack_all_images(args, arch, model, save_result_path)
         model.cpu()
@@ -21,7 +21,12 @@ class BundleBanditsAttack(object):
     def __init__(self, args):
         self.dataset_loader = DataLoaderMaker.get_test_attacked_data(args.dataset, args.batch_size)
         self.total_images = len(self.dataset_loader.dataset)
-        self.query_all = torch.zeros(self.total_images)
+        # each image is attacked with num_targets target classes, the statistics are kept for each (image, target) pair
+        self.num_targets = args.num_targets if args.targeted else 1
+        if self.num_targets == 1:
+            self.query_all = torch.zeros(self.total_images)
+        else:
+            self.query_all = torch.zeros(self.total_images, self.num_targets)
         self.correct_all = torch.zeros_like(self.query_all)  # number of images
         self.not_done_all = torch.zeros_like(self.query_all)  # always set to 0 if the original image is misclassified
         self.success_all = torch.zeros_like(self.query_all)
@@ -112,21 +117,45 @@ class BundleBanditsAttack(object):
 
 
     def bundle_logits(self, logits, target_labels):
-        index_others = []
-        for idx, target in enumerate(target_labels):
-            index_others.append([label for label in range(logits.size(1)) if label != target.item()])
-        index_others = torch.from_numpy(np.array(index_others)).cuda().long()
-        logits_others = torch.gather(logits, 1, index_others)
+        # bundle all non-target logits into one: [logit_target, sum of the other logits]
         logits_target = torch.gather(logits, 1, target_labels.unsqueeze(1))
-        logits_others = torch.sum(logits_others, dim=1, keepdim=True)
+        others_mask = torch.ones_like(logits).scatter_(1, target_labels.unsqueeze(1), 0.0)
+        logits_others = torch.sum(logits * others_mask, dim=1, keepdim=True)
         reformed_logits = torch.cat([logits_target, logits_others],dim=1)
         # reformed_logits = F.softmax(reformed_logits, dim=1)
         return reformed_logits
 
+    def get_target_labels(self, args, logit, true_labels, num_targets):
+        """
+        :return: num_targets different target classes of each image, shape = (batch_size, num_targets)
+        """
+        num_classes = CLASS_NUM[args.dataset]
+        assert num_targets < num_classes, "at most {} target classes can be attacked".format(num_classes - 1)
+        if args.target_type == 'random':
+            if num_targets == 1:
+                target_labels = torch.randint(low=0, high=num_classes, size=true_labels.size()).long().cuda()
+                invalid_target_index = target_labels.eq(true_labels)
+                while invalid_target_index.sum().item() > 0:
+                    target_labels[invalid_target_index] = torch.randint(low=0, high=logit.shape[1],
+                                                                 size=target_labels[invalid_target_index].shape).long().cuda()
+                    invalid_target_index = target_labels.eq(true_labels)
+                return target_labels.unsqueeze(1)
+            random_scores = torch.rand(true_labels.size(0), num_classes, device=true_labels.device)
+            random_scores.scatter_(1, true_labels.unsqueeze(1), -1.0)  # the true label is never chosen
+            return random_scores.topk(num_targets, dim=1)[1]
+        elif args.target_type == 'least_likely':
+            return logit.topk(num_targets, dim=1, largest=False)[1]
+        elif args.target_type == "increment":
+            increment = torch.arange(1, num_targets + 1, device=true_labels.device).unsqueeze(0)
+            return torch.fmod(true_labels.unsqueeze(1) + increment, num_classes)
+        else:
+            raise NotImplementedError('Unknown target_type: {}'.format(args.target_type))
 
     def make_adversarial_examples(self, batch_index, images, true_labels, args, target_model):
         '''
         The attack process for generating adversarial examples with priors.
+        In the targeted attack, each image is attacked with num_targets target classes at the same time,
+        the (image, target class) pairs are stacked along the batch dimension in the image-major order.
         '''
         prior_size = target_model.input_size[-1] if not args.tiling else args.tile_size
         assert args.tiling == (args.dataset == "ImageNet")
@@ -134,109 +163,102 @@ class BundleBanditsAttack(object):
             upsampler = Upsample(size=(target_model.input_size[-2], target_model.input_size[-1]))
         else:
             upsampler = lambda x: x
+        batch_size = images.size(0)
         with torch.no_grad():
             logit = target_model(images)
         pred = logit.argmax(dim=1)
-        query = torch.zeros(args.batch_size).cuda()
-        correct = pred.eq(true_labels).float()  # shape = (batch_size,)
-        not_done = correct.clone()  # shape = (batch_size,)
         selected = torch.arange(batch_index * args.batch_size,
                                 min((batch_index + 1) * args.batch_size, self.total_images))  # 选择这个batch的所有图片的index
         if args.targeted:
-            if args.target_type == 'random':
-                target_labels = torch.randint(low=0, high=CLASS_NUM[args.dataset], size=true_labels.size()).long().cuda()
-                invalid_target_index = target_labels.eq(true_labels)
-                while invalid_target_index.sum().item() > 0:
-                    target_labels[invalid_target_index] = torch.randint(low=0, high=logit.shape[1],
-                                                                 size=target_labels[invalid_target_index].shape).long().cuda()
-                    invalid_target_index = target_labels.eq(true_labels)
-            elif args.target_type == 'least_likely':
-                target_labels = logit.argmin(dim=1)
-            elif args.target_type == "increment":
-                target_labels = torch.fmod(true_labels + 1, CLASS_NUM[args.dataset])
-            else:
-                raise NotImplementedError('Unknown target_type: {}'.format(args.target_type))
+            target_labels = self.get_target_labels(args, logit, true_labels, self.num_targets).view(-1)
         else:
             target_labels = None
-        prior = torch.zeros(args.batch_size, IN_CHANNELS[args.dataset], prior_size, prior_size).cuda()
-        dim = prior.nelement() / args.batch_size               # nelement() --> total number of elements
+        num_rows = batch_size * self.num_targets
+        images = images.repeat_interleave(self.num_targets, dim=0)  # (B * num_targets, C, H, W)
+        true_labels = true_labels.repeat_interleave(self.num_targets)
+        correct = pred.eq(true_labels.view(batch_size, self.num_targets)[:, 0]).repeat_interleave(self.num_targets)
+        not_done = correct.clone()  # shape = (B * num_targets,), bool
+        query = torch.zeros(num_rows).cuda()
+        not_done_loss = torch.zeros(num_rows).cuda()
+        not_done_prob = torch.zeros(num_rows).cuda()
+        prior = torch.zeros(num_rows, IN_CHANNELS[args.dataset], prior_size, prior_size).cuda()
+        dim = prior.nelement() / num_rows               # nelement() --> total number of elements
         prior_step = self.gd_prior_step if args.norm == 'l2' else self.eg_prior_step
         image_step = self.l2_image_step if args.norm == 'l2' else self.linf_image_step
         proj_maker = self.l2_proj if args.norm == 'l2' else self.linf_proj  # 调用proj_maker返回的是一个函数
-        proj_step = proj_maker(images, args.epsilon)
         criterion = self.cw_loss if args.loss == "cw" else self.xent_loss
         # Loss function
         adv_images = images.clone()
         for step_index in range(args.max_queries // 2):
+            if not not_done.any():  # all success
+                break
+            idx = torch.nonzero(not_done).view(-1)  # only the (image, target class) pairs that are not done are queried
+            idx_true_labels = true_labels[idx]
+            idx_target_labels = target_labels[idx] if args.targeted else None
             # Create noise for exporation, estimate the gradient, and take a PGD step
-            exp_noise = args.exploration * torch.randn_like(prior) / (dim ** 0.5)  # parameterizes the exploration to be done around the prior
+            exp_noise = args.exploration * torch.randn_like(prior[idx]) / (dim ** 0.5)  # parameterizes the exploration to be done around the prior
             # Query deltas for finite difference estimator
-            exp_noise = exp_noise.cuda()
-            q1 = upsampler(prior + exp_noise)  # 这就是Finite Difference算法， prior相当于论文里的v，这个prior也会更新，把梯度累积上去
-            q2 = upsampler(prior - exp_noise)   # prior 相当于累积的更新量，用这个更新量，再去修改image，就会变得非常准
-            # Loss points for finite difference estimator
-            q1_images = adv_images + args.fd_eta * q1 / self.norm(q1)
-            q2_images = adv_images + args.fd_eta * q2 / self.norm(q2)
+            q1 = upsampler(prior[idx] + exp_noise)  # 这就是Finite Difference算法， prior相当于论文里的v，这个prior也会更新，把梯度累积上去
+            q2 = upsampler(prior[idx] - exp_noise)   # prior 相当于累积的更新量，用这个更新量，再去修改image，就会变得非常准
+            # Loss points for finite difference estimator, q1 and q2 are stacked in one forward
+            q_images = torch.cat([adv_images[idx] + args.fd_eta * q1 / self.norm(q1),
+                                  adv_images[idx] + args.fd_eta * q2 / self.norm(q2)], 0)
             with torch.no_grad():
-                q1_logits = target_model(q1_images)
-                q2_logits = target_model(q2_images)
+                q_logits = target_model(q_images)
             if args.targeted:
-                q1_logits = self.bundle_logits(q1_logits, target_labels)
-                q2_logits = self.bundle_logits(q2_logits, target_labels)
-
-            l1 = criterion(q1_logits, true_labels, target_labels)
-            l2 = criterion(q2_logits, true_labels, target_labels)
+                q_logits = self.bundle_logits(q_logits, idx_target_labels.repeat(2))
+            l1, l2 = criterion(q_logits, idx_true_labels.repeat(2),
+                               idx_target_labels.repeat(2) if args.targeted else None).chunk(2)
             # Finite differences estimate of directional derivative
             est_deriv = (l1 - l2) / (args.fd_eta * args.exploration)  # 方向导数 , l1和l2是loss
             # 2-query gradient estimate
             est_grad = est_deriv.view(-1, 1, 1, 1) * exp_noise  # B, C, H, W,
             # Update the prior with the estimated gradient
-            prior = prior_step(prior, est_grad, args.online_lr)  # 注意，修正的是prior,这就是bandit算法的精髓
-            grad = upsampler(prior)  # prior相当于梯度
+            prior[idx] = prior_step(prior[idx], est_grad, args.online_lr)  # 注意，修正的是prior,这就是bandit算法的精髓
+            grad = upsampler(prior[idx])  # prior相当于梯度
             ## Update the image:
             # take a pgd step using the prior
-            adv_images = image_step(adv_images, grad * correct.view(-1, 1, 1, 1), args.image_lr)  # prior放大后相当于累积的更新量，可以用来更新
-            adv_images = proj_step(adv_images)
-            adv_images = torch.clamp(adv_images, 0, 1)
+            idx_adv_images = image_step(adv_images[idx], grad, args.image_lr)  # prior放大后相当于累积的更新量，可以用来更新
+            idx_adv_images = proj_maker(images[idx], args.epsilon)(idx_adv_images)
+            adv_images[idx] = torch.clamp(idx_adv_images, 0, 1)
             with torch.no_grad():
-                adv_logit = target_model(adv_images)
+                adv_logit = target_model(adv_images[idx])
             adv_pred = adv_logit.argmax(dim=1)
             adv_prob = F.softmax(adv_logit, dim=1)
-            adv_loss = criterion(adv_logit, true_labels, target_labels)
+            adv_loss = criterion(adv_logit, idx_true_labels, idx_target_labels)
             ## Continue query count
-            query = query + 2 * not_done
+            query[idx] += 2
             if args.targeted:
-                not_done = not_done * (1 - adv_pred.eq(target_labels).float()).float()  # not_done初始化为 correct, shape = (batch_size,)
+                idx_not_done = ~adv_pred.eq(idx_target_labels)  # not_done初始化为 correct
             else:
-                not_done = not_done * adv_pred.eq(true_labels).float()  # 只要是跟原始label相等的，就还需要query，还没有成功
-            success = (1 - not_done) * correct
-            success_query = success * query
-            not_done_loss = adv_loss * not_done
-            not_done_prob = adv_prob[torch.arange(args.batch_size), true_labels] * not_done
+                idx_not_done = adv_pred.eq(idx_true_labels)  # 只要是跟原始label相等的，就还需要query，还没有成功
+            not_done[idx] = idx_not_done
+            success = (~not_done) & correct
+            success_query = success.float() * query
+            not_done_loss[idx] = adv_loss * idx_not_done.float()
+            not_done_prob[idx] = adv_prob[torch.arange(idx.size(0)), idx_true_labels] * idx_not_done.float()
 
             log.info('Attacking image {} - {} / {}, step {}, max query {}'.format(
                 batch_index * args.batch_size, (batch_index + 1) * args.batch_size,
                 self.total_images, step_index + 1, int(query.max().item())
             ))
-            log.info('        correct: {:.4f}'.format(correct.mean().item()))
-            log.info('       not_done: {:.4f}'.format(not_done[correct.byte()].mean().item()))
+            log.info('        correct: {:.4f}'.format(correct.float().mean().item()))
+            log.info('       not_done: {:.4f}'.format(not_done[correct].float().mean().item()))
             log.info('      fd_scalar: {:.9f}'.format((l1 - l2).mean().item()))
             if success.sum().item() > 0:
-                log.info('     mean_query: {:.4f}'.format(success_query[success.byte()].mean().item()))
-                log.info('   median_query: {:.4f}'.format(success_query[success.byte()].median().item()))
+                log.info('     mean_query: {:.4f}'.format(success_query[success].mean().item()))
+                log.info('   median_query: {:.4f}'.format(success_query[success].median().item()))
             if not_done.sum().item() > 0:
-                log.info('  not_done_loss: {:.4f}'.format(not_done_loss[not_done.byte()].mean().item()))
-                log.info('  not_done_prob: {:.4f}'.format(not_done_prob[not_done.byte()].mean().item()))
-
-            if not not_done.byte().any():  # all success
-                break
-
+                log.info('  not_done_loss: {:.4f}'.format(not_done_loss[not_done].mean().item()))
+                log.info('  not_done_prob: {:.4f}'.format(not_done_prob[not_done].mean().item()))
 
+        success = (~not_done) & correct
+        success_query = success.float() * query
         for key in ['query', 'correct',  'not_done',
                     'success', 'success_query', 'not_done_loss', 'not_done_prob']:
             value_all = getattr(self, key+"_all")
             value = eval(key)
-            value_all[selected] = value.detach().float().cpu()  # 由于value_all是全部图片都放在一个数组里，当前batch选择出来
+            value_all[selected] = value.detach().float().cpu().view(value_all[selected].size())  # 由于value_all是全部图片都放在一个数组里，当前batch选择出来
 
 
     def attack_all_images(self, args, arch_name, target_model, result_dump_path):
@@ -334,6 +356,9 @@ if __name__ == "__main__":
     parser.add_argument('--test_archs', action="store_true")
     parser.add_argument('--targeted', action="store_true")
     parser.add_argument('--target_type',type=str, default='increment', choices=['random', 'least_likely',"increment"])
+    parser.add_argument('--num_targets', type=int, default=1,
+                        help='the number of target classes of each image in the targeted attack, all target classes '
+                             'of one image are attacked together in one stacked batch')
     parser.add_argument('--exp-dir', default='logs', type=str,
                         help='directory to save results and logs')
     parser.add_argument('--seed', default=0, type=int, help='random seed')
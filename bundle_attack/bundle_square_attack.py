@@ -141,13 +141,10 @@ class BundleSquareAttack(object):
             return -F.cross_entropy(logits, label, reduction='none')
 
     def bundle_logits(self, logits, target_labels):
-        index_others = []
-        for idx, target in enumerate(target_labels):
-            index_others.append([label for label in range(logits.size(1)) if label != target.item()])
-        index_others = torch.from_numpy(np.array(index_others)).cuda().long()
-        logits_others = torch.gather(logits, 1, index_others)
+        # bundle all non-target logits into one: [logit_target, sum of the other logits]
         logits_target = torch.gather(logits, 1, target_labels.unsqueeze(1))
-        logits_others = torch.sum(logits_others, dim=1, keepdim=True)
+        others_mask = torch.ones_like(logits).scatter_(1, target_labels.unsqueeze(1), 0.0)
+        logits_others = torch.sum(logits * others_mask, dim=1, keepdim=True)
         reformed_logits = torch.cat([logits_target, logits_others], dim=1)
         reformed_logits = F.softmax(reformed_logits, dim=1)
         return reformed_logits
@@ -8,6 +8,7 @@ import json
 from config import MODELS_TEST_STANDARD, CLASS_NUM, IN_CHANNELS
 from dataset.dataset_loader_maker import DataLoaderMaker
 from dataset.defensive_model import DefensiveModel
+from dataset.query_profiler import QueryProfiler, ProfiledModel
 from dataset.standard_model import StandardModel
 from utils import *
 import itertools
@@ -67,6 +68,7 @@ class CorrAttack_Diff(object):
         self.success_all = torch.zeros_like(self.query_all)
         self.success_query_all = torch.zeros_like(self.query_all)
         self.maximum_queries = self.config["max_queries"]
+        self.profiler = QueryProfiler(self.total_images, self.batch_size, enabled=args.profile)
 
     def split_block(self, image, upper_left, lower_right, block_size):
         blocks = []
@@ -272,7 +274,10 @@ class CorrAttack_Diff(object):
                                        align_corners=False)
             images = images.to(self.device)
             true_labels = true_labels.to(self.device)
-            with torch.no_grad():
+            selected = torch.arange(batch_index * args.batch_size,
+                                    min((batch_index + 1) * args.batch_size, self.total_images))  # 选择这个batch的所有图片的index
+            self.profiler.set_batch(selected)
+            with torch.no_grad(), self.profiler.uncharged():  # the clean prediction is not a query of the attack
                 logit = self.model(images)
             pred = logit.argmax(dim=1)
             query = torch.zeros(args.batch_size).to(self.device)
@@ -304,8 +309,6 @@ class CorrAttack_Diff(object):
             success = torch.tensor([int(success)]).float()
             not_done = torch.ones_like(success) - success
             success_query = success * query
-            selected = torch.arange(batch_index * args.batch_size,
-                                    min((batch_index + 1) * args.batch_size, self.total_images))  # 选择这个batch的所有图片的index
             for key in ['query', 'correct', 'not_done',
                         'success', 'success_query']:
                 value_all = getattr(self, key + "_all")
@@ -329,6 +332,9 @@ class CorrAttack_Diff(object):
         with open(result_dump_path, "w") as result_file_obj:
             json.dump(meta_info_dict, result_file_obj, sort_keys=True)
         log.info("done, write stats info to {}".format(result_dump_path))
+        if args.profile:
+            self.profiler.export(result_dump_path)
+            self.profiler.reset()
 
 
 def get_exp_dir_name(dataset, norm, targeted, target_type, args):
@@ -373,6 +379,7 @@ if __name__ == "__main__":
                         choices=['CIFAR-10', 'CIFAR-100', 'ImageNet', "FashionMNIST", "MNIST", "TinyImageNet"],
                         help='which dataset to use')
     parser.add_argument('--norm', type=str, default="linf", help='Which lp constraint to run bandits [linf|l2]')
+    parser.add_argument('--profile', action="store_true", help='export the query/latency profile next to the result json')
 
     args = parser.parse_args()
     os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
@@ -443,6 +450,8 @@ if __name__ == "__main__":
 
         function = Function(model, state['batch_size'], state['margin'], CLASS_NUM[args.dataset], state['target'])
         attacker = CorrAttack_Diff(function, state, device)
+        if args.profile:  # Function chunks the queries of one image, each chunk is charged to that image
+            function.model = attacker.model = ProfiledModel(model, attacker.profiler)
         attacker.attack_all_images(args, arch, save_result_path)
         model.cpu()
 
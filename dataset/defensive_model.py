@@ -361,9 +361,12 @@ class DefensiveModel(nn.Module):
             self.input_space = 'RGB'
             self.input_range = [0, 1]
             self.input_size = [IN_CHANNELS[dataset], IMAGE_SIZE[dataset][0], IMAGE_SIZE[dataset][1]]
-            pretrained_model_path = "{root}/train_pytorch_model/adversarial_train/feature_denoise/pgd_adv_train_{dataset}@{arch}_NonLocal_Filter_3.pth.tar".format(
-                root=PY_ROOT, dataset=dataset, arch=arch)
-            assert os.path.exists(pretrained_model_path), "{} does not exist!".format(pretrained_model_path)
+            # adv_train_feature_denoise.py prefixes the checkpoint with its --train_mode, the pgd one is preferred
+            model_path_list = ["{root}/train_pytorch_model/adversarial_train/feature_denoise/{train_mode}_adv_train_{dataset}@{arch}_NonLocal_Filter_3.pth.tar".format(
+                root=PY_ROOT, train_mode=train_mode, dataset=dataset, arch=arch) for train_mode in ["pgd", "replay"]]
+            model_path_list = [model_path for model_path in model_path_list if os.path.exists(model_path)]
+            assert len(model_path_list) > 0, "Neither pgd_adv_train nor replay_adv_train model of {}@{} exists!".format(dataset, arch)
+            pretrained_model_path = model_path_list[0]
             state_dict = torch.load(pretrained_model_path, map_location=lambda storage, location: storage)["state_dict"]
             filtered_dict = {}
             for key, value in state_dict.items():
@@ -1,6 +1,7 @@
 import glob
 import os
 import random
+from collections import OrderedDict
 
 import numpy as np
 import torch
@@ -15,18 +16,41 @@ from dataset.standard_model import StandardModel
 from dataset.tiny_imagenet import TinyImageNet
 
 
+class ResidentModelCache(object):
+    """
+    Keep at most max_resident models on GPU, the least recently used one is moved back to CPU when a new arch comes.
+    """
+    def __init__(self, model_dict, max_resident):
+        self.model_dict = model_dict
+        self.max_resident = max_resident
+        self.resident = OrderedDict()
+
+    def get(self, arch):
+        if arch in self.resident:
+            self.resident.move_to_end(arch)
+            return self.resident[arch]
+        while len(self.resident) >= self.max_resident:
+            _, evicted_model = self.resident.popitem(last=False)
+            evicted_model.cpu()
+        model = self.model_dict[arch].cuda()
+        self.resident[arch] = model
+        return model
+
+
 class MetaImgOnlineGradTaskDataset(data.Dataset):
     """
     Support 和query数据用同样的PGD 40 sequence, support数据是指用0~20 PGD的前一半迭代，或指定几个监督信号， query数据是指用20~40的后一半
     """
-    def __init__(self, tot_num_tasks, dataset, inner_batch_size, protocol):
+    def __init__(self, tot_num_tasks, dataset, inner_batch_size, protocol, max_resident_models=None):
         """
         Args:
             num_samples_per_class: num samples to generate "per class" in one batch
             batch_size: size of meta batch size (e.g. number of functions)
+            max_resident_models: the number of models kept on GPU, default is all models (2 models for ImageNet)
         """
         self.img_size = IMAGE_SIZE[dataset]
         self.dataset = dataset
+        self.inner_batch_size = inner_batch_size
 
         if protocol == SPLIT_DATA_PROTOCOL.TRAIN_I_TEST_II:
             self.model_names = MODELS_TRAIN_STANDARD[self.dataset]
@@ -39,9 +63,10 @@ class MetaImgOnlineGradTaskDataset(data.Dataset):
         for arch in self.model_names:
             if StandardModel.check_arch(arch, dataset):
                 model = StandardModel(dataset, arch, no_grad=False).eval()
-                if dataset != "ImageNet":
-                    model = model.cuda()
                 self.model_dict[arch] = model
+        if max_resident_models is None:
+            max_resident_models = 2 if dataset == "ImageNet" else len(self.model_dict)
+        self.model_cache = ResidentModelCache(self.model_dict, max_resident_models)
         is_train = True
         preprocessor = DataLoaderMaker.get_preprocessor(IMAGE_SIZE[dataset], is_train)
         if dataset == "CIFAR-10":
@@ -74,32 +99,109 @@ class MetaImgOnlineGradTaskDataset(data.Dataset):
         second_max_logit = logit[torch.arange(logit.shape[0]), second_max_index]
         return second_max_logit - gt_logit
 
-    def __getitem__(self, task_index):
-        data_json = self.all_tasks[task_index]
-        arch = data_json["arch"]
-        # print("using {}".format(arch))
-        image_indexes = data_json["image"]
-        images, labels = [], []
-        for image_index in image_indexes:
-            image, label = self.train_dataset[image_index]
-            images.append(image)
-            labels.append(label)
-        images, labels = torch.stack(images).cuda(), torch.from_numpy(np.array(labels)).cuda().long()
+    def compute_grad(self, images, labels, arch):
+        """
+        Compute the gradients of the tasks that share the same arch by one forward/backward.
+        :param images: shape of (T, inner_batch_size, C, H, W) or (inner_batch_size, C, H, W)
+        :param labels: shape of (T, inner_batch_size) or (inner_batch_size,)
+        :return: images and gradients of the same shape as the input images
+        """
+        shape = images.size()
+        images = images.view(-1, *shape[-3:]).cuda()
+        labels = labels.view(-1).cuda().long()
         images.requires_grad_()
-        model = self.model_dict[arch].cuda()
+        model = self.model_cache.get(arch)
         logits = model(images)
-        loss = self.cw_loss(logits, labels).mean()
+        # each task is averaged over its own inner batch, as if the tasks were computed one by one
+        loss = self.cw_loss(logits, labels).sum() / shape[-4] if len(shape) == 5 else self.cw_loss(logits, labels).mean()
         model.zero_grad()
         loss.backward()
         grad_gt = images.grad
-        if self.dataset == "ImageNet":
-            self.model_dict[arch].cpu()
-        return images.detach(), grad_gt.detach()
+        return images.detach().view(shape), grad_gt.detach().view(shape)
+
+    def __getitem__(self, task_index):
+        images, labels, arch = OnlineGradTaskImageView.load_task(self.train_dataset, self.all_tasks[task_index])
+        return self.compute_grad(images, labels, arch)
+
+    def __len__(self):
+        return len(self.all_tasks)
+
+    def grouped_task_loader(self, meta_batch_size, num_workers=4, shuffle=True):
+        """
+        Iterate the tasks in meta batches whose tasks share the same arch, the images are loaded and augmented in
+        the workers of DataLoader, and the gradients are computed in the main process with the resident models.
+        :return: generator of (images, grads, arch), images and grads are shape of (T, inner_batch_size, C, H, W)
+        """
+        sampler = ArchGroupedTaskSampler(self.all_tasks, meta_batch_size, shuffle)
+        loader = data.DataLoader(OnlineGradTaskImageView(self.train_dataset, self.all_tasks), batch_sampler=sampler,
+                                 num_workers=num_workers, pin_memory=True, collate_fn=OnlineGradTaskImageView.collate)
+        for images, labels, arch in loader:
+            images, grads = self.compute_grad(images, labels, arch)
+            yield images, grads, arch
+
+
+class OnlineGradTaskImageView(data.Dataset):
+    """
+    The CPU part of MetaImgOnlineGradTaskDataset (loading and augmenting the images of one task), it does not hold any
+    model, so that it can be sent to the DataLoader workers.
+    """
+    def __init__(self, train_dataset, all_tasks):
+        self.train_dataset = train_dataset
+        self.all_tasks = all_tasks
+
+    @staticmethod
+    def load_task(train_dataset, task):
+        images, labels = [], []
+        for image_index in task["image"]:
+            image, label = train_dataset[image_index]
+            images.append(image)
+            labels.append(label)
+        return torch.stack(images), torch.from_numpy(np.array(labels)).long(), task["arch"]
+
+    @staticmethod
+    def collate(batch):
+        archs = set(arch for _, _, arch in batch)
+        assert len(archs) == 1, "the tasks of one meta batch must share the same arch, but got {}".format(archs)
+        images = torch.stack([images for images, _, _ in batch])
+        labels = torch.stack([labels for _, labels, _ in batch])
+        return images, labels, batch[0][2]
+
+    def __getitem__(self, task_index):
+        return self.load_task(self.train_dataset, self.all_tasks[task_index])
 
     def __len__(self):
         return len(self.all_tasks)
 
 
+class ArchGroupedTaskSampler(data.Sampler):
+    """
+    Yield the meta batches of task indexes, all the tasks of one meta batch use the same arch, the order of the meta
+    batches is shuffled, so consecutive batches still visit different archs.
+    """
+    def __init__(self, all_tasks, meta_batch_size, shuffle=True):
+        self.meta_batch_size = meta_batch_size
+        self.shuffle = shuffle
+        self.arch_tasks = OrderedDict()
+        for task_index, task in all_tasks.items():
+            self.arch_tasks.setdefault(task["arch"], []).append(task_index)
+
+    def __iter__(self):
+        batches = []
+        for task_indexes in self.arch_tasks.values():
+            task_indexes = list(task_indexes)
+            if self.shuffle:
+                random.shuffle(task_indexes)
+            for begin in range(0, len(task_indexes), self.meta_batch_size):
+                batches.append(task_indexes[begin:begin + self.meta_batch_size])
+        if self.shuffle:
+            random.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        return sum((len(task_indexes) + self.meta_batch_size - 1) // self.meta_batch_size
+                   for task_indexes in self.arch_tasks.values())
+
+
 class MetaImgOfflineGradTaskDataset(data.Dataset):
 
     def __init__(self, tot_num_tasks, dataset, inner_batch_size, protocol):
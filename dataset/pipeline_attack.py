@@ -0,0 +1,234 @@
+import json
+from contextlib import nullcontext
+
+import glog as log
+import numpy as np
+import torch
+from torch.nn import functional as F
+
+from config import CLASS_NUM
+
+
+class PipelineAttack(object):
+    """
+    The pipeline attack of LeBA for any batch attack: the images are attacked in slot_num slots, every refill_interval
+    steps (or when all slots are done) the finished images are recorded and newly loaded images are swapped into
+    their slots, so that a batch never waits for its slowest image.
+    The attacker only implements the following three methods on a state dict, each value of the state is a tensor
+    whose first dimension is the image:
+        init_state(images, true_labels, target_labels, target_model, args) -> state,
+                   it must contain "adv_images", "query" and "success"
+        step(state, target_model, args) -> state, one iteration of the images that are not done
+        is_done(state, args) -> bool tensor, the images that are successful or run out of the query budget
+    The driver adds the key "slot" (the slot index of each image) to the state, an attack that keeps
+    per-image resources outside the state (e.g. the fine-tuned weights of a simulator) can use it as the key.
+    """
+    def __init__(self, attacker, dataset_loader, dataset, slot_num, refill_interval=50):
+        self.attacker = attacker
+        self.dataset_loader = dataset_loader
+        self.dataset = dataset
+        self.total_images = len(dataset_loader.dataset)
+        self.slot_num = slot_num
+        self.refill_interval = refill_interval
+        self.profiler = getattr(attacker, "profiler", None)
+
+        self.query_all = torch.zeros(self.total_images)
+        self.correct_all = torch.zeros_like(self.query_all)  # number of images
+        self.not_done_all = torch.zeros_like(self.query_all)  # always set to 0 if the original image is misclassified
+        self.success_all = torch.zeros_like(self.query_all)
+        self.success_query_all = torch.zeros_like(self.query_all)
+        self.not_done_prob_all = torch.zeros_like(self.query_all)
+
+    def image_stream(self, target_model):
+        image_index = 0
+        for data_tuple in self.dataset_loader:
+            if self.dataset == "ImageNet":
+                if target_model.input_size[-1] >= 299:
+                    images, true_labels = data_tuple[1], data_tuple[2]
+                else:
+                    images, true_labels = data_tuple[0], data_tuple[2]
+            else:
+                images, true_labels = data_tuple[0], data_tuple[1]
+            if images.size(-1) != target_model.input_size[-1]:
+                images = F.interpolate(images, size=target_model.input_size[-1], mode='bilinear', align_corners=True)
+            selected = torch.arange(image_index, image_index + images.size(0))
+            image_index += images.size(0)
+            yield selected, images, true_labels
+
+    def get_target_labels(self, args, logit, true_labels):
+        if args.target_type == 'random':
+            target_labels = torch.randint(low=0, high=CLASS_NUM[args.dataset], size=true_labels.size()).long().cuda()
+            invalid_target_index = target_labels.eq(true_labels)
+            while invalid_target_index.sum().item() > 0:
+                target_labels[invalid_target_index] = torch.randint(low=0, high=logit.shape[1],
+                                                                    size=target_labels[invalid_target_index].shape).long().cuda()
+                invalid_target_index = target_labels.eq(true_labels)
+        elif args.target_type == 'least_likely':
+            target_labels = logit.argmin(dim=1)
+        elif args.target_type == "increment":
+            target_labels = torch.fmod(true_labels + 1, CLASS_NUM[args.dataset])
+        else:
+            raise NotImplementedError('Unknown target_type: {}'.format(args.target_type))
+        return target_labels
+
+    def load_images(self, stream, num, target_model):
+        """
+        Load num correctly classified images, the misclassified images are recorded directly (correct = 0).
+        :return: global indexes, images, true labels of at most num images
+        """
+        selected_list, images_list, labels_list = [], [], []
+        loaded = 0
+        while loaded < num:
+            if not self.pending:
+                try:
+                    self.pending.append(next(stream))
+                except StopIteration:
+                    break
+            selected, images, true_labels = self.pending.pop(0)
+            if selected.size(0) > num - loaded:
+                rest = num - loaded
+                self.pending.insert(0, (selected[rest:], images[rest:], true_labels[rest:]))
+                selected, images, true_labels = selected[:rest], images[:rest], true_labels[:rest]
+            images, true_labels = images.cuda(), true_labels.cuda()
+            with torch.no_grad():
+                logit = self.target_model_forward(target_model, images)
+            correct = logit.argmax(dim=1).eq(true_labels)
+            self.correct_all[selected] = correct.float().cpu()
+            correct_idx = torch.nonzero(correct).view(-1)
+            selected_list.append(selected[correct_idx.cpu()])
+            images_list.append(images[correct_idx])
+            labels_list.append(true_labels[correct_idx])
+            loaded += correct_idx.size(0)
+        if loaded == 0:
+            return None
+        return torch.cat(selected_list), torch.cat(images_list), torch.cat(labels_list)
+
+    def uncharged(self):
+        # the forwards which are not queries of the attack (e.g. the clean prediction) are not charged to any image
+        return self.profiler.uncharged() if self.profiler is not None else nullcontext()
+
+    def target_model_forward(self, target_model, images):
+        # the clean prediction of the new images is not charged to the images in the slots
+        with self.uncharged():
+            return target_model(images)
+
+    def record(self, rows, state, target_model, args):
+        """
+        Record the statistics of the finished images in rows into the *_all tensors.
+        """
+        selected = self.slot_image_index[rows]
+        query = state["query"][rows.to(state["query"].device)].detach().float().cpu()
+        success = state["success"][rows.to(state["success"].device)].detach().float().cpu()
+        success = success * (query <= args.max_queries).float()  # out of the query budget is not successful
+        with torch.no_grad(), self.uncharged():  # the final verification is not a query of the attack
+            adv_logit = target_model(state["adv_images"][rows.to(state["adv_images"].device)].float().cuda())
+        adv_prob = F.softmax(adv_logit, dim=1).detach().cpu()
+        true_labels = self.slot_true_labels[rows.to(self.slot_true_labels.device)].cpu()
+        not_done = 1 - success
+        self.query_all[selected] = query
+        self.not_done_all[selected] = not_done
+        self.success_all[selected] = success
+        self.success_query_all[selected] = success * query
+        self.not_done_prob_all[selected] = adv_prob[torch.arange(rows.size(0)), true_labels].float() * not_done
+        for image_index, image_query, image_success in zip(selected.tolist(), query.tolist(), success.tolist()):
+            log.info("{}-th image success: {}, query: {}".format(image_index, bool(image_success), int(image_query)))
+
+    def refill(self, stream, state, target_model, args):
+        """
+        Record the finished images and swap the newly loaded images into their slots.
+        :return: the new state, None if there is no image left to attack
+        """
+        if state is not None:
+            done = self.attacker.is_done(state, args).bool().cpu() & self.occupied
+            done_rows = torch.nonzero(done).view(-1)
+            if done_rows.size(0) > 0:
+                self.record(done_rows, state, target_model, args)
+                self.occupied[done_rows] = False
+            free_rows = torch.nonzero(~self.occupied).view(-1)
+        else:
+            free_rows = torch.arange(self.slot_num)
+        new_images = self.load_images(stream, free_rows.size(0), target_model)
+        if new_images is not None:
+            selected, images, true_labels = new_images
+            target_labels = self.get_target_labels(args, self.target_model_forward(target_model, images),
+                                                   true_labels) if args.targeted else None
+            if self.profiler is not None:  # the initial queries (if any) are charged to the new images
+                self.profiler.set_batch(selected)
+            new_state = self.attacker.init_state(images, true_labels, target_labels, target_model, args)
+            if state is None:  # the first refill allocates the slots
+                state = new_state
+                state["slot"] = torch.arange(images.size(0))  # fewer slots if the dataset is smaller than slot_num
+                self.occupied = torch.ones(images.size(0)).bool()
+                self.slot_image_index = selected.clone()
+                self.slot_true_labels = true_labels.clone()
+            else:
+                rows = free_rows[:images.size(0)]
+                for key, value in new_state.items():
+                    state[key][rows.to(state[key].device)] = value
+                self.occupied[rows] = True
+                self.slot_image_index[rows] = selected
+                self.slot_true_labels[rows.to(self.slot_true_labels.device)] = true_labels
+            log.info("Load {} new images into the slots, {} images are loaded".format(images.size(0),
+                                                                                      int(selected[-1].item()) + 1))
+        if state is None or not self.occupied.any():
+            return None
+        if self.profiler is not None:
+            self.profiler.set_batch(self.slot_image_index)
+        return state
+
+    def attack_all_images(self, args, arch_name, target_model, result_dump_path):
+        stream = self.image_stream(target_model)
+        self.pending = []
+        self.occupied = None
+        state = self.refill(stream, None, target_model, args)
+        step_index = 0
+        while state is not None:
+            active = (~self.attacker.is_done(state, args).bool().cpu()) & self.occupied
+            if not active.any() or (step_index > 0 and step_index % self.refill_interval == 0):
+                state = self.refill(stream, state, target_model, args)
+                step_index += 1
+                continue
+            rows = torch.nonzero(active).view(-1)
+            if self.profiler is not None:
+                self.profiler.set_active(rows)
+            sub_state = {key: value[rows.to(value.device)] for key, value in state.items()}
+            sub_state = self.attacker.step(sub_state, target_model, args)
+            for key, value in sub_state.items():
+                state[key][rows.to(state[key].device)] = value
+            step_index += 1
+            if step_index % 10 == 0:
+                log.info('Pipeline attack step {}, {} images are attacking, max query {}'.format(
+                    step_index, rows.size(0), int(state["query"][rows.to(state["query"].device)].max().item())))
+        self.save_result(args, arch_name, result_dump_path)
+
+    def save_result(self, args, arch_name, result_dump_path):
+        log.info('{} is attacked finished ({} images)'.format(arch_name, self.total_images))
+        log.info('     avg correct: {:.4f}'.format(self.correct_all.mean().item()))
+        log.info('     avg not_done: {:.4f}'.format(self.not_done_all.mean().item()))  # 有多少图没做完
+        if self.success_all.sum().item() > 0:
+            log.info('     avg mean_query: {:.4f}'.format(self.success_query_all[self.success_all.byte()].mean().item()))
+            log.info('     avg median_query: {:.4f}'.format(self.success_query_all[self.success_all.byte()].median().item()))
+            log.info('     max query: {}'.format(self.success_query_all[self.success_all.byte()].max().item()))
+        if self.not_done_all.sum().item() > 0:
+            log.info('  avg not_done_prob: {:.4f}'.format(self.not_done_prob_all[self.not_done_all.byte()].mean().item()))
+        log.info('Saving results to {}'.format(result_dump_path))
+        meta_info_dict = {"avg_correct": self.correct_all.mean().item(),
+                          "avg_not_done": self.not_done_all[self.correct_all.byte()].mean().item(),
+                          "mean_query": self.success_query_all[self.success_all.byte()].mean().item(),
+                          "median_query": self.success_query_all[self.success_all.byte()].median().item(),
+                          "max_query": self.success_query_all[self.success_all.byte()].max().item(),
+                          "correct_all": self.correct_all.detach().cpu().numpy().astype(np.int32).tolist(),
+                          "not_done_all": self.not_done_all.detach().cpu().numpy().astype(np.int32).tolist(),
+                          "query_all": self.query_all.detach().cpu().numpy().astype(np.int32).tolist(),
+                          "not_done_prob": self.not_done_prob_all[self.not_done_all.byte()].mean().item(),
+                          "pipeline_slots": self.slot_num,
+                          "refill_interval": self.refill_interval,
+                          "args": vars(args)}
+        with open(result_dump_path, "w") as result_file_obj:
+            json.dump(meta_info_dict, result_file_obj, sort_keys=True)
+        log.info("done, write stats info to {}".format(result_dump_path))
+        if self.profiler is not None and self.profiler.enabled:
+            self.profiler.export(result_dump_path)
+            self.profiler.reset()
+        for key in ['query', 'correct', 'not_done', 'success', 'success_query', 'not_done_prob']:
+            getattr(self, key + "_all").fill_(0)
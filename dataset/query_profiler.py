@@ -0,0 +1,211 @@
+import json
+import os.path as osp
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import glog as log
+import numpy as np
+import torch
+from torch import nn
+
+
+class QueryProfiler(object):
+    """
+    A QueryProfiler records every model call issued by an attack: the number of queries charged to each image,
+    the forward latency, the batch occupancy, the host->device transfer time of the inputs.
+    One profiler is shared by the target model and the simulator (or any other surrogate), each call is recorded
+    under a tag (e.g., "target", "simulator"), so the ratio of simulator calls to target calls is available too.
+    The calls that are not queries of the attack (e.g. the clean prediction and the final verification of the
+    adversarial images) run inside uncharged(), they are recorded under the tag "{tag}_uncharged" and are not charged
+    to any image, thus query_all of a tag is the query count of the attack itself.
+    A disabled profiler records nothing, thus the attack can call it unconditionally.
+    """
+    def __init__(self, total_images, batch_size, enabled=True):
+        self.total_images = total_images
+        self.batch_size = batch_size
+        self.enabled = enabled
+        self.query_all = defaultdict(lambda: torch.zeros(self.total_images))  # tag -> queries of each image
+        self.calls = defaultdict(int)
+        self.images = defaultdict(int)
+        self.forward_time = defaultdict(float)
+        self.transfer_time = defaultdict(float)
+        self.occupancy = defaultdict(float)
+        self.batch_index = None
+        self.active_index = None
+        self.row_index = None  # the images of the rows of the next calls
+        self.uncharged_depth = 0
+        self.start_time = time.time()
+
+    def set_batch(self, selected):
+        """
+        :param selected: the global indexes of the images in current batch, (batch_size,)
+        """
+        self.batch_index = selected.detach().cpu().long()
+        self.active_index = self.batch_index
+        self.row_index = self.batch_index
+
+    def set_active(self, idx_in_batch, full_batch_rows=False):
+        """
+        Only the images of idx_in_batch are charged by the next queries, e.g. the images that are not done.
+        :param idx_in_batch: bool mask or index of the current batch, an index may repeat (e.g. one index per row of
+                             the next query), each occurrence is charged one query
+        :param full_batch_rows: False means the rows of the next queries are the images of idx_in_batch only,
+                                True means the next queries still forward the whole batch (e.g. bandits), but only the
+                                images of idx_in_batch are charged.
+        """
+        if isinstance(idx_in_batch, np.ndarray):
+            idx_in_batch = torch.from_numpy(idx_in_batch)
+        idx_in_batch = idx_in_batch.detach().cpu()
+        if idx_in_batch.dtype in [torch.bool, torch.uint8]:
+            idx_in_batch = torch.nonzero(idx_in_batch.bool()).view(-1)
+        self.active_index = self.batch_index[idx_in_batch.long()]
+        self.row_index = self.batch_index if full_batch_rows else self.active_index
+
+    def reset_active(self):
+        self.active_index = self.batch_index
+        self.row_index = self.batch_index
+
+    @contextmanager
+    def uncharged(self):
+        """
+        The calls inside this context are not queries of the attack, they are recorded but not charged to any image.
+        """
+        self.uncharged_depth += 1
+        try:
+            yield self
+        finally:
+            self.uncharged_depth -= 1
+
+    def record(self, tag, num_rows, forward_time, transfer_time=0.0):
+        if not self.enabled:
+            return
+        if self.uncharged_depth > 0:
+            tag = "{}_uncharged".format(tag)
+        self.calls[tag] += 1
+        self.images[tag] += num_rows
+        self.forward_time[tag] += forward_time
+        self.transfer_time[tag] += transfer_time
+        self.occupancy[tag] += min(float(num_rows) / self.batch_size, 1.0)
+        if self.uncharged_depth > 0 or self.active_index is None or len(self.active_index) == 0:
+            return
+        if num_rows % len(self.row_index) == 0:  # the stacked queries (e.g. q1 and q2 in one forward) of same images
+            repeats = num_rows // len(self.row_index)
+            self.query_all[tag].index_add_(0, self.active_index, torch.full((len(self.active_index),), float(repeats)))
+        else:
+            log.warn("{} rows of {} call can not be assigned to {} images".format(num_rows, tag, len(self.row_index)))
+
+    def transfer(self, x, device, tag="target"):
+        """
+        Move the query tensor x to device, the elapsed time is charged to the transfer time of tag.
+        """
+        if not self.enabled:
+            return x.to(device)
+        _synchronize()
+        transfer_start = time.perf_counter()
+        x = x.to(device)
+        _synchronize()
+        self.transfer_time[tag] += time.perf_counter() - transfer_start
+        return x
+
+    def timing(self, tag, num_rows):
+        """
+        Context manager used to profile the call that does not go through ProfiledModel (e.g. simulator.predict).
+        """
+        return _TimingContext(self, tag, num_rows)
+
+    def summary(self):
+        summary = {}
+        target_calls = self.calls.get("target", 0)
+        for tag in list(self.calls.keys()):
+            calls = self.calls[tag]
+            summary[tag] = {"calls": calls,
+                            "images": self.images[tag],
+                            "total_forward_time": self.forward_time[tag],
+                            "mean_forward_latency": self.forward_time[tag] / calls,
+                            "total_transfer_time": self.transfer_time[tag],
+                            "mean_batch_occupancy": self.occupancy[tag] / calls}
+            if not tag.endswith("_uncharged"):
+                summary[tag]["query_all"] = self.query_all[tag].numpy().astype(np.int32).tolist()
+        if target_calls > 0:
+            for tag in list(self.calls.keys()):
+                if tag != "target" and not tag.endswith("_uncharged"):
+                    summary["{}_vs_target_call_ratio".format(tag)] = float(self.calls[tag]) / target_calls
+        summary["wall_time"] = time.time() - self.start_time
+        return summary
+
+    def export(self, result_dump_path):
+        """
+        The profile is written next to the result json, e.g. resnet-110_result.json -> resnet-110_profile.json
+        """
+        profile_path = osp.splitext(result_dump_path)[0]
+        if profile_path.endswith("_result"):
+            profile_path = profile_path[:-len("_result")]
+        profile_path = profile_path + "_profile.json"
+        with open(profile_path, "w") as file_obj:
+            json.dump(self.summary(), file_obj, sort_keys=True)
+        log.info("write profile info to {}".format(profile_path))
+        return profile_path
+
+    def reset(self):
+        self.__init__(self.total_images, self.batch_size, self.enabled)
+
+
+class _TimingContext(object):
+    def __init__(self, profiler, tag, num_rows):
+        self.profiler = profiler
+        self.tag = tag
+        self.num_rows = num_rows
+
+    def __enter__(self):
+        if self.profiler.enabled:
+            _synchronize()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.profiler.enabled:
+            _synchronize()
+        self.profiler.record(self.tag, self.num_rows, time.perf_counter() - self.start)
+        return False
+
+
+def _synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+class ProfiledModel(nn.Module):
+    """
+    A ProfiledModel wraps a model (e.g. StandardModel or DefensiveModel) and records each forward into a QueryProfiler.
+    The other attributes (input_size, input_space, etc.) are read from the wrapped model.
+    """
+    def __init__(self, model, profiler, tag="target"):
+        super(ProfiledModel, self).__init__()
+        self.model = model
+        self.profiler = profiler
+        self.tag = tag
+
+    def __getattr__(self, name):
+        try:
+            return super(ProfiledModel, self).__getattr__(name)
+        except AttributeError:
+            return getattr(self._modules["model"], name)
+
+    def forward(self, x):
+        if not self.profiler.enabled:
+            return self.model(x)
+        transfer_time = 0.0
+        param = next(self.model.parameters(), None)
+        if param is not None and x.device != param.device:
+            _synchronize()
+            transfer_start = time.perf_counter()
+            x = x.to(param.device)
+            _synchronize()
+            transfer_time = time.perf_counter() - transfer_start
+        _synchronize()
+        forward_start = time.perf_counter()
+        output = self.model(x)
+        _synchronize()
+        self.profiler.record(self.tag, x.size(0), time.perf_counter() - forward_start, transfer_time)
+        return output
@@ -0,0 +1,125 @@
+import random
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+class SurrogateEnsemble(object):
+    """
+    A SurrogateEnsemble executes a list of surrogate models on the same batch.
+    The models are kept resident on the device, if their total size exceeds memory_budget (in bytes),
+    the least recently used models are moved back to CPU to make room for the next one.
+    """
+    def __init__(self, models, device="cuda", memory_budget=None):
+        """
+        :param models: list of surrogate models (e.g. StandardModel)
+        :param memory_budget: the bytes of parameters and buffers allowed on the device, None means all models are resident
+        """
+        self.models = models
+        self.device = torch.device(device)
+        self.memory_budget = memory_budget
+        self.model_bytes = [self.get_model_bytes(model) for model in models]
+        self.resident = OrderedDict()  # model index -> bytes, ordered from the least recently used
+        if memory_budget is None:
+            for idx in range(len(self.models)):
+                self.acquire(idx)
+
+    @staticmethod
+    def get_model_bytes(model):
+        tensors = list(model.parameters()) + list(model.buffers())
+        return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+    def __len__(self):
+        return len(self.models)
+
+    def acquire(self, idx):
+        """
+        Make sure the idx-th model is on the device, return this model.
+        """
+        if idx in self.resident:
+            self.resident.move_to_end(idx)
+            return self.models[idx]
+        if self.memory_budget is not None:
+            while self.resident and sum(self.resident.values()) + self.model_bytes[idx] > self.memory_budget:
+                evicted_idx, _ = self.resident.popitem(last=False)
+                self.models[evicted_idx].cpu()
+        self.models[idx].to(self.device)
+        self.resident[idx] = self.model_bytes[idx]
+        return self.models[idx]
+
+    def __getitem__(self, idx):
+        return self.acquire(idx)
+
+    def sample(self):
+        """
+        Randomly choose one surrogate model (same as random.choice(models)) and return it on the device.
+        """
+        return self.acquire(random.choice(range(len(self.models))))
+
+    def losses(self, x, loss_fn):
+        """
+        Run all surrogate models on x, the resident models run first so that fewer models are swapped.
+        :param x: the query images, numpy array or tensor, shape = (batch_size, C, H, W)
+        :param loss_fn: a function maps the logits of one model to the loss of each image, shape = (batch_size,)
+        :return: loss matrix, shape = (n_surrogates, batch_size), numpy array if x is numpy array
+        """
+        is_numpy = isinstance(x, np.ndarray)
+        if is_numpy:
+            x = torch.from_numpy(x).float()
+        x = x.to(self.device)
+        all_losses = torch.zeros(len(self.models), x.size(0), device=self.device)
+        order = [idx for idx in self.resident] + [idx for idx in range(len(self.models)) if idx not in self.resident]
+        with torch.no_grad():
+            for idx in order:
+                model = self.acquire(idx)
+                all_losses[idx] = loss_fn(model(x)).detach().float()
+        if is_numpy:
+            return all_losses.cpu().numpy()
+        return all_losses
+
+    def output_gradients(self, x, output_weights, model_indexes):
+        """
+        The gradient of (model(x) * output_weight).sum() w.r.t. x for K pairs of (model, output_weight),
+        e.g. the directions of output diversified sampling (ODS). The pairs of the same model are computed in one
+        forward on x repeated K times. If all models are resident (no memory_budget), the forwards of all models
+        share one backward, otherwise each model runs its own backward before the next model may evict it.
+        :param x: the images, shape = (batch_size, C, H, W)
+        :param output_weights: shape = (K, batch_size, #class), the output weights of each pair
+        :param model_indexes: the model index of each pair, list of K ints
+        :return: shape = (K, batch_size, C, H, W)
+        """
+        x = x.detach().to(self.device)
+        output_weights = output_weights.to(self.device)
+        grads = torch.zeros(len(model_indexes), *x.shape, device=self.device)
+        groups = OrderedDict()  # model index -> the pairs of this model
+        for k, idx in enumerate(model_indexes):
+            groups.setdefault(idx, []).append(k)
+        order = [idx for idx in self.resident if idx in groups] + [idx for idx in groups if idx not in self.resident]
+        fused = self.memory_budget is None
+        fused_inputs, fused_losses, fused_pairs = [], [], []
+        with torch.enable_grad():
+            for idx in order:
+                pairs = groups[idx]
+                model = self.acquire(idx)
+                repeated_x = x.unsqueeze(0).repeat(len(pairs), 1, 1, 1, 1).requires_grad_()
+                logits = model(repeated_x.view(-1, *x.shape[1:])).view(len(pairs), x.size(0), -1)
+                loss = (logits * output_weights[pairs]).sum()
+                if fused:
+                    fused_inputs.append(repeated_x)
+                    fused_losses.append(loss)
+                    fused_pairs.append(pairs)
+                else:
+                    grads[pairs] = torch.autograd.grad(loss, [repeated_x])[0].detach()
+            if fused:
+                for pairs, grad in zip(fused_pairs, torch.autograd.grad(sum(fused_losses), fused_inputs)):
+                    grads[pairs] = grad.detach()
+        return grads
+
+    def offload(self):
+        """
+        Move all models back to CPU, e.g. before the next target model is loaded.
+        """
+        for idx in list(self.resident.keys()):
+            self.models[idx].cpu()
+        self.resident.clear()
@@ -175,25 +175,21 @@ class MetaAttack(object):
             meta_output = meta_model(input_adv.detach())
             indice = torch.abs(meta_output.data).cpu().numpy().reshape(-1).argsort()[-500:]
         if (step + 1) % self.every_iter == 0 and step < self.max_iter:
-            zoo_gradients = []
             generate_grad = GradientGenerator(update_pixels=self.update_pixels,
                                               targeted=self.targeted, classes=CLASS_NUM[self.dataset])
-            zoo_grad, select_indice = generate_grad.run(model, input_adv_copy, target, indice)  # query for batch_size times
+            select_indice = torch.from_numpy(np.asarray(indice)).long().view(1, -1).to(input_adv_copy.device)
+            zoo_gradients = generate_grad.run_batch(model, input_adv_copy, target, select_indice)  # query for batch_size times
             query += self.update_pixels
-            zoo_gradients.append(zoo_grad)
-            zoo_gradients = np.array(zoo_gradients, np.float32)
-            zoo_gradients = torch.from_numpy(zoo_gradients).cuda()
-
-            std = zoo_gradients.cpu().numpy().std(axis=(1, 2, 3))
-            std = std.reshape((-1, 1, 1, 1)) + 1e-23
-            zoo_gradients = zoo_gradients / torch.from_numpy(std).cuda()
+            std = zoo_gradients.std(dim=(1, 2, 3), unbiased=False, keepdim=True) + 1e-23
+            zoo_gradients = zoo_gradients / std
             assert not torch.isnan(zoo_gradients.sum())
             for i in range(20):
                 meta_optimizer.zero_grad()
                 meta_grads = meta_model(input_adv_copy)
                 # meta_grads = meta_grads * torch.sign(torch.abs(zoo_gradients))
                 # meta_loss = F.mse_loss(meta_grads, zoo_gradients)
-                meta_loss = F.mse_loss(meta_grads.reshape(-1)[select_indice], zoo_gradients.reshape(-1)[select_indice])
+                meta_loss = F.mse_loss(meta_grads.reshape(-1)[select_indice.view(-1)],
+                                       zoo_gradients.reshape(-1)[select_indice.view(-1)])
                 meta_loss.backward()
                 meta_optimizer.step()
         meta_output = meta_model(input_adv.detach())
@@ -43,27 +43,40 @@ class GradientGenerator(object):
         return loss, loss1, loss2
 
     def run(self, model, img, target, indice):
-        ori_img = img.clone()
-        grad = torch.zeros(self.batch_size, dtype=torch.float32)
-        modifier = torch.zeros_like(img, dtype=torch.float32)
-        target_onehot = torch.zeros(target.size() + (self.num_classes,))
-        if torch.cuda.is_available():
-            target_onehot = target_onehot.cuda()
-        target_onehot.scatter_(1, target.unsqueeze(1), 1.)
-        target_var = target_onehot.detach()
-        target_var.requires_grad = False
-        img_var = img.repeat(self.batch_size * 2 + 1, 1, 1, 1)
-        for i in range(self.batch_size):
-            img_var[i * 2 + 1].reshape(-1)[indice[i]] += 0.0001
-            img_var[i * 2 + 2].reshape(-1)[indice[i]] -= 0.0000
-        with torch.no_grad():
-            output = F.softmax(model(img_var), dim=1).detach()
-            dist = l2_dist(img_var, ori_img, keepdim=True).squeeze(2).squeeze(2)
-            loss, loss1, loss2 = self._loss(output.data, target_var, dist, self.constant)
-            for i in range(self.batch_size):
-                grad[i] = (loss[i * 2 + 1] - loss[i * 2 + 2]) / 0.0002
-            modifier.reshape(-1)[indice] = grad.cuda()
+        indice_tensor = torch.from_numpy(np.asarray(indice)).long().view(1, -1)
+        modifier = self.run_batch(model, img, target, indice_tensor)
         return modifier.detach().cpu().numpy()[0], indice
 
-
-
+    def run_batch(self, model, imgs, targets, indices, chunk_size=None):
+        """
+        Estimate the coordinate gradients of many images at once, the result stays on the device of imgs.
+        :param imgs: shape of (N, C, H, W)
+        :param targets: shape of (N,)
+        :param indices: LongTensor of shape (N, update_pixels), the flat coordinate indexes of each image
+        :param chunk_size: the max number of rows per forward, default is all the N * (2 * update_pixels + 1) rows
+        :return: modifier of shape (N, C, H, W), the estimated gradients are scattered at indices, the others are zero
+        """
+        num_images = imgs.size(0)
+        num_pixels = indices.size(1)
+        indices = indices.to(imgs.device)
+        flat_imgs = imgs.reshape(num_images, 1, -1)
+        # row 0 is the image itself, row 2i+1 / 2i+2 is the + / - perturbation of the i-th coordinate
+        img_var = flat_imgs.repeat(1, num_pixels * 2 + 1, 1)
+        img_var[:, 1::2].scatter_add_(2, indices.unsqueeze(2),
+                                      torch.full((num_images, num_pixels, 1), 0.0001, device=imgs.device))
+        img_var[:, 2::2].scatter_add_(2, indices.unsqueeze(2),
+                                      torch.full((num_images, num_pixels, 1), -0.0000, device=imgs.device))
+        img_var = img_var.view(-1, *imgs.size()[1:])
+        target_var = torch.zeros(num_images, self.num_classes, device=imgs.device)
+        target_var.scatter_(1, targets.view(-1, 1).to(imgs.device), 1.)
+        target_var = target_var.repeat_interleave(num_pixels * 2 + 1, dim=0)
+        chunk_size = chunk_size or img_var.size(0)
+        with torch.no_grad():
+            output = torch.cat([F.softmax(model(img_var[start:start + chunk_size]), dim=1).detach()
+                                for start in range(0, img_var.size(0), chunk_size)], 0)
+            loss, _, _ = self._loss(output, target_var, 0, self.constant)
+            loss = loss.view(num_images, num_pixels * 2 + 1)
+            grad = (loss[:, 1::2] - loss[:, 2::2]) / 0.0002
+            modifier = torch.zeros(num_images, flat_imgs.size(2), device=imgs.device)
+            modifier.scatter_(1, indices, grad)
+        return modifier.view_as(imgs)
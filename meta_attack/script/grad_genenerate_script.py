@@ -11,13 +11,14 @@ from torchvision.datasets import CIFAR10, CIFAR100, ImageFolder
 from config import IMAGE_SIZE, IMAGE_DATA_ROOT, MODELS_TRAIN_STANDARD, PY_ROOT
 from dataset.standard_model import StandardModel
 from dataset.dataset_loader_maker import DataLoaderMaker
-from meta_attack.script.utils import save_gradient
+from meta_attack.script.utils import save_gradients
 
 parser = argparse.ArgumentParser(description='PyTorch CIFAR10 Training')
 parser.add_argument("--dataset",type=str, required=True)
 parser.add_argument("--batch_size",type=int,default=100)
 parser.add_argument("--gpu",type=int,required=True)
 parser.add_argument("--max_items",type=int, default=50000)
+parser.add_argument("--concurrent_models", type=int, default=1, help="the number of models that share each loaded batch")
 args = parser.parse_args()
 os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
 best_acc = 0  # best test accuracy
@@ -59,11 +60,15 @@ for arch in arch_list:
         model_dict[arch] = model.eval()
         print("use arch {} done".format(arch))
 print("==> Save gradient..")
-for arch, model in model_dict.items():
-    dump_path = "{}/data_grad_regression/{}/{}_images.npy".format(PY_ROOT, args.dataset, arch)
-    # if os.path.exists(dump_path):
-    #     continue
-    os.makedirs(os.path.dirname(dump_path), exist_ok=True)
-    model = model.cuda()
-    save_gradient(model, train_loader, dump_path, args.batch_size, args.max_items)
-    model.cpu()
+arch_list = list(model_dict.keys())
+for begin in range(0, len(arch_list), args.concurrent_models):
+    dump_path_model_dict = {}
+    for arch in arch_list[begin:begin + args.concurrent_models]:
+        dump_path = "{}/data_grad_regression/{}/{}_images.npy".format(PY_ROOT, args.dataset, arch)
+        # if os.path.exists(dump_path):
+        #     continue
+        os.makedirs(os.path.dirname(dump_path), exist_ok=True)
+        dump_path_model_dict[dump_path] = model_dict[arch].cuda()
+    save_gradients(dump_path_model_dict, train_loader, args.batch_size, args.max_items)
+    for model in dump_path_model_dict.values():
+        model.cpu()
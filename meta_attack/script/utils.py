@@ -148,57 +148,87 @@ def cw_loss(output, target):
     return loss
 
 
-def save_gradient(model, train_loader, dump_path, batch_size, max_items):
-    model.eval()
-    correct = 0
-    loss_avg = 0
+class GradientDumpWriter(object):
+    """
+    Write the images, gradients and labels of one model into the dump files as soon as each batch is produced.
+    The images and gradients memmaps are preallocated from max_items (raw float32 files, row-indexed, the same format
+    that ImageGradientDataset reads), and are truncated to the number of written items when closed.
+    """
+    def __init__(self, dump_path, max_items, item_shape):
+        self.image_dump_path = dump_path
+        self.grad_dump_path = dump_path.replace("images.npy", "grads.npy")
+        self.label_dump_path = dump_path.replace("images.npy", "labels.npy")
+        self.max_items = max_items
+        self.item_shape = tuple(item_shape)
+        self.images = np.memmap(self.image_dump_path, dtype='float32', mode='w+', shape=(max_items,) + self.item_shape)
+        self.grads = np.memmap(self.grad_dump_path, dtype='float32', mode='w+', shape=(max_items,) + self.item_shape)
+        self.labels = np.zeros(max_items, dtype=np.int32)
+        self.num_items = 0
+
+    def is_full(self):
+        return self.num_items >= self.max_items
+
+    def write(self, images, grads, labels):
+        n = min(len(images), self.max_items - self.num_items)
+        self.images[self.num_items:self.num_items + n] = images[:n]
+        self.grads[self.num_items:self.num_items + n] = grads[:n]
+        self.labels[self.num_items:self.num_items + n] = labels[:n]
+        self.num_items += n
+
+    def close(self):
+        self.images.flush()
+        self.grads.flush()
+        del self.images
+        del self.grads
+        if self.num_items < self.max_items:
+            item_bytes = int(np.prod(self.item_shape)) * 32 // 8
+            os.truncate(self.image_dump_path, self.num_items * item_bytes)
+            os.truncate(self.grad_dump_path, self.num_items * item_bytes)
+        np.save(self.label_dump_path, self.labels[:self.num_items])
 
-    process_images = []
-    process_grads = []
-    process_labels = []
-    image_dump_path = dump_path
-    grad_dump_path = dump_path.replace("images.npy","grads.npy")
-    label_dump_path = dump_path.replace("images.npy", "labels.npy")
 
+def save_gradient(model, train_loader, dump_path, batch_size, max_items):
+    save_gradients({dump_path: model}, train_loader, batch_size, max_items)
+
+
+def save_gradients(dump_path_model_dict, train_loader, batch_size, max_items):
+    """
+    Compute the gradients of several models on the same loaded batches, the result of each model is streamed into
+    its own GradientDumpWriter, so the memory never holds more than one batch per model.
+    :param dump_path_model_dict: dump path of images (e.g. xxx/resnet-110_images.npy) -> model on GPU
+    """
+    writers = {}
+    correct = {dump_path: 0 for dump_path in dump_path_model_dict}
+    loss_avg = {dump_path: 0 for dump_path in dump_path_model_dict}
+    for model in dump_path_model_dict.values():
+        model.eval()
+    num_batches = 0
+    num_evaluated = 0  # the accuracy is over all evaluated samples, the last batch may be only partly saved
     for batch_idx, (data, target) in enumerate(train_loader):
         if batch_idx * batch_size >= max_items:
             break
+        num_batches += 1
+        num_evaluated += target.size(0)
         data, target = data.cuda(), target.cuda()
-
-        data.requires_grad_()
-        model.zero_grad()
-
-        output = model(data)
-
-        loss = cw_loss(F.softmax(output, dim=1), target)
-        grad = torch.autograd.grad(loss, data)[0]
-
-        loss_avg += loss.item()
-        pred = output.argmax(dim=1, keepdim=True)
-        correct += pred.eq(target.view_as(pred)).sum().item()
-
-        grad = grad.detach().cpu().numpy()
-        data = data.detach().cpu().numpy()
-        target = target.detach().cpu().numpy()
-        process_images.append(data)
-        process_grads.append(grad)
-        process_labels.append(target)
-
-    loss_avg /= float(len(train_loader) - 1)
-
-    print('Average Loss: {:4f}%, Accuracy: {}/{} ({:.0f}%)\n'.format(
-        loss_avg, correct, len(train_loader.dataset),
-        100. * correct / len(train_loader.dataset)))
-    process_images = np.concatenate(process_images, 0)
-    assert process_images.ndim == 4
-    process_grads = np.concatenate(process_grads, 0)
-    process_labels = np.concatenate(process_labels, 0).astype(np.int32)
-    fp = np.memmap(image_dump_path, dtype='float32', mode='w+', shape=process_images.shape)
-    fp[:, :, :, :] = process_images[:, :, :, :]
-    del fp
-    del process_images
-    fp = np.memmap(grad_dump_path, dtype='float32', mode='w+', shape=process_grads.shape)
-    fp[:, :, :, :] = process_grads[:, :, :, :]
-    del fp
-    del process_grads
-    np.save(label_dump_path, process_labels)
\ No newline at end of file
+        target_np = target.detach().cpu().numpy()
+        data_np = data.detach().cpu().numpy()
+        for dump_path, model in dump_path_model_dict.items():
+            if dump_path not in writers:
+                writers[dump_path] = GradientDumpWriter(dump_path, max_items, data_np.shape[1:])
+            data.requires_grad_()
+            model.zero_grad()
+            output = model(data)
+            loss = cw_loss(F.softmax(output, dim=1), target)
+            grad = torch.autograd.grad(loss, data)[0]
+            data = data.detach()
+
+            loss_avg[dump_path] += loss.item()
+            pred = output.argmax(dim=1, keepdim=True)
+            correct[dump_path] += pred.eq(target.view_as(pred)).sum().item()
+            writers[dump_path].write(data_np, grad.detach().cpu().numpy(), target_np)
+
+    for dump_path, writer in writers.items():
+        writer.close()
+        print('{} Average Loss: {:4f}, Accuracy: {}/{} ({:.0f}%), {} items are saved\n'.format(
+            os.path.basename(dump_path), loss_avg[dump_path] / float(max(num_batches, 1)), correct[dump_path],
+            num_evaluated, 100. * correct[dump_path] / max(num_evaluated, 1), writer.num_items))
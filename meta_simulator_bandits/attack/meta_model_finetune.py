@@ -78,12 +78,22 @@ class MetaModelFinetune(object):
             network = MetaLearnerModelBuilder.construct_imagenet_model(arch, dataset)
         return network
 
-    def finetune(self, q1_images, q2_images, q1_gt_logits, q2_gt_logits, finetune_times, is_first_finetune):
+    def reset_weights(self, batch_idxes):
+        '''
+        Reset the fine-tuned weights of the slots batch_idxes to the pretrained weights, e.g. new images are loaded
+        into these slots by the pipeline attack.
+        '''
+        for batch_idx in batch_idxes:
+            self.batch_weights[batch_idx] = self.pretrained_weights
+
+    def finetune(self, q1_images, q2_images, q1_gt_logits, q2_gt_logits, finetune_times, is_first_finetune,
+                 img_idx_to_batch_idx=None):
         '''
         :param q1_images: shape of (B,T,C,H,W) where T is sequence length
         :param q2_images: shape of (B,T,C,H,W)
         :param q1_gt_logits: shape of (B, T, #class)
         :param q2_gt_logits: shape of (B, T, #class)
+        :param img_idx_to_batch_idx: the slot of the weights of each image, None means the i-th image uses the i-th slot
         :return:
         '''
         log.info("begin finetune images")
@@ -91,9 +101,11 @@ class MetaModelFinetune(object):
             for i in range(self.batch_size):
                 self.batch_weights[i] = self.pretrained_weights
             self.meta_network.load_state_dict(self.pretrained_weights)
+        if img_idx_to_batch_idx is None:
+            img_idx_to_batch_idx = list(range(len(q1_images)))
         for img_idx, (q1_images_tensor,q2_images_tensor, each_q1_gt_logits,each_q2_gt_logits) in enumerate(zip(q1_images,
                                                                                 q2_images,q1_gt_logits,q2_gt_logits)):
-            self.meta_network.load_state_dict(self.batch_weights[img_idx])
+            self.meta_network.load_state_dict(self.batch_weights[img_idx_to_batch_idx[img_idx]])
             # meta_network.copy_weights(self.master_network) # delete this line, only fine-tune 1 time for later iterations
             # self.meta_network.train()
             optimizer = Adam(self.meta_network.parameters(), lr=self.inner_lr)
@@ -116,20 +128,23 @@ class MetaModelFinetune(object):
                 tot_loss.backward()
                 optimizer.step()
             self.meta_network.eval()
-            self.batch_weights[img_idx] = self.meta_network.state_dict().copy()
+            self.batch_weights[img_idx_to_batch_idx[img_idx]] = self.meta_network.state_dict().copy()
         log.info("finetune images done")
 
-    def predict(self, q1_images, q2_images):
+    def predict(self, q1_images, q2_images, img_idx_to_batch_idx=None):
         '''
         :param q1_images: shape of (B,C,H,W)
         :param q2_images: shape of (B,C,H,W)
+        :param img_idx_to_batch_idx: the slot of the weights of each image, None means the i-th image uses the i-th slot
         :return:
         '''
         log.info("predict from meta model")
+        if img_idx_to_batch_idx is None:
+            img_idx_to_batch_idx = list(range(len(q1_images)))
         q1_output = []
         q2_output = []
         for img_idx, (q1_img, q2_img) in enumerate(zip(q1_images, q2_images)):
-            self.meta_network.load_state_dict(self.batch_weights[img_idx])
+            self.meta_network.load_state_dict(self.batch_weights[img_idx_to_batch_idx[img_idx]])
             self.meta_network.eval()
             q1_img = torch.unsqueeze(q1_img, 0)
             q2_img=  torch.unsqueeze(q2_img, 0)
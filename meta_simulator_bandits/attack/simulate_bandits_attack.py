@@ -10,6 +10,8 @@ import os.path as osp
 import random
 from types import SimpleNamespace
 from dataset.standard_model import StandardModel
+from dataset.pipeline_attack import PipelineAttack
+from dataset.query_profiler import QueryProfiler, ProfiledModel
 import glog as log
 import numpy as np
 import torch
@@ -31,6 +33,7 @@ class SimulateBanditsAttack(object):
         self.not_done_loss_all = torch.zeros_like(self.query_all)
         self.not_done_prob_all = torch.zeros_like(self.query_all)
         self.meta_finetuner = meta_finetuner
+        self.profiler = QueryProfiler(self.total_images, args.batch_size, enabled=args.profile)
 
     def norm(self, t):
         assert len(t.shape) == 4
@@ -125,7 +128,7 @@ class SimulateBanditsAttack(object):
             upsampler = Upsample(size=(target_model.input_size[-2], target_model.input_size[-1]))
         else:
             upsampler = lambda x: x
-        with torch.no_grad():
+        with torch.no_grad(), self.profiler.uncharged():  # the clean prediction is not a query of the attack
             logit = target_model(images)
         pred = logit.argmax(dim=1)
         query = torch.zeros(args.batch_size).cuda()
@@ -133,6 +136,7 @@ class SimulateBanditsAttack(object):
         not_done = correct.clone()  # shape = (batch_size,)
         selected = torch.arange(batch_index * args.batch_size,
                                 min((batch_index + 1) * args.batch_size, self.total_images))  # 选择这个batch的所有图片的index
+        self.profiler.set_batch(selected)
         if args.targeted:
             if args.target_type == 'random':
                 target_labels = torch.randint(low=0, high=CLASS_NUM[args.dataset], size=true_labels.size()).long().cuda()
@@ -173,6 +177,8 @@ class SimulateBanditsAttack(object):
                     or not_done.mean().item() <= use_target_threshold:
                 log.info("predict from target model")
                 predict_by_target_model = True
+                # the whole batch is forwarded, but only the images that are not done are charged
+                self.profiler.set_active(not_done.bool(), full_batch_rows=True)
                 with torch.no_grad():
                     q1_logits = target_model(q1_images)
                     q2_logits = target_model(q2_images)
@@ -186,11 +192,12 @@ class SimulateBanditsAttack(object):
                     q1_logits_seq = torch.stack(list(q1_logits_for_finetune)).permute(1, 0, 2).contiguous()  # B,T,#class
                     q2_logits_seq = torch.stack(list(q2_logits_for_finetune)).permute(1, 0, 2).contiguous()  # B,T,#class
                     finetune_times = args.finetune_times if first_finetune else random.randint(1, 3)
-                    self.meta_finetuner.finetune(q1_images_seq, q2_images_seq, q1_logits_seq, q2_logits_seq, finetune_times,
-                                            first_finetune)
+                    with self.profiler.timing("simulator_finetune", q1_images.size(0)):
+                        self.meta_finetuner.finetune(q1_images_seq, q2_images_seq, q1_logits_seq, q2_logits_seq,
+                                                     finetune_times, first_finetune)
                     first_finetune = False
             else:
-                with torch.no_grad():
+                with torch.no_grad(), self.profiler.timing("simulator", q1_images.size(0) * 2):
                     q1_logits, q2_logits = self.meta_finetuner.predict(q1_images, q2_images)
 
             l1 = criterion(q1_logits, true_labels, target_labels)
@@ -206,7 +213,7 @@ class SimulateBanditsAttack(object):
             adv_images = image_step(adv_images, grad * correct.view(-1, 1, 1, 1), args.image_lr)  # prior放大后相当于累积的更新量，可以用来更新
             adv_images = proj_step(adv_images)
             adv_images = torch.clamp(adv_images, 0, 1)
-            with torch.no_grad():
+            with torch.no_grad(), self.profiler.uncharged():  # the verification of adv_images is not counted
                 adv_logit = target_model(adv_images)
             adv_pred = adv_logit.argmax(dim=1)
             adv_prob = F.softmax(adv_logit, dim=1)
@@ -239,6 +246,7 @@ class SimulateBanditsAttack(object):
 
             if not not_done.byte().any():  # all success
                 break
+        self.profiler.reset_active()
 
 
         for key in ['query', 'correct',  'not_done',
@@ -248,6 +256,122 @@ class SimulateBanditsAttack(object):
             value_all[selected] = value.detach().float().cpu()  # 由于value_all是全部图片都放在一个数组里，当前batch选择出来
 
 
+    def init_state(self, images, true_labels, target_labels, target_model, args):
+        """
+        The per-image state of the pipeline attack (dataset/pipeline_attack.py). The step index and the finetune
+        sequences (ring buffers of meta_seq_len target queries) of make_adversarial_examples are kept for each image,
+        because the images of the slots start at different steps.
+        """
+        batch_size = images.size(0)
+        prior_size = target_model.input_size[-1] if not args.tiling else args.tile_size
+        state = {"images": images, "adv_images": images.clone(), "true_labels": true_labels,
+                 "prior": torch.zeros(batch_size, IN_CHANNELS[args.dataset], prior_size, prior_size).cuda(),
+                 "query": torch.zeros(batch_size).cuda(),
+                 "success": torch.zeros(batch_size).bool().cuda(),
+                 "step_index": torch.zeros(batch_size).long().cuda(),
+                 "finetuned": torch.zeros(batch_size).bool().cuda(),
+                 "seq_len": torch.zeros(batch_size).long().cuda()}
+        for key in ["q1_images_seq", "q2_images_seq"]:
+            state[key] = torch.zeros(batch_size, args.meta_seq_len, *images.shape[1:]).cuda()  # B,T,C,H,W
+        for key in ["q1_logits_seq", "q2_logits_seq"]:
+            state[key] = torch.zeros(batch_size, args.meta_seq_len, CLASS_NUM[args.dataset]).cuda()  # B,T,#class
+        if target_labels is not None:
+            state["target_labels"] = target_labels
+        return state
+
+    def finetune_slots(self, state, idx, args):
+        """
+        Finetune the simulator weights of the images idx on their own sequences, the image which is fine-tuned
+        for the first time starts from the pretrained weights.
+        """
+        seq_len = torch.clamp(state["seq_len"][idx], max=args.meta_seq_len)
+        first_finetune = ~state["finetuned"][idx]
+        for is_first_finetune in [True, False]:
+            group_idx = idx[first_finetune == is_first_finetune]
+            if group_idx.size(0) == 0:
+                continue
+            if is_first_finetune:
+                self.meta_finetuner.reset_weights(state["slot"][group_idx.cpu()].tolist())
+            finetune_times = args.finetune_times if is_first_finetune else random.randint(1, 3)
+            group_seq_len = seq_len[first_finetune == is_first_finetune]
+            for length in torch.unique(group_seq_len).tolist():
+                rows = group_idx[group_seq_len == length]
+                with self.profiler.timing("simulator_finetune", rows.size(0)):
+                    self.meta_finetuner.finetune(state["q1_images_seq"][rows, :length],
+                                                 state["q2_images_seq"][rows, :length],
+                                                 state["q1_logits_seq"][rows, :length],
+                                                 state["q2_logits_seq"][rows, :length], finetune_times, False,
+                                                 state["slot"][rows.cpu()].tolist())
+        state["finetuned"][idx] = True
+
+    def step(self, state, target_model, args):
+        if args.tiling:
+            upsampler = Upsample(size=(target_model.input_size[-2], target_model.input_size[-1]))
+        else:
+            upsampler = lambda x: x
+        images, adv_images, prior = state["images"], state["adv_images"], state["prior"]
+        true_labels, target_labels = state["true_labels"], state.get("target_labels")
+        batch_size = images.size(0)
+        slots = state["slot"].cpu()
+        dim = prior.nelement() / batch_size
+        prior_step = self.gd_prior_step if args.norm == 'l2' else self.eg_step
+        image_step = self.l2_image_step if args.norm == 'l2' else self.linf_step
+        proj_maker = self.l2_proj if args.norm == 'l2' else self.linf_proj
+        criterion = self.cw_loss if args.data_loss == "cw" else self.xent_loss
+        exp_noise = args.exploration * torch.randn_like(prior) / (dim ** 0.5)
+        q1 = upsampler(prior + exp_noise)
+        q2 = upsampler(prior - exp_noise)
+        q1_images = adv_images + args.fd_eta * q1 / self.norm(q1)
+        q2_images = adv_images + args.fd_eta * q2 / self.norm(q2)
+        step_index = state["step_index"] + 1
+        # the warm-up and periodic steps of each image query the target model, the other steps query the simulator
+        predict_by_target_model = (step_index <= args.warm_up_steps) | \
+                                  ((step_index - args.warm_up_steps) % args.meta_predict_steps == 0) | ~state["finetuned"]
+        q1_logits = torch.zeros(batch_size, CLASS_NUM[args.dataset]).cuda()
+        q2_logits = torch.zeros_like(q1_logits)
+        target_idx = torch.nonzero(predict_by_target_model).view(-1)
+        if target_idx.size(0) > 0:
+            self.profiler.set_active(slots[target_idx.cpu()])
+            with torch.no_grad():
+                logits = target_model(torch.cat([q1_images[target_idx], q2_images[target_idx]], dim=0))
+            q1_logits[target_idx], q2_logits[target_idx] = logits[:target_idx.size(0)], logits[target_idx.size(0):]
+            position = state["seq_len"][target_idx] % args.meta_seq_len
+            state["q1_images_seq"][target_idx, position] = q1_images[target_idx].detach()
+            state["q2_images_seq"][target_idx, position] = q2_images[target_idx].detach()
+            state["q1_logits_seq"][target_idx, position] = q1_logits[target_idx].detach()
+            state["q2_logits_seq"][target_idx, position] = q2_logits[target_idx].detach()
+            state["seq_len"][target_idx] += 1
+            finetune_idx = target_idx[step_index[target_idx] >= args.warm_up_steps]
+            if finetune_idx.size(0) > 0:
+                self.finetune_slots(state, finetune_idx, args)
+        simulator_idx = torch.nonzero(~predict_by_target_model).view(-1)
+        if simulator_idx.size(0) > 0:
+            with torch.no_grad(), self.profiler.timing("simulator", simulator_idx.size(0) * 2):
+                q1_logits[simulator_idx], q2_logits[simulator_idx] = self.meta_finetuner.predict(
+                    q1_images[simulator_idx], q2_images[simulator_idx], slots[simulator_idx.cpu()].tolist())
+        l1 = criterion(q1_logits, true_labels, target_labels)
+        l2 = criterion(q2_logits, true_labels, target_labels)
+        # Finite differences estimate of directional derivative
+        est_deriv = (l1 - l2) / (args.fd_eta * args.exploration)
+        est_grad = est_deriv.view(-1, 1, 1, 1) * exp_noise
+        prior = prior_step(prior, est_grad, args.online_lr)
+        grad = upsampler(prior)
+        adv_images = image_step(adv_images, grad, args.image_lr)
+        adv_images = proj_maker(images, args.epsilon)(adv_images)
+        adv_images = torch.clamp(adv_images, 0, 1)
+        with torch.no_grad(), self.profiler.uncharged():  # the verification of adv_images is not counted
+            adv_pred = target_model(adv_images).argmax(dim=1)
+        if args.targeted:
+            state["success"] = adv_pred.eq(target_labels)
+        else:
+            state["success"] = ~adv_pred.eq(true_labels)
+        state["query"] = state["query"] + 2 * predict_by_target_model.float()
+        state["adv_images"], state["prior"], state["step_index"] = adv_images.detach(), prior.detach(), step_index
+        return state
+
+    def is_done(self, state, args):
+        return state["success"] | (state["query"] >= args.max_queries)
+
     def attack_all_images(self, args, arch_name, target_model, result_dump_path):
         for batch_idx, data_tuple in enumerate(self.dataset_loader):
             if args.dataset == "ImageNet":
@@ -287,6 +411,9 @@ class SimulateBanditsAttack(object):
         with open(result_dump_path, "w") as result_file_obj:
             json.dump(meta_info_dict, result_file_obj, sort_keys=True)
         log.info("done, write stats info to {}".format(result_dump_path))
+        if args.profile:
+            self.profiler.export(result_dump_path)
+            self.profiler.reset()
         self.query_all.fill_(0)
         self.correct_all.fill_(0)
         self.not_done_all.fill_(0)
@@ -352,6 +479,10 @@ if __name__ == "__main__":
     parser.add_argument("--meta_predict_steps", type=int, default=40)
     parser.add_argument("--warm_up_steps", type=int, default=20)
     parser.add_argument("--meta_seq_len", type=int, default=20)
+    parser.add_argument('--profile', action="store_true", help='export the query/latency profile next to the result json')
+    parser.add_argument('--pipeline', action="store_true",
+                        help='refill the finished images of a batch with new images instead of waiting for the slowest one')
+    parser.add_argument('--refill_interval', type=int, default=50, help='refill the finished slots every N steps')
 
     args = parser.parse_args()
     os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
@@ -433,5 +564,12 @@ if __name__ == "__main__":
         model = StandardModel(args.dataset, arch, no_grad=True)
         model.cuda()
         model.eval()
-        attacker.attack_all_images(args, arch, model, save_result_path)
+        if args.profile:
+            model = ProfiledModel(model, attacker.profiler)
+        if args.pipeline:
+            pipeline = PipelineAttack(attacker, attacker.dataset_loader, args.dataset, args.batch_size,
+                                      args.refill_interval)
+            pipeline.attack_all_images(args, arch, model, save_result_path)
+        else:
+            attacker.attack_all_images(args, arch, model, save_result_path)
         model.cpu()
@@ -1,68 +1,54 @@
 from collections import OrderedDict
 from torch import nn
+from torch.func import functional_call, vmap
 import torch
-import copy
 
 
 class InnerLoop(nn.Module):
     '''
-    This module performs the inner loop
-    The forward method updates weights with gradient steps on training data, 
-    then computes and returns a meta-gradient w.r.t. validation data
+    This module performs the inner loop of all tasks of a meta-batch at once
+    The fast weights of the tasks are stacked parameter tensors of shape (Task_num, ...), each inner update runs one
+    vmapped functional forward of the network over all tasks, and one backward gives the gradients of all tasks
+    (the losses of different tasks do not share any fast weight).
     '''
     def __init__(self, network, num_updates, step_size, meta_batch_size):
         super(InnerLoop, self).__init__()
-        self.network = copy.deepcopy(network)
+        self.network = network  # the base network, its parameters are only read
         # Number of updates to be taken
         self.num_updates = num_updates
         # Step size for the updates
         self.step_size = step_size
         self.meta_batch_size = meta_batch_size
         self.mse_loss = nn.MSELoss(reduction="mean")
-        self.softmax = nn.Softmax(dim=1)
 
-    def copy_weights(self, net):
-        ''' Set this module's weights to be the same as those of 'net' '''
-        self.network.copy_weights(net)
-
-    def net_forward(self, x, weights=None):
-        return self.network.net_forward(x, weights)
-
-    def compute_diff(self, weights):
+    def stack_weights(self, num_tasks):
+        ''' Every task starts from the base parameters, the buffers (e.g. BN running stats) are per-task copies '''
+        fast_weights = OrderedDict((name, param.detach().unsqueeze(0).repeat(num_tasks, *[1] * param.dim())
+                                    .requires_grad_()) for name, param in self.network.named_parameters())
+        buffers = OrderedDict((name, buffer.unsqueeze(0).repeat(num_tasks, *[1] * buffer.dim()))
+                              for name, buffer in self.network.named_buffers())
+        return fast_weights, buffers
+
+    def task_loss(self, weights, buffers, imgs_1, imgs_2, target_1, target_2):
+        ''' The loss of one task, shape = () '''
+        out_1 = functional_call(self.network, (weights, buffers), (imgs_1,))
+        out_2 = functional_call(self.network, (weights, buffers), (imgs_2,))
+        return self.mse_loss(out_1, target_1) + self.mse_loss(out_2, target_2)
+
+    def forward(self, task_support_images_1, task_support_images_2, task_support_target_1, task_support_target_2):
         '''
-        this method is to computer the difference between received weights
-        and the self.net.parameters(), it will return the difference
+        :param task_support_images_1: shape = (Task_num, T, C, H, W)
+        :param task_support_target_1: shape = (Task_num, T, #class)
+        :return: the fast weights after num_updates steps, an OrderedDict of shape (Task_num, ...) tensors
         '''
-        diff = {}
-        for name, each in self.network.named_parameters():
-            diff[name] = (each - weights[name]).clone().detach()
-        return diff
-
-    def forward_pass(self, imgs_1, imgs_2, target_1, target_2, weights=None):
-        ''' Run data through net, return loss and output '''
-        imgs_1 = imgs_1.cuda()
-        imgs_2 = imgs_2.cuda()
-        out_1 = self.net_forward(imgs_1, weights)
-        out_2 = self.net_forward(imgs_2, weights)
-        diff_loss1 = self.mse_loss(out_1, target_1)
-        diff_loss2 = self.mse_loss(out_2, target_2)
-        loss = diff_loss1 + diff_loss2
-        return loss
-
-    
-    def forward(self, task_support_images_1, task_support_images_2, task_query_images_1, task_query_images_2,
-                      task_support_target_1, task_support_target_2, task_query_target_1, task_query_target_2):
-        fast_weights = OrderedDict((name, param) for (name, param) in self.network.named_parameters())
+        fast_weights, buffers = self.stack_weights(task_support_images_1.size(0))
+        batched_loss = vmap(self.task_loss)
         for i in range(self.num_updates):
-            if i==0:
-                loss = self.forward_pass(task_support_images_1, task_support_images_2, task_support_target_1, task_support_target_2)
-                grads = torch.autograd.grad(loss, self.parameters())
-            else:
-                loss = self.forward_pass(task_support_images_1, task_support_images_2, task_support_target_1, task_support_target_2,
-                                         fast_weights)
-                grads = torch.autograd.grad(loss, fast_weights.values())
-            fast_weights = OrderedDict((name, param - self.step_size * grad)
-                                     for ((name, param), grad) in zip(fast_weights.items(), grads))
-        current_task_diff = self.compute_diff(fast_weights)
-        return current_task_diff
-
+            losses = batched_loss(fast_weights, buffers, task_support_images_1, task_support_images_2,
+                                  task_support_target_1, task_support_target_2)  # shape = (Task_num,)
+            grads = torch.autograd.grad(losses.sum(), list(fast_weights.values()))
+            # first-order updates, the fast weights of the last update do not need gradients
+            fast_weights = OrderedDict((name, (param - self.step_size * grad).detach()
+                                        .requires_grad_(i < self.num_updates - 1))
+                                       for ((name, param), grad) in zip(fast_weights.items(), grads))
+        return fast_weights
@@ -8,7 +8,6 @@ import random
 from torch.utils.data import DataLoader
 from cifar_models_myself import *
 from meta_simulator_bandits.learning.meta_network import MetaNetwork
-import numpy as np
 from meta_simulator_bandits.reptile_learning.inner_loop import InnerLoop
 from dataset.standard_model import MetaLearnerModelBuilder
 
@@ -43,7 +42,6 @@ class MetaTwoQueriesLearner(object):
         self.loss_fn = nn.MSELoss()
         self.fast_net = InnerLoop(self.network, self.num_inner_updates,
                                   self.inner_step_size, self.meta_batch_size)  # 并行执行每个task
-        self.fast_net.cuda()
         self.opt = Adam(self.network.parameters(), lr=meta_step_size)
         self.arch_pool = {}
 
@@ -61,21 +59,16 @@ class MetaTwoQueriesLearner(object):
         loss = self.loss_fn(output, target)
         return loss, output
 
-    def compute_meta_weight(self, task_diff_weights):
+    def compute_meta_weight(self, fast_weights, meta_step=1.0):
         '''
         meta optim for reptile
-        this method will update the self.net.parameters according to the
-        reveived weights, which is the updating directions. The updata learning
-        rate is self.update.lr
+        this method moves the self.network.parameters towards the average of the fast weights of the tasks,
+        which is the updating direction, meta_step=1.0 replaces the parameters with the average.
+        :param fast_weights: the output of InnerLoop, an OrderedDict of shape (Task_num, ...) tensors
         '''
-        dic = self.network.state_dict()
-        for param_name, each in task_diff_weights[0].items():
-            diff = torch.zeros_like(each)
-            for j in range(len(task_diff_weights)):
-                diff += task_diff_weights[j][param_name]  # j is task index
-            diff /= len(task_diff_weights)
-            dic[param_name] -= diff
-        self.network.load_state_dict(dic)
+        with torch.no_grad():
+            for param_name, param in self.network.named_parameters():
+                param.lerp_(fast_weights[param_name].mean(0), meta_step)
 
     def train(self, model_path, resume_epoch=0):
         for epoch in range(resume_epoch, self.epoch):
@@ -86,44 +79,18 @@ class MetaTwoQueriesLearner(object):
                 self.adjust_learning_rate(itr, self.meta_step_size, self.lr_decay_itr)
                 seq_len = q1_images.size(1)
                 support_index_list = sorted(random.sample(range(seq_len // 2), self.num_support))
-                query_index_list = np.arange(seq_len // 2, seq_len).tolist()
                 support_q1_images = q1_images[:, support_index_list, :, :, :]
-                support_q2_images = q2_images[:, support_index_list, :, :, :]
-                query_q1_images = q1_images[:, query_index_list, :, :, :]
-                query_q2_images = q2_images[:, query_index_list, :, :, :]  # (Task_num, T, C, H, W)
+                support_q2_images = q2_images[:, support_index_list, :, :, :]  # (Task_num, T, C, H, W)
                 support_q1_logits = q1_logits[:, support_index_list, :]
                 support_q2_logits = q2_logits[:, support_index_list, :]  # (Task_num, T, #class)
-                query_q1_logits = q1_logits[:, query_index_list, :]
-                query_q2_logits = q2_logits[:, query_index_list,:]  # (Task_num, T, #class)
-                task_diff_weights = []
-                for task_idx in range(q1_images.size(0)):  # 每个task的teacher model不同，所以
-                    task_support_q1 = support_q1_images[task_idx].cuda() # T, C, H, W
-                    task_support_q2 = support_q2_images[task_idx].cuda()
-                    task_query_q1 = query_q1_images[task_idx].cuda()
-                    task_query_q2 = query_q2_images[task_idx].cuda()
-                    task_support_q1_logits = support_q1_logits[task_idx].cuda()
-                    task_support_q2_logits = support_q2_logits[task_idx].cuda()
-                    task_query_q1_logits = query_q1_logits[task_idx].cuda()
-                    task_query_q2_logits = query_q2_logits[task_idx].cuda()
-                    task_support_q1_logits = task_support_q1_logits/torch.norm(task_support_q1_logits,p=2,dim=-1,keepdim=True)
-                    task_support_q2_logits = task_support_q2_logits/torch.norm(task_support_q2_logits,p=2,dim=-1,keepdim=True)
-                    task_query_q1_logits = task_query_q1_logits/torch.norm(task_query_q1_logits,p=2,dim=-1,keepdim=True)
-                    task_query_q2_logits = task_query_q2_logits/torch.norm(task_query_q2_logits,p=2,dim=-1,keepdim=True)
-                    self.fast_net.copy_weights(self.network)
-                    current_task_diff = self.fast_net.forward(task_support_q1, task_support_q2, task_query_q1, task_query_q2,
-                                              task_support_q1_logits, task_support_q2_logits,
-                                              task_query_q1_logits, task_query_q2_logits)
-                    task_diff_weights.append(current_task_diff)
-                    support_q1_images[task_idx].cpu()  # T, C, H, W
-                    support_q2_images[task_idx].cpu()
-                    query_q1_images[task_idx].cpu()
-                    query_q2_images[task_idx].cpu()
-                    support_q1_logits[task_idx].cpu()
-                    support_q2_logits[task_idx].cpu()
-                    query_q1_logits[task_idx].cpu()
-                    query_q2_logits[task_idx].cpu()
-
-                self.compute_meta_weight(task_diff_weights)
+                # 每个task的teacher model不同，所有task的fast weights在一次vmap的forward中更新，query set不参与reptile的更新
+                support_q1_logits = support_q1_logits.cuda()
+                support_q2_logits = support_q2_logits.cuda()
+                support_q1_logits = support_q1_logits / torch.norm(support_q1_logits, p=2, dim=-1, keepdim=True)
+                support_q2_logits = support_q2_logits / torch.norm(support_q2_logits, p=2, dim=-1, keepdim=True)
+                fast_weights = self.fast_net.forward(support_q1_images.cuda(), support_q2_images.cuda(),
+                                                     support_q1_logits, support_q2_logits)
+                self.compute_meta_weight(fast_weights)
             torch.save({
                 'epoch': epoch + 1,
                 'state_dict': self.network.state_dict(),
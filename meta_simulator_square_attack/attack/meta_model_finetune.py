@@ -6,6 +6,12 @@ import re
 import os
 from torch import nn
 import torch
+from torch.func import functional_call, vmap
+from torch.nn import functional as F
+from torch.optim import Adam
+
+from dataset.standard_model import MetaLearnerModelBuilder
+from meta_simulator_square_attack.learning.meta_network import MetaNetwork
 
 class MemoryEfficientMetaModelFinetune(object):
     def __init__(self, dataset,  batch_size, meta_arch, meta_train_type, distill_loss, data_loss, norm, targeted, use_softmax,
@@ -53,6 +59,12 @@ class MemoryEfficientMetaModelFinetune(object):
         self.batch_size = batch_size
         for i in range(batch_size):
             self.batch_weights[i] = self.pretrained_weights
+        # the parameters of the simulators of all slots are stacked into one device-resident tensor per parameter,
+        # shape = (batch_size, *param.shape), so that all simulators are fine-tuned and run in one vmap call
+        self.buffers = {name: buffer for name, buffer in self.meta_network.named_buffers()}
+        self.pretrained_params = {name: param.detach().clone() for name, param in self.meta_network.named_parameters()}
+        self.slot_weights = {name: param.unsqueeze(0).repeat(batch_size, *[1] * param.dim())
+                             for name, param in self.pretrained_params.items()}
 
     def construct_model(self, arch, dataset):
         if dataset in ["CIFAR-10", "CIFAR-100", "MNIST", "FashionMNIST"]:
@@ -124,4 +136,90 @@ class MemoryEfficientMetaModelFinetune(object):
             q2_output.append(q2_logits)
         q1_output = torch.cat(q1_output, 0)
         q2_output = torch.cat(q2_output, 0)
-        return q1_output, q2_output
\ No newline at end of file
+        return q1_output, q2_output
+
+    def reset_weights(self, batch_idxes):
+        '''
+        Reset the simulators of the slots batch_idxes to the pretrained weights, e.g. a new batch of images is attacked.
+        :param batch_idxes: tensor of slot indexes
+        '''
+        with torch.no_grad():
+            for name, param in self.pretrained_params.items():
+                self.slot_weights[name][batch_idxes] = param
+
+    def functional_forward(self, params, images):
+        # runs the meta network with the parameters of one slot, the buffers (running stats of BN) are shared
+        return functional_call(self.meta_network, {**params, **self.buffers}, (images,))
+
+    @staticmethod
+    def masked_mean(error, mask):
+        # the mean of error over the valid entries of each slot, shape = (B,)
+        return (error * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+
+    def pair_distance_loss(self, output, gt_logits, mse_error, valid_mask):
+        '''
+        The pair_mse distillation loss of finetune on the history: the adjacent entries (t, t+1) of the history of each slot are the
+        pairs (q1, q2), the distance of each predicted pair should be the distance of the pair of the target model.
+        :param output: shape of (B, T, #class)
+        :param mse_error: shape of (B, T), the mean squared error of each entry
+        :return: the sum of the loss of each slot
+        '''
+        num_class = output.size(-1)
+        pair_mask = valid_mask[:, :-1] * valid_mask[:, 1:]  # B,T-1
+        predict_distance = self.pair_wise_distance(output[:, :-1].reshape(-1, num_class),
+                                                   output[:, 1:].reshape(-1, num_class)).view_as(pair_mask)
+        target_distance = self.pair_wise_distance(gt_logits[:, :-1].reshape(-1, num_class),
+                                                  gt_logits[:, 1:].reshape(-1, num_class)).view_as(pair_mask)
+        distance_loss = self.masked_mean((predict_distance - target_distance).pow(2), pair_mask)
+        mse_error_q1 = self.masked_mean(mse_error[:, :-1], pair_mask)
+        mse_error_q2 = self.masked_mean(mse_error[:, 1:], pair_mask)
+        return (distance_loss + 0.1 * mse_error_q1 + 0.1 * mse_error_q2).sum()
+
+    def batch_finetune(self, images, gt_logits, valid_mask, finetune_times, batch_idxes):
+        '''
+        Fine-tune the simulators of batch_idxes on their own history in one vmap call. The loss is the sum of the mean
+        squared error (or the pair_mse loss, see pair_distance_loss) of each slot, so the gradient (and the Adam update)
+        of each slot is the same as fine-tuning it alone.
+        :param images: shape of (B,T,C,H,W) where T is sequence length
+        :param gt_logits: shape of (B, T, #class), the logits of the target model
+        :param valid_mask: shape of (B, T), False for the entries that are not filled yet
+        :param batch_idxes: shape of (B,), the slot of each image
+        :return:
+        '''
+        params = {name: self.slot_weights[name][batch_idxes].clone().requires_grad_()
+                  for name in self.pretrained_params.keys()}
+        optimizer = Adam(params.values(), lr=self.inner_lr)
+        valid_mask = valid_mask.float()
+        if self.use_softmax:
+            gt_logits = F.softmax(gt_logits, dim=-1)
+        for _ in range(finetune_times):
+            output = vmap(self.functional_forward)(params, images)  # B,T,#class
+            if self.use_softmax:
+                output = F.softmax(output, dim=-1)
+            mse_error = (output - gt_logits).pow(2).mean(dim=-1)  # B,T
+            if self.need_pair_distance:
+                tot_loss = self.pair_distance_loss(output, gt_logits, mse_error, valid_mask)
+            else:
+                tot_loss = self.masked_mean(mse_error, valid_mask).sum()
+            optimizer.zero_grad()
+            tot_loss.backward()
+            optimizer.step()
+        with torch.no_grad():
+            for name, param in params.items():
+                self.slot_weights[name][batch_idxes] = param.detach()
+
+    def batch_predict(self, images, batch_idxes):
+        '''
+        Each image is predicted by the simulator of its slot, all simulators run in one vmap call.
+        :param images: shape of (B,C,H,W)
+        :param batch_idxes: shape of (B,), the slot of each image
+        :return: logits, shape of (B, #class)
+        '''
+        if batch_idxes.size(0) == self.batch_size and \
+                torch.equal(batch_idxes.cpu(), torch.arange(self.batch_size)):
+            params = self.slot_weights  # avoid the copy of all parameters
+        else:
+            params = {name: weight[batch_idxes] for name, weight in self.slot_weights.items()}
+        with torch.no_grad():
+            logits = vmap(self.functional_forward)(params, images.unsqueeze(1))  # B,1,#class
+        return logits.squeeze(1)
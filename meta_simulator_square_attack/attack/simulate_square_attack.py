@@ -7,7 +7,6 @@ import random
 sys.path.append("/home1/machen/meta_perturbations_black_box_attack")
 import argparse
 from types import SimpleNamespace
-from collections import deque, OrderedDict
 import glob
 import glog as log
 import json
@@ -19,50 +18,34 @@ from config import PY_ROOT, MODELS_TEST_STANDARD, CLASS_NUM
 from dataset.dataset_loader_maker import DataLoaderMaker
 from dataset.defensive_model import DefensiveModel
 from dataset.standard_model import StandardModel
+from meta_simulator_square_attack.attack.meta_model_finetune import MemoryEfficientMetaModelFinetune
 
 
-class FinetuneQueue(object):
-    def __init__(self, batch_size, meta_seq_len, img_idx_to_batch_idx):
-        self.img_idx_to_batch_idx = img_idx_to_batch_idx
-        self.images_for_finetune = {}
-        self.loss_for_finetune = {}
-        for batch_idx in range(batch_size):
-            self.images_for_finetune[batch_idx] = deque(maxlen=meta_seq_len)
-            self.loss_for_finetune[batch_idx] = deque(maxlen=meta_seq_len)
-
-    def append(self, images, losses):
-        for img_idx, (image, loss) in enumerate(zip(images, losses)):
-            batch_idx = self.img_idx_to_batch_idx[img_idx]
-            self.images_for_finetune[batch_idx].append(image.detach().cpu())
-            self.loss_for_finetune[batch_idx].append(loss.detach().cpu())
-
-    def stack_history_track(self):
-        images = []
-        losses = []
-        for img_idx, batch_idx in sorted(self.img_idx_to_batch_idx.proj_dict.items(), key=lambda e:e[0]):
-            images.append(torch.stack(list(self.images_for_finetune[batch_idx])))  # T,C,H,W
-            losses.append(torch.stack(list(self.loss_for_finetune[batch_idx])))  # T, 1
-        images = torch.stack(images).cuda()
-        losses = torch.stack(losses).cuda()
-        return images, losses
-
-
-class ImageIdxToOrigBatchIdx(object):
-    def __init__(self, batch_size):
-        self.proj_dict = OrderedDict()
-        for img_idx in range(batch_size):
-            self.proj_dict[img_idx] = img_idx
-
-    def del_by_index_list(self, del_img_idx_list):
-        for del_img_idx in del_img_idx_list:
-            del self.proj_dict[del_img_idx]
-        all_key_value = sorted(list(self.proj_dict.items()), key=lambda e: e[0])
-        for seq_idx, (img_idx, batch_idx) in enumerate(all_key_value):
-            del self.proj_dict[img_idx]
-            self.proj_dict[seq_idx] = batch_idx
-
-    def __getitem__(self, img_idx):
-        return self.proj_dict[img_idx]
+class FinetuneHistoryBuffer(object):
+    """
+    The target model's queries of each slot are kept on the device in ring buffers of meta_seq_len entries:
+    images of shape (batch_size, T, C, H, W) and logits of shape (batch_size, T, #class), so that the history of all
+    images is gathered by one index operation for the batched fine-tuning.
+    """
+    def __init__(self, batch_size, meta_seq_len, image_shape, num_classes):
+        self.meta_seq_len = meta_seq_len
+        self.images = torch.zeros(batch_size, meta_seq_len, *image_shape).cuda()
+        self.logits = torch.zeros(batch_size, meta_seq_len, num_classes).cuda()
+        self.count = torch.zeros(batch_size).long().cuda()
+
+    def reset(self):
+        self.count.zero_()
+
+    def append(self, batch_idxes, images, logits):
+        position = self.count[batch_idxes] % self.meta_seq_len
+        self.images[batch_idxes, position] = images.detach()
+        self.logits[batch_idxes, position] = logits.detach()
+        self.count[batch_idxes] += 1
+
+    def stack_history_track(self, batch_idxes):
+        valid_mask = torch.arange(self.meta_seq_len, device=self.count.device).unsqueeze(0) < \
+                     self.count[batch_idxes].unsqueeze(1)  # B,T
+        return self.images[batch_idxes], self.logits[batch_idxes], valid_mask
 
 
 class MetaSimulatorSquareAttack(object):
@@ -204,15 +187,100 @@ class MetaSimulatorSquareAttack(object):
                 return self.cw_loss(logits,label, None)
 
 
+    def query_proposals(self, model, x_new, y_curr, batch_idxes, i_iter, first_finetune, loss_type, history, args):
+        """
+        Score the proposals of the images that are not done. In the warm-up steps and every meta_predict_steps steps
+        the target model is queried, its logits are appended to the history of each image and (after the warm-up)
+        the simulators are fine-tuned on the history. In other steps the simulators of all images predict the logits
+        in one forward, no query is charged.
+        :param x_new: the proposals, numpy array of shape (n, C, H, W)
+        :param batch_idxes: the slots of the images in the batch, numpy array of shape (n,)
+        :return: loss, margin (None if predicted by the simulator, thus it can not decide the success),
+                 whether the target model is queried
+        """
+        x_new = torch.from_numpy(x_new).cuda().float()
+        y_curr = torch.from_numpy(y_curr).long().cuda()
+        batch_idxes = torch.from_numpy(batch_idxes).long().cuda()
+        predict_by_target_model = i_iter <= args.warm_up_steps or \
+                                  (i_iter - args.warm_up_steps) % args.meta_predict_steps == 0
+        if predict_by_target_model:
+            with torch.no_grad():
+                logits = model(x_new)
+            history.append(batch_idxes, x_new, logits)
+            if i_iter >= args.warm_up_steps:
+                history_images, history_logits, valid_mask = history.stack_history_track(batch_idxes)
+                finetune_times = args.finetune_times if first_finetune else random.randint(3, 5)
+                self.meta_finetuner.batch_finetune(history_images, history_logits, valid_mask, finetune_times,
+                                                   batch_idxes)
+            margin = self.loss(logits, y_curr, loss_type='cw_loss').detach().cpu().numpy()
+        else:
+            logits = self.meta_finetuner.batch_predict(x_new, batch_idxes)
+            margin = None
+        loss = self.loss(logits, y_curr, loss_type=loss_type).detach().cpu().numpy()
+        return loss, margin, predict_by_target_model
+
+    def init_simulator(self, model, x_best, y, loss_type, args):
+        """
+        Query the initial images, reset the simulators and the history of the slots for a new batch.
+        """
+        history = FinetuneHistoryBuffer(args.batch_size, args.meta_seq_len, x_best.shape[1:], CLASS_NUM[args.dataset])
+        batch_idxes = torch.arange(x_best.shape[0]).cuda()
+        self.meta_finetuner.reset_weights(batch_idxes)
+        x_best = torch.from_numpy(x_best).cuda().float()
+        with torch.no_grad():
+            logits = model(x_best)
+        history.append(batch_idxes, x_best, logits)
+        loss_min = self.loss(logits, torch.from_numpy(y).long().cuda(), loss_type=loss_type).detach().cpu().numpy()
+        margin_min = self.loss(logits, torch.from_numpy(y).long().cuda(), loss_type='cw_loss').detach().cpu().numpy()
+        return history, loss_min, margin_min
+
+    def attack_loop(self, model, x, y, x_best, max_queries, p_init, loss_type, args, make_proposals):
+        """
+        The loop shared by the L2 and Linf attack, the proposals of the images that are not done are accepted or
+        rejected together. Only the steps that query the target model are charged and may decide the success
+        (margin_min is only updated by the target model), the schedule of p follows the number of queries.
+        :param make_proposals: function (x_curr, x_best_curr, p) -> x_new
+        """
+        history, loss_min, margin_min = self.init_simulator(model, x_best, y, loss_type, args)
+        n_queries = np.ones(x.shape[0])  # ones because we have already used 1 query
+        n_iters = max_queries - 1
+        query_fail_times = np.zeros(x.shape[0])
+        query_success_times = np.zeros(x.shape[0])
+        first_finetune = True
+        i_iter = 0
+        while True:
+            idx_to_fool = (margin_min > 0.0) & (n_queries < max_queries)
+            if not idx_to_fool.any():
+                break
+            batch_idxes = np.nonzero(idx_to_fool)[0]
+            x_curr, x_best_curr, y_curr = x[idx_to_fool], x_best[idx_to_fool], y[idx_to_fool]
+            loss_min_curr, margin_min_curr = loss_min[idx_to_fool], margin_min[idx_to_fool]
+            # the images that are not done are queried the same times, since they are charged in the same steps
+            p = self.p_selection(p_init, int(n_queries[idx_to_fool].max()) - 1, n_iters)
+            x_new = make_proposals(x_curr, x_best_curr, p)
+            loss, margin, predict_by_target_model = self.query_proposals(model, x_new, y_curr, batch_idxes, i_iter,
+                                                                         first_finetune, loss_type, history, args)
+            if predict_by_target_model and i_iter >= args.warm_up_steps:
+                first_finetune = False
+
+            idx_improved = loss < loss_min_curr
+            loss_min[idx_to_fool] = np.where(idx_improved, loss, loss_min_curr)
+            x_best[idx_to_fool] = np.where(idx_improved.reshape([-1, *[1] * len(x.shape[:-1])]), x_new, x_best_curr)
+            if predict_by_target_model:
+                margin_min[idx_to_fool] = np.where(idx_improved, margin, margin_min_curr)
+                query_success_times[idx_to_fool] += idx_improved
+                query_fail_times[idx_to_fool] += ~idx_improved
+                n_queries[idx_to_fool] += 1
+            i_iter += 1
+        curr_norms_image = np.sqrt(np.sum((x_best - x) ** 2, axis=(1, 2, 3), keepdims=True))
+        log.info('Maximal norm of the perturbations: {:.5f}, {} steps'.format(np.amax(curr_norms_image), i_iter))
+        return n_queries, query_success_times, query_fail_times, x_best
+
     def square_attack_l2(self, model, x, y, eps, max_queries, p_init, loss_type, args):
         """ The L2 square attack """
-        img_idx_to_batch_idx = ImageIdxToOrigBatchIdx(args.batch_size)
-        finetune_queue = FinetuneQueue(args.batch_size, args.meta_seq_len, img_idx_to_batch_idx)
         np.random.seed(0)
         c, h, w = x.shape[1:]
         n_features = c * h * w
-        n_ex_total = x.shape[0]
-        # x, y = x[corr_classified], y[corr_classified]
         ### initialization
         delta_init = np.zeros(x.shape)
         s = h // 5
@@ -229,25 +297,8 @@ class MetaSimulatorSquareAttack(object):
 
         x_best = np.clip(x + delta_init / np.sqrt(np.sum(delta_init ** 2, axis=(1, 2, 3), keepdims=True)) * eps, self.lower_bound, self.upper_bound)
 
-        logits = model(torch.from_numpy(x_best).cuda().float())
-        loss_min = self.loss(logits, torch.from_numpy(y).long().cuda(), loss_type=loss_type).detach().cpu().numpy()
-        margin_min = self.loss(logits, torch.from_numpy(y).long().cuda(), loss_type='cw_loss').detach().cpu().numpy()
-        n_queries = np.ones(x.shape[0])  # ones because we have already used 1 query
-
-        time_start = time.time()
-        n_iters = max_queries - 1
-        metrics = np.zeros([n_iters, 7])
-        query_fail_times = np.zeros(x.shape[0])
-        query_success_times = np.zeros(x.shape[0])
-        first_finetune = True
-        for i_iter in range(n_iters):
-            idx_to_fool = (margin_min > 0.0).astype(np.bool)
-            x_curr, x_best_curr = x[idx_to_fool], x_best[idx_to_fool]
-            y_curr, margin_min_curr = y[idx_to_fool], margin_min[idx_to_fool]
-            loss_min_curr = loss_min[idx_to_fool]
+        def make_proposals(x_curr, x_best_curr, p):
             delta_curr = x_best_curr - x_curr
-
-            p = self.p_selection(p_init, i_iter, n_iters)
             s = max(int(round(np.sqrt(p * n_features / c))), 3)
 
             if s % 2 == 0:
@@ -283,92 +334,22 @@ class MetaSimulatorSquareAttack(object):
             delta_curr[:, :, center_h_2:center_h_2 + s2, center_w_2:center_w_2 + s2] = 0.0  # set window_2 to 0
             delta_curr[:, :, center_h:center_h + s, center_w:center_w + s] = new_deltas + 0  # update window_1
 
-            # hps_str = 's={}->{}'.format(s_init, s)
             x_new = x_curr + delta_curr / np.sqrt(np.sum(delta_curr ** 2, axis=(1, 2, 3), keepdims=True)) * eps
-            x_new = np.clip(x_new, self.lower_bound, self.upper_bound)
-            # curr_norms_image = np.sqrt(np.sum((x_new - x_curr) ** 2, axis=(1, 2, 3), keepdims=True))
-            predict_by_target_model = False
-            if (i_iter <= args.warm_up_steps or (i_iter - args.warm_up_steps) % args.meta_predict_steps == 0):
-                predict_by_target_model = True
-                logits = model(torch.from_numpy(x_new).cuda().float())
-                loss = self.loss(logits, torch.from_numpy(y_curr).long().cuda(), loss_type=loss_type).detach().cpu().numpy()
-                finetune_queue.append(torch.from_numpy(x_new), loss)
-                if i_iter>=args.warm_up_steps:
-                    history_images, history_losses = finetune_queue.stack_history_track()
-                    finetune_times = args.finetune_times if first_finetune else random.randint(3, 5)
-                    self.meta_finetuner.finetune(history_images, history_losses, finetune_times, first_finetune, img_idx_to_batch_idx)
-                    first_finetune = False
-            else:
-                with torch.no_grad():
-                    loss = self.meta_finetuner.finetune(torch.from_numpy(x_new).cuda().float())
-
-            margin = self.loss(logits, torch.from_numpy(y_curr).long().cuda(), loss_type='cw_loss').detach().cpu().numpy()
-
-            idx_improved = (loss < loss_min_curr).astype(np.bool)
-            qq = query_success_times[idx_to_fool]
-            qq[idx_improved] += 1
-            query_success_times[idx_to_fool] = qq
-            qq = query_fail_times[idx_to_fool]
-            qq[~idx_improved] += 1
-            query_fail_times[idx_to_fool] = qq
-            loss_min[idx_to_fool] = idx_improved * loss + ~idx_improved * loss_min_curr
-            margin_min[idx_to_fool] = idx_improved * margin + ~idx_improved * margin_min_curr
-
-            idx_improved = np.reshape(idx_improved, [-1, *[1] * len(x.shape[:-1])])
-            x_best[idx_to_fool] = idx_improved * x_new + ~idx_improved * x_best_curr
-            n_queries[idx_to_fool] += 1
-
-            acc = (margin_min > 0.0).sum() / n_ex_total
-            acc_corr = (margin_min > 0.0).mean()
-            mean_nq, mean_nq_ae, median_nq, median_nq_ae = np.mean(n_queries), np.mean(
-                n_queries[margin_min <= 0]), np.median(n_queries), np.median(n_queries[margin_min <= 0])
-
-            time_total = time.time() - time_start
-            # log.info(
-            #     '{}: acc={:.2%} acc_corr={:.2%} avg#q_ae={:.1f} med#q_ae={:.1f} {}, n_ex={}, {:.0f}s, loss={:.3f}, max_pert={:.1f}, impr={:.0f}'.
-            #         format(i_iter + 1, acc, acc_corr, mean_nq_ae, median_nq_ae, hps_str, x.shape[0], time_total,
-            #                np.mean(margin_min), np.amax(curr_norms_image), np.sum(idx_improved)))
-            metrics[i_iter] = [acc, acc_corr, mean_nq, mean_nq_ae, median_nq, margin_min.mean(), time_total]
-            # if (i_iter <= 500 and i_iter % 500) or (i_iter > 100 and i_iter % 500) or i_iter + 1 == n_iters or acc == 0:
-            #     np.save(metrics_path, metrics)
-            if acc == 0:
-                curr_norms_image = np.sqrt(np.sum((x_best - x) ** 2, axis=(1, 2, 3), keepdims=True))
-                log.info('Maximal norm of the perturbations: {:.5f}'.format(np.amax(curr_norms_image)))
-                break
+            return np.clip(x_new, self.lower_bound, self.upper_bound)
 
-        curr_norms_image = np.sqrt(np.sum((x_best - x) ** 2, axis=(1, 2, 3), keepdims=True))
-        log.info('Maximal norm of the perturbations: {:.5f}'.format(np.amax(curr_norms_image)))
-
-        return n_queries, query_success_times, query_fail_times, x_best
+        return self.attack_loop(model, x, y, x_best, max_queries, p_init, loss_type, args, make_proposals)
 
-    def square_attack_linf(self, model, x, y, eps, max_queries, p_init, loss_type):
+    def square_attack_linf(self, model, x, y, eps, max_queries, p_init, loss_type, args):
         """ The Linf square attack """
         np.random.seed(0)  # important to leave it here as well
         c, h, w = x.shape[1:]
         n_features = c * h * w
-        n_ex_total = x.shape[0]
-        # x, y = x[corr_classified], y[corr_classified]
         # [c, 1, w], i.e. vertical stripes work best for untargeted attacks
         init_delta = np.random.choice([-eps, eps], size=[x.shape[0], c, 1, w])
         x_best = np.clip(x + init_delta, self.lower_bound, self.upper_bound)
 
-        logits = model(torch.from_numpy(x_best).cuda().float())
-        loss_min = self.loss(logits, torch.from_numpy(y).long().cuda(), loss_type=loss_type).detach().cpu().numpy()
-        margin_min = self.loss(logits, torch.from_numpy(y).long().cuda(), loss_type='cw_loss').detach().cpu().numpy()
-        n_queries = np.ones(x.shape[0])  # ones because we have already used 1 query
-
-        time_start = time.time()
-        n_iters = max_queries - 1
-        metrics = np.zeros([n_iters, 7])
-        query_fail_times = np.zeros(x.shape[0])
-        query_success_times = np.zeros(x.shape[0])
-        for i_iter in range(n_iters - 1):
-            idx_to_fool = (margin_min > 0).astype(np.bool)
-            x_curr, x_best_curr, y_curr = x[idx_to_fool], x_best[idx_to_fool], y[idx_to_fool]
-            loss_min_curr, margin_min_curr = loss_min[idx_to_fool], margin_min[idx_to_fool]
+        def make_proposals(x_curr, x_best_curr, p):
             deltas = x_best_curr - x_curr
-
-            p = self.p_selection(p_init, i_iter, n_iters)
             for i_img in range(x_best_curr.shape[0]):
                 s = int(round(np.sqrt(p * n_features / c)))
                 s = min(max(s, 1), h - 1)  # at least c x 1 x 1 window is taken and at most c x h-1 x h-1
@@ -382,45 +363,9 @@ class MetaSimulatorSquareAttack(object):
                                 self.upper_bound) - x_best_curr_window) < 10 ** -7) == c * s * s:
                     deltas[i_img, :, center_h:center_h + s, center_w:center_w + s] = np.random.choice([-eps, eps],
                                                                                                       size=[c, 1, 1])
+            return np.clip(x_curr + deltas, self.lower_bound, self.upper_bound)
 
-            x_new = np.clip(x_curr + deltas, self.lower_bound, self.upper_bound)
-
-            logits = model(torch.from_numpy(x_new).cuda().float())
-            loss = self.loss(logits, torch.from_numpy(y_curr).long().cuda(), loss_type=loss_type).detach().cpu().numpy()
-            margin = self.loss(logits,torch.from_numpy(y_curr).long().cuda(), loss_type='cw_loss').detach().cpu().numpy()
-
-            idx_improved = (loss < loss_min_curr).astype(np.bool)
-            qq = query_success_times[idx_to_fool]
-            qq[idx_improved] += 1
-            query_success_times[idx_to_fool] = qq
-            qq = query_fail_times[idx_to_fool]
-            qq[~idx_improved] += 1
-            query_fail_times[idx_to_fool] = qq
-            loss_min[idx_to_fool] = idx_improved * loss + ~idx_improved * loss_min_curr
-            margin_min[idx_to_fool] = idx_improved * margin + ~idx_improved * margin_min_curr
-            idx_improved = np.reshape(idx_improved, [-1, *[1] * len(x.shape[:-1])])
-            x_best[idx_to_fool] = idx_improved * x_new + ~idx_improved * x_best_curr
-            n_queries[idx_to_fool] += 1
-
-            acc = (margin_min > 0.0).sum() / n_ex_total
-            acc_corr = (margin_min > 0.0).mean()
-            mean_nq, mean_nq_ae, median_nq_ae = np.mean(n_queries), np.mean(n_queries[margin_min <= 0]), np.median(
-                n_queries[margin_min <= 0])
-            # avg_margin_min = np.mean(margin_min)
-            time_total = time.time() - time_start
-            # log.info(
-            #     '{}: acc={:.2%} acc_corr={:.2%} avg#q_ae={:.2f} med#q={:.1f}, avg_margin={:.2f} (n_ex={}, eps={:.3f}, {:.2f}s)'.
-            #     format(i_iter + 1, acc, acc_corr, mean_nq_ae, median_nq_ae, avg_margin_min, x.shape[0], eps,
-            #            time_total))
-
-            metrics[i_iter] = [acc, acc_corr, mean_nq, mean_nq_ae, median_nq_ae, margin_min.mean(), time_total]
-            # if (i_iter <= 500 and i_iter % 20 == 0) or (
-            #         i_iter > 100 and i_iter % 50 == 0) or i_iter + 1 == n_iters or acc == 0:
-            #     np.save(metrics_path, metrics)
-            if acc == 0:
-                break
-
-        return n_queries, query_success_times, query_fail_times, x_best
+        return self.attack_loop(model, x, y, x_best, max_queries, p_init, loss_type, args, make_proposals)
 
     def attack_all_images(self, args, arch_name, target_model, result_dump_path):
 
@@ -468,11 +413,11 @@ class MetaSimulatorSquareAttack(object):
             if self.norm == "l2":
                 query, query_success_times, query_fail_times, adv_images = self.square_attack_l2(target_model, images.detach().cpu().numpy(),
                                                           labels.detach().cpu().numpy(),
-                                         args.epsilon, args.max_queries, args.p, loss_type)
+                                         args.epsilon, args.max_queries, args.p, loss_type, args)
             elif self.norm == "linf":
                 query, query_success_times, query_fail_times, adv_images = self.square_attack_linf(target_model, images.detach().cpu().numpy(),
                                                             labels.detach().cpu().numpy(),
-                                                            args.epsilon, args.max_queries, args.p, loss_type)
+                                                            args.epsilon, args.max_queries, args.p, loss_type, args)
             query = torch.from_numpy(query).float().cuda()
             query_success_times = torch.from_numpy(query_success_times)
             query_fail_times = torch.from_numpy(query_fail_times)
@@ -567,6 +512,18 @@ def main():
     parser.add_argument('--defense_model', type=str, default=None)
     parser.add_argument('--arch', default=None, type=str, help='network architecture')
     parser.add_argument('--test_archs', action="store_true")
+    # meta-learning arguments
+    parser.add_argument("--meta_arch", type=str, default="resnet34")
+    parser.add_argument("--meta_train_type", type=str, default="2q_distillation",
+                        choices=["logits_distillation", "2q_distillation"])
+    parser.add_argument("--data_loss", type=str, required=True, choices=["xent", "cw"])
+    parser.add_argument("--distillation_loss", type=str, required=True, choices=["mse", "pair_mse"])
+    parser.add_argument("--finetune_times", type=int, default=20)
+    parser.add_argument("--meta_predict_steps", type=int, default=40)
+    parser.add_argument("--warm_up_steps", type=int, default=20)
+    parser.add_argument("--meta_seq_len", type=int, default=20)
+    parser.add_argument("--without_resnet", action="store_true")
+    parser.add_argument('--seed', default=1398, type=int, help='random seed')
     args = parser.parse_args()
     os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
     os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
@@ -630,8 +587,16 @@ def main():
     log.info("Log file is written in {}".format(log_file_path))
     log.info('Called with args:')
     print_args(args)
+    meta_finetuner = MemoryEfficientMetaModelFinetune(args.dataset, args.batch_size, args.meta_arch, args.meta_train_type,
+                                                      args.distillation_loss, args.data_loss, args.norm, args.targeted,
+                                                      args.data_loss == "xent", args.without_resnet)
+    args.meta_model_path = meta_finetuner.meta_model_path
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
     attacker = MetaSimulatorSquareAttack(args.dataset, args.batch_size,
-                                         args.targeted, args.target_type, args.epsilon, args.norm, max_queries=args.max_queries)
+                                         args.targeted, args.target_type, args.epsilon, args.norm, meta_finetuner,
+                                         max_queries=args.max_queries)
     for arch in archs:
         if args.attack_defense:
             save_result_path = args.exp_dir + "/{}_{}_result.json".format(arch, args.defense_model)
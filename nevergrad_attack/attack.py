@@ -25,11 +25,18 @@ from dataset.dataset_loader_maker import DataLoaderMaker
 import numpy as np
 
 class NeverGradAttack:
+    """
+    Each image has its own nevergrad optimizer, the optimizers are driven by an explicit ask/tell loop:
+    in each round every image that is not done asks num_candidates candidates, all candidates of all images are
+    evaluated in one stacked forward, and the loss of each candidate is told back to the optimizer of its image.
+    """
     def __init__(self, image, epsilon, true_labels, target_labels, model, image_height, image_width, in_channels, args):
         self.loss_fn = args.loss
         self.epsilon = epsilon
         self.targeted = args.targeted
         self.discrete = args.discrete
+        self.budget = args.iterations
+        self.num_candidates = args.num_candidates
         self.model = model
         self.image = torch.from_numpy(image).cuda().float()
         self.dims    = image_height * image_width * in_channels                   #problem dimensions
@@ -40,17 +47,21 @@ class NeverGradAttack:
         self.target_labels = target_labels
         if self.target_labels is not None:
             self.target_labels = target_labels.cuda()
+        self.optimizers = []
         if not self.discrete:
-            self.lb      =  np.clip(image.reshape(self.image.size(0), -1) - epsilon, 0, 1.0).ravel()        #lower bound for each dimensions
-            self.ub      =  np.clip(image.reshape(self.image.size(0), -1) + epsilon, 0, 1.0).ravel()     #upper bound for each dimensions
-
-            init = self.from_unit_cube(np.random.rand(self.image.size(0), self.dims).ravel(), self.lb, self.ub).astype(np.float)
-            self.param = ng.p.Array(init=init).set_bounds(self.lb.ravel(), self.ub.ravel(), method='clipping')
-            self.optimizer = ng.optimizers.NGOpt(parametrization=self.param, budget=args.iterations)
+            self.lb      =  np.clip(image.reshape(self.image.size(0), -1) - epsilon, 0, 1.0)        #lower bound for each dimensions
+            self.ub      =  np.clip(image.reshape(self.image.size(0), -1) + epsilon, 0, 1.0)     #upper bound for each dimensions
+            for img_idx in range(self.image.size(0)):
+                init = self.from_unit_cube(np.random.rand(self.dims), self.lb[img_idx], self.ub[img_idx]).astype(np.float64)
+                param = ng.p.Array(init=init).set_bounds(self.lb[img_idx], self.ub[img_idx], method='clipping')
+                self.optimizers.append(ng.optimizers.NGOpt(parametrization=param, budget=self.budget,
+                                                           num_workers=self.num_candidates))
         else:
             # Discrete, ordered
-            variables = ng.p.TransitionChoice([-1,1],repetitions=self.dims)
-            self.optimizer = ng.optimizers.NGOpt(parametrization=variables, budget=args.iterations)
+            for img_idx in range(self.image.size(0)):
+                variables = ng.p.TransitionChoice([-1,1],repetitions=self.dims)
+                self.optimizers.append(ng.optimizers.NGOpt(parametrization=variables, budget=self.budget,
+                                                           num_workers=self.num_candidates))
             # instrum = ng.p.Instrumentation(*variables)
             # self.optimizer = ng.optimizers.DiscreteOnePlusOne(parametrization=instrum, budget=args.iterations, num_workers=1)
         self.query_all = torch.zeros(self.image.size(0)).float()
@@ -64,9 +75,9 @@ class NeverGradAttack:
 
     def xent_loss(self, logit, label, target=None):
         if target is not None:
-            return -F.cross_entropy(logit, target)
+            return -F.cross_entropy(logit, target, reduction='none')
         else:
-            return F.cross_entropy(logit, label)
+            return F.cross_entropy(logit, label, reduction='none')
 
     def cw_loss(self, logit, label, target=None):
         if target is not None:
@@ -86,37 +97,71 @@ class NeverGradAttack:
             second_max_logit = logit[torch.arange(logit.shape[0]), second_max_index]
             return second_max_logit - gt_logit
 
-    def __call__(self, x):
+    def candidate_to_image(self, value, img_idx):
         if not self.discrete:
-            assert np.all(x <= self.ub) and np.all(x >= self.lb)
-            logits = self.model(torch.from_numpy(x.reshape(-1, self.channels, self.image_height, self.image_width)).cuda().float())
-        else:
-            x = torch.from_numpy(np.array([xx for xx in x])).cuda().float() * self.epsilon
-            image = self.image + x.view_as(self.image)
-            image = image.view(-1, self.channels, self.image_height, self.image_width)
-            logits = self.model(image).cuda().float()
+            assert np.all(value <= self.ub[img_idx]) and np.all(value >= self.lb[img_idx])
+            return torch.from_numpy(np.asarray(value).reshape(self.channels, self.image_height, self.image_width)).float()
+        pert = torch.from_numpy(np.array([xx for xx in value])).float() * self.epsilon
+        return self.image[img_idx].cpu() + pert.view_as(self.image[img_idx].cpu())
+
+    def evaluate(self, candidate_images, img_idxes):
+        """
+        Evaluate the candidates of all images in one forward.
+        :param candidate_images: shape = (N, C, H, W), N is the total number of candidates of this round
+        :param img_idxes: the image of each candidate, shape = (N,)
+        :return: the loss (larger is better for the attacker) and the success of each candidate
+        """
+        with torch.no_grad():
+            logits = self.model(candidate_images.cuda())
         adv_pred = logits.argmax(dim=1)
-        self.query_all = self.query_all + self.not_done_all.detach().cpu().float()
+        true_labels = self.true_labels[img_idxes]
+        target_labels = self.target_labels[img_idxes] if self.target_labels is not None else None
         if self.targeted:
-            self.not_done_all = self.not_done_all * (1 - adv_pred.eq(self.target_labels).float()).float()
+            success = adv_pred.eq(target_labels)
         else:
-            self.not_done_all = self.not_done_all * adv_pred.eq(self.true_labels).float()
+            success = ~adv_pred.eq(true_labels)
         criterion = self.cw_loss if self.loss_fn == "cw" else self.xent_loss
-        loss = criterion(logits, self.true_labels, self.target_labels).mean()
-        return -loss.item()
+        loss = criterion(logits, true_labels, target_labels)
+        return loss.detach().cpu(), success.detach().cpu()
 
     def attack(self):
-        logits = self.model(self.image)
+        with torch.no_grad():
+            logits = self.model(self.image)
         pred = logits.argmax(dim=1)
         correct = pred.eq(self.true_labels).float()
-        self.not_done_all = correct.clone()
-        adv_images = self.optimizer.minimize(self).value
-        if self.discrete:
-            pert = torch.from_numpy(np.array([xx for xx in adv_images])).cuda().float() * self.epsilon
-            adv_images = self.image + pert.view_as(self.image)
-        else:
-            assert np.all(adv_images <= self.ub) and np.all(adv_images >= self.lb)
-            adv_images = torch.from_numpy(adv_images.reshape(-1, self.channels, self.image_height, self.image_width)).cuda().float()
+        self.not_done_all = correct.clone().cpu()
+        adv_images = [None] * self.image.size(0)
+        num_ask = np.zeros(self.image.size(0), dtype=np.int64)
+        while True:
+            attacking = [img_idx for img_idx in range(self.image.size(0))
+                         if self.not_done_all[img_idx].item() and num_ask[img_idx] < self.budget]
+            if len(attacking) == 0:
+                break
+            candidates, candidate_images, img_idxes = [], [], []
+            for img_idx in attacking:
+                for _ in range(min(self.num_candidates, self.budget - num_ask[img_idx])):
+                    candidate = self.optimizers[img_idx].ask()
+                    candidates.append(candidate)
+                    candidate_images.append(self.candidate_to_image(candidate.value, img_idx))
+                    img_idxes.append(img_idx)
+                    num_ask[img_idx] += 1
+            img_idxes = torch.LongTensor(img_idxes)
+            loss, success = self.evaluate(torch.stack(candidate_images), img_idxes.cuda())
+            for candidate, img_idx, each_loss, each_success, candidate_image in zip(candidates, img_idxes.tolist(),
+                                                                        loss.tolist(), success.tolist(), candidate_images):
+                self.optimizers[img_idx].tell(candidate, -each_loss)
+                # the queries after the first successful candidate of an image are not counted
+                self.query_all[img_idx] += self.not_done_all[img_idx]
+                if each_success and self.not_done_all[img_idx].item():
+                    self.not_done_all[img_idx] = 0
+                    adv_images[img_idx] = candidate_image
+        for img_idx in range(self.image.size(0)):
+            if not correct[img_idx].item():  # misclassified image is not attacked
+                adv_images[img_idx] = self.image[img_idx].cpu()
+            elif adv_images[img_idx] is None:
+                adv_images[img_idx] = self.candidate_to_image(self.optimizers[img_idx].provide_recommendation().value,
+                                                              img_idx)
+        adv_images = torch.stack(adv_images).cuda()
         with torch.no_grad():
             adv_logit = self.model(adv_images)
         adv_pred = adv_logit.argmax(dim=1)
@@ -167,6 +212,8 @@ parser.add_argument('--defense_model',type=str, default=None)
 parser.add_argument('--batch_size', type=int, default=1)
 parser.add_argument("--loss", type=str, required=True, choices=["xent", "cw"])
 parser.add_argument("--discrete", action="store_true")
+parser.add_argument("--num_candidates", type=int, default=1,
+                    help='the number of candidates asked from the optimizer of each image per round')
 args = parser.parse_args()
 os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
 os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
@@ -44,7 +44,7 @@ class ParsimoniousAttack(object):
 
     def _split_block(self, upper_left, lower_right, block_size):
         """Split an image into a set of blocks.
-        Note that a block consists of [upper_left, lower_right, channel]
+        Note that a block consists of [x, y, channel], where [x, y] is the upper left of the block
 
         Args:
           upper_left: [x, y], the coordinate of the upper left of an image
@@ -52,42 +52,42 @@ class ParsimoniousAttack(object):
           block_size: int, the size of a block
 
         Return:
-          blocks: list, a set of blocks
+          blocks: LongTensor of size [num_blocks, 3], a set of blocks
         """
         blocks = []
         xs = torch.arange(upper_left[0], lower_right[0], block_size)
         ys = torch.arange(upper_left[1], lower_right[1], block_size)
         for x, y in itertools.product(xs.detach().numpy(), ys.detach().numpy()):
             for c in range(3):
-                blocks.append([[x, y], [x + block_size, y + block_size], c])
-        return blocks
+                blocks.append([x, y, c])
+        return torch.LongTensor(blocks)
 
     def perturb(self, image, label):
-        """Perturb an image.
+        """Perturb a batch of images, all the images are searched together.
 
         Args:
-          image: numpy array of size [1, 3, 32, 32], an original image
-          label: numpy array of size [1], the label of the image (or target label)
+          image: torch array of size [N, 3, 32, 32], the original images
+          label: torch array of size [N], the labels of the images (or target labels)
 
         Returns:
-          adv_image: numpy array of size [1, 32, 32, 3], an adversarial image
-          num_queries: int, the number of queries
-          success: bool, True if attack is successful
+          num_queries: LongTensor of size [N], the number of queries of each image
+          success: BoolTensor of size [N], True if attack is successful
         """
-
-        adv_image = image.clone()
-        num_queries = 0
+        num_images = image.size(0)
+        num_queries = torch.zeros(num_images, dtype=torch.long, device=image.device)
+        success = torch.zeros(num_images, dtype=torch.bool, device=image.device)
+        attacking = torch.ones(num_images, dtype=torch.bool, device=image.device)
         block_size = self.block_size
         upper_left = [0, 0]
         lower_right = [image.size(2), image.size(2)]
         # Split an image into a set of blocks
-        blocks = self._split_block(upper_left, lower_right, block_size)
+        blocks = self._split_block(upper_left, lower_right, block_size).to(image.device)
         # Initialize a noise to -epsilon
         noise = -self.epsilon * torch.ones_like(image).float().cuda()
         # Construct a batch
         num_blocks = len(blocks)
         batch_size = self.batch_size if self.batch_size > 0 else num_blocks
-        curr_order = torch.randperm(num_blocks)
+        curr_order = torch.argsort(torch.rand(num_images, num_blocks, device=image.device), dim=1)  # 每张图片各自的顺序
         # Main loop
         while True:
             num_batches = int(math.ceil(num_blocks / batch_size))
@@ -95,28 +95,28 @@ class ParsimoniousAttack(object):
                 # Pick a mini-batch
                 bstart = i * batch_size
                 bend = min(bstart + batch_size, num_blocks)
-                blocks_batch = [blocks[curr_order[idx].item()]
-                                for idx in range(bstart, bend)]
+                idx = torch.nonzero(attacking).view(-1)
+                blocks_batch = blocks[curr_order[idx, bstart:bend]]  # [n, bend - bstart, 3]
                 # Run local search algorithm on the mini-batch
-                noise, queries, loss, success = self.local_search.perturb(
-                    image, noise, label, blocks_batch)
-                num_queries += queries
-                log.info("Block size: {}, batch: {}, loss: {:.4f}, num queries: {}".format(block_size, i, loss, num_queries))
-                # If query count exceeds the maximum queries, then return False
-                if num_queries > self.max_queries:
-                    return num_queries, False
+                noise[idx], queries, loss, succeed = self.local_search.perturb(
+                    image[idx], noise[idx], label[idx], blocks_batch, block_size)
+                num_queries[idx] += queries
+                log.info("Block size: {}, batch: {}, {} images, mean loss: {:.4f}, mean num queries: {:.1f}".format(
+                    block_size, i, idx.size(0), loss.mean().item(), num_queries[idx].float().mean().item()))
+                # If query count exceeds the maximum queries, then the attack fails
+                over_query = num_queries[idx] > self.max_queries
                 # Generate an adversarial image
                 # adv_image = self._perturb_image(image, noise)
-                # If attack succeeds, return True
-                if success:
-                    return num_queries, True
+                # If attack succeeds, the image is done
+                success[idx] = succeed & ~over_query
+                attacking[idx] = ~(succeed | over_query)
+                if not attacking.any():
+                    return num_queries, success
             # If block size is >= 2, then split the image into smaller blocks and reconstruct a batch
             if not self.no_hier and block_size >= 2:
                 block_size //= 2
-                blocks = self._split_block(upper_left, lower_right, block_size)
+                blocks = self._split_block(upper_left, lower_right, block_size).to(image.device)
                 num_blocks = len(blocks)
                 batch_size = self.batch_size if self.batch_size > 0 else num_blocks
-                curr_order = torch.randperm(num_blocks)
             # Otherwise, shuffle the order of the batch
-            else:
-                curr_order = torch.randperm(num_blocks)
\ No newline at end of file
+            curr_order = torch.argsort(torch.rand(num_images, num_blocks, device=image.device), dim=1)
@@ -1,4 +1,3 @@
-import heapq
 import math
 
 import torch
@@ -34,7 +33,8 @@ def gather_nd(params, indices):
 
 class LocalSearchHelper(object):
     """A helper for local seearch algorithm.
-      Note that since heapq library only supports min heap, we flip the sign of loss function.
+      All the images of a batch are searched together, the priority queue of each image is a row of a margin tensor
+      (the blocks which are not in the queue have the margin of +inf), thus popping the best element is an argmin.
     """
     def __init__(self, model, args):
         """Initialize local search helper.
@@ -49,13 +49,20 @@ class LocalSearchHelper(object):
         self.max_iters = args.max_iters
         self.targeted = args.targeted
         self.loss_func = args.loss_func
+        # the number of blocks of each image evaluated in one round, a successful block ends the rounds of its image
+        self.eval_batch_size = 100
+        # the maximum number of images sent to the model in one forward
+        self.forward_chunk_size = args.forward_chunk_size
         # Network Setting
         self.model = model
         self.softmax = nn.Softmax(dim=1)
         self.in_channels= IN_CHANNELS[args.dataset]
 
     def get_logits(self, image):
-        return self.model(image)
+        logits = []
+        for chunk in torch.split(image, self.forward_chunk_size):
+            logits.append(self.model(chunk))
+        return torch.cat(logits, 0)
 
     def get_loss(self, logits, labels):
         probs = self.softmax(logits)
@@ -68,217 +75,172 @@ class LocalSearchHelper(object):
         max_probs = gather_nd(params=probs, indices=max_indices)
         if self.targeted:
             if self.loss_func == "xent":
-                loss_val = F.cross_entropy(logits, labels)
+                loss_val = F.cross_entropy(logits, labels, reduction='none')
             elif self.loss_func == "cw":
                 loss_val = torch.log(max_probs + 1e-10) - torch.log(ground_truth_probs+1e-10)
         else:
             if self.loss_func == "xent":
-                loss_val = - F.cross_entropy(logits, labels)
+                loss_val = - F.cross_entropy(logits, labels, reduction='none')
             elif self.loss_func == "cw":
                 loss_val = torch.log(ground_truth_probs+1e-10) - torch.log(max_probs + 1e-10)
         return loss_val
 
+    def _is_success(self, preds, labels):
+        if self.targeted:
+            return preds.eq(labels)
+        return preds.ne(labels)
+
     def _perturb_image(self, image, noise):
         adv_image = image + noise
         adv_image = torch.clamp(adv_image, 0, 1)
         return adv_image
 
-    def _flip_noise(self, noise, block):
-        """Filp the sign of perturbation on a block.
+    def _block_pixel_index(self, blocks, block_size, img_size):
+        """The flattened pixel indexes of blocks.
             Args:
-              noise: numpy array of size [1, 3, 32, 32], a noise
-              block: [upper_left, lower_right, channel], a block
+              blocks: LongTensor of size [..., 3], each block is [x, y, channel] of its upper left corner
+              block_size: int, the size of a block
 
             Returns:
-              noise_new: numpy array with size [1,3, 32, 32], an updated noise
+              pixel_index: LongTensor of size [..., block_size * block_size], the index into C*H*W of each pixel,
+                           the pixels outside of the image are clamped to the border pixels of the same block
         """
-        noise_new = noise.clone()
-        upper_left, lower_right, channel = block
-        noise_new[0, channel, upper_left[0]:lower_right[0], upper_left[1]:lower_right[1]] *= -1
-        return noise_new
+        offset = torch.arange(block_size, device=blocks.device)
+        rows = torch.clamp(blocks[..., 0:1] + offset, max=img_size - 1)  # [..., block_size]
+        cols = torch.clamp(blocks[..., 1:2] + offset, max=img_size - 1)
+        pixel_index = blocks[..., 2:3].unsqueeze(-1) * img_size * img_size + rows.unsqueeze(-1) * img_size \
+                      + cols.unsqueeze(-2)
+        return pixel_index.view(*blocks.shape[:-1], block_size * block_size)
+
+    def _flip_noise(self, noise, pixel_index):
+        """Filp the sign of perturbation on a block of each row.
+            Args:
+              noise: tensor of size [K, C, H, W], the noise of each candidate
+              pixel_index: LongTensor of size [K, block_size * block_size], the block of each candidate
 
-    def perturb(self, image, noise, label, blocks):
-        """Update a noise with local search algorithm.
+            Returns:
+              noise_new: tensor of size [K, C, H, W], the updated noise
+        """
+        flip = torch.ones(noise.size(0), noise.shape[1:].numel(), device=noise.device)
+        flip.scatter_(1, pixel_index, -1.0)
+        return noise * flip.view_as(noise)
+
+    def _evaluate(self, image, noise, label, owner, pixel_index):
+        """Evaluate the candidates, each candidate flips one block of the noise of its image (owner).
+          The candidates are built and evaluated chunk by chunk, so only forward_chunk_size perturbed images are held
+          at once, the noise of a selected candidate is rebuilt by _flip_noise from its owner and pixel_index.
+        """
+        losses, success = [], []
+        for chunk_owner, chunk_pixel_index in zip(torch.split(owner, self.forward_chunk_size),
+                                                  torch.split(pixel_index, self.forward_chunk_size)):
+            noise_batch = self._flip_noise(noise[chunk_owner], chunk_pixel_index)
+            logits = self.model(self._perturb_image(image[chunk_owner], noise_batch))
+            preds = torch.argmax(logits, 1)
+            losses.append(self.get_loss(logits, label[chunk_owner]))
+            success.append(self._is_success(preds, label[chunk_owner]))
+        return torch.cat(losses), torch.cat(success)
+
+    def _lazy_greedy(self, image, noise, label, A, block_index, curr_loss, num_queries, success, insert):
+        """One lazy greedy insertion (insert=True) or deletion of all images, the tensors are updated in place."""
+        num_images, num_blocks = A.size()
+        image_index = torch.arange(num_images, device=A.device)
+        margins = torch.full((num_images, num_blocks), float("inf"), device=A.device)
+        candidates = (A.eq(0) if insert else A.eq(1)) & ~success.unsqueeze(1)
+        rank = torch.cumsum(candidates.long(), 1) - 1  # the position of each candidate in its image
+        num_rounds = int(math.ceil(candidates.long().sum(1).max().item() / self.eval_batch_size))
+        for iround in range(num_rounds):
+            in_round = candidates & ~success.unsqueeze(1) & (rank >= iround * self.eval_batch_size) & \
+                       (rank < (iround + 1) * self.eval_batch_size)
+            owner, blk = torch.nonzero(in_round, as_tuple=True)
+            if owner.numel() == 0:
+                break
+            losses, succ = self._evaluate(image, noise, label, owner, block_index[owner, blk])
+            # Early stopping: the first successful candidate of an image ends its search
+            first_success = torch.full((num_images,), owner.numel(), dtype=torch.long, device=A.device)
+            row = torch.arange(owner.numel(), device=A.device)
+            first_success.scatter_reduce_(0, owner[succ], row[succ], reduce="amin")
+            done = first_success < owner.numel()
+            done_rows = first_success[done]
+            noise[done] = self._flip_noise(noise[done], block_index[owner[done_rows], blk[done_rows]])
+            curr_loss[done] = losses[done_rows]
+            num_queries[done] += (rank[owner[done_rows], blk[done_rows]] - iround * self.eval_batch_size + 1)
+            success |= done
+            not_done_rows = ~done[owner]
+            num_queries.index_add_(0, owner[not_done_rows], torch.ones_like(owner[not_done_rows]))
+            # Push into the priority queue
+            margins[owner[not_done_rows], blk[not_done_rows]] = losses[not_done_rows] - curr_loss[owner[not_done_rows]]
+        margins[success] = float("inf")
+        # Pick the best element and insert (delete) it into (from) the working set
+        best_margin, best_idx = margins.min(1)
+        picked = torch.isfinite(best_margin)
+        if picked.any():
+            curr_loss[picked] += best_margin[picked]
+            noise[picked] = self._flip_noise(noise[picked], block_index[picked, best_idx[picked]])
+            A[picked, best_idx[picked]] = 1 - A[picked, best_idx[picked]]
+            margins[picked, best_idx[picked]] = float("inf")
+        # Add (delete) elements into (from) the working set, the best element of all images is re-evaluated together
+        searching = picked & torch.isfinite(margins).any(1)
+        while searching.any():
+            idx = image_index[searching]
+            cand_idx = margins[idx].argmin(1)
+            margins[idx, cand_idx] = float("inf")
+            # Re-evalulate the element
+            losses, succ = self._evaluate(image, noise, label, idx, block_index[idx, cand_idx])
+            num_queries[idx] += 1
+            margin = losses - curr_loss[idx]
+            # If the cardinality has not changed, add (delete) the element
+            accept = margin <= margins[idx].min(1)[0]
+            # If there is no element that has negative margin, then break
+            stop = accept & (margin > 0)
+            accept = accept & ~stop
+            accepted = idx[accept]
+            curr_loss[accepted] = losses[accept]
+            noise[accepted] = self._flip_noise(noise[accepted], block_index[accepted, cand_idx[accept]])
+            A[accepted, cand_idx[accept]] = 1 - A[accepted, cand_idx[accept]]
+            # Early stopping
+            success[accepted] |= succ[accept]
+            # If the cardinality has changed, push the element into the priority queue
+            margins[idx[~accept & ~stop], cand_idx[~accept & ~stop]] = margin[~accept & ~stop]
+            searching[idx[stop]] = False
+            searching &= ~success & torch.isfinite(margins).any(1)
+
+    def perturb(self, image, noise, label, blocks, block_size):
+        """Update the noises of a batch of images with local search algorithm.
 
         Args:
-          image: torch array of size [1, 3, 32, 32], an original image
-          noise: torch array of size [1, 3, 32, 32], a noise
-          label: torch array of size [1], the label of the image (or target label)
-          blocks: list, a set of blocks
+          image: torch array of size [N, 3, 32, 32], the original images
+          noise: torch array of size [N, 3, 32, 32], the noises
+          label: torch array of size [N], the labels of the images (or target labels)
+          blocks: LongTensor of size [N, M, 3], the set of blocks of each image, a block is [x, y, channel]
+          block_size: int, the size of a block
 
         Returns:
-          noise: numpy array of size [1, 256, 256, 3], an updated noise
-          num_queries: int, the number of queries
-          curr_loss: float, the value of loss function
-          success: bool, True if attack is successful
+          noise: torch array of size [N, 3, 32, 32], the updated noises
+          num_queries: LongTensor of size [N], the number of queries of each image
+          curr_loss: torch array of size [N], the value of loss function
+          success: BoolTensor of size [N], True if attack is successful
         """
-        # Local variables
-        priority_queue = []
-        num_queries = 0
+        noise = noise.clone()
         img_size = image.size(2)
+        block_index = self._block_pixel_index(blocks, block_size, img_size)  # [N, M, block_size * block_size]
         # Check if a block is in the working set or not
-        A = torch.zeros((len(blocks)), dtype=torch.int32)
-        for i, block in enumerate(blocks):
-            upper_left, _, channel = block
-            x = upper_left[0]
-            y = upper_left[1]
-            # If the sign of perturbation on the block is positive,
-            # which means the block is in the working set, then set A to 1
-            if noise[0, channel, x, y] > 0:
-                A[i] = 1
+        # If the sign of perturbation on the block is positive,
+        # which means the block is in the working set, then set A to 1
+        upper_left_index = blocks[..., 2] * img_size * img_size + blocks[..., 0] * img_size + blocks[..., 1]
+        A = (torch.gather(noise.view(noise.size(0), -1), 1, upper_left_index) > 0).long()
         # Calculate the current loss
-        image_batch = self._perturb_image(image, noise)
-        label_batch = label.clone()
-        logits = self.get_logits(image_batch)
+        logits = self.get_logits(self._perturb_image(image, noise))
         preds = torch.argmax(logits, 1)
-        losses = self.get_loss(logits, label_batch)
-        num_queries += 1
-        curr_loss = losses[0]
+        curr_loss = self.get_loss(logits, label)
+        num_queries = torch.ones(image.size(0), dtype=torch.long, device=image.device)
         # Early stopping
-        if self.targeted:
-            if torch.all(preds.eq(label)).item():
-                return noise, num_queries, curr_loss, True
-        else:
-            if not torch.all(preds.eq(label)).item():
-                return noise, num_queries, curr_loss, True
+        success = self._is_success(preds, label)
         # Main loop
         for _ in range(self.max_iters):
-            # Lazy greedy insert、
-            indices = torch.nonzero(A==0).view(-1)
-            batch_size =  100
-            num_batches = int(math.ceil(indices.size(0) / batch_size))
-            for ibatch in range(num_batches):
-                bstart = ibatch * batch_size
-                bend = min(bstart + batch_size, indices.size(0))
-                image_batch = torch.zeros([bend - bstart,self.in_channels,img_size,img_size]).float().cuda()
-                noise_batch = torch.zeros([bend - bstart,self.in_channels,img_size,img_size]).float().cuda()
-                label_batch = label.repeat(bend - bstart)
-                for i, idx in enumerate(indices[bstart:bend]):
-                    idx = idx.item()
-                    noise_batch[i:i + 1, ...] = self._flip_noise(noise, blocks[idx])
-                    image_batch[i:i + 1, ...] = self._perturb_image(image, noise_batch[i:i + 1, ...])
-                logits = self.get_logits(image_batch)
-                preds = torch.argmax(logits, 1)
-                losses = self.get_loss(logits, label_batch)
-                # Early stopping
-                success_indices = torch.nonzero((preds == label_batch).long()).view(-1) if self.targeted else torch.nonzero((preds!=label_batch).long()).view(-1)
-                if success_indices.size(0) > 0:
-                    noise[0, ...] = noise_batch[success_indices[0], ...]
-                    curr_loss = losses[success_indices[0]]
-                    num_queries += success_indices[0].item() + 1
-                    return noise, num_queries, curr_loss, True
-
-                num_queries += bend - bstart
-                # Push into the priority queue
-                for i in range(bend - bstart):
-                    idx = indices[bstart + i]
-                    margin = losses[i] - curr_loss
-                    heapq.heappush(priority_queue, (margin.item(), idx))
-            # Pick the best element and insert it into the working set
-            if len(priority_queue) > 0:
-                best_margin, best_idx = heapq.heappop(priority_queue)
-                curr_loss += best_margin
-                noise = self._flip_noise(noise, blocks[best_idx])
-                A[best_idx] = 1
-            # Add elements into the working set
-            while len(priority_queue) > 0:
-                # Pick the best element
-                cand_margin, cand_idx = heapq.heappop(priority_queue)
-                # Re-evalulate the element
-                image_batch = self._perturb_image(
-                    image, self._flip_noise(noise, blocks[cand_idx]))
-                label_batch = label.clone()
-                logits = self.get_logits(image_batch)
-                preds = torch.argmax(logits, 1)
-                losses = self.get_loss(logits, label_batch)
-                num_queries += 1
-                margin = losses[0] - curr_loss
-                # If the cardinality has not changed, add the element
-                if len(priority_queue) == 0 or margin.item() <= priority_queue[0][0]:
-                    # If there is no element that has negative margin, then break
-                    if margin.item() > 0:
-                        break
-                    # Update the noise
-                    curr_loss = losses[0]
-                    noise = self._flip_noise(noise, blocks[cand_idx])
-                    A[cand_idx] = 1
-                    # Early stopping
-                    if self.targeted:
-                        if torch.all(preds.eq(label)).item():
-                            return noise, num_queries, curr_loss, True
-                    else:
-                        if not torch.all(preds.eq(label)).item():
-                            return noise, num_queries, curr_loss, True
-                # If the cardinality has changed, push the element into the priority queue
-                else:
-                    heapq.heappush(priority_queue, (margin.item(), cand_idx))
-            priority_queue = []
+            if success.all():
+                break
+            # Lazy greedy insert
+            self._lazy_greedy(image, noise, label, A, block_index, curr_loss, num_queries, success, insert=True)
             # Lazy greedy delete
-            indices  = torch.nonzero(A == 1).view(-1)
-            batch_size = 100
-            num_batches = int(math.ceil(indices.size(0) / batch_size))
-            for ibatch in range(num_batches):
-                bstart = ibatch * batch_size
-                bend = min(bstart + batch_size, indices.size(0))
-
-                image_batch = torch.zeros([bend - bstart,self.in_channels, img_size, img_size]).float().cuda()
-                noise_batch = torch.zeros([bend - bstart,self.in_channels, img_size, img_size]).float().cuda()
-                label_batch = label.repeat(bend - bstart)
-                for i, idx in enumerate(indices[bstart:bend]):
-                    noise_batch[i:i + 1, ...] = self._flip_noise(noise, blocks[idx])
-                    image_batch[i:i + 1, ...] = self._perturb_image(image, noise_batch[i:i+1, ...])
-                logits = self.get_logits(image_batch)
-                preds = torch.argmax(logits, 1)
-                losses = self.get_loss(logits, label_batch)
-                success_indices = torch.nonzero((preds == label_batch).long()).view(-1) if self.targeted else torch.nonzero((preds!=label_batch).long()).view(-1)
-                if success_indices.size(0) > 0:
-                    noise[0, ...] = noise_batch[success_indices[0], ...]
-                    curr_loss = losses[success_indices[0]]
-                    num_queries += success_indices[0].item() + 1
-                    return noise, num_queries, curr_loss, True
-                num_queries += bend - bstart
-                # Push into the priority queue
-                for i in range(bend - bstart):
-                    idx = indices[bstart + i].item()
-                    margin = losses[i] - curr_loss
-                    heapq.heappush(priority_queue, (margin.item(), idx))
-
-            # Pick the best element and remove it from the working set
-            if len(priority_queue) > 0:
-                best_margin, best_idx = heapq.heappop(priority_queue)
-                curr_loss += best_margin
-                noise = self._flip_noise(noise, blocks[best_idx])
-                A[best_idx] = 0
-            # Delete elements from the working set
-            while len(priority_queue) > 0:
-                # pick the best element
-                cand_margin, cand_idx = heapq.heappop(priority_queue)
-                # Re-evalulate the element
-                image_batch = self._perturb_image(image, self._flip_noise(noise, blocks[cand_idx]))
-                label_batch = label.clone()
-                logits = self.get_logits(image_batch)
-                preds = torch.argmax(logits, 1)
-                losses = self.get_loss(logits, label_batch)
-                num_queries += 1
-                margin = losses[0] - curr_loss
-                # If the cardinality has not changed, remove the element
-                if len(priority_queue) == 0 or margin.item() <= priority_queue[0][0]:
-                    # If there is no element that has negative margin, then break
-                    if margin.item() > 0:
-                        break
-                    # Update the noise
-                    curr_loss = losses[0]
-                    noise = self._flip_noise(noise, blocks[cand_idx])
-                    A[cand_idx] = 0
-                    # Early stopping
-                    if self.targeted:
-                        if torch.all(preds.eq(label)).item():
-                            return noise, num_queries, curr_loss, True
-                    else:
-                        if not torch.all(preds.eq(label)).item():
-                            return noise, num_queries, curr_loss, True
-                else:
-                    heapq.heappush(priority_queue, (margin.item(), cand_idx))
-
-            priority_queue = []
-        return noise, num_queries, curr_loss, False
\ No newline at end of file
+            self._lazy_greedy(image, noise, label, A, block_index, curr_loss, num_queries, success, insert=False)
+        return noise, num_queries, curr_loss, success
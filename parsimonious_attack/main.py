@@ -63,23 +63,26 @@ def attack_all_images(dataset_loader, attacker, target_model, args, result_dump_
             pred = logits.argmax(dim=1)
             correct = pred.eq(true_labels).detach().cpu().numpy().astype(np.int32)
             correct_all.append(correct)
-            if correct[0].item() == 0:
-                queries.append(0)
-                not_done.append(1)
-                log.info("The {}-th image is already classified incorrectly.".format(batch_idx))
-                continue
-
-        if args.targeted:
-            num_queries, is_success = attacker.perturb(images, target_labels)
-        else:
-            num_queries, is_success = attacker.perturb(images, true_labels)
-        if is_success:
-            not_done.append(0)
-            queries.append(num_queries)
-        else:
-            not_done.append(1)
-            queries.append(args.max_queries)
-        log.info("Attack {}-th image done, attack: {}, query: {}".format(batch_idx, "success" if is_success else "fail", num_queries))
+        batch_queries = np.zeros(images.size(0), dtype=np.int32)
+        batch_not_done = np.ones(images.size(0), dtype=np.int32)
+        correct_idx = torch.nonzero(pred.eq(true_labels)).view(-1)
+        if correct_idx.size(0) < images.size(0):
+            log.info("{} images of the {}-th batch are already classified incorrectly.".format(
+                images.size(0) - correct_idx.size(0), batch_idx))
+        if correct_idx.size(0) > 0:
+            if args.targeted:
+                num_queries, is_success = attacker.perturb(images[correct_idx], target_labels[correct_idx])
+            else:
+                num_queries, is_success = attacker.perturb(images[correct_idx], true_labels[correct_idx])
+            num_queries = num_queries.detach().cpu().numpy()
+            is_success = is_success.detach().cpu().numpy()
+            correct_idx = correct_idx.detach().cpu().numpy()
+            batch_queries[correct_idx] = np.where(is_success, num_queries, args.max_queries)
+            batch_not_done[correct_idx] = 1 - is_success.astype(np.int32)
+            log.info("Attack {}-th batch done, success: {}/{}, mean query: {:.1f}".format(
+                batch_idx, int(is_success.sum()), correct_idx.shape[0], float(num_queries.mean())))
+        queries.extend(batch_queries.tolist())
+        not_done.extend(batch_not_done.tolist())
 
     correct_all = np.concatenate(correct_all, axis=0).astype(np.int32)
     query_all = np.array(queries).astype(np.int32)
@@ -133,6 +136,9 @@ def get_parse_args():
     parser.add_argument('--block_size', default=4, type=int, help='Initial block size')
     parser.add_argument('--batch_size', default=64, type=int, help='The size of batch. No batch if negative')
     parser.add_argument('--no_hier', action='store_true', help='No hierarchical evaluation if true')
+    parser.add_argument('--attack_batch_size', default=100, type=int, help='The number of images attacked together')
+    parser.add_argument('--forward_chunk_size', default=1000, type=int,
+                        help='The maximum number of images sent to the model in one forward')
     parser.add_argument('--dataset',type=str, required=True)
     parser.add_argument('--exp-dir', default='logs', type=str,
                         help='directory to save results and logs')
@@ -215,7 +221,7 @@ if __name__ == "__main__":
     log.info("Log file is written in {}".format(log_file_path))
     log.info('Called with args:')
     print_args(args)
-    data_loader = DataLoaderMaker.get_test_attacked_data(args.dataset, 1)
+    data_loader = DataLoaderMaker.get_test_attacked_data(args.dataset, args.attack_batch_size)
     for arch in archs:
         if args.attack_defense:
             save_result_path = args.exp_dir + "/{}_{}_result.json".format(arch, args.defense_model)
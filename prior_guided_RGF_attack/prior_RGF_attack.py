@@ -18,6 +18,7 @@ from torch.nn import functional as F
 
 from config import IMAGE_SIZE, IN_CHANNELS, PY_ROOT, MODELS_TEST_STANDARD, CLASS_NUM
 from dataset.dataset_loader_maker import DataLoaderMaker
+from dataset.query_profiler import QueryProfiler, ProfiledModel
 from dataset.standard_model import StandardModel
 from utils.statistics_toolkit import success_rate_and_query_coorelation, success_rate_avg_query
 
@@ -38,6 +39,8 @@ class PriorRGFAttack(object):
         self.target_type = target_type
         self.clip_min = 0.0
         self.clip_max = 1.0
+        # each image is attacked alone, the gradient estimation forwards samples_per_draw rows in one call
+        self.profiler = QueryProfiler(len(self.data_loader.dataset), args.samples_per_draw, enabled=args.profile)
 
 
     def xent_loss(self, logit, true_labels, target_labels=None):
@@ -104,9 +107,10 @@ class PriorRGFAttack(object):
                 learning_rate = args.image_lr
             images = images.cuda()
             true_labels = true_labels.cuda()
+            self.profiler.set_batch(torch.tensor([batch_idx]))
 
 
-            with torch.no_grad():
+            with torch.no_grad(), self.profiler.uncharged():  # the clean prediction is not a query of the attack
                 logits = self.model(images)
                 pred = logits.argmax(dim=1)
                 correct = pred.eq(true_labels).detach().cpu().numpy().astype(np.int32)
@@ -143,7 +147,8 @@ class PriorRGFAttack(object):
             torch.cuda.manual_seed(0)
             adv_images = images.clone().cuda()
             assert images.size(0) == 1
-            logits_real_images = self.model(images)
+            with self.profiler.uncharged():
+                logits_real_images = self.model(images)
             l = self.xent_loss(logits_real_images, true_labels, target_labels)  # 按照元素论文来写的，好奇怪
             lr = float(learning_rate)
             total_q = 0
@@ -285,8 +290,8 @@ class PriorRGFAttack(object):
                             les.append((loss_p - l)[0].item())
                         log.info("losses: ".format(les))
 
-                    if args.show_loss:
-                        if args.method == 'biased' or args.method == 'fixed_biased':
+                    if args.show_loss and (args.method == 'biased' or args.method == 'fixed_biased'):
+                        with self.profiler.uncharged():  # the debug losses are not queries of the attack
                             show_input = adv_images + lr * prior
                             logits_show = self.model(show_input)
                             lprior = self.xent_loss(logits_show, true_labels, target_labels) - l
@@ -315,8 +320,8 @@ class PriorRGFAttack(object):
                     adv_images = adv_images + lr * torch.sign(grad)
                     adv_images = torch.min(torch.max(adv_images, images - eps), images + eps)
                 adv_images = torch.clamp(adv_images, self.clip_min, self.clip_max)
-                adv_labels = self.get_pred(self.model, adv_images)
-                logits_ = self.model(adv_images)
+                logits_ = self.model(adv_images)  # one query (the total_q += 1 above) gives both the label and the loss
+                adv_labels = logits_.max(1)[1]
                 l = self.xent_loss(logits_, true_labels, target_labels)
                 log.info('queries:', total_q, 'loss:', l, 'learning rate:', lr, 'sigma:', sigma, 'prediction:', adv_labels,
                       'distortion:', torch.max(torch.abs(adv_images - images)).item(), torch.norm((adv_images - images).view(images.size(0),-1)).item())
@@ -350,6 +355,9 @@ class PriorRGFAttack(object):
         with open(result_dump_path, "w") as result_file_obj:
             json.dump(meta_info_dict, result_file_obj, sort_keys=True)
         log.info("done, write stats info to {}".format(result_dump_path))
+        if args.profile:
+            self.profiler.export(result_dump_path)
+            self.profiler.reset()
 
 
 def get_expr_dir_name(dataset, method, surrogate_arch, norm, targeted, target_type, args):
@@ -416,6 +424,7 @@ if __name__ == "__main__":
     parser.add_argument('--attack_defense', action="store_true")
     parser.add_argument('--defense_model', type=str, default=None)
     parser.add_argument('--image-lr', type=float)
+    parser.add_argument('--profile', action="store_true", help='export the query/latency profile next to the result json')
 
     args = parser.parse_args()
     os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
@@ -494,6 +503,9 @@ if __name__ == "__main__":
         model.eval()
         log.info("Begin attack {} on {}, result will be saved to {}".format(arch, args.dataset, save_result_path))
         attacker = PriorRGFAttack(args.dataset, model, surrogate_model, args.targeted, args.target_type)
+        if args.profile:
+            attacker.model = ProfiledModel(model, attacker.profiler)
+            attacker.surrogate_model = ProfiledModel(surrogate_model, attacker.profiler, tag="surrogate")
         with torch.no_grad():
             attacker.attack_dataset(args, arch, save_result_path)
         attacker.model.cpu()
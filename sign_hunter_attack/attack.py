@@ -16,6 +16,7 @@ import torch
 from config import IMAGE_SIZE, IN_CHANNELS, CLASS_NUM, MODELS_TEST_STANDARD, PY_ROOT
 from dataset.dataset_loader_maker import DataLoaderMaker
 from dataset.defensive_model import DefensiveModel
+from dataset.pipeline_attack import PipelineAttack
 from sign_hunter_attack.utils import sign, lp_step
 from torch.nn import functional as F
 import glog as log
@@ -25,7 +26,7 @@ from dataset.standard_model import StandardModel
 
 class SignHunterAttack(object):
     def __init__(self, dataset, targeted, target_type, epsilon, norm, lower_bound=0.0, upper_bound=1.0,
-                 max_queries=10000, max_crit_queries=np.inf):
+                 max_queries=10000, max_crit_queries=np.inf, block_flips=1):
         """
             :param epsilon: perturbation limit according to lp-ball
             :param norm: norm for the lp-ball constraint
@@ -33,6 +34,8 @@ class SignHunterAttack(object):
             :param upper_bound: maximum value data point can take in any coordinate
             :param max_queries: max number of calls to model per data point
             :param max_crit_queries: max number of calls to early stopping criterion  per data poinr
+            :param block_flips: the number of block flips evaluated per image in one stacked forward (charging
+                                block_flips queries), the best one is accepted. 1 is the original sequential SignHunter.
         """
         assert norm in ['linf', 'l2'], "{} is not supported".format(norm)
         assert not (np.isinf(max_queries) and np.isinf(max_crit_queries)), "one of the budgets has to be finite!"
@@ -40,8 +43,10 @@ class SignHunterAttack(object):
         self.norm = norm
         self.max_queries = max_queries
         self.max_crit_queries = max_crit_queries
+        self.block_flips = block_flips
 
         self.best_est_deriv = None
+        self.base_loss = None
         self.xo_t = None
         self.sgn_t = None
         self.h = 0
@@ -204,7 +209,8 @@ class SignHunterAttack(object):
 
             self.attack_batch_images(batch_idx, images, true_labels, target_labels, model,
                                       args)
-            tmp_info_dict = {"batch_idx": batch_idx + 1, "batch_size": args.batch_size}
+            tmp_info_dict = {"batch_idx": batch_idx + 1, "batch_size": args.batch_size,
+                             "block_flips": self.block_flips}
             for key in ['query_all', 'correct_all', 'not_done_all',
                         'success_all', 'success_query_all']:
                 value_all = getattr(self, key).detach().cpu().numpy().tolist()
@@ -225,6 +231,7 @@ class SignHunterAttack(object):
                           "correct_all": self.correct_all.detach().cpu().numpy().astype(np.int32).tolist(),
                           "not_done_all": self.not_done_all.detach().cpu().numpy().astype(np.int32).tolist(),
                           "query_all": self.query_all.detach().cpu().numpy().astype(np.int32).tolist(),
+                          "block_flips": self.block_flips,
                           "args": vars(args)}
         with open(result_dump_path, "w") as result_file_obj:
             json.dump(meta_info_dict, result_file_obj, sort_keys=True)
@@ -327,52 +334,164 @@ class SignHunterAttack(object):
             self.h = 0
             self.i = 0
             self.exhausted = False
+            self.base_loss = None
+        if self.base_loss is None:
+            # the loss of each image at the base point xo_t is cached, it is computed again only after xo_t is replaced
+            self.base_loss = self.loss_fct(model, self.xo_t, label, target)
         if self.i == 0 and self.h == 0:
             self.sgn_t = sign(torch.ones(_shape[0], dim).cuda())
             fxs_t = lp_step(self.xo_t, self.sgn_t.view(_shape), self.epsilon, self.norm)
-            bxs_t = self.xo_t
-            est_deriv = (self.loss_fct(model, fxs_t, label, target) - self.loss_fct(model, bxs_t, label, target)) / self.epsilon
+            est_deriv = (self.loss_fct(model, fxs_t, label, target) - self.base_loss) / self.epsilon
             self.best_est_deriv = est_deriv
             #add_queries = 3  # because of bxs_t and the 2 evaluations in the i=0, h=0, case.
             query_count += 2
 
         chunk_len = np.ceil(dim / (2 ** self.h)).astype(int)
+        # evaluate the next num_blocks blocks of current level h, each candidate flips one block of the current sign
+        num_blocks = min(self.block_flips, 2 ** self.h - self.i, int(np.ceil(dim / chunk_len)) - self.i)
         istart = self.i * chunk_len
-        iend = min(dim, (self.i + 1) * chunk_len)
-        self.sgn_t[:, istart:iend] *= - 1.
-        fxs_t = lp_step(self.xo_t, self.sgn_t.view(_shape), self.epsilon, self.norm)
-        bxs_t = self.xo_t
-        est_deriv = (self.loss_fct(model, fxs_t, label, target) - self.loss_fct(model, bxs_t, label, target)) / self.epsilon
-        query_count += 1
+        iend = min(dim, (self.i + num_blocks) * chunk_len)
+        block_index = torch.arange(dim, device=self.sgn_t.device).unsqueeze(0)
+        block_start = (istart + torch.arange(num_blocks, device=self.sgn_t.device) * chunk_len).unsqueeze(1)
+        block_mask = (block_index >= block_start) & (block_index < block_start + chunk_len)  # num_blocks, dim
+        sgn_candidates = self.sgn_t.unsqueeze(0) * (1. - 2. * block_mask.float()).unsqueeze(1)  # num_blocks, B, dim
+        fxs_t = lp_step(self.xo_t.unsqueeze(0).repeat(num_blocks, *[1] * len(_shape)).view(-1, *_shape[1:]),
+                        sgn_candidates.view(-1, *_shape[1:]), self.epsilon, self.norm)
+        candidate_target = target.repeat(num_blocks) if target is not None else None
+        candidate_loss = self.loss_fct(model, fxs_t, label.repeat(num_blocks), candidate_target).view(num_blocks, -1)
+        est_deriv, best_block = ((candidate_loss - self.base_loss.unsqueeze(0)) / self.epsilon).max(dim=0)
+        query_count += num_blocks
         if self.exhausted:
             query_count += 1
             self.exhausted = False
-        self.sgn_t[[i for i, val in enumerate(est_deriv < self.best_est_deriv) if val], istart: iend] *= -1.  # loss decrease, revert the sign
-        self.best_est_deriv = (est_deriv >= self.best_est_deriv).float() * est_deriv \
-                              + (est_deriv < self.best_est_deriv).float() * self.best_est_deriv  # loss increase , 保留大的作为best
+        # only the best flip of each image is accepted, if it does not decrease the loss
+        accept = est_deriv >= self.best_est_deriv
+        self.sgn_t[block_mask[best_block] & accept.unsqueeze(1)] *= -1.
+        self.best_est_deriv = accept.float() * est_deriv \
+                              + (1 - accept.float()) * self.best_est_deriv  # loss increase , 保留大的作为best
         # compute the cosine similarity
         # cos_sims, ham_sims = metric_fct(self.xo_t.cpu().numpy(), self.sgn_t.cpu().numpy())
         # perform the step
         new_xs = lp_step(self.xo_t, self.sgn_t.view(_shape), self.epsilon, self.norm)   # 第三个变量函数定义明明是lr，因为是sign gradient，所以lr == epsilon
         # update i and h for next iteration
-        self.i += 1
+        self.i += num_blocks
         if self.i == 2 ** self.h or iend == dim:  # it is time to shrink the block and search again.
             self.h += 1
             self.i = 0
             # if h is exhausted, set xo_t to be xs_t
             if self.h == np.ceil(np.log2(dim)).astype(int) + 1:
                 self.xo_t = xs_t.clone()
+                self.base_loss = None
                 self.h = 0
                 self.exhausted = True
         return new_xs, query_count
 
+    def init_state(self, xs, true_labels, target_labels, model, args):
+        """
+        The per-image state of the pipeline attack (dataset/pipeline_attack.py), the batch-wide self.h, self.i,
+        self.xo_t, etc. of _suggest become per-image tensors because the images of the slots start at different steps.
+        """
+        batch_size = xs.size(0)
+        dim = np.prod(list(xs.shape[1:])).item()
+        state = {"images": xs.clone(), "adv_images": xs.clone(), "xo": xs.clone(), "true_labels": true_labels,
+                 "sgn": torch.ones(batch_size, dim).cuda(),
+                 "best_est_deriv": torch.zeros(batch_size).cuda(),
+                 "base_loss": torch.zeros(batch_size).cuda(),
+                 "base_loss_valid": torch.zeros(batch_size).bool().cuda(),
+                 "h": torch.zeros(batch_size).long().cuda(),
+                 "i": torch.zeros(batch_size).long().cuda(),
+                 "exhausted": torch.zeros(batch_size).bool().cuda(),
+                 "query": torch.zeros(batch_size).float().cuda(),
+                 "success": torch.zeros(batch_size).bool().cuda()}
+        if target_labels is not None:
+            state["target_labels"] = target_labels
+        return state
+
+    def step(self, state, model, args):
+        xs, xo, sgn = state["adv_images"], state["xo"], state["sgn"].clone()
+        _shape = list(xs.shape)
+        batch_size = _shape[0]
+        dim = np.prod(_shape[1:]).item()
+        label, target = state["true_labels"], state.get("target_labels")
+        query_count = torch.zeros(batch_size).float().cuda()
+
+        def loss_of(x, idx):
+            return self.loss_fct(model, x, label[idx], target[idx] if target is not None else None)
+
+        # the loss of each image at the base point xo is computed again only after xo is replaced
+        base_loss, best_est_deriv = state["base_loss"].clone(), state["best_est_deriv"].clone()
+        idx = torch.nonzero(~state["base_loss_valid"]).view(-1)
+        if idx.size(0) > 0:
+            base_loss[idx] = loss_of(xo[idx], idx)
+        h, i = state["h"], state["i"]
+        idx = torch.nonzero((i == 0) & (h == 0)).view(-1)
+        if idx.size(0) > 0:
+            sgn[idx] = 1.
+            fxs_t = lp_step(xo[idx], sgn[idx].view([-1] + _shape[1:]), self.epsilon, self.norm)
+            best_est_deriv[idx] = (loss_of(fxs_t, idx) - base_loss[idx]) / self.epsilon
+            query_count[idx] += 2
+
+        # evaluate the next num_blocks blocks of the current level h of each image
+        chunk_len = torch.ceil(dim / torch.pow(2, h).double()).long()
+        num_blocks = torch.min(torch.min(torch.full_like(i, self.block_flips), torch.pow(2, h) - i),
+                               torch.ceil(dim / chunk_len.double()).long() - i)
+        block_range = torch.arange(num_blocks.max().item(), device=sgn.device).unsqueeze(1)  # num_blocks, 1
+        block_start = ((i.unsqueeze(0) + block_range) * chunk_len.unsqueeze(0)).unsqueeze(2)  # num_blocks, B, 1
+        block_index = torch.arange(dim, device=sgn.device).view(1, 1, dim)
+        block_mask = (block_index >= block_start) & (block_index < block_start + chunk_len.view(1, -1, 1))
+        block_id, image_id = torch.nonzero(block_range < num_blocks.unsqueeze(0), as_tuple=True)
+        sgn_candidates = sgn[image_id] * (1. - 2. * block_mask[block_id, image_id].float())
+        fxs_t = lp_step(xo[image_id], sgn_candidates.view([-1] + _shape[1:]), self.epsilon, self.norm)
+        candidate_loss = torch.full(block_mask.shape[:2], -np.inf, device=sgn.device)
+        candidate_loss[block_id, image_id] = loss_of(fxs_t, image_id)
+        est_deriv, best_block = ((candidate_loss - base_loss.unsqueeze(0)) / self.epsilon).max(dim=0)
+        query_count += num_blocks.float() + state["exhausted"].float()
+        # only the best flip of each image is accepted, if it does not decrease the loss
+        accept = est_deriv >= best_est_deriv
+        sgn[block_mask[best_block, torch.arange(batch_size)] & accept.unsqueeze(1)] *= -1.
+        best_est_deriv = torch.where(accept, est_deriv, best_est_deriv)
+        new_xs = lp_step(xo, sgn.view(_shape), self.epsilon, self.norm)
+        # update i and h for next iteration
+        iend = torch.clamp((i + num_blocks) * chunk_len, max=dim)
+        i = i + num_blocks
+        level_done = (i == torch.pow(2, h)) | (iend == dim)
+        h = h + level_done.long()
+        i = i * (~level_done).long()
+        # if h is exhausted, set xo to be xs
+        h_exhausted = h == np.ceil(np.log2(dim)).astype(int) + 1
+        state["xo"] = torch.where(h_exhausted.view([-1] + [1] * (len(_shape) - 1)), xs, xo)
+        state["h"] = h * (~h_exhausted).long()
+        state["i"] = i
+        state["exhausted"] = h_exhausted
+        state["base_loss_valid"] = ~h_exhausted
+        state["base_loss"], state["best_est_deriv"], state["sgn"] = base_loss, best_est_deriv, sgn
+        return self.update_adv_state(state, new_xs, query_count, model)
+
+    def update_adv_state(self, state, new_xs, query_count, model):
+        if self.norm == 'l2':
+            _proj = self.l2_proj_maker(state["images"], self.epsilon)
+        else:
+            _proj = self.linf_proj_maker(state["images"], self.epsilon)
+        state["adv_images"] = torch.clamp(_proj(new_xs), self.lower_bound, self.upper_bound)
+        with torch.no_grad():
+            adv_pred = model(state["adv_images"]).argmax(dim=1)
+        if "target_labels" in state:
+            state["success"] = adv_pred.eq(state["target_labels"])
+        else:
+            state["success"] = ~adv_pred.eq(state["true_labels"])
+        state["query"] = state["query"] + query_count
+        return state
+
+    def is_done(self, state, args):
+        return state["success"] | (state["query"] >= args.max_queries)
+
 
 class RandSignAttack(SignHunterAttack):
     def __init__(self, dataset, targeted, target_type, epsilon, norm, lower_bound=0.0, upper_bound=1.0,
-                 max_queries=10000, max_crit_queries=np.inf):
+                 max_queries=10000, max_crit_queries=np.inf, block_flips=1):
         super(RandSignAttack, self).__init__(dataset, targeted, target_type, epsilon, norm,
                  lower_bound=lower_bound, upper_bound=upper_bound,
-                 max_queries=max_queries, max_crit_queries=max_crit_queries)
+                 max_queries=max_queries, max_crit_queries=max_crit_queries, block_flips=block_flips)
 
     def _suggest(self, model, xs_t, label, target):
         _shape = list(xs_t.shape)
@@ -384,6 +503,13 @@ class RandSignAttack(SignHunterAttack):
         new_xs = lp_step(self.xo_t, sgn_t.view(_shape), self.epsilon, self.norm)
         return new_xs, torch.ones(_shape[0])
 
+    def step(self, state, model, args):
+        _shape = list(state["images"].shape)
+        dim = np.prod(_shape[1:]).item()
+        sgn_t = sign(torch.rand(_shape[0], dim) - 0.5).cuda()
+        new_xs = lp_step(state["images"], sgn_t.view(_shape), self.epsilon, self.norm)
+        return self.update_adv_state(state, new_xs, torch.ones(_shape[0]).cuda(), model)
+
 
 def get_exp_dir_name(attacker, dataset, norm, targeted, target_type, args):
     target_str = "untargeted" if not targeted else "targeted_{}".format(target_type)
@@ -419,6 +545,11 @@ if __name__ == "__main__":
     parser.add_argument('--arch', default=None, type=str, help='network architecture')
     parser.add_argument('--test_archs', action="store_true")
     parser.add_argument('--batch_size',type=int,default=100)
+    parser.add_argument('--block_flips', type=int, default=1,
+                        help='the number of block flips evaluated per image in one stacked forward, the best is accepted')
+    parser.add_argument('--pipeline', action="store_true",
+                        help='refill the finished images of a batch with new images instead of waiting for the slowest one')
+    parser.add_argument('--refill_interval', type=int, default=50, help='refill the finished slots every N steps')
     parser.add_argument('--json-config', type=str,
                         default='/home1/machen/meta_perturbations_black_box_attack/configures/sign_hunter_attack.json',
                         help='a configures file to be passed in instead of arguments')
@@ -499,10 +630,12 @@ if __name__ == "__main__":
     print_args(args)
     if args.attacker == 'sign_hunter':
         attacker = SignHunterAttack(args.dataset, args.targeted, args.target_type, args.epsilon, args.norm,
-                                lower_bound=0.0, upper_bound=1.0, max_queries=args.max_queries)
+                                lower_bound=0.0, upper_bound=1.0, max_queries=args.max_queries,
+                                block_flips=args.block_flips)
     elif args.attacker == "rand_sign":
         attacker = RandSignAttack(args.dataset, args.targeted, args.target_type, args.epsilon, args.norm,
-                                lower_bound=0.0, upper_bound=1.0, max_queries=args.max_queries)
+                                lower_bound=0.0, upper_bound=1.0, max_queries=args.max_queries,
+                                block_flips=args.block_flips)
     for arch in archs:
         if args.attack_defense:
             save_result_path = args.exp_dir + "/{}_{}_result.json".format(arch, args.defense_model)
@@ -519,6 +652,11 @@ if __name__ == "__main__":
             model = StandardModel(args.dataset, arch, no_grad=True)
         model.cuda()
         model.eval()
-        attacker.attack_all_images(model, args, tmp_result_path, save_result_path)
+        if args.pipeline:
+            pipeline = PipelineAttack(attacker, attacker.data_loader, args.dataset, args.batch_size,
+                                      args.refill_interval)
+            pipeline.attack_all_images(args, arch, model, save_result_path)
+        else:
+            attacker.attack_all_images(model, args, tmp_result_path, save_result_path)
         model.cpu()
         os.unlink(tmp_result_path)
\ No newline at end of file
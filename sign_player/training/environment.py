@@ -2,6 +2,8 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 
+from sign_player.training.state import State
+
 class Environment(object):
     def __init__(self):
         self.previous_loss = 0
@@ -16,3 +18,108 @@ class Environment(object):
         self.previous_loss = current_loss.detach().clone()
         return reward
 
+
+class VectorEnvironment(object):
+    """
+    num_envs independent episodes of the pixel-wise attack, each episode attacks its own image batch and runs at its
+    own time step. The images of all episodes are concatenated into one State of num_envs * batch_size images, so that
+    one step of all episodes costs one forward of the agent and one forward of the target model.
+    An episode is reset with the next batch of the data loader as soon as it has run episode_len steps.
+    """
+    def __init__(self, target_model, data_loader, epochs, num_envs, batch_size, image_shape, norm, epsilon,
+                 episode_len, gamma=1.0, stagger=True):
+        """
+        :param image_shape: (C, H, W)
+        :param stagger: the first episode of the i-th environment starts at time step i * episode_len // num_envs,
+                        so that the episodes finish (and the target model sees the clean images) at different steps
+        """
+        self.target_model = target_model
+        self.data_loader = data_loader
+        self.epochs = epochs
+        self.num_envs = num_envs
+        self.batch_size = batch_size
+        self.episode_len = episode_len
+        self.gamma = gamma
+        self.stagger = stagger
+        self.state = State((num_envs * batch_size, *image_shape), norm, epsilon)
+        self.labels = torch.zeros(num_envs * batch_size).long().cuda()
+        self.previous_loss = torch.zeros(num_envs * batch_size).cuda()
+        self.t = torch.zeros(num_envs).long()  # the time step of each episode
+        self.episode_reward = torch.zeros(num_envs)  # the discounted reward of the running episodes
+        self.finished_rewards = []  # the discounted rewards of the finished episodes, main() pops them for logging
+        self.epoch = 0  # the epoch of the latest loaded batch
+        self.exhausted = False  # the data loader has run all epochs, the episodes cannot be reset any more
+
+    def image_stream(self):
+        for epoch in range(self.epochs):
+            for raw_x, true_labels in self.data_loader:
+                if raw_x.size(0) != self.batch_size:  # the last incomplete batch does not fit in the rows of an episode
+                    continue
+                yield epoch, raw_x, true_labels
+
+    def env_rows(self, env_indexes):
+        return (env_indexes.view(-1, 1) * self.batch_size + torch.arange(self.batch_size).view(1, -1)).view(-1)
+
+    def loss_fn(self, x, label):
+        with torch.no_grad():
+            logit = self.target_model(x)
+        return F.cross_entropy(logit, label, reduction='none')
+
+    def load(self, env_indexes):
+        """
+        Reset the episodes of env_indexes with the next batches, the clean images of all of them share one forward.
+        :return: False if the data loader is exhausted
+        """
+        images, labels = [], []
+        for _ in range(env_indexes.size(0)):
+            try:
+                self.epoch, raw_x, true_labels = next(self.stream)
+            except StopIteration:
+                self.exhausted = True
+                return False
+            images.append(raw_x)
+            labels.append(true_labels)
+        rows = self.env_rows(env_indexes).cuda()
+        images = torch.cat(images, 0).cuda()
+        labels = torch.cat(labels, 0).cuda()
+        self.state.reset_rows(rows, images)
+        self.labels[rows] = labels
+        self.previous_loss[rows] = self.loss_fn(images, labels)  # initalize the first loss using clean images
+        self.t[env_indexes] = 0
+        self.episode_reward[env_indexes] = 0
+        return True
+
+    def reset(self):
+        """
+        Start all episodes, :return: the concatenated images, shape = (num_envs * batch_size, C, H, W)
+        """
+        self.stream = self.image_stream()
+        self.state.reset(torch.zeros_like(self.state.image))
+        self.exhausted = False
+        self.load(torch.arange(self.num_envs))
+        if self.stagger:
+            self.t = torch.arange(self.num_envs) * self.episode_len // self.num_envs
+        return self.state.image
+
+    def step(self, action):
+        """
+        Apply the action of all episodes, reset the finished episodes.
+        :param action: shape = (num_envs * batch_size, C, H, W)
+        :return: the images of the next step (the new batch for the reset episodes), the reward and the done flag of
+                 each image, shape = (num_envs * batch_size,)
+        """
+        image = self.state.step(action)
+        current_loss = self.loss_fn(image, self.labels)  # loss 越大越好
+        reward = current_loss - self.previous_loss
+        self.previous_loss = current_loss.detach().clone()
+        self.episode_reward += reward.view(self.num_envs, self.batch_size).mean(1).cpu() * \
+                               torch.pow(self.gamma, self.t.float())
+        self.t += 1
+        done_envs = torch.nonzero(self.t >= self.episode_len).view(-1)
+        done = torch.zeros(self.num_envs).bool()
+        done[done_envs] = True
+        done = done.view(-1, 1).repeat(1, self.batch_size).view(-1).cuda()
+        if done_envs.size(0) > 0:
+            self.finished_rewards.extend(self.episode_reward[done_envs].tolist())
+            self.load(done_envs)
+        return self.state.image, reward, done
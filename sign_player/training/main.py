@@ -9,9 +9,8 @@ import torchvision.datasets as datasets
 from PIL import Image
 from torch.utils import data
 from sign_player.training.FCN import MyFCN
-from sign_player.training.environment import Environment
-from sign_player.training.pixelwise_a3c import PixelWiseA3C
-from sign_player.training.state import State
+from sign_player.training.environment import VectorEnvironment
+from sign_player.training.pixelwise_a2c import PixelWiseA2C
 from config import IN_CHANNELS, IMAGE_SIZE, IMAGE_DATA_ROOT, PY_ROOT
 from torch.optim import Adam
 import glog as log
@@ -113,6 +112,12 @@ def get_parse_args():
     parser.add_argument("--epsilon", type=float)
     parser.add_argument("--norm", type=str, choices=["l2","linf"], required=True)
     parser.add_argument("--gpu",type=int,required=True)
+    parser.add_argument("--num_envs", type=int, default=1,
+                        help="the number of episodes (each on its own image batch) that are stepped in one forward")
+    parser.add_argument("--t_max", type=int, default=None,
+                        help="the number of steps of each A2C update, default is episode_len")
+    parser.add_argument("--no_stagger", action="store_true",
+                        help="start all episodes at the same time step instead of staggering them")
     args = parser.parse_args()
     return args
 
@@ -137,14 +142,14 @@ if __name__ == "__main__":
     os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
     target_model = StandardModel(args.dataset, args.model, no_grad=True)
     target_model = target_model.cuda()
-    current_state = State((args.batch_size, IN_CHANNELS[args.dataset], IMAGE_SIZE[args.dataset][0],
-                           IMAGE_SIZE[args.dataset][1]), args.norm, args.epsilon)
     fcn = MyFCN((IN_CHANNELS[args.dataset], IMAGE_SIZE[args.dataset][0], IMAGE_SIZE[args.dataset][1]), args.n_actions)
     fcn.apply(fcn.init_weights)
+    fcn.cuda()
     optimizer = Adam(fcn.parameters(),lr=args.learning_rate)
-    agent = PixelWiseA3C(fcn, optimizer, args.episode_len, args.gamma)
-    agent.model.cuda()
-    agent.shared_model.cuda()
+    agent = PixelWiseA2C(fcn, optimizer, args.t_max or args.episode_len, args.gamma)
+    environment = VectorEnvironment(target_model, data_loader, args.epochs, args.num_envs, args.batch_size,
+                                    (IN_CHANNELS[args.dataset], IMAGE_SIZE[args.dataset][0], IMAGE_SIZE[args.dataset][1]),
+                                    args.norm, args.epsilon, args.episode_len, args.gamma, stagger=not args.no_stagger)
     i = 0
     episode = 0
     save_model_path = "{}/train_pytorch_model/sign_player/{}_untargeted_{}_attack_on_{}.pth.tar".format(PY_ROOT, args.dataset, args.norm,
@@ -154,30 +159,29 @@ if __name__ == "__main__":
                                                                                              args.model)
     set_log_file(log_path)
     log.info("The trained model file will be saved to {}".format(save_model_path))
-    for epoch in range(args.epochs):
-        for raw_x, true_labels in data_loader:
+    def save_model(epoch):
+        torch.save({"epoch":epoch+1, "state_dict": agent.shared_model.state_dict(),
+                    "optimizer":agent.optimizer.state_dict()}, save_model_path)
+        log.info("The {}-th epoch is trained over!".format(epoch))
+
+    # 每一步把所有episode的图像拼在一起, 一次FCN forward和一次target model forward
+    image = environment.reset()
+    epoch = environment.epoch
+    while not environment.exhausted:
+        action = agent.batch_act_and_train(image)
+        image, reward, done = environment.step(action)
+        agent.batch_observe_and_train(image, reward, done)
+        for sum_reward in environment.finished_rewards:
             episode += 1
-            raw_x = raw_x.cuda()
-            true_labels = true_labels.cuda()
-            current_state.reset(raw_x)
-            reward = torch.zeros(raw_x.size(0)).float()
-            sum_reward = 0
-            environment = Environment()
-            environment.get_reward(target_model, raw_x, true_labels)  # initalize the first loss using clean images
-            for t in range(0, args.episode_len):
-                action = agent.act_and_train(current_state.image, reward)
-                current_state.step(action)
-                reward = environment.get_reward(target_model, current_state.image, true_labels)  # shape= (batch_size,)
-                sum_reward += reward.mean().item() * np.power(args.gamma, t)
-            agent.stop_episode_and_train(current_state.image, reward, True)
             if episode % 100 == 0:
                 log.info("{e}-th episode rain total reward {a}".format(e=episode, a=sum_reward))
             if episode % args.test_episodes == 0:
                 test(test_data_loader, agent, target_model, args)
             adjust_learning_rate(optimizer, args.learning_rate, episode, args.n_episodes)
-
-        torch.save({"epoch":epoch+1, "state_dict": agent.shared_model.state_dict(),
-                    "optimizer":agent.optimizer.state_dict()}, save_model_path)
-        log.info("The {}-th epoch is trained over!".format(epoch))
+        environment.finished_rewards.clear()
+        if environment.epoch != epoch:
+            save_model(epoch)
+            epoch = environment.epoch
+    save_model(epoch)
     log.info("The training is completely over")
         
\ No newline at end of file
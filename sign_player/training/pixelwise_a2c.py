@@ -0,0 +1,154 @@
+from sign_player.rl import agent
+from sign_player.rl.a3c_model import A3CModel
+
+import glog as log
+import torch
+
+
+class PixelWiseA2C(agent.AttributeSavingMixin, agent.BatchAgent):
+    """A2C: synchronous Advantage Actor-Critic of the pixel-wise policy.
+        The training runs in one process on one device, so there is no local model and no copy of the gradients to a
+        shared model: the model is updated by the rollout of t_max steps of all images of a VectorEnvironment.
+        Args:
+            model (A3CModel): Model to train
+            optimizer (torch.optim.optimizer.Optimizer): optimizer used to train the model
+            t_max (int): The model is updated after every t_max steps of the batch
+            gamma (float): Discount factor [0,1]
+            beta (float): Weight coefficient for the entropy regularizaiton term.
+            pi_loss_coef (float): Weight coefficient for the loss of the policy
+            v_loss_coef (float): Weight coefficient for the loss of the value
+                function
+            act_deterministically (bool): If set true, choose most probable actions
+                in act method.
+        """
+    saved_attributes = ['model', 'optimizer']
+
+    def __init__(self, model, optimizer, t_max, gamma, beta=1e-2, pi_loss_coef=1.0, v_loss_coef=0.5,
+                 act_deterministically=False, log_interval=100):
+        assert isinstance(model, A3CModel)
+        self.model = model
+        self.shared_model = model  # the model is also saved and tested as shared_model in main.py and test.py
+        self.optimizer = optimizer
+        self.t_max = t_max
+        self.gamma = gamma
+        self.beta = beta
+        self.pi_loss_coef = pi_loss_coef
+        self.v_loss_coef = v_loss_coef
+        self.act_deterministically = act_deterministically
+        self.log_interval = log_interval
+
+        self.update_count = 0
+        self.past_action_log_prob = []
+        self.past_action_entropy = []
+        self.past_values = []
+        self.past_rewards = []
+        self.past_dones = []
+
+        # Stats
+        self.average_value = 0
+        self.average_entropy = 0
+
+    def update(self, batch_obs):
+        """
+        :param batch_obs: the images after the last step of the rollout, their value is the bootstrap of the return,
+                          None if all episodes are finished
+        """
+        if batch_obs is None:  # all episodes are finished, nothing to bootstrap from
+            R = torch.zeros_like(self.past_rewards[-1]).float()
+        else:
+            with torch.no_grad():
+                _, vout = self.model.pi_and_v(batch_obs.cuda())
+            R = vout.float().view(-1)
+        pi_loss = 0
+        v_loss = 0
+        for i in reversed(range(len(self.past_rewards))):
+            # the return of a finished episode does not bootstrap from the first images of the next episode
+            R = self.past_rewards[i] + self.gamma * R * (1 - self.past_dones[i].float())
+            v = self.past_values[i]
+            advantage = (R - v).detach()  # shape = (B,)
+            log_prob = self.past_action_log_prob[i]  # shape = B,C,H,W
+            entropy = self.past_action_entropy[i]  # shape = B,C,H,W
+            # Log probability is increased proportionally to advantage
+            pi_loss -= log_prob * advantage.view(-1, 1, 1, 1).float()
+            # Entropy is maximized
+            pi_loss -= self.beta * entropy.view_as(pi_loss)
+            # Accumulate gradients of value function
+            v_loss += torch.mul(v - R, v - R) / 2
+        if self.pi_loss_coef != 1.0:
+            pi_loss *= self.pi_loss_coef
+        if self.v_loss_coef != 1.0:
+            v_loss *= self.v_loss_coef
+        self.update_count += 1
+        if self.update_count % self.log_interval == 0:
+            log.info("pi_loss:{} v_loss:{}".format(pi_loss.mean().item(), v_loss.mean().item()))
+        total_loss = torch.mean(pi_loss + v_loss.view(-1, 1, 1, 1))
+        self.optimizer.zero_grad()
+        total_loss.backward()
+        self.optimizer.step()
+        self.past_action_log_prob = []
+        self.past_action_entropy = []
+        self.past_values = []
+        self.past_rewards = []
+        self.past_dones = []
+
+    def batch_act_and_train(self, batch_obs):
+        pout, vout = self.model.pi_and_v(batch_obs.cuda())
+        action = pout.sample()  # Do not backprop through sampled actions # shape =(batch_size,C,H,W)
+        self.past_action_log_prob.append(pout.mylog_prob(action))
+        self.past_action_entropy.append(pout.myentropy)  # B,C,H,W
+        self.past_values.append(vout.view(-1))
+        return action
+
+    def batch_observe_and_train(self, batch_obs, batch_reward, batch_done, batch_reset=None):
+        """
+        :param batch_obs: the images after the step, the reset episodes already show the images of the next episode
+        :param batch_reward: shape = (B,)
+        :param batch_done: shape = (B,), True if the episode of the image is finished in this step
+        """
+        self.past_rewards.append(batch_reward.cuda())
+        self.past_dones.append(batch_done.cuda())
+        if len(self.past_rewards) == self.t_max:
+            self.update(batch_obs)
+
+    def batch_act(self, batch_obs):
+        with torch.no_grad():
+            pout, _ = self.model.pi_and_v(batch_obs.cuda())
+            if self.act_deterministically:
+                return pout.most_probable.cpu()
+            else:
+                return pout.sample().cpu()
+
+    def batch_observe(self, batch_obs, batch_reward, batch_done, batch_reset):
+        pass
+
+    def act(self, obs):
+        return self.batch_act(obs)
+
+    def act_and_train(self, obs, reward):
+        """
+        The single-environment API of PixelWiseA3C: reward is the reward of the previous action, obs is the images
+        after that action.
+        """
+        if len(self.past_values) > len(self.past_rewards):  # the previous action is waiting for its reward
+            self.batch_observe_and_train(obs, reward, torch.zeros(reward.size(0), dtype=torch.bool))
+        return self.batch_act_and_train(obs)
+
+    def stop_episode_and_train(self, state, reward, done=False):
+        """
+        Record the reward of the last action and update the model with the rollout of the finished episode,
+        the return bootstraps from the value of state unless done.
+        """
+        if len(self.past_values) == len(self.past_rewards):  # no action since the last update
+            return
+        self.past_rewards.append(reward.cuda())  # reward = (batch_size,)
+        self.past_dones.append(torch.full((reward.size(0),), bool(done), dtype=torch.bool).cuda())
+        self.update(None if done else state)
+
+    def stop_episode(self):
+        pass
+
+    def get_statistics(self):
+        return [
+            ('average_value', self.average_value),
+            ('average_entropy', self.average_entropy),
+        ]
@@ -11,11 +11,20 @@ class State(object):
 
     def reset(self, x):
         self.image = x.cuda()
-        self.proj_step = self.proj_maker(x.cuda(), self.epsilon)
+        self.orig = x.cuda().clone()
+        self.proj_step = self.proj_maker(self.orig, self.epsilon)
+
+    def reset_rows(self, rows, x):
+        """
+        Restart the images in rows from x (e.g. one episode of VectorEnvironment), the other images are not changed.
+        The projection reads self.orig, so the new original images take effect in the next step.
+        """
+        self.image[rows] = x.cuda()
+        self.orig[rows] = x.cuda()
 
 
     def l2_proj(self, image, eps):
-        orig = image.clone()
+        orig = image  # reset() passes a copy
         def proj(new_x):
             delta = new_x - orig
             out_of_bounds_mask = (self.normalize(delta) > eps).float()
@@ -25,7 +34,7 @@ class State(object):
         return proj
 
     def linf_proj(self, image, eps):
-        orig = image.clone()
+        orig = image  # reset() passes a copy
         def proj(new_x):
             return orig + torch.clamp(new_x - orig, -eps, eps)
         return proj
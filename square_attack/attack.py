@@ -15,13 +15,15 @@ import os.path as osp
 from config import PY_ROOT, MODELS_TEST_STANDARD, CLASS_NUM
 from dataset.dataset_loader_maker import DataLoaderMaker
 from dataset.defensive_model import DefensiveModel
+from dataset.pipeline_attack import PipelineAttack
+from dataset.query_profiler import QueryProfiler, ProfiledModel
 from dataset.standard_model import StandardModel
 
 np.set_printoptions(precision=5, suppress=True)
 
 class SquareAttack(object):
     def __init__(self, dataset, batch_size, targeted, target_type, epsilon, norm, lower_bound=0.0, upper_bound=1.0,
-                 max_queries=10000):
+                 max_queries=10000, profile=False):
         """
             :param epsilon: perturbation limit according to lp-ball
             :param norm: norm for the lp-ball constraint
@@ -29,6 +31,7 @@ class SquareAttack(object):
             :param upper_bound: maximum value data point can take in any coordinate
             :param max_queries: max number of calls to model per data point
             :param max_crit_queries: max number of calls to early stopping criterion  per data poinr
+            :param profile: record the query/latency profile of the target model
         """
         assert norm in ['linf', 'l2'], "{} is not supported".format(norm)
         self.epsilon = epsilon
@@ -52,6 +55,7 @@ class SquareAttack(object):
         self.success_all = torch.zeros_like(self.query_all)
         self.success_query_all = torch.zeros_like(self.query_all)
         self.not_done_prob_all = torch.zeros_like(self.query_all)
+        self.profiler = QueryProfiler(self.total_images, batch_size, enabled=profile)
 
 
     def p_selection(self, p_init, it, n_iters):
@@ -153,14 +157,9 @@ class SquareAttack(object):
             else:
                 return self.cw_loss(logits,label, None)
 
-    def square_attack_l2(self, model, x, y, eps, max_queries, p_init, loss_type):
-        """ The L2 square attack """
-        np.random.seed(0)
+    def l2_init(self, x, eps):
+        """ The initialization of the L2 square attack: a grid of pseudo gaussian bumps with random signs """
         c, h, w = x.shape[1:]
-        n_features = c * h * w
-        n_ex_total = x.shape[0]
-        # x, y = x[corr_classified], y[corr_classified]
-        ### initialization
         delta_init = np.zeros(x.shape)
         s = h // 5
         # log.info('Initial square side={} for bumps'.format(s))
@@ -173,9 +172,62 @@ class SquareAttack(object):
                     [1, 1, s, s]) * np.random.choice([-1, 1], size=[x.shape[0], c, 1, 1])
                 center_w += s
             center_h += s
+        return np.clip(x + delta_init / np.sqrt(np.sum(delta_init ** 2, axis=(1, 2, 3), keepdims=True)) * eps,
+                       self.lower_bound, self.upper_bound)
+
+    def l2_square_size(self, p, n_features, c):
+        s = max(int(round(np.sqrt(p * n_features / c))), 3)
+        if s % 2 == 0:
+            s += 1
+        return s
+
+    def l2_square_update(self, x_curr, x_best_curr, s, eps):
+        """ The proposal of the L2 square attack, all images of x_curr share the windows of side s """
+        c, h, w = x_curr.shape[1:]
+        delta_curr = x_best_curr - x_curr
+        s2 = s + 0
+        ### window_1
+        center_h = np.random.randint(0, h - s)
+        center_w = np.random.randint(0, w - s)
+        new_deltas_mask = np.zeros(x_curr.shape)
+        new_deltas_mask[:, :, center_h:center_h + s, center_w:center_w + s] = 1.0
+
+        ### window_2
+        center_h_2 = np.random.randint(0, h - s2)
+        center_w_2 = np.random.randint(0, w - s2)
+        new_deltas_mask_2 = np.zeros(x_curr.shape)
+        new_deltas_mask_2[:, :, center_h_2:center_h_2 + s2, center_w_2:center_w_2 + s2] = 1.0
+        ### compute total norm available
+        curr_norms_window = np.sqrt(
+            np.sum(((x_best_curr - x_curr) * new_deltas_mask) ** 2, axis=(2, 3), keepdims=True))
+        curr_norms_image = np.sqrt(np.sum((x_best_curr - x_curr) ** 2, axis=(1, 2, 3), keepdims=True))
+        mask_2 = np.maximum(new_deltas_mask, new_deltas_mask_2)
+        norms_windows = np.sqrt(np.sum((delta_curr * mask_2) ** 2, axis=(2, 3), keepdims=True))
+
+        ### create the updates
+        new_deltas = np.ones([x_curr.shape[0], c, s, s])
+        new_deltas = new_deltas * self.meta_pseudo_gaussian_pert(s).reshape([1, 1, s, s])
+        new_deltas *= np.random.choice([-1, 1], size=[x_curr.shape[0], c, 1, 1])
+        old_deltas = delta_curr[:, :, center_h:center_h + s, center_w:center_w + s] / (1e-10 + curr_norms_window)
+        new_deltas += old_deltas
+        new_deltas = new_deltas / np.sqrt(np.sum(new_deltas ** 2, axis=(2, 3), keepdims=True)) * (
+                np.maximum(eps ** 2 - curr_norms_image ** 2, 0) / c + norms_windows ** 2) ** 0.5
+        delta_curr[:, :, center_h_2:center_h_2 + s2, center_w_2:center_w_2 + s2] = 0.0  # set window_2 to 0
+        delta_curr[:, :, center_h:center_h + s, center_w:center_w + s] = new_deltas + 0  # update window_1
+
+        x_new = x_curr + delta_curr / np.sqrt(np.sum(delta_curr ** 2, axis=(1, 2, 3), keepdims=True)) * eps
+        return np.clip(x_new, self.lower_bound, self.upper_bound)
 
-        x_best = np.clip(x + delta_init / np.sqrt(np.sum(delta_init ** 2, axis=(1, 2, 3), keepdims=True)) * eps, self.lower_bound, self.upper_bound)
-        logits = model(torch.from_numpy(x_best).cuda().float())
+    def square_attack_l2(self, model, x, y, eps, max_queries, p_init, loss_type):
+        """ The L2 square attack """
+        np.random.seed(0)
+        c, h, w = x.shape[1:]
+        n_features = c * h * w
+        n_ex_total = x.shape[0]
+        # x, y = x[corr_classified], y[corr_classified]
+        ### initialization
+        x_best = self.l2_init(x, eps)
+        logits = model(self.profiler.transfer(torch.from_numpy(x_best).float(), "cuda"))
         loss_min = self.loss(logits, torch.from_numpy(y).long().cuda(), loss_type=loss_type).detach().cpu().numpy()
         margin_min = self.loss(logits, torch.from_numpy(y).long().cuda(), loss_type='cw_loss').detach().cpu().numpy()  # 用来判断有没有攻击成功
         n_queries = np.ones(x.shape[0])  # ones because we have already used 1 query
@@ -188,48 +240,13 @@ class SquareAttack(object):
             x_curr, x_best_curr = x[idx_to_fool], x_best[idx_to_fool]
             y_curr, margin_min_curr = y[idx_to_fool], margin_min[idx_to_fool]
             loss_min_curr = loss_min[idx_to_fool]
-            delta_curr = x_best_curr - x_curr
 
             p = self.p_selection(p_init, i_iter, n_iters)
-            s = max(int(round(np.sqrt(p * n_features / c))), 3)
-
-            if s % 2 == 0:
-                s += 1
+            s = self.l2_square_size(p, n_features, c)
+            x_new = self.l2_square_update(x_curr, x_best_curr, s, eps)
 
-            s2 = s + 0
-            ### window_1
-            center_h = np.random.randint(0, h - s)
-            center_w = np.random.randint(0, w - s)
-            new_deltas_mask = np.zeros(x_curr.shape)
-            new_deltas_mask[:, :, center_h:center_h + s, center_w:center_w + s] = 1.0
-
-            ### window_2
-            center_h_2 = np.random.randint(0, h - s2)
-            center_w_2 = np.random.randint(0, w - s2)
-            new_deltas_mask_2 = np.zeros(x_curr.shape)
-            new_deltas_mask_2[:, :, center_h_2:center_h_2 + s2, center_w_2:center_w_2 + s2] = 1.0
-            ### compute total norm available
-            curr_norms_window = np.sqrt(
-                np.sum(((x_best_curr - x_curr) * new_deltas_mask) ** 2, axis=(2, 3), keepdims=True))
-            curr_norms_image = np.sqrt(np.sum((x_best_curr - x_curr) ** 2, axis=(1, 2, 3), keepdims=True))
-            mask_2 = np.maximum(new_deltas_mask, new_deltas_mask_2)
-            norms_windows = np.sqrt(np.sum((delta_curr * mask_2) ** 2, axis=(2, 3), keepdims=True))
-
-            ### create the updates
-            new_deltas = np.ones([x_curr.shape[0], c, s, s])
-            new_deltas = new_deltas * self.meta_pseudo_gaussian_pert(s).reshape([1, 1, s, s])
-            new_deltas *= np.random.choice([-1, 1], size=[x_curr.shape[0], c, 1, 1])
-            old_deltas = delta_curr[:, :, center_h:center_h + s, center_w:center_w + s] / (1e-10 + curr_norms_window)
-            new_deltas += old_deltas
-            new_deltas = new_deltas / np.sqrt(np.sum(new_deltas ** 2, axis=(2, 3), keepdims=True)) * (
-                    np.maximum(eps ** 2 - curr_norms_image ** 2, 0) / c + norms_windows ** 2) ** 0.5
-            delta_curr[:, :, center_h_2:center_h_2 + s2, center_w_2:center_w_2 + s2] = 0.0  # set window_2 to 0
-            delta_curr[:, :, center_h:center_h + s, center_w:center_w + s] = new_deltas + 0  # update window_1
-
-            x_new = x_curr + delta_curr / np.sqrt(np.sum(delta_curr ** 2, axis=(1, 2, 3), keepdims=True)) * eps
-            x_new = np.clip(x_new, self.lower_bound, self.upper_bound)
-
-            logits = model(torch.from_numpy(x_new).cuda().float())
+            self.profiler.set_active(idx_to_fool)
+            logits = model(self.profiler.transfer(torch.from_numpy(x_new).float(), "cuda"))
             loss = self.loss(logits, torch.from_numpy(y_curr).long().cuda(), loss_type=loss_type).detach().cpu().numpy()
             margin = self.loss(logits, torch.from_numpy(y_curr).long().cuda(), loss_type='cw_loss').detach().cpu().numpy()
 
@@ -247,10 +264,6 @@ class SquareAttack(object):
                 n_queries[margin_min <= 0]), np.median(n_queries), np.median(n_queries[margin_min <= 0])
 
             time_total = time.time() - time_start
-            # log.info(
-            #     '{}: acc={:.2%} acc_corr={:.2%} avg#q_ae={:.1f} med#q_ae={:.1f} {}, n_ex={}, {:.0f}s, loss={:.3f}, max_pert={:.1f}, impr={:.0f}'.
-            #         format(i_iter + 1, acc, acc_corr, mean_nq_ae, median_nq_ae, hps_str, x.shape[0], time_total,
-            #                np.mean(margin_min), np.amax(curr_norms_image), np.sum(idx_improved)))
             metrics[i_iter] = [acc, acc_corr, mean_nq, mean_nq_ae, median_nq, margin_min.mean(), time_total]
             # if (i_iter <= 500 and i_iter % 500) or (i_iter > 100 and i_iter % 500) or i_iter + 1 == n_iters or acc == 0:
             #     np.save(metrics_path, metrics)
@@ -262,8 +275,38 @@ class SquareAttack(object):
         curr_norms_image = np.sqrt(np.sum((x_best - x) ** 2, axis=(1, 2, 3), keepdims=True))
         log.info('Maximal norm of the perturbations: {:.5f}'.format(np.amax(curr_norms_image)))
 
+        self.profiler.reset_active()
         return n_queries, x_best
 
+    def linf_init(self, x, eps):
+        """ The initialization of the Linf square attack """
+        c, h, w = x.shape[1:]
+        # [c, 1, w], i.e. vertical stripes work best for untargeted attacks
+        init_delta = np.random.choice([-eps, eps], size=[x.shape[0], c, 1, w])
+        return np.clip(x + init_delta, self.lower_bound, self.upper_bound)
+
+    def linf_square_size(self, p, n_features, c, h):
+        s = int(round(np.sqrt(p * n_features / c)))
+        return min(max(s, 1), h - 1)  # at least c x 1 x 1 window is taken and at most c x h-1 x h-1
+
+    def linf_square_update(self, x_curr, x_best_curr, sizes, eps):
+        """ The proposal of the Linf square attack, the i-th image changes a window of side sizes[i] """
+        c, h, w = x_curr.shape[1:]
+        deltas = x_best_curr - x_curr
+        for i_img in range(x_best_curr.shape[0]):
+            s = sizes[i_img]
+            center_h = np.random.randint(0, h - s)
+            center_w = np.random.randint(0, w - s)
+
+            x_curr_window = x_curr[i_img, :, center_h:center_h + s, center_w:center_w + s]
+            x_best_curr_window = x_best_curr[i_img, :, center_h:center_h + s, center_w:center_w + s]
+            # prevent trying out a delta if it doesn't change x_curr (e.g. an overlapping patch)
+            while np.sum(np.abs(np.clip(x_curr_window + deltas[i_img, :, center_h:center_h + s, center_w:center_w + s],
+                                        self.lower_bound, self.upper_bound) - x_best_curr_window) < 10 ** -7) == c * s * s:
+                deltas[i_img, :, center_h:center_h + s, center_w:center_w + s] = np.random.choice([-eps, eps],
+                                                                                                  size=[c, 1, 1])
+        return np.clip(x_curr + deltas, self.lower_bound, self.upper_bound)
+
     def square_attack_linf(self, model, x, y, eps, max_queries, p_init, loss_type):
         """ The Linf square attack """
         np.random.seed(0)  # important to leave it here as well
@@ -271,11 +314,9 @@ class SquareAttack(object):
         n_features = c * h * w
         n_ex_total = x.shape[0]
         # x, y = x[corr_classified], y[corr_classified]
-        # [c, 1, w], i.e. vertical stripes work best for untargeted attacks
-        init_delta = np.random.choice([-eps, eps], size=[x.shape[0], c, 1, w])
-        x_best = np.clip(x + init_delta, self.lower_bound, self.upper_bound)
+        x_best = self.linf_init(x, eps)
 
-        logits = model(torch.from_numpy(x_best).cuda().float())
+        logits = model(self.profiler.transfer(torch.from_numpy(x_best).float(), "cuda"))
         loss_min = self.loss(logits, torch.from_numpy(y).long().cuda(), loss_type=loss_type).detach().cpu().numpy()
         margin_min = self.loss(logits, torch.from_numpy(y).long().cuda(), loss_type='cw_loss').detach().cpu().numpy()
         n_queries = np.ones(x.shape[0])  # ones because we have already used 1 query
@@ -287,26 +328,13 @@ class SquareAttack(object):
             idx_to_fool = (margin_min > 0).astype(np.bool)
             x_curr, x_best_curr, y_curr = x[idx_to_fool], x_best[idx_to_fool], y[idx_to_fool]
             loss_min_curr, margin_min_curr = loss_min[idx_to_fool], margin_min[idx_to_fool]
-            deltas = x_best_curr - x_curr
 
             p = self.p_selection(p_init, i_iter, n_iters)
-            for i_img in range(x_best_curr.shape[0]):
-                s = int(round(np.sqrt(p * n_features / c)))
-                s = min(max(s, 1), h - 1)  # at least c x 1 x 1 window is taken and at most c x h-1 x h-1
-                center_h = np.random.randint(0, h - s)
-                center_w = np.random.randint(0, w - s)
-
-                x_curr_window = x_curr[i_img, :, center_h:center_h + s, center_w:center_w + s]
-                x_best_curr_window = x_best_curr[i_img, :, center_h:center_h + s, center_w:center_w + s]
-                # prevent trying out a delta if it doesn't change x_curr (e.g. an overlapping patch)
-                while np.sum(np.abs(np.clip(x_curr_window + deltas[i_img, :, center_h:center_h + s, center_w:center_w + s],
-                                            self.lower_bound, self.upper_bound) - x_best_curr_window) < 10 ** -7) == c * s * s:
-                    deltas[i_img, :, center_h:center_h + s, center_w:center_w + s] = np.random.choice([-eps, eps],
-                                                                                                      size=[c, 1, 1])
-
-            x_new = np.clip(x_curr + deltas, self.lower_bound, self.upper_bound)
-
-            logits = model(torch.from_numpy(x_new).cuda().float())
+            s = self.linf_square_size(p, n_features, c, h)
+            x_new = self.linf_square_update(x_curr, x_best_curr, [s] * x_curr.shape[0], eps)
+
+            self.profiler.set_active(idx_to_fool)
+            logits = model(self.profiler.transfer(torch.from_numpy(x_new).float(), "cuda"))
             loss = self.loss(logits, torch.from_numpy(y_curr).long().cuda(), loss_type=loss_type).detach().cpu().numpy()
             margin = self.loss(logits,torch.from_numpy(y_curr).long().cuda(), loss_type='cw_loss').detach().cpu().numpy()
 
@@ -335,8 +363,58 @@ class SquareAttack(object):
             if acc == 0:
                 break
 
+        self.profiler.reset_active()
         return n_queries, x_best
 
+    def init_state(self, images, true_labels, target_labels, target_model, args):
+        """
+        The per-image state of the pipeline attack (dataset/pipeline_attack.py), the numpy arrays of
+        square_attack_l2/square_attack_linf are kept as CPU tensors.
+        """
+        x = images.detach().cpu().numpy()
+        y = (target_labels if self.targeted else true_labels).detach().cpu().numpy()
+        loss_type = "cw_loss" if not self.targeted else "xent_loss"
+        x_best = self.l2_init(x, args.epsilon) if self.norm == "l2" else self.linf_init(x, args.epsilon)
+        logits = target_model(self.profiler.transfer(torch.from_numpy(x_best).float(), "cuda"))
+        loss_min = self.loss(logits, torch.from_numpy(y).long().cuda(), loss_type=loss_type).detach().cpu()
+        margin_min = self.loss(logits, torch.from_numpy(y).long().cuda(), loss_type='cw_loss').detach().cpu()
+        return {"images": torch.from_numpy(x), "adv_images": torch.from_numpy(x_best), "labels": torch.from_numpy(y),
+                "loss_min": loss_min, "margin_min": margin_min,
+                "query": torch.ones(x.shape[0]),  # ones because we have already used 1 query
+                "i_iter": torch.zeros(x.shape[0]).long(),  # the p of each image is scheduled by its own iteration
+                "success": margin_min <= 0}
+
+    def step(self, state, target_model, args):
+        x, x_best, y = state["images"].numpy(), state["adv_images"].numpy(), state["labels"].numpy()
+        c, h, w = x.shape[1:]
+        n_features = c * h * w
+        n_iters = args.max_queries - 1
+        loss_type = "cw_loss" if not self.targeted else "xent_loss"
+        p = [self.p_selection(args.p, i_iter, n_iters) for i_iter in state["i_iter"].tolist()]
+        if self.norm == "l2":
+            sizes = np.array([self.l2_square_size(p_img, n_features, c) for p_img in p])
+            x_new = np.empty_like(x_best)
+            for s in np.unique(sizes):  # the images of the same square side share the windows as square_attack_l2
+                group = sizes == s
+                x_new[group] = self.l2_square_update(x[group], x_best[group], s, args.epsilon)
+        else:
+            sizes = [self.linf_square_size(p_img, n_features, c, h) for p_img in p]
+            x_new = self.linf_square_update(x, x_best, sizes, args.epsilon)
+        logits = target_model(self.profiler.transfer(torch.from_numpy(x_new).float(), "cuda"))
+        loss = self.loss(logits, torch.from_numpy(y).long().cuda(), loss_type=loss_type).detach().cpu()
+        margin = self.loss(logits, torch.from_numpy(y).long().cuda(), loss_type='cw_loss').detach().cpu()
+        idx_improved = loss < state["loss_min"]
+        state["loss_min"] = torch.where(idx_improved, loss, state["loss_min"])
+        state["margin_min"] = torch.where(idx_improved, margin, state["margin_min"])
+        state["adv_images"] = torch.where(idx_improved.view(-1, 1, 1, 1), torch.from_numpy(x_new), state["adv_images"])
+        state["query"] = state["query"] + 1
+        state["i_iter"] = state["i_iter"] + 1
+        state["success"] = state["margin_min"] <= 0
+        return state
+
+    def is_done(self, state, args):
+        return state["success"] | (state["query"] >= args.max_queries)
+
     def attack_all_images(self, args, arch_name, target_model, result_dump_path):
 
         for batch_idx, data_tuple in enumerate(self.dataset_loader):
@@ -353,6 +431,7 @@ class SquareAttack(object):
             true_labels = true_labels.cuda()
             selected = torch.arange(batch_idx * args.batch_size,
                                     min((batch_idx + 1) * args.batch_size, self.total_images))
+            self.profiler.set_batch(selected)
             if self.targeted:
                 if self.target_type == 'random':
                     target_labels = torch.randint(low=0, high=CLASS_NUM[args.dataset],
@@ -363,7 +442,8 @@ class SquareAttack(object):
                                   size=target_labels[invalid_target_index].shape).long().cuda()
                         invalid_target_index = target_labels.eq(true_labels)
                 elif args.target_type == 'least_likely':
-                    logits = target_model(images)
+                    with self.profiler.uncharged():
+                        logits = target_model(images)
                     target_labels = logits.argmin(dim=1)
                 elif args.target_type == "increment":
                     target_labels = torch.fmod(true_labels + 1, CLASS_NUM[args.dataset])
@@ -372,7 +452,7 @@ class SquareAttack(object):
             else:
                 target_labels = None
 
-            with torch.no_grad():
+            with torch.no_grad(), self.profiler.uncharged():  # the clean prediction is not a query of the attack
                 logit = target_model(images)
             pred = logit.argmax(dim=1)
             correct = pred.eq(true_labels).float()
@@ -390,7 +470,7 @@ class SquareAttack(object):
                                                             args.epsilon, args.max_queries, args.p, loss_type)
             query = torch.from_numpy(query).float().cuda()
             adv_images = torch.from_numpy(adv_images).float().cuda()
-            with torch.no_grad():
+            with torch.no_grad(), self.profiler.uncharged():  # the final verification is not a query of the attack
                 adv_logit = target_model(adv_images)
                 adv_prob = F.softmax(adv_logit, dim=1)
             adv_pred = adv_logit.argmax(dim=1)
@@ -431,6 +511,9 @@ class SquareAttack(object):
         with open(result_dump_path, "w") as result_file_obj:
             json.dump(meta_info_dict, result_file_obj, sort_keys=True)
         log.info("done, write stats info to {}".format(result_dump_path))
+        if self.profiler.enabled:
+            self.profiler.export(result_dump_path)
+            self.profiler.reset()
 
 def print_args(args):
     keys = sorted(vars(args).keys())
@@ -473,6 +556,10 @@ def main():
     parser.add_argument('--target_type', type=str, default='increment', choices=['random', 'least_likely', "increment"])
     parser.add_argument('--attack_defense', action="store_true")
     parser.add_argument('--defense_model', type=str, default=None)
+    parser.add_argument('--profile', action="store_true", help='export the query/latency profile next to the result json')
+    parser.add_argument('--pipeline', action="store_true",
+                        help='refill the finished images of a batch with new images instead of waiting for the slowest one')
+    parser.add_argument('--refill_interval', type=int, default=50, help='refill the finished slots every N steps')
     parser.add_argument('--arch', default=None, type=str, help='network architecture')
     parser.add_argument('--test_archs', action="store_true")
     args = parser.parse_args()
@@ -539,7 +626,8 @@ def main():
     log.info('Called with args:')
     print_args(args)
     attacker = SquareAttack(args.dataset, args.batch_size,
-                            args.targeted, args.target_type, args.epsilon, args.norm, max_queries=args.max_queries)
+                            args.targeted, args.target_type, args.epsilon, args.norm, max_queries=args.max_queries,
+                            profile=args.profile)
     for arch in archs:
         if args.attack_defense:
             save_result_path = args.exp_dir + "/{}_{}_result.json".format(arch, args.defense_model)
@@ -554,7 +642,14 @@ def main():
             model = StandardModel(args.dataset, arch, no_grad=True)
         model.cuda()
         model.eval()
-        attacker.attack_all_images(args, arch, model, save_result_path)
+        if args.profile:
+            model = ProfiledModel(model, attacker.profiler)
+        if args.pipeline:
+            pipeline = PipelineAttack(attacker, attacker.dataset_loader, args.dataset, args.batch_size,
+                                      args.refill_interval)
+            pipeline.attack_all_images(args, arch, model, save_result_path)
+        else:
+            attacker.attack_all_images(args, arch, model, save_result_path)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -2,8 +2,6 @@ import os
 import sys
 import time
 
-import random
-
 sys.path.append("/home1/machen/meta_perturbations_black_box_attack")
 import argparse
 from types import SimpleNamespace
@@ -19,6 +17,7 @@ from config import PY_ROOT, MODELS_TEST_STANDARD, CLASS_NUM, MODELS_TRAIN_WITHOU
 from dataset.dataset_loader_maker import DataLoaderMaker
 from dataset.defensive_model import DefensiveModel
 from dataset.standard_model import StandardModel
+from dataset.surrogate_ensemble import SurrogateEnsemble
 
 np.set_printoptions(precision=5, suppress=True)
 
@@ -193,7 +192,7 @@ class SquareAttack(object):
         return proj
 
 
-    def square_attack_l2(self, model, surrogate_models, x, y, eps, max_queries, p_init, loss_type):
+    def square_attack_l2(self, model, surrogate_ensemble, x, y, eps, max_queries, p_init, loss_type):
         """ The L2 square attack """
         np.random.seed(0)
         c, h, w = x.shape[1:]
@@ -240,8 +239,7 @@ class SquareAttack(object):
                 s += 1
 
             s2 = s + 0
-            surrogate_model = random.choice(surrogate_models)
-            surrogate_model = surrogate_model.cuda()
+            surrogate_model = surrogate_ensemble.sample()  # resident on GPU, no copy per iteration
             surrogate_loss_before, gradient = self.get_grad(surrogate_model,
                                                             torch.from_numpy(x_best_curr).cuda().float(),
                                                             torch.from_numpy(y_curr).cuda().long(),
@@ -284,7 +282,6 @@ class SquareAttack(object):
             x_new = x_curr + delta_curr / np.sqrt(np.sum(delta_curr ** 2, axis=(1, 2, 3), keepdims=True)) * eps
             x_new = np.clip(x_new, self.lower_bound, self.upper_bound)
 
-            surrogate_model.cpu()
 
             logits = model(torch.from_numpy(x_new).cuda().float())
             loss = self.loss(logits, torch.from_numpy(y_curr).long().cuda(), loss_type=loss_type).detach().cpu().numpy()
@@ -322,7 +319,7 @@ class SquareAttack(object):
         array_to_fool[idx_improved_surrogate] += 1
         array[idx_to_fool] = array_to_fool
 
-    def square_attack_linf(self, model, surrogate_models, x, y, eps, max_queries, p_init, loss_type):
+    def square_attack_linf(self, model, surrogate_ensemble, x, y, eps, max_queries, p_init, loss_type):
         """ The Linf square attack """
         np.random.seed(0)  # important to leave it here as well
         c, h, w = x.shape[1:]
@@ -352,8 +349,7 @@ class SquareAttack(object):
             proj_step = proj_maker(torch.from_numpy(x_curr).float(), eps)
 
             p = self.p_selection(p_init, i_iter, n_iters)
-            surrogate_model = random.choice(surrogate_models)
-            surrogate_model = surrogate_model.cuda()
+            surrogate_model = surrogate_ensemble.sample()  # resident on GPU, no copy per iteration
             surrogate_loss_before, gradient = self.get_grad(surrogate_model,
                                      torch.from_numpy(x_best_curr).cuda().float(), torch.from_numpy(y_curr).long().cuda(),
                                      loss_type)
@@ -379,7 +375,6 @@ class SquareAttack(object):
             #     surrogate_logits = surrogate_model(torch.from_numpy(x_new).cuda().float())
             #     surrogate_loss_after = self.loss(surrogate_logits, torch.from_numpy(y_curr).long().cuda(), loss_type=loss_type).detach().cpu().numpy()
             #     idx_improved_surrogate = surrogate_loss_after < surrogate_loss_before   # loss变小了，可以去查询目标模型，否则直接拒绝，不要查询目标模型
-            surrogate_model.cpu()
 
             logits = model(torch.from_numpy(x_new).cuda().float())
             loss = self.loss(logits, torch.from_numpy(y_curr).long().cuda(), loss_type=loss_type).detach().cpu().numpy()
@@ -409,7 +404,7 @@ class SquareAttack(object):
 
         return n_queries, x_best
 
-    def attack_all_images(self, args, arch_name, target_model, surrogate_models, result_dump_path):
+    def attack_all_images(self, args, arch_name, target_model, surrogate_ensemble, result_dump_path):
 
         for batch_idx, data_tuple in enumerate(self.dataset_loader):
             if args.dataset == "ImageNet":
@@ -453,11 +448,11 @@ class SquareAttack(object):
             loss_type = "cw_loss" if not self.targeted else "xent_loss"
             labels = true_labels if not self.targeted else target_labels
             if self.norm == "l2":
-                query, adv_images = self.square_attack_l2(target_model, surrogate_models, images.detach().cpu().numpy(),
+                query, adv_images = self.square_attack_l2(target_model, surrogate_ensemble, images.detach().cpu().numpy(),
                                                           labels.detach().cpu().numpy(),
                                          args.epsilon, args.max_queries, args.p, loss_type)
             elif self.norm == "linf":
-                query, adv_images = self.square_attack_linf(target_model, surrogate_models, images.detach().cpu().numpy(),
+                query, adv_images = self.square_attack_linf(target_model, surrogate_ensemble, images.detach().cpu().numpy(),
                                                             labels.detach().cpu().numpy(),
                                                             args.epsilon, args.max_queries, args.p, loss_type)
             query = torch.from_numpy(query).float().cuda()
@@ -547,6 +542,9 @@ def main():
     parser.add_argument('--defense_model', type=str, default=None)
     parser.add_argument('--arch', default=None, type=str, help='network architecture')
     parser.add_argument('--test_archs', action="store_true")
+    parser.add_argument('--surrogate_memory_budget', type=float, default=None,
+                        help='GPU memory (GB) of the resident surrogate models, the least recently used ones are swapped '
+                             'out when exceeded. Default keeps all surrogate models resident.')
     args = parser.parse_args()
     os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
     os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
@@ -621,6 +619,8 @@ def main():
         surrogate_model = StandardModel(args.dataset, surr_arch, False)
         surrogate_model.eval()
         surrogate_models.append(surrogate_model)
+    memory_budget = int(args.surrogate_memory_budget * 1024 ** 3) if args.surrogate_memory_budget is not None else None
+    surrogate_ensemble = SurrogateEnsemble(surrogate_models, memory_budget=memory_budget)
 
     for arch in archs:
         if args.attack_defense:
@@ -636,7 +636,7 @@ def main():
             model = StandardModel(args.dataset, arch, no_grad=True)
         model.cuda()
         model.eval()
-        attacker.attack_all_images(args, arch, model, surrogate_models, save_result_path)
+        attacker.attack_all_images(args, arch, model, surrogate_ensemble, save_result_path)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
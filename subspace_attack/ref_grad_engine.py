@@ -0,0 +1,76 @@
+from contextlib import contextmanager
+
+import torch
+import torch.nn.functional as F
+
+
+class RefGradEngine(object):
+    """
+    A RefGradEngine keeps the reference models of the subspace attack resident on the device and computes the gradient
+    directions of several reference models in one fused step: the same adv_image is broadcast to all selected models,
+    the resized input is computed once for each input size, and one backward (with grad_outputs from the gradient of
+    the victim model's logit) returns the gradients of all models, shape = (n_refs, batch_size, C, H, W).
+    """
+    def __init__(self, ref_models, input_size, device="cuda"):
+        """
+        :param ref_models: list of reference models (e.g. StandardModel with no_grad=False)
+        :param input_size: the input size of the victim model, i.e. the size of adv_image
+        """
+        self.device = torch.device(device)
+        self.ref_models = [ref_model.to(self.device).eval() for ref_model in ref_models]
+        self.input_size = input_size
+
+    def __len__(self):
+        return len(self.ref_models)
+
+    @staticmethod
+    def drop_holder(ref_model):
+        # the network that reads the drop probability in its forward, the wrapper of StandardModel does not forward it
+        network = getattr(ref_model, "cnn", ref_model)
+        return network if hasattr(network, "drop") else None
+
+    @contextmanager
+    def dropout(self, ref_model, drop):
+        """
+        Apply the drop probability to ref_model only during the forward inside this context.
+        """
+        holder = self.drop_holder(ref_model)
+        if holder is None:
+            yield
+            return
+        orig_drop = holder.drop
+        holder.drop = drop
+        try:
+            yield
+        finally:
+            holder.drop = orig_drop
+
+    def directions(self, adv_image, logit_grad, ref_indexes=None, drop=0.0):
+        """
+        :param adv_image: shape = (batch_size, C, H, W), the input of the victim model
+        :param logit_grad: shape = (batch_size, #class), the gradient of the loss w.r.t. the victim model's logit
+        :param ref_indexes: the indexes of the reference models, None means all models
+        :param drop: the drop probability of the reference models in this step
+        :return: shape = (n_refs, batch_size, C, H, W), the gradient of each reference model
+        """
+        if ref_indexes is None:
+            ref_indexes = list(range(len(self.ref_models)))
+        n_refs = len(ref_indexes)
+        adv_image = adv_image.detach().to(self.device)
+        stacked_image = adv_image.unsqueeze(0).repeat(n_refs, 1, 1, 1, 1).requires_grad_()  # n_refs,B,C,H,W
+        resized_images = {}  # input size -> resized stacked_image, shared by the models with the same input size
+        ref_logits = []
+        for i, ref_index in enumerate(ref_indexes):
+            ref_model = self.ref_models[ref_index]
+            size = tuple(ref_model.input_size[-2:])
+            if size not in resized_images:
+                if size == tuple(self.input_size[-2:]):
+                    resized_images[size] = stacked_image
+                else:
+                    resized = F.interpolate(stacked_image.view(-1, *stacked_image.shape[2:]), size=size,
+                                            mode='bilinear', align_corners=True)
+                    resized_images[size] = resized.view(n_refs, adv_image.size(0), *resized.shape[1:])
+            with self.dropout(ref_model, drop):
+                ref_logits.append(ref_model(resized_images[size][i]))
+        ref_grads = torch.autograd.grad(ref_logits, [stacked_image], grad_outputs=[logit_grad] * n_refs)[0]
+        return ref_grads.detach()
@@ -15,6 +15,7 @@ import torch
 import torch.nn.functional as F
 import numpy as np
 from dataset.standard_model import StandardModel
+from subspace_attack.ref_grad_engine import RefGradEngine
 from dataset.dataset_loader_maker import DataLoaderMaker
 from config import PY_ROOT, MODELS_TEST_STANDARD, CLASS_NUM
 from utils.statistics_toolkit import success_rate_and_query_coorelation, success_rate_avg_query
@@ -56,6 +57,10 @@ def parse_args():
                         help='increase dropout probability at this iteration')
     parser.add_argument('--ref-arch-drop-gamma', type=float,
                         help='control dropout probability increasing speed')
+    parser.add_argument('--num-ref-per-step', default=1, type=int,
+                        help='number of ref models whose gradients are computed together in each step')
+    parser.add_argument('--ref-grad-reduce', default='sample', type=str, choices=['sample', 'mean'],
+                        help='how to reduce the directions of several ref models: each image samples one, or average')
     parser.add_argument('--fix-grad', action='store_true',
                         help='fix gradient from dL/dv to dl/dv')
     parser.add_argument('--loss', required=True, type=str, choices=['xent', 'cw'],
@@ -192,6 +197,7 @@ def main(target_model,  result_dump_path, args):
         ref_models[ref_arch] = StandardModel(args.dataset, ref_arch, no_grad=False, is_subspace_attack_ref_arch=True,
                                              ref_arch_train_data=args.ref_arch_train_data, ref_arch_epoch=args.ref_arch_epoch).cuda().eval()
     log.info('All target_models have been initialized, including 1 target model and {} ref target_models'.format(len(args.ref_arch)))
+    ref_grad_engine = RefGradEngine(list(ref_models.values()), target_model.input_size)
 
     # make loader
     loader = DataLoaderMaker.get_test_attacked_data(args.dataset, args.batch_size)
@@ -314,9 +320,11 @@ def main(target_model,  result_dump_path, args):
 
             # finite difference for gradient estimation
             if len(ref_models) > 0:
-                # select ref model to calculate gradient
-                #
-                selected_ref_arch_index = torch.randint(low=0, high=len(ref_models), size=(1,)).long().item()
+                # select ref models to calculate gradient
+                if args.num_ref_per_step == 1:
+                    selected_ref_arch_indexes = [torch.randint(low=0, high=len(ref_models), size=(1,)).long().item()]
+                else:
+                    selected_ref_arch_indexes = torch.randperm(len(ref_models))[:args.num_ref_per_step].tolist()
 
                 # get original model logit's grad
                 adv_logit = adv_logit.detach()
@@ -325,45 +333,41 @@ def main(target_model,  result_dump_path, args):
                 logit_grad = torch.autograd.grad(loss, [adv_logit])[0]
 
                 # calculate gradient for all ref target_models
-                def calc_ref_grad(adv_image_, ref_model_, drop_=0):
-                    adv_image_ = adv_image_.detach()
-                    adv_image_.requires_grad = True
-                    if adv_image_.grad:
-                        adv_image_.grad[:] = 0.
-                    ref_model_.zero_grad()
-
-                    # assign dropout probability
-                    ref_model_.drop = drop_  # 这个可以进模型代码看看，drop怎么做的
-
-                    # forward ref model
-                    if ref_model_.input_size != model.input_size:
-                        ref_logit_ = ref_model_(F.interpolate(adv_image_, size=ref_model_.input_size[-1],
-                                                              mode='bilinear', align_corners=True))
-                    else:
-                        ref_logit_ = ref_model_(adv_image_)
-
-                    # backward ref model using logit_grad from the victim model
-                    ref_grad_ = torch.autograd.grad(ref_logit_, [adv_image_], grad_outputs=[logit_grad])[0]
-                    ref_grad_ = downsampler(ref_grad_)  # 高维度缩小
+                def calc_ref_grad(adv_image_, ref_indexes_, drop_=0):
+                    # shape = (n_refs, B, C, H, W), computed in one fused forward/backward of the selected ref models
+                    ref_grad_ = ref_grad_engine.directions(adv_image_, logit_grad, ref_indexes_, drop=drop_)
+                    n_refs_ = ref_grad_.size(0)
+                    ref_grad_ = downsampler(ref_grad_.view(-1, *ref_grad_.shape[2:]))  # 高维度缩小
+                    ref_grad_ = ref_grad_.view(n_refs_, -1, *ref_grad_.shape[1:])
 
                     # compute dl/dv
                     if args.fix_grad:
                         if prior.view(prior.shape[0], -1).norm(dim=1).min().item() > 0:
                             # -1 / ||v|| ** 3 (||v|| ** 2 dL/dv - v(v^T dL/dv))
-                            g1 = norm(prior) ** 2 * ref_grad_
-                            g2 = prior * (prior * ref_grad_).sum(dim=(1, 2, 3)).view(-1, 1, 1, 1)
+                            g1 = norm(prior).unsqueeze(0) ** 2 * ref_grad_
+                            g2 = prior.unsqueeze(0) * (prior.unsqueeze(0) * ref_grad_).sum(dim=(2, 3, 4)).view(
+                                n_refs_, -1, 1, 1, 1)
                             ref_grad_ = g1 - g2
-                    return ref_grad_ / norm(ref_grad_)  # 拿到direction
+                    ref_grad_ = ref_grad_.view(-1, *ref_grad_.shape[2:])
+                    return (ref_grad_ / norm(ref_grad_)).view(n_refs_, -1, *ref_grad_.shape[1:])  # 拿到direction
 
-                # calculate selected ref model's gradient
+                # calculate selected ref models' gradient
                 if args.num_fix_direction == 0:
-                    # 随机选择一个模型，输入adv_image,得到梯度.这个梯度是否准确不知道，因为是随机选择的模型，不如用网络生成
-                    direction = calc_ref_grad(adv_image, list(ref_models.values())[selected_ref_arch_index], drop_=drop)
+                    # 随机选择模型，输入adv_image,得到梯度.这个梯度是否准确不知道，因为是随机选择的模型，不如用网络生成
+                    directions = calc_ref_grad(adv_image, selected_ref_arch_indexes, drop_=drop)
                 else:
                     # for illustrate experiment in rebuttal
                     assert args.loss == 'cw'
                     assert drop == 0
-                    direction = calc_ref_grad(image, list(ref_models.values())[selected_ref_arch_index], drop_=drop)
+                    directions = calc_ref_grad(image, selected_ref_arch_indexes, drop_=drop)
+                if directions.size(0) == 1:
+                    direction = directions[0]
+                elif args.ref_grad_reduce == "mean":
+                    direction = directions.mean(dim=0)
+                else:
+                    # each image samples the direction of one of the selected ref models
+                    sampled = torch.randint(low=0, high=directions.size(0), size=(directions.size(1),)).to(device)
+                    direction = directions[sampled, torch.arange(directions.size(1)).to(device)]
 
             else:
                 # use random search direction solely
@@ -15,6 +15,7 @@ from config import PY_ROOT, MODELS_TEST_STANDARD, CLASS_NUM, MODELS_TRAIN_STANDA
 from dataset.dataset_loader_maker import DataLoaderMaker
 from dataset.defensive_model import DefensiveModel
 from dataset.standard_model import StandardModel
+from dataset.surrogate_ensemble import SurrogateEnsemble
 
 np.set_printoptions(precision=5, suppress=True)
 
@@ -152,7 +153,7 @@ class SquareAttack(object):
             else:
                 return self.cw_loss(logits,label, None)
 
-    def square_attack_l2(self, model, surrogate_models, surrogate_accept_threshold, x, y, eps, max_queries,
+    def square_attack_l2(self, model, surrogate_ensemble, surrogate_accept_threshold, x, y, eps, max_queries,
                          surrogate_queries, p_init, loss_type):
         """ The L2 square attack """
         np.random.seed(0)
@@ -183,21 +184,16 @@ class SquareAttack(object):
         time_start = time.time()
         n_iters = max_queries - 1
         metrics = np.zeros([n_iters, 7])
-        surrogate_loss_min_list = []
-        for surrogate_model in surrogate_models:
-            surrogate_model.cuda()
-            surrogate_logits = surrogate_model(torch.from_numpy(x_best).cuda().float())
-            surrogate_model.cpu()
-            surrogate_loss_min = self.loss(surrogate_logits, torch.from_numpy(y).long().cuda(),
-                                           loss_type=loss_type).detach().cpu().numpy()
-            surrogate_loss_min_list.append(surrogate_loss_min)
+        y_tensor = torch.from_numpy(y).long().cuda()
+        surrogate_loss_min = surrogate_ensemble.losses(x_best, lambda logits: self.loss(logits, y_tensor, loss_type))  # (n_surrogates, B)
         for i_iter in range(n_iters):
             idx_to_fool = (margin_min > 0.0).astype(np.bool)
             x_curr, x_best_curr = x[idx_to_fool], x_best[idx_to_fool]
             y_curr, margin_min_curr = y[idx_to_fool], margin_min[idx_to_fool]
             loss_min_curr = loss_min[idx_to_fool]
+            y_curr_tensor = y_tensor[torch.from_numpy(idx_to_fool).cuda()]
 
-            surrogate_loss_min_curr_list = [surrogate_loss[idx_to_fool] for surrogate_loss in surrogate_loss_min_list]
+            surrogate_loss_min_curr = surrogate_loss_min[:, idx_to_fool]
             surrogate_accept_idx = np.zeros(shape=x_curr.shape[0]).astype(np.bool)
             last_deltas = x_best_curr - x_curr
             for inner_iter in range(surrogate_queries):  # 尝试各种窗口，直到找到合适的
@@ -236,22 +232,14 @@ class SquareAttack(object):
                         np.maximum(eps ** 2 - curr_norms_image ** 2, 0) / c + norms_windows ** 2) ** 0.5
                 delta_curr[:, :, center_h_2:center_h_2 + s2, center_w_2:center_w_2 + s2] = 0.0  # set window_2 to 0
                 delta_curr[:, :, center_h:center_h + s, center_w:center_w + s] = new_deltas + 0  # update window_1
-                for i_img in range(x_curr.shape[0]):
-                    if surrogate_accept_idx[i_img].item():  # it has already accepted such acceptance, jump
-                        delta_curr[i_img] = last_deltas[i_img]  # the deltas follows the last iteration if it already pass the vote
+                # the deltas follows the last iteration if it already pass the vote
+                delta_curr[surrogate_accept_idx] = last_deltas[surrogate_accept_idx]
                 x_attempt = x_curr + delta_curr / np.sqrt(np.sum(delta_curr ** 2, axis=(1, 2, 3), keepdims=True)) * eps
                 x_attempt = np.clip(x_attempt, self.lower_bound, self.upper_bound)
-                vote = np.zeros(shape=x_attempt.shape[0], dtype=np.int32)
-                for idx, surrogate_model in enumerate(surrogate_models):
-                    surrogate_model.cuda()
-                    surrogate_logits = surrogate_model(torch.from_numpy(x_attempt).cuda().float())
-                    surrogate_model.cpu()
-                    surrogate_loss = self.loss(surrogate_logits, torch.from_numpy(y_curr).long().cuda(),
-                                               loss_type=loss_type).detach().cpu().numpy()
-                    surrogate_idx_improved = (surrogate_loss < surrogate_loss_min_curr_list[idx]).astype(np.bool)
-                    surrogate_loss_min_list[idx][idx_to_fool] = surrogate_idx_improved * surrogate_loss + ~surrogate_idx_improved * \
-                                       surrogate_loss_min_curr_list[idx]
-                    vote += surrogate_idx_improved.astype(np.int32)
+                surrogate_loss = surrogate_ensemble.losses(x_attempt, lambda logits: self.loss(logits, y_curr_tensor, loss_type))
+                surrogate_idx_improved = surrogate_loss < surrogate_loss_min_curr  # (n_surrogates, b)
+                surrogate_loss_min[:, idx_to_fool] = np.where(surrogate_idx_improved, surrogate_loss, surrogate_loss_min_curr)
+                vote = surrogate_idx_improved.sum(axis=0).astype(np.int32)
                 surrogate_accept_idx = np.logical_or(surrogate_accept_idx.astype(np.bool), vote >= surrogate_accept_threshold)
                 surrogate_accept_idx_x = np.reshape(surrogate_accept_idx, [-1, *[1] * len(x_attempt.shape[:-1])])
                 x_new = surrogate_accept_idx_x * x_attempt + ~surrogate_accept_idx_x * x_best_curr
@@ -289,7 +277,7 @@ class SquareAttack(object):
 
         return n_queries, x_best
 
-    def square_attack_linf(self, model, surrogate_models, surrogate_accept_threshold,
+    def square_attack_linf(self, model, surrogate_ensemble, surrogate_accept_threshold,
                            x, y, eps, max_queries, surrogate_queries, p_init, loss_type):
         """ The Linf square attack """
         np.random.seed(0)  # important to leave it here as well
@@ -310,29 +298,24 @@ class SquareAttack(object):
         n_iters = max_queries - 1
         metrics = np.zeros([n_iters, 7])
 
-        surrogate_loss_min_list = []
-        for surrogate_model in surrogate_models:
-            surrogate_model.cuda()
-            surrogate_logits = surrogate_model(torch.from_numpy(x_best).cuda().float())
-            surrogate_loss_min = self.loss(surrogate_logits, torch.from_numpy(y).long().cuda(), loss_type=loss_type).detach().cpu().numpy()
-            surrogate_loss_min_list.append(surrogate_loss_min)
-            surrogate_model.cpu()
+        y_tensor = torch.from_numpy(y).long().cuda()
+        surrogate_loss_min = surrogate_ensemble.losses(x_best, lambda logits: self.loss(logits, y_tensor, loss_type))  # (n_surrogates, B)
 
         for i_iter in range(n_iters - 1):
             idx_to_fool = (margin_min > 0).astype(np.bool)   # which images have been attacked successfully
             x_curr, x_best_curr, y_curr = x[idx_to_fool], x_best[idx_to_fool], y[idx_to_fool]
             loss_min_curr, margin_min_curr = loss_min[idx_to_fool], margin_min[idx_to_fool]
+            y_curr_tensor = y_tensor[torch.from_numpy(idx_to_fool).cuda()]
 
-            surrogate_loss_min_curr_list = [surrogate_loss[idx_to_fool] for surrogate_loss in surrogate_loss_min_list]
+            surrogate_loss_min_curr = surrogate_loss_min[:, idx_to_fool]
             surrogate_accept_idx = np.zeros(shape=x_curr.shape[0]).astype(np.bool)
             last_deltas = x_best_curr - x_curr
             for inner_iter in range(surrogate_queries):  # 尝试各种窗口，直到找到合适的
                 deltas = x_best_curr - x_curr
                 p = self.p_selection(p_init, i_iter, n_iters)
-                for i_img in range(x_best_curr.shape[0]):
-                    if surrogate_accept_idx[i_img].item():  # it has already accepted such acceptance, jump
-                        deltas[i_img] = last_deltas[i_img]  # the deltas follows the last iteration if it already pass the vote
-                        continue
+                # the deltas follows the last iteration if it already pass the vote
+                deltas[surrogate_accept_idx] = last_deltas[surrogate_accept_idx]
+                for i_img in np.nonzero(~surrogate_accept_idx)[0]:  # the accepted images are jumped
                     s = int(round(np.sqrt(p * n_features / c)))
                     s = min(max(s, 1), h - 1)  # at least c x 1 x 1 window is taken and at most c x h-1 x h-1
                     center_h = np.random.randint(0, h - s)
@@ -344,17 +327,12 @@ class SquareAttack(object):
                                                 self.lower_bound, self.upper_bound) - x_best_curr_window) < 10 ** -7) == c * s * s:
                         deltas[i_img, :, center_h:center_h + s, center_w:center_w + s] = np.random.choice([-eps, eps],
                                                                                                           size=[c, 1, 1])
-                    last_deltas[i_img] = deltas[i_img].copy()
+                last_deltas[~surrogate_accept_idx] = deltas[~surrogate_accept_idx]
                 x_attempt = np.clip(x_curr + deltas, self.lower_bound, self.upper_bound)
-                vote = np.zeros(shape=x_attempt.shape[0], dtype=np.int32)
-                for idx, surrogate_model in enumerate(surrogate_models):
-                    surrogate_model.cuda()
-                    surrogate_logits = surrogate_model(torch.from_numpy(x_attempt).cuda().float())
-                    surrogate_model.cpu()
-                    surrogate_loss = self.loss(surrogate_logits, torch.from_numpy(y_curr).long().cuda(), loss_type=loss_type).detach().cpu().numpy()
-                    surrogate_idx_improved = surrogate_loss < surrogate_loss_min_curr_list[idx]
-                    surrogate_loss_min_list[idx][idx_to_fool] = surrogate_idx_improved * surrogate_loss + ~surrogate_idx_improved * surrogate_loss_min_curr_list[idx]
-                    vote += surrogate_idx_improved.astype(np.int32)
+                surrogate_loss = surrogate_ensemble.losses(x_attempt, lambda logits: self.loss(logits, y_curr_tensor, loss_type))
+                surrogate_idx_improved = surrogate_loss < surrogate_loss_min_curr  # (n_surrogates, b)
+                surrogate_loss_min[:, idx_to_fool] = np.where(surrogate_idx_improved, surrogate_loss, surrogate_loss_min_curr)
+                vote = surrogate_idx_improved.sum(axis=0).astype(np.int32)
                 surrogate_accept_idx = np.logical_or(surrogate_accept_idx.astype(np.bool), vote >= surrogate_accept_threshold)
                 surrogate_accept_idx_x = np.reshape(surrogate_accept_idx, [-1,*[1] * len(x_attempt.shape[:-1])])
                 x_new = surrogate_accept_idx_x * x_attempt + ~surrogate_accept_idx_x * x_best_curr
@@ -384,9 +362,9 @@ class SquareAttack(object):
 
         return n_queries, x_best
 
-    def attack_all_images(self, args, arch_name, target_model, surrogate_models, result_dump_path):
+    def attack_all_images(self, args, arch_name, target_model, surrogate_ensemble, result_dump_path):
 
-        accept_model_num_threshold = int(float(len(surrogate_models)) * args.accept_ratio)
+        accept_model_num_threshold = int(float(len(surrogate_ensemble)) * args.accept_ratio)
 
         for batch_idx, data_tuple in enumerate(self.dataset_loader):
             if args.dataset == "ImageNet":
@@ -428,11 +406,11 @@ class SquareAttack(object):
             loss_type = "cw_loss" if not self.targeted else "xent_loss"
             labels = true_labels if not self.targeted else target_labels
             if self.norm == "l2":
-                query, adv_images = self.square_attack_l2(target_model, surrogate_models, accept_model_num_threshold,
+                query, adv_images = self.square_attack_l2(target_model, surrogate_ensemble, accept_model_num_threshold,
                                                           images.detach().cpu().numpy(), labels.detach().cpu().numpy(),
                                                 args.epsilon, args.max_queries, args.surrogate_queries, args.p, loss_type)
             elif self.norm == "linf":
-                query, adv_images = self.square_attack_linf(target_model, surrogate_models, accept_model_num_threshold,
+                query, adv_images = self.square_attack_linf(target_model, surrogate_ensemble, accept_model_num_threshold,
                                                             images.detach().cpu().numpy(),
                                                             labels.detach().cpu().numpy(),
                                                             args.epsilon, args.max_queries, args.surrogate_queries, args.p, loss_type)
@@ -525,6 +503,9 @@ def main():
     parser.add_argument('--arch', default=None, type=str, help='network architecture')
     parser.add_argument('--test_archs', action="store_true")
     parser.add_argument('--accept_ratio', type=float, default=0.75, help="14 surrogate models * 0.75 = 10 models")
+    parser.add_argument('--surrogate_memory_budget', type=float, default=None,
+                        help='GPU memory (GB) of the resident surrogate models, the least recently used ones are swapped '
+                             'out when exceeded. Default keeps all surrogate models resident.')
 
     args = parser.parse_args()
     os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
@@ -594,6 +575,8 @@ def main():
         surrogate_model = StandardModel(args.dataset, surr_arch, no_grad=True)
         surrogate_model.eval()
         surrogate_models.append(surrogate_model)
+    memory_budget = int(args.surrogate_memory_budget * 1024 ** 3) if args.surrogate_memory_budget is not None else None
+    surrogate_ensemble = SurrogateEnsemble(surrogate_models, memory_budget=memory_budget)
 
     args.arch = ", ".join(archs)
     log.info('Command line is: {}'.format(' '.join(sys.argv)))
@@ -616,7 +599,7 @@ def main():
             model = StandardModel(args.dataset, arch, no_grad=True)
         model.cuda()
         model.eval()
-        attacker.attack_all_images(args, arch, model, surrogate_models, save_result_path)
+        attacker.attack_all_images(args, arch, model, surrogate_ensemble, save_result_path)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file